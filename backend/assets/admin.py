@@ -1,4 +1,5 @@
 from django.contrib import admin
+from django.db.models import Prefetch
 from mptt.admin import DraggableMPTTAdmin
 from django import forms
 from import_export.admin import ImportExportModelAdmin
@@ -10,6 +11,7 @@ from django.utils.http import urlencode
 from urllib.parse import urlparse, parse_qs
 from core.admin_mixins import CustomDeleteActionMixin, MasterAdminMixin
 from core.admin_filters import MasterCampaignFilter
+from campagne.sovrapposizione import righe, righe_per_campagna
 from django.utils.functional import SimpleLazyObject
 from simple_history.admin import SimpleHistoryAdmin
 from .resources import AssetResource, StrutturaTemplateResource, NodoTemplateResource, NodoStrutturaResource
@@ -25,11 +27,9 @@ class StrutturaTemplateAdmin(CustomDeleteActionMixin, MasterAdminMixin, SimpleHi
 
     def get_queryset(self, request):
         qs = super().get_queryset(request)
+        # La dimensione è letta dai contatori dell'ElementType del solo nodo radice
         return qs.prefetch_related(
-            'nodi_template__element_type__minacce',
-            'nodi_template__element_type__controls_assigned_to_elementtype',
-            'nodi_template__element_type__component_element_types__minacce',
-            'nodi_template__element_type__component_element_types__controls_assigned_to_elementtype'
+            Prefetch('nodi_template', queryset=NodoTemplate.objects.filter(level=0).select_related('element_type'))
         )
 
     def dimensione_matrice(self, obj):
@@ -61,12 +61,7 @@ class NodoTemplateAdmin(CustomDeleteActionMixin, MasterAdminMixin, SimpleHistory
 
     def get_queryset(self, request):
         qs = super().get_queryset(request)
-        return qs.select_related('element_type').prefetch_related(
-            'element_type__minacce',
-            'element_type__controls_assigned_to_elementtype',
-            'element_type__component_element_types__minacce',
-            'element_type__component_element_types__controls_assigned_to_elementtype'
-        )
+        return qs.select_related('element_type')
 
     def dimensione_matrice(self, obj):
         return obj.get_dimensione_matrice_display()
@@ -93,19 +88,15 @@ class AssetAdmin(CustomDeleteActionMixin, MasterAdminMixin, SimpleHistoryAdmin,
 
         # Filtra i template in base alla campagna (o mostra solo i master se non c'è campagna)
         if campagna_id:
-            form.base_fields['template_da_applicare'].queryset = StrutturaTemplate.objects.filter(campagna_id=campagna_id)
+            form.base_fields['template_da_applicare'].queryset = righe_per_campagna(StrutturaTemplate.objects.all(), campagna_id)
         else:
             form.base_fields['template_da_applicare'].queryset = StrutturaTemplate.objects.filter(campagna__isnull=True)
         return form
 
     def get_queryset(self, request):
         qs = super().get_queryset(request)
-        return qs.prefetch_related(
-            'nodi_struttura__element_type__minacce',
-            'nodi_struttura__element_type__controls_assigned_to_elementtype',
-            'nodi_struttura__element_type__component_element_types__minacce',
-            'nodi_struttura__element_type__component_element_types__controls_assigned_to_elementtype'
-        )
+        # La dimensione è letta dai contatori della matrice aggregata dell'asset
+        return qs.select_related('matrice_aggregata')
 
     def dimensione_matrice(self, obj):
         return obj.get_dimensione_matrice_display()
@@ -154,7 +145,7 @@ class NodoStrutturaAdmin(CustomDeleteActionMixin, MasterAdminMixin, SimpleHistor
     list_filter = (MasterCampaignFilter, 'asset')
     fieldsets = (
         (None, {
-            'fields': ('asset_nome', 'parent', 'element_type', 'nome_specifico')
+            'fields': ('asset_nome', 'parent', 'element_type', 'nome_specifico', 'profilo_rischio')
         }),
     )
 
@@ -166,7 +157,7 @@ class NodoStrutturaAdmin(CustomDeleteActionMixin, MasterAdminMixin, SimpleHistor
         """
         return {}
 
-    readonly_fields = ('campagna',)
+    readonly_fields = ('campagna', 'profilo_rischio')
     resource_class = NodoStrutturaResource
 
     def add_view(self, request, form_url='', extra_context=None):
@@ -244,7 +235,8 @@ class NodoStrutturaAdmin(CustomDeleteActionMixin, MasterAdminMixin, SimpleHistor
 
                         # Filtra gli element type in base alla campagna dell'asset
                         if asset.campagna:
-                            element_type_queryset = ElementType.objects.filter(campagna=asset.campagna).exclude(nome="root")
+                            # Nelle campagne a copia su scrittura anche gli ElementType master non copiati
+                            element_type_queryset = righe(ElementType, asset.campagna).exclude(nome="root")
                         else:
                             element_type_queryset = ElementType.objects.filter(campagna__isnull=True).exclude(nome="root")
 
@@ -349,14 +341,19 @@ class NodoStrutturaAdmin(CustomDeleteActionMixin, MasterAdminMixin, SimpleHistor
         if asset_id_for_filter:
             qs = qs.filter(asset_id=asset_id_for_filter)
         
-        # Mantiene il prefetching originale per le performance
-        return qs.select_related('element_type').prefetch_related(
-            'element_type__minacce',
-            'element_type__controls_assigned_to_elementtype',
-            'element_type__component_element_types__minacce',
-            'element_type__component_element_types__controls_assigned_to_elementtype'
-        )
+        # La dimensione della matrice è materializzata sull'ElementType (sull'asset per le radici)
+        return qs.select_related('element_type', 'asset__matrice_aggregata')
 
     def dimensione_matrice(self, obj):
         return obj.get_dimensione_matrice_display()
-    dimensione_matrice.short_description = 'Dim. Matrice'
\ No newline at end of file
+    dimensione_matrice.short_description = 'Dim. Matrice'
+
+    def profilo_rischio(self, obj):
+        """Dimensione e valore massimo della matrice aggregata del sottoalbero del nodo (una query)."""
+        if not obj or not obj.pk:
+            return "N/D"
+        matrice = obj.get_matrice_sottoalbero()
+        if not matrice.minacce_ids:
+            return "N/D"
+        return f"{len(matrice.minacce_ids)} x {len(matrice.controlli_ids)}, valore massimo {matrice.valori.max():.2f}"
+    profilo_rischio.short_description = 'Profilo di rischio del sottoalbero'
\ No newline at end of file
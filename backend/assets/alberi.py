@@ -0,0 +1,212 @@
+"""
+Costruzione in blocco degli alberi MPTT di NodoStruttura e NodoTemplate.
+
+Creare i nodi uno alla volta con `objects.create` costa, per ogni nodo, lo
+spostamento di lft/rght dell'albero, una riga di storico, l'espansione dei
+componenti e la ri-aggregazione della matrice radice. Qui l'intero albero di
+destinazione viene descritto come dizionario annidato (il formato di
+`TreeManager.build_tree_nodes`; lft/rght/level/tree_id sono calcolati in memoria),
+inserito con un bulk insert per livello e storicizzato con un solo bulk insert.
+Allo stesso modo `inserisci_figli` aggiunge interi sottoalberi sotto un nodo
+esistente (l'espansione dei componenti di un nodo derivato appena salvato).
+Chi lo usa aggrega la matrice radice una volta sola al termine. Gli asset e i
+template master toccati vengono prima preservati nelle campagne congelate
+(`campagne.sovrapposizione.preserva_righe`), come farebbero i segnali dei nodi.
+"""
+from collections import defaultdict
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+FIGLI = 'children'
+
+
+def dati_da_nodi(righe, campi, mappa_tipi=None):
+    """
+    Converte i nodi sorgente (tuple `(id, parent_id, element_type_id, campi_nodo)` ordinate per
+    livello e id, cioè genitori prima dei figli e fratelli in ordine di creazione) nei dizionari annidati da inserire, aggiungendo a ogni nodo i `campi` comuni.
+    Con `mappa_tipi` gli ElementType vengono rimappati e i nodi senza corrispondenza saltati
+    (i loro figli diventano radici, come nella copia nodo per nodo).
+    """
+    radici, per_id = [], {}
+    for nodo_id, parent_id, element_type_id, campi_nodo in righe:
+        if mappa_tipi is not None:
+            element_type_id = mappa_tipi.get(element_type_id)
+            if element_type_id is None:
+                continue
+        dati = {**campi, **campi_nodo, 'element_type_id': element_type_id, FIGLI: []}
+        per_id[nodo_id] = dati
+        genitore = per_id.get(parent_id)
+        (genitore[FIGLI] if genitore else radici).append(dati)
+    return radici
+
+
+def espandi_componenti(radici, campi):
+    """
+    Aggiunge sotto ogni nodo derivato i nodi dei suoi componenti, ricorsivamente, come fa
+    `NodoStruttura.save` alla creazione (prima dei figli già presenti; un figlio con lo stesso
+    ElementType di un componente viene unito al nodo del componente). Carica i componenti di
+    tutti gli ElementType coinvolti con due query.
+    """
+    from elementtypes.models import ElementType, ElementTypeClosure
+
+    def tipi(nodi):
+        for dati in nodi:
+            yield dati['element_type_id']
+            yield from tipi(dati[FIGLI])
+
+    raggiungibili = ElementTypeClosure.objects.filter(ancestor_id__in=set(tipi(radici))).values('descendant_id')
+    info = {
+        et_id: (nome, is_base)
+        for et_id, nome, is_base in ElementType.objects.filter(pk__in=raggiungibili).values_list('id', 'nome', 'is_base')
+    }
+    componenti = defaultdict(list)
+    for derivato_id, componente_id in ElementType.component_element_types.through.objects.filter(
+        from_elementtype_id__in=raggiungibili
+    ).order_by('id').values_list('from_elementtype_id', 'to_elementtype_id'):
+        componenti[derivato_id].append(componente_id)
+
+    def espandi(dati):
+        nome, is_base = info[dati['element_type_id']]
+        esistenti = dati[FIGLI]
+        if is_base:
+            if esistenti:
+                raise ValidationError(
+                    f"Non è possibile aggiungere un nodo figlio a '{dati.get('nome_specifico') or nome}', "
+                    f"perché il suo tipo '{nome}' è di base e non può essere derivato."
+                )
+            return
+        dati[FIGLI] = [
+            {**campi, 'element_type_id': et_id, 'nome_specifico': info[et_id][0], FIGLI: []}
+            for et_id in componenti[dati['element_type_id']]
+        ]
+        _unisci(dati[FIGLI], esistenti)
+        for figlio in dati[FIGLI]:
+            espandi(figlio)
+
+    for radice in radici:
+        espandi(radice)
+    return radici
+
+
+def _unisci(figli, aggiunti):
+    per_tipo = {figlio['element_type_id']: figlio for figlio in figli}
+    for dati in aggiunti:
+        esistente = per_tipo.get(dati['element_type_id'])
+        if esistente is None:
+            figli.append(dati)
+            per_tipo[dati['element_type_id']] = dati
+        else:
+            _unisci(esistente[FIGLI], dati[FIGLI])
+
+
+@transaction.atomic
+def inserisci_alberi(modello, radici, motivo="", batch_size=None):
+    """
+    Inserisce gli alberi descritti da `radici` (un nuovo tree_id per ciascuno) con un bulk
+    insert per livello, poi lo storico di tutti i nodi con un solo bulk insert. Le coordinate
+    sono calcolate in memoria e il primo tree_id libero è letto una volta sola, quindi il numero
+    di query non dipende dal numero di alberi. Nessun segnale o `save()` viene eseguito.
+    Restituisce i nodi creati in ordine di albero.
+    """
+    if not radici:
+        return []
+    opzioni = modello._mptt_meta
+    nodi, genitori = [], {}
+    primo_tree_id = modello._tree_manager._get_next_tree_id()
+    for scostamento, radice in enumerate(radici):
+        _costruisci(modello, radice, primo_tree_id + scostamento, 0, 1, nodi, genitori)
+    _preserva_proprietari(modello, nodi)
+
+    per_livello = defaultdict(list)
+    for nodo in nodi:
+        per_livello[getattr(nodo, opzioni.level_attr)].append(nodo)
+    for livello in sorted(per_livello):
+        lotto = per_livello[livello]
+        for nodo in lotto:
+            if livello:
+                setattr(nodo, opzioni.parent_attr, genitori[id(nodo)])
+        # Fratelli nello stesso lotto in ordine di albero: gli id crescenti rispettano order_insertion_by
+        modello.objects.bulk_create(lotto, batch_size=batch_size)
+    modello.history.bulk_history_create(nodi, batch_size=batch_size, default_change_reason=motivo)
+    _incrementa_versioni(modello, nodi)
+    return nodi
+
+
+@transaction.atomic
+def inserisci_figli(genitore, figli, motivo=""):
+    """
+    Inserisce sotto `genitore`, già salvato, i sottoalberi descritti da `figli` come suoi ultimi
+    figli, con un numero di query che non dipende da dimensione e profondità: apre lo spazio in
+    lft/rght con un solo UPDATE (`_create_space` di django-mptt), calcola in memoria le coordinate
+    dei nuovi nodi, li inserisce con un solo bulk insert e collega ai genitori i nodi più profondi
+    con un solo bulk update; lo storico è scritto con un bulk insert. Restituisce i nodi creati in
+    ordine di albero.
+    """
+    if not figli:
+        return []
+    modello = type(genitore)
+    opzioni = modello._mptt_meta
+    tree_id = getattr(genitore, opzioni.tree_id_attr)
+    destra = getattr(genitore, opzioni.right_attr)
+
+    nodi, genitori = [], {}
+    sinistra = destra
+    for dati in figli:
+        sinistra = _costruisci(
+            modello, dati, tree_id, getattr(genitore, opzioni.level_attr) + 1, sinistra, nodi, genitori, genitore
+        ) + 1
+    dimensione = sinistra - destra
+
+    _preserva_proprietari(modello, [genitore])
+    modello._tree_manager._create_space(dimensione, destra - 1, tree_id)
+    setattr(genitore, opzioni.right_attr, destra + dimensione)
+    profondi = []
+    for nodo in nodi:
+        if genitori[id(nodo)] is genitore:
+            setattr(nodo, opzioni.parent_attr, genitore)
+        else:
+            profondi.append(nodo)
+    # In ordine di albero gli id crescenti rispettano order_insertion_by tra fratelli
+    modello.objects.bulk_create(nodi)
+    for nodo in profondi:
+        setattr(nodo, opzioni.parent_attr, genitori[id(nodo)])
+    if profondi:
+        modello.objects.bulk_update(profondi, [opzioni.parent_attr])
+    modello.history.bulk_history_create(nodi, default_change_reason=motivo)
+    _incrementa_versioni(modello, nodi)
+    return nodi
+
+
+def _costruisci(modello, dati, tree_id, livello, sinistra, nodi, genitori, parent=None):
+    """
+    Crea in memoria il nodo descritto da `dati` e i suoi discendenti, con le coordinate MPTT a
+    partire da `sinistra`; li aggiunge a `nodi` in ordine di albero e annota in `genitori` il
+    genitore di ciascuno (per id dell'oggetto). Restituisce il `rght` del nodo.
+    """
+    opzioni = modello._mptt_meta
+    nodo = modello(**{campo: valore for campo, valore in dati.items() if campo != FIGLI})
+    if parent is not None:
+        genitori[id(nodo)] = parent
+    setattr(nodo, opzioni.tree_id_attr, tree_id)
+    setattr(nodo, opzioni.level_attr, livello)
+    setattr(nodo, opzioni.left_attr, sinistra)
+    nodi.append(nodo)
+    prossimo = sinistra + 1
+    for figlio in dati[FIGLI]:
+        prossimo = _costruisci(modello, figlio, tree_id, livello + 1, prossimo, nodi, genitori, nodo) + 1
+    setattr(nodo, opzioni.right_attr, prossimo)
+    return prossimo
+
+
+def _preserva_proprietari(modello, nodi):
+    from campagne.sovrapposizione import preserva_righe
+
+    campo = modello._meta.get_field(modello.campo_albero)
+    preserva_righe(campo.related_model, {
+        getattr(nodo, campo.attname) for nodo in nodi if nodo.campagna_id is None
+    })
+
+
+def _incrementa_versioni(modello, nodi):
+    modello.incrementa_versione({getattr(nodo, f'{modello.campo_albero}_id') for nodo in nodi})
@@ -0,0 +1,126 @@
+"""
+Matrici aggregate per asset (`MatriceAsset`).
+
+La matrice di un asset è il MAX, cella per cella, delle matrici degli
+ElementType dei figli diretti dei suoi nodi radice. Ogni asset ha la propria
+riga, nella stessa forma impacchettata di `MatriceCompatta` (vedi
+`elementtypes/compatta.py`): le aggregazioni di asset diversi non condividono
+dati e possono procedere in parallelo, e le letture a livello di asset
+caricano la matrice con un solo fetch. L'ElementType "root" dei nodi radice
+resta solo come tipo del nodo e non porta valori.
+"""
+from django.db.models import Max
+
+from elementtypes.compatta import impacchetta, impronta, riduci, spacchetta
+from elementtypes.matrix import MatriceDensa
+
+
+def carica_matrici_asset(asset_ids):
+    """{asset_id: MatriceDensa} per gli asset indicati; gli asset mai aggregati non compaiono."""
+    from .models import MatriceAsset
+
+    return {
+        asset_id: spacchetta(minacce_ids, controlli_ids, valori)
+        for asset_id, minacce_ids, controlli_ids, valori in MatriceAsset.objects.filter(
+            asset_id__in=asset_ids
+        ).values_list('asset_id', 'minacce_ids', 'controlli_ids', 'valori')
+    }
+
+
+def carica_matrice_asset(asset_id):
+    """Matrice aggregata di un singolo asset (vuota se non ha celle)."""
+    return carica_matrici_asset([asset_id]).get(asset_id) or MatriceDensa([], [])
+
+
+def matrice_sottoalbero(nodo):
+    """
+    Matrice aggregata del sottoalbero di un NodoStruttura, nodo compreso: MAX(valore) raggruppato
+    per (minaccia, controllo) sulle celle degli ElementType dei nodi con `lft` nell'intervallo
+    [lft, rght] del nodo, in una sola query. Vale per qualunque livello (es. lo strato database di un asset).
+    """
+    from elementtypes.models import ValoreElementType
+
+    celle = ValoreElementType.objects.filter(
+        elementtype__nodi_istanziati__tree_id=nodo.tree_id,
+        elementtype__nodi_istanziati__lft__range=(nodo.lft, nodo.rght),
+    ).values('minaccia_id', 'controllo_id').annotate(valore=Max('valore')).values_list('minaccia_id', 'controllo_id', 'valore')
+    return _da_celle({(minaccia_id, controllo_id): valore for minaccia_id, controllo_id, valore in celle})
+
+
+def stato(asset_id):
+    """(impronta, impronta_input) della matrice salvata dell'asset, oppure (None, None)."""
+    from .models import MatriceAsset
+
+    return MatriceAsset.objects.filter(asset_id=asset_id).values_list(
+        'impronta', 'impronta_input'
+    ).first() or (None, None)
+
+
+def registra_input(asset_id, impronta_input):
+    """Associa alla matrice salvata (invariata) dell'asset l'impronta degli input appena verificati."""
+    from .models import MatriceAsset
+
+    MatriceAsset.objects.filter(asset_id=asset_id).update(impronta_input=impronta_input)
+
+
+def salva_matrici_asset(matrici, impronte_input=None):
+    """
+    Scrive (upsert) le matrici aggregate {asset_id: MatriceDensa}, ridotte alle celle
+    valorizzate, con i contatori di dimensione. `impronte_input` ({asset_id: hash})
+    registra gli input da cui sono state aggregate.
+    """
+    from .models import MatriceAsset
+
+    if not matrici:
+        return
+    impronte_input = impronte_input or {}
+    oggetti = []
+    for asset_id, matrice in matrici.items():
+        matrice = riduci(matrice)
+        campi = impacchetta(matrice)
+        oggetti.append(MatriceAsset(
+            asset_id=asset_id, minacce_ids=campi[0], controlli_ids=campi[1], valori=campi[2],
+            num_minacce=len(matrice.minacce_ids), num_controlli=len(matrice.controlli_ids),
+            impronta=impronta(campi), impronta_input=impronte_input.get(asset_id, ''),
+        ))
+    MatriceAsset.objects.bulk_create(
+        oggetti,
+        update_conflicts=True,
+        unique_fields=['asset'],
+        update_fields=[
+            'minacce_ids', 'controlli_ids', 'valori', 'num_minacce', 'num_controlli',
+            'impronta', 'impronta_input', 'aggiornata_il',
+        ],
+        batch_size=500,
+    )
+
+
+def aggiorna_celle_asset(celle_per_asset):
+    """
+    Applica alle matrici degli asset le celle ricalcolate {asset_id: {(minaccia_id, controllo_id): valore}}
+    (valore 0 = cella eliminata). L'impronta degli input viene azzerata: la prossima aggregazione
+    completa ricontrolla il risultato. Restituisce il numero di celle effettivamente cambiate.
+    """
+    celle_per_asset = {asset_id: celle for asset_id, celle in celle_per_asset.items() if celle}
+    if not celle_per_asset:
+        return 0
+    esistenti = carica_matrici_asset(celle_per_asset)
+    aggiornate, cambiate = {}, 0
+    for asset_id, nuove in celle_per_asset.items():
+        matrice = esistenti.get(asset_id)
+        celle = {(m, c): v for m, c, v in matrice.celle()} if matrice else {}
+        diverse = {cella: valore for cella, valore in nuove.items() if celle.get(cella, 0.0) != valore}
+        if not diverse:
+            continue
+        cambiate += len(diverse)
+        celle.update(diverse)
+        aggiornate[asset_id] = _da_celle({cella: valore for cella, valore in celle.items() if valore > 0})
+    salva_matrici_asset(aggiornate)
+    return cambiate
+
+
+def _da_celle(celle):
+    matrice = MatriceDensa(sorted({m for m, _ in celle}), sorted({c for _, c in celle}))
+    for (minaccia_id, controllo_id), valore in celle.items():
+        matrice.valori[matrice.indice_minacce[minaccia_id], matrice.indice_controlli[controllo_id]] = valore
+    return matrice
@@ -0,0 +1,85 @@
+# Generated by Django 5.2.3 on 2026-10-18 11:25
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def popola_matrici_asset(apps, schema_editor):
+    import numpy as np
+
+    NodoStruttura = apps.get_model('assets', 'NodoStruttura')
+    MatriceAsset = apps.get_model('assets', 'MatriceAsset')
+    ValoreElementType = apps.get_model('elementtypes', 'ValoreElementType')
+
+    figli = {}
+    for asset_id, et_id in NodoStruttura.objects.filter(level=1).values_list('asset_id', 'element_type_id'):
+        figli.setdefault(asset_id, set()).add(et_id)
+    celle_et = {}
+    for et_id, minaccia_id, controllo_id, valore in ValoreElementType.objects.filter(
+        elementtype_id__in=set().union(*figli.values()) if figli else set()
+    ).values_list('elementtype_id', 'minaccia_id', 'controllo_id', 'valore').iterator(chunk_size=10000):
+        celle_et.setdefault(et_id, []).append((minaccia_id, controllo_id, valore))
+
+    matrici = []
+    for asset_id, et_ids in figli.items():
+        celle = {}
+        for et_id in et_ids:
+            for minaccia_id, controllo_id, valore in celle_et.get(et_id, ()):
+                if valore > celle.get((minaccia_id, controllo_id), 0.0):
+                    celle[(minaccia_id, controllo_id)] = valore
+        minacce = sorted({m for m, _ in celle})
+        controlli = sorted({c for _, c in celle})
+        righe = {m: i for i, m in enumerate(minacce)}
+        colonne = {c: j for j, c in enumerate(controlli)}
+        valori = np.zeros((len(minacce), len(controlli)), dtype=np.uint8)
+        for (minaccia_id, controllo_id), valore in celle.items():
+            valori[righe[minaccia_id], colonne[controllo_id]] = round(min(valore, 1.0) * 100)
+        matrici.append(MatriceAsset(
+            asset_id=asset_id,
+            minacce_ids=np.asarray(minacce, dtype='<i8').tobytes(),
+            controlli_ids=np.asarray(controlli, dtype='<i8').tobytes(),
+            valori=valori.tobytes(),
+            num_minacce=len(minacce),
+            num_controlli=len(controlli),
+        ))
+    MatriceAsset.objects.bulk_create(matrici, batch_size=500)
+
+    # Le matrici aggregate scritte finora sull'ElementType "root" dei nodi radice non sono più lette
+    ElementType = apps.get_model('elementtypes', 'ElementType')
+    MatriceCompatta = apps.get_model('elementtypes', 'MatriceCompatta')
+    radici = list(ElementType.objects.filter(
+        nome="root", pk__in=NodoStruttura.objects.filter(level=0).values('element_type_id')
+    ).values_list('pk', flat=True))
+    ValoreElementType.objects.filter(elementtype_id__in=radici).delete()
+    MatriceCompatta.objects.filter(elementtype_id__in=radici).delete()
+    ElementType.objects.filter(pk__in=radici).update(num_minacce=0, num_controlli=0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('assets', '0001_initial'),
+        ('elementtypes', '0005_impronte_matrici'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MatriceAsset',
+            fields=[
+                ('asset', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='matrice_aggregata', serialize=False, to='assets.asset')),
+                ('minacce_ids', models.BinaryField(verbose_name='Id minacce (righe)')),
+                ('controlli_ids', models.BinaryField(verbose_name='Id controlli (colonne)')),
+                ('valori', models.BinaryField(verbose_name='Valori (percentuale)')),
+                ('num_minacce', models.PositiveIntegerField(default=0, verbose_name='N. minacce')),
+                ('num_controlli', models.PositiveIntegerField(default=0, verbose_name='N. controlli')),
+                ('impronta', models.CharField(blank=True, help_text='Hash del contenuto: cambia a ogni modifica della matrice e ne fa da versione.', max_length=40, verbose_name='Impronta')),
+                ('impronta_input', models.CharField(blank=True, help_text='Hash degli ElementType figli delle radici e delle loro versioni (vedi elementtypes/memo.py).', max_length=40, verbose_name='Impronta degli input')),
+                ('aggiornata_il', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Matrice aggregata Asset',
+                'verbose_name_plural': 'Matrici aggregate Asset',
+            },
+        ),
+        migrations.RunPython(popola_matrici_asset, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.3 on 2026-10-18 11:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('assets', '0002_matrici_asset'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='asset',
+            name='versione_albero',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text="Incrementato a ogni modifica dei nodi: fa da ETag della lettura dell'albero.", verbose_name='Versione albero'),
+        ),
+        migrations.AddField(
+            model_name='strutturatemplate',
+            name='versione_albero',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text="Incrementato a ogni modifica dei nodi: fa da ETag della lettura dell'albero.", verbose_name='Versione albero'),
+        ),
+    ]
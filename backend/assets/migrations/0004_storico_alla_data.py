@@ -0,0 +1,27 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('assets', '0003_versione_albero'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='historicalasset',
+            index=models.Index(fields=['id', 'history_date'], name='assets_hist_id_365de4_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='historicalnodostruttura',
+            index=models.Index(fields=['id', 'history_date'], name='assets_hist_id_673dd2_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='historicalnodotemplate',
+            index=models.Index(fields=['id', 'history_date'], name='assets_hist_id_cf6e68_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='historicalstrutturatemplate',
+            index=models.Index(fields=['id', 'history_date'], name='assets_hist_id_c52e2d_idx'),
+        ),
+    ]
@@ -1,18 +1,47 @@
 from django.db import models
+from django.db.models import F
 from django.contrib.auth.models import User
-from simple_history.models import HistoricalRecords
+from core.storico import StoricoRecords, operazione_massiva
 from mptt.models import MPTTModel, TreeForeignKey
 from campagne.models import Campagna
+from elementtypes import memo
 from elementtypes.models import ElementType
+from .alberi import FIGLI, dati_da_nodi, espandi_componenti, inserisci_alberi, inserisci_figli
+from .radici import segna_radice
 import logging
 
 from django.core.exceptions import ValidationError
-class StrutturaTemplate(models.Model):
+
+
+class ProprietarioAlbero:
+    """
+    Proprietario di un albero di nodi (asset o template) con il contatore `versione_albero`, che
+    i nodi incrementano con `update()`: il salvataggio di un'istanza letta in precedenza non lo
+    riscrive (lo escluderebbe dal confronto degli ETag riportandolo indietro) e lo rilegge.
+    """
+
+    def save(self, *args, **kwargs):
+        esistente = not self._state.adding
+        if esistente:
+            campi = kwargs.get('update_fields')
+            if campi is None:
+                campi = [campo.name for campo in self._meta.concrete_fields if not campo.primary_key]
+            kwargs['update_fields'] = [campo for campo in campi if campo != 'versione_albero']
+        super().save(*args, **kwargs)
+        if esistente:
+            self.refresh_from_db(fields=['versione_albero'])
+
+
+class StrutturaTemplate(ProprietarioAlbero, models.Model):
     nome = models.CharField("Nome Template", max_length=255)
     descrizione = models.TextField("Descrizione", blank=True)
     campagna = models.ForeignKey(Campagna, on_delete=models.CASCADE, related_name='templates_struttura', null=True, blank=True)
     cloned_from = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True, related_name='clones')
-    history = HistoricalRecords()
+    versione_albero = models.PositiveIntegerField(
+        "Versione albero", default=0, editable=False,
+        help_text="Incrementato a ogni modifica dei nodi: fa da ETag della lettura dell'albero."
+    )
+    history = StoricoRecords(excluded_fields=['versione_albero'])
 
     def __str__(self):
         return self.nome
@@ -25,13 +54,16 @@ class StrutturaTemplate(models.Model):
             self._clona_nodi_da_template(template_to_clone_from)
 
     def _clona_nodi_da_template(self, source_template):
-        """Clona l'albero di NodoTemplate da un template sorgente."""
+        """Clona l'albero di NodoTemplate da un template sorgente, con un inserimento in blocco."""
         self.nodi_template.all().delete()
-        node_map = {}
-        for source_node in source_template.nodi_template.all().order_by('level'):
-            parent_nodo_template = node_map.get(source_node.parent_id) if source_node.parent_id else None
-            nuovo_nodo = NodoTemplate.objects.create(template=self, element_type=source_node.element_type, parent=parent_nodo_template)
-            node_map[source_node.id] = nuovo_nodo
+        radici = dati_da_nodi(
+            ((nodo_id, parent_id, et_id, {}) for nodo_id, parent_id, et_id in source_template.nodi_template.order_by(
+                'level', 'id').values_list('id', 'parent_id', 'element_type_id')),
+            {'template': self, 'campagna_id': self.campagna_id},
+        )
+        motivo = f"Clonato dal template {source_template.nome}"
+        with operazione_massiva(motivo, campagna_id=self.campagna_id):
+            inserisci_alberi(NodoTemplate, radici, motivo=motivo)
 
     class Meta:
         verbose_name = "Template di Struttura"
@@ -46,12 +78,33 @@ class StrutturaTemplate(models.Model):
             return root_node.get_dimensione_matrice_display()
         return "N/D"
 
-class NodoTemplate(MPTTModel):
+class NodoAlbero:
+    """
+    Nodo di un albero con contatore di versione sul proprietario (`campo_albero`: l'asset o il
+    template), incrementato a ogni modifica dei nodi. Chi scrive i nodi senza `save()` (inserimenti
+    in blocco, `update()`) chiama esplicitamente `incrementa_versione`.
+    """
+    campo_albero = None
+
+    @classmethod
+    def incrementa_versione(cls, proprietari_ids):
+        proprietari_ids = {pk for pk in proprietari_ids if pk is not None}
+        if proprietari_ids:
+            cls._meta.get_field(cls.campo_albero).related_model.objects.filter(pk__in=proprietari_ids).update(
+                versione_albero=F('versione_albero') + 1
+            )
+
+    def incrementa_versione_albero(self):
+        self.incrementa_versione([getattr(self, f'{self.campo_albero}_id')])
+
+
+class NodoTemplate(NodoAlbero, MPTTModel):
     template = models.ForeignKey(StrutturaTemplate, on_delete=models.CASCADE, related_name='nodi_template')
     element_type = models.ForeignKey(ElementType, on_delete=models.CASCADE)
     parent = TreeForeignKey('self', on_delete=models.CASCADE, null=True, blank=True, related_name='children')
     campagna = models.ForeignKey(Campagna, on_delete=models.CASCADE, related_name='+', null=True, blank=True)
-    history = HistoricalRecords(excluded_fields=['lft', 'rght', 'tree_id', 'level'])
+    history = StoricoRecords(excluded_fields=['lft', 'rght', 'tree_id', 'level'])
+    campo_albero = 'template'
 
     class MPTTMeta:
         order_insertion_by = ['id']
@@ -60,6 +113,7 @@ class NodoTemplate(MPTTModel):
         if self.template and self.campagna is None:
             self.campagna = self.template.campagna
         super().save(*args, **kwargs)
+        self.incrementa_versione_albero()
 
     def __str__(self):
         return f"{self.template.nome} - {self.element_type.nome}"
@@ -75,7 +129,7 @@ class NodoTemplate(MPTTModel):
         verbose_name_plural = "Nodi di Template"
         unique_together = ('template', 'element_type', 'parent')
 
-class Asset(models.Model):
+class Asset(ProprietarioAlbero, models.Model):
     STATUS_CHOICES = [('in_produzione', 'In Produzione'), ('in_sviluppo', 'In Sviluppo'), ('dismesso', 'Dismesso')]
     nome = models.CharField("Nome Asset", max_length=255)
     descrizione = models.TextField("Descrizione", blank=True)
@@ -87,7 +141,11 @@ class Asset(models.Model):
     template_da_applicare = models.ForeignKey(StrutturaTemplate, on_delete=models.SET_NULL, null=True, blank=True, verbose_name="Template di Struttura")
     campagna = models.ForeignKey(Campagna, on_delete=models.CASCADE, related_name='assets', null=True, blank=True)
     cloned_from = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True, related_name='clones')
-    history = HistoricalRecords()
+    versione_albero = models.PositiveIntegerField(
+        "Versione albero", default=0, editable=False,
+        help_text="Incrementato a ogni modifica dei nodi: fa da ETag della lettura dell'albero."
+    )
+    history = StoricoRecords(excluded_fields=['versione_albero'])
 
     def __str__(self):
         return self.nome
@@ -102,22 +160,22 @@ class Asset(models.Model):
             old_nome = Asset.objects.get(pk=self.pk).nome
             if old_nome != self.nome:
                 logging.info(f"Asset name changed from '{old_nome}' to '{self.nome}'. Updating root node name.")
-                if self.nodi_struttura.filter(level=0).exists():
-                    self.nodi_struttura.filter(level=0).update(nome_specifico=self.nome)
+                if self.nodi_struttura.filter(level=0).update(nome_specifico=self.nome):
+                    NodoStruttura.incrementa_versione([self.pk])
 
         super().save(*args, **kwargs)
 
         if is_new:
             logging.info(f"New asset '{self.nome}': creating structure.")
             
-            if template_to_apply:
-                self._applica_struttura_da_template(template_to_apply)
-            elif asset_to_clone_from:
-                self._clona_struttura_da_asset(asset_to_clone_from)
-                if self.nodi_struttura.filter(level=0).exists():
-                    self.nodi_struttura.filter(level=0).update(nome_specifico=self.nome)
-            else:
-                self._crea_nodo_radice()
+            with memo.misura() as aggregazioni:
+                if template_to_apply:
+                    self._applica_struttura_da_template(template_to_apply)
+                elif asset_to_clone_from:
+                    self._clona_struttura_da_asset(asset_to_clone_from)
+                else:
+                    self._crea_nodo_radice()
+            logging.info(f"Structure of asset '{self.nome}' created, matrix aggregations: {aggregazioni or 'none'}.")
 
     def _crea_nodo_radice(self):
         """Crea un nodo radice per un nuovo asset."""
@@ -146,52 +204,73 @@ class Asset(models.Model):
             logging.error(f"Error creating root node for asset '{self.nome}': {e}")
 
     def _applica_struttura_da_template(self, template):
+        """
+        Crea l'albero dei nodi dal template, con i componenti dei nodi derivati espansi come in
+        `NodoStruttura.save`, in un unico inserimento in blocco; la radice prende il nome dell'asset.
+        """
         self.nodi_struttura.all().delete()
-        node_map = {}
-        for nodo_template in template.nodi_template.all().order_by('level'):
-            parent_nodo_struttura = node_map.get(nodo_template.parent_id) if nodo_template.parent_id else None
-            nuovo_nodo = NodoStruttura.objects.create(
-                asset=self, element_type=nodo_template.element_type, parent=parent_nodo_struttura
-            )
-            node_map[nodo_template.id] = nuovo_nodo
-        # Dopo aver creato i nodi dal template, impostiamo il nome del primo nodo uguale al nome dell'asset
-        if self.nodi_struttura.filter(level=0).exists():
-            self.nodi_struttura.filter(level=0).update(nome_specifico=self.nome)
-
-
-
-
+        campi = {'asset': self, 'campagna_id': self.campagna_id}
+        radici = dati_da_nodi(
+            ((nodo_id, parent_id, et_id, {}) for nodo_id, parent_id, et_id in template.nodi_template.order_by(
+                'level', 'id').values_list('id', 'parent_id', 'element_type_id')),
+            campi,
+        )
+        espandi_componenti(radici, campi)
+        self._inserisci_struttura(radici, f"Applicato il template {template.nome}")
 
     def _clona_struttura_da_asset(self, source_asset):
+        """Clona così com'è l'albero di NodoStruttura da un asset sorgente, in un unico inserimento in blocco."""
         logging.info(f"Clonazione struttura dall'asset {source_asset.nome} all'asset {self.nome}")
-        """Clona l'albero di NodoStruttura da un asset sorgente."""
         self.nodi_struttura.all().delete()
-        node_map = {}
-        for source_node in source_asset.nodi_struttura.all().order_by('level'):
-            parent_nodo_struttura = node_map.get(source_node.parent_id) if source_node.parent_id else None
-            nuovo_nodo = NodoStruttura.objects.create(asset=self, element_type=source_node.element_type, parent=parent_nodo_struttura, nome_specifico=source_node.nome_specifico)
-            node_map[source_node.id] = nuovo_nodo 
+        radici = dati_da_nodi(
+            ((nodo_id, parent_id, et_id, {'nome_specifico': nome}) for nodo_id, parent_id, et_id, nome in
+             source_asset.nodi_struttura.order_by('level', 'id').values_list('id', 'parent_id', 'element_type_id', 'nome_specifico')),
+            {'asset': self, 'campagna_id': self.campagna_id},
+        )
+        self._inserisci_struttura(radici, f"Clonato dall'asset {source_asset.nome}")
+
+    def _inserisci_struttura(self, radici, motivo):
+        for radice in radici:
+            radice['nome_specifico'] = self.nome
+        with operazione_massiva(motivo, campagna_id=self.campagna_id):
+            nodi = inserisci_alberi(NodoStruttura, radici, motivo=motivo)
+        # Una sola aggregazione per radice, a struttura completa
+        for nodo in nodi:
+            if nodo.level == 0:
+                segna_radice(nodo.tree_id)
 
     def get_dimensione_matrice_display(self):
-        """Restituisce la dimensione della matrice del nodo radice dell'asset."""
-        # Itera sulla cache prefetched per efficienza
-        root_node = next((node for node in self.nodi_struttura.all() if node.level == 0), None)
-        if root_node and root_node.element_type: # Ensure element_type exists
-            return root_node.element_type.get_dimensione_matrice_display()
-        return "N/D"
+        """Restituisce la dimensione della matrice aggregata dell'asset (contatori materializzati)."""
+        try:
+            matrice = self.matrice_aggregata
+        except MatriceAsset.DoesNotExist:
+            matrice = None
+        if matrice and (matrice.num_minacce or matrice.num_controlli):
+            return f"{matrice.num_minacce} x {matrice.num_controlli}"
+        return "N/D (Root Aggregato)"
+
+    def get_matrice(self):
+        """Matrice aggregata dell'asset (MatriceDensa), letta dalla sua riga precalcolata o dall'istantanea della campagna chiusa."""
+        from campagne.istantanea import leggi
+        from campagne.models import VoceIstantanea
+        from .matrici import carica_matrice_asset
+
+        voce = leggi(VoceIstantanea.ASSET, self)
+        return voce.matrice() if voce is not None else carica_matrice_asset(self.pk)
 
     class Meta:
         verbose_name = "Asset"
         verbose_name_plural = "Assets"
         unique_together = ('nome', 'campagna')
 
-class NodoStruttura(MPTTModel):
+class NodoStruttura(NodoAlbero, MPTTModel):
     asset = models.ForeignKey(Asset, on_delete=models.CASCADE, related_name='nodi_struttura')
     element_type = models.ForeignKey(ElementType, on_delete=models.CASCADE, related_name='nodi_istanziati')
     parent = TreeForeignKey('self', on_delete=models.CASCADE, null=True, blank=True, related_name='children')
     nome_specifico = models.CharField("Nome Specifico", max_length=255, blank=True)
     campagna = models.ForeignKey(Campagna, on_delete=models.CASCADE, related_name='+', null=True, blank=True)
-    history = HistoricalRecords(excluded_fields=['lft', 'rght', 'tree_id', 'level'])
+    history = StoricoRecords(excluded_fields=['lft', 'rght', 'tree_id', 'level'])
+    campo_albero = 'asset'
 
     class MPTTMeta:
         order_insertion_by = ['id']
@@ -207,29 +286,30 @@ class NodoStruttura(MPTTModel):
         
         super().save(*args, **kwargs)
 
-        # Se è un nuovo nodo non di base, crea automaticamente i suoi componenti
+        # Se è un nuovo nodo non di base, crea automaticamente l'intero sottoalbero dei suoi componenti
         if is_new and not self.element_type.is_base:
-            for component_et in self.element_type.component_element_types.all():
-                NodoStruttura.objects.create(
-                    asset=self.asset,
-                    element_type=component_et,
-                    parent=self,
-                    nome_specifico=component_et.nome  # Opzionale: imposta un nome di default
-                )
+            self._espandi_componenti()
+        self.incrementa_versione_albero()
         
-        # Trigger aggregation of the root node's matrix
-        if self.is_root_node():
-            self.aggregate_root_node_matrix()
-        else:
-            root_node = self.get_root()
-            if root_node: # Ensure root_node exists
-                root_node.aggregate_root_node_matrix()
+        # La matrice della radice va ri-aggregata: al commit se in una transazione (vedi radici.py)
+        segna_radice(self.tree_id)
+
+    def _espandi_componenti(self):
+        """
+        Crea i nodi dei componenti, ricorsivamente fino ai tipi di base, risolvendo l'intero
+        sottoalbero con due query e inserendolo in blocco sotto questo nodo (vedi `alberi.py`).
+        """
+        campi = {'asset': self.asset, 'campagna_id': self.campagna_id}
+        [dati] = espandi_componenti([{'element_type_id': self.element_type_id, FIGLI: []}], campi)
+        inserisci_figli(self, dati[FIGLI], motivo=f"Componenti di {self.element_type.nome}")
 
     def __str__(self):
         return self.nome_specifico or self.element_type.nome
 
     def get_dimensione_matrice_display(self):
-        """Restituisce la dimensione della matrice dell'ElementType associato."""
+        """Restituisce la dimensione della matrice dell'ElementType associato (dell'asset per la radice)."""
+        if self.level == 0 and self.asset_id:
+            return self.asset.get_dimensione_matrice_display()
         if self.element_type:
             return self.element_type.get_dimensione_matrice_display()
         return "N/D"
@@ -237,54 +317,83 @@ class NodoStruttura(MPTTModel):
     def is_root_node(self):
         return self.level == 0
 
+    def get_matrice_sottoalbero(self):
+        """
+        Matrice aggregata (MatriceDensa) del sottoalbero di questo nodo, con una sola query (vedi `matrici.py`);
+        nelle campagne chiuse è letta dall'istantanea precalcolata.
+        """
+        from campagne.istantanea import leggi
+        from campagne.models import VoceIstantanea
+        from .matrici import matrice_sottoalbero
+
+        voce = leggi(VoceIstantanea.NODO, self)
+        return voce.matrice() if voce is not None else matrice_sottoalbero(self)
+
     def aggregate_root_node_matrix(self):
-        from elementtypes.models import ElementType, ValoreElementType
-        root_element_type = self.element_type
+        """
+        Aggrega la matrice dell'asset del nodo radice (`MatriceAsset`): MAX, cella per
+        cella, delle matrici degli ElementType figli delle radici dell'asset.
+        L'aggregazione è memoizzata sull'impronta degli ElementType figli e delle loro
+        versioni (vedi `elementtypes.memo`): con input invariati non si ricalcola, con
+        risultato invariato non si riscrive. L'ElementType "root" non viene modificato.
+        """
+        from elementtypes.compatta import attive, carica_matrici, impacchetta, impronta, riduci
+        from elementtypes.matrix import massimo
+        from . import matrici
+
+        if not self.asset_id:
+            logging.warning(f"Root node {self.pk} has no asset. Cannot aggregate matrix.")
+            return
 
-        if not root_element_type:
-            logging.warning(f"Root node {self.pk} has no element type. Cannot aggregate matrix.")
+        figli_ids = sorted(set(
+            NodoStruttura.objects.filter(asset_id=self.asset_id, level=1).values_list('element_type_id', flat=True)
+        ))
+        impronta_nuova = impronta_salvata = None
+        if attive():
+            impronta_salvata, impronta_input_salvata = matrici.stato(self.asset_id)
+            impronta_nuova = memo.impronta_input(figli_ids, memo.impronte(figli_ids), ['radice'])
+            if impronta_input_salvata == impronta_nuova:
+                memo.registra('radice', 'hit')
+                return
+            memo.registra('radice', 'miss')
+
+        # Le righe ridotte alle celle valorizzate coincidono con la forma salvata
+        matrice = riduci(massimo(carica_matrici(figli_ids).values()))
+        if impronta_salvata and impronta_salvata == impronta(impacchetta(matrice)):
+            memo.registra('radice', 'scrittura_evitata')
+            matrici.registra_input(self.asset_id, impronta_nuova or '')
             return
-        """Aggrega la matrice del nodo radice basata sui figli."""
-        logging.info(f"--- Aggregating matrix for root node: {self.nome_specifico or self.element_type.nome} (Asset: {self.asset.nome}) ---")
-        children = NodoStruttura.objects.filter(parent=self)
-        if children.exists():
-            from elementtypes.models import ElementType, ValoreElementType
-            
-            logging.info(f"Child nodes found: {children.count()}")
-            for child in children:
-                logging.info(f"  Child: {child.nome_specifico or child.element_type.nome}, ElementType: {child.element_type.nome}, Dimension: {child.element_type.get_dimensione_matrice_display()}")
 
-            # Ensure element_type and its related values are prefetched for children
-            children = children.select_related('element_type').prefetch_related('element_type__valori_matrice')
-            element_types = [child.element_type for child in children]
-            
-            aggregated_values = ElementType.get_aggregated_matrix_values(element_types)
-            logging.info(f"Aggregated values from children: {aggregated_values}")
-
-            # Clear existing values for the root ElementType and create new ones.
-            ValoreElementType.objects.filter(elementtype=root_element_type).delete()
-            logging.info(f"Cleared existing matrix values for root ElementType: {root_element_type.nome}")
-
-            new_valori = []
-            for (minaccia_id, controllo_id), valore in aggregated_values.items():
-                new_valori.append(
-                    ValoreElementType(
-                        elementtype=root_element_type,
-                        minaccia_id=minaccia_id,
-                        controllo_id=controllo_id,
-                        valore=valore
-                    )
-                )
-            ValoreElementType.objects.bulk_create(new_valori)
-            logging.info(f"Bulk created {len(new_valori)} new matrix values for root ElementType.")
-            
-            # Refresh the root element type to get the updated dimension
-            root_element_type.refresh_from_db()
-            logging.info(f"New dimension of root ElementType ({root_element_type.nome}): {root_element_type.get_dimensione_matrice_display()}")
-        else:
-            logging.info(f"No children found for root node: {self.nome_specifico or self.element_type.nome}. Matrix will be N/D.")
-            # If no children, clear the matrix for the root ElementType
-            ValoreElementType.objects.filter(elementtype=root_element_type).delete()
-            root_element_type.refresh_from_db()
-            logging.info(f"Root ElementType ({root_element_type.nome}) matrix cleared. Dimension: {root_element_type.get_dimensione_matrice_display()}")
-    
\ No newline at end of file
+        matrici.salva_matrici_asset({self.asset_id: matrice}, impronte_input={self.asset_id: impronta_nuova or ''})
+        logging.info(
+            f"Root node {self.nome_specifico or self.element_type.nome} (Asset: {self.asset.nome}): "
+            f"{len(figli_ids)} child element types, {len(matrice.minacce_ids)} x {len(matrice.controlli_ids)} matrix written."
+        )
+
+
+class MatriceAsset(models.Model):
+    """
+    Matrice aggregata di un asset (vedi `matrici.py`), nella forma impacchettata di
+    `MatriceCompatta`: vettori ordinati degli id di minacce e controlli (int64) e valori
+    in percentuale (uint8) riga per riga, con i contatori di dimensione e le impronte
+    per la memoizzazione. Una riga per asset: le aggregazioni di asset diversi sono indipendenti.
+    """
+    asset = models.OneToOneField(Asset, on_delete=models.CASCADE, primary_key=True, related_name='matrice_aggregata')
+    minacce_ids = models.BinaryField("Id minacce (righe)")
+    controlli_ids = models.BinaryField("Id controlli (colonne)")
+    valori = models.BinaryField("Valori (percentuale)")
+    num_minacce = models.PositiveIntegerField("N. minacce", default=0)
+    num_controlli = models.PositiveIntegerField("N. controlli", default=0)
+    impronta = models.CharField(
+        "Impronta", max_length=40, blank=True,
+        help_text="Hash del contenuto: cambia a ogni modifica della matrice e ne fa da versione."
+    )
+    impronta_input = models.CharField(
+        "Impronta degli input", max_length=40, blank=True,
+        help_text="Hash degli ElementType figli delle radici e delle loro versioni (vedi elementtypes/memo.py)."
+    )
+    aggiornata_il = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = 'Matrice aggregata Asset'
+        verbose_name_plural = 'Matrici aggregate Asset'
@@ -0,0 +1,76 @@
+"""
+Aggregazione differita delle matrici dei nodi radice.
+
+Ogni salvataggio di un NodoStruttura rende "sporca" la matrice della radice del
+suo albero. Dentro una transazione (le viste dell'admin, gli import, il seeding,
+la creazione di campagne e asset) le radici sporche vengono solo annotate e
+ri-aggregate una volta sola al commit, da un'unica callback `on_commit` per
+transazione registrata alla prima annotazione. La connessione tiene della
+callback (e delle radici che raccoglie) solo un riferimento debole: se la
+transazione, o il savepoint in cui la callback è stata registrata, viene
+annullata, Django la scarta e con lei le radici annotate, e l'annotazione
+successiva ne registra una nuova. Fuori da una transazione l'aggregazione è immediata. `aggregazione_differita()` apre esplicitamente un
+blocco in cui le aggregazioni vengono accorpate.
+
+Le richieste accorpate sono conteggiate in `elementtypes.memo` come
+`radice.differita` (prima richiesta per radice) e `radice.accorpata` (successive).
+"""
+import weakref
+from contextlib import contextmanager
+
+from django.db import transaction
+
+from elementtypes import memo
+
+
+def segna_radice(tree_id, using=None):
+    """Annota la radice dell'albero `tree_id` da ri-aggregare al commit (subito, fuori da una transazione)."""
+    connessione = transaction.get_connection(using)
+    if not connessione.in_atomic_block:
+        aggrega_radici([tree_id])
+        return
+    riferimento = connessione.__dict__.get('_radici_in_attesa')
+    in_attesa = riferimento() if riferimento is not None else None
+    if in_attesa is None or in_attesa.eseguita:
+        # Prima annotazione della transazione, o la callback precedente è stata eseguita o scartata
+        in_attesa = _RadiciInAttesa()
+        connessione._radici_in_attesa = weakref.ref(in_attesa)
+        transaction.on_commit(in_attesa, using=using)
+    memo.registra('radice', 'accorpata' if tree_id in in_attesa.tree_ids else 'differita')
+    in_attesa.tree_ids.add(tree_id)
+
+
+class _RadiciInAttesa:
+    """Radici annotate in una transazione; eseguita al commit come callback di `on_commit`."""
+
+    def __init__(self):
+        self.tree_ids = set()
+        self.eseguita = False
+
+    def __call__(self):
+        self.eseguita = True
+        if self.tree_ids:
+            aggrega_radici(self.tree_ids)
+
+
+def aggrega_radici(tree_ids):
+    """Aggrega, una volta per asset, le matrici degli asset delle radici degli alberi indicati."""
+    from .models import NodoStruttura
+
+    radici = NodoStruttura.objects.filter(tree_id__in=set(tree_ids), level=0).select_related('element_type', 'asset')
+    aggregati = set()
+    for radice in radici:
+        if radice.asset_id not in aggregati:
+            aggregati.add(radice.asset_id)
+            radice.aggregate_root_node_matrix()
+
+
+@contextmanager
+def aggregazione_differita(using=None):
+    """
+    Blocco transazionale in cui i salvataggi di nodi annotano soltanto le radici da
+    aggregare: ogni radice viene aggregata una volta al commit del blocco (o della
+    transazione esterna che lo contiene).
+    """
+    with transaction.atomic(using=using):
+        yield
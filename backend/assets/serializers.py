@@ -2,16 +2,49 @@ from rest_framework import serializers
 from .models import Asset, NodoStruttura, StrutturaTemplate, NodoTemplate
 
 class AssetSerializer(serializers.ModelSerializer):
+    utente_responsabile_username = serializers.CharField(source='utente_responsabile.username', read_only=True, default=None)
+    responsabile_applicativo_username = serializers.CharField(source='responsabile_applicativo.username', read_only=True, default=None)
+
     class Meta:
         model = Asset
-        fields = '__all__'
+        fields = (
+            'id', 'nome', 'descrizione', 'cmdb', 'utente_responsabile', 'utente_responsabile_username',
+            'responsabile_applicativo', 'responsabile_applicativo_username', 'legal_entity', 'status',
+            'template_da_applicare', 'campagna', 'cloned_from', 'versione_albero',
+        )
 
 class NodoStrutturaSerializer(serializers.ModelSerializer):
+    """Il nodo senza i campi interni di MPTT (`lft`, `rght`, `tree_id`, `level`)."""
+    element_type_nome = serializers.CharField(source='element_type.nome', read_only=True)
+
     class Meta:
         model = NodoStruttura
-        fields = '__all__'
+        fields = ('id', 'asset', 'element_type', 'element_type_nome', 'parent', 'nome_specifico', 'campagna')
 
 class StrutturaTemplateSerializer(serializers.ModelSerializer):
     class Meta:
         model = StrutturaTemplate
-        fields = '__all__'
\ No newline at end of file
+        fields = ('id', 'nome', 'descrizione', 'campagna', 'cloned_from', 'versione_albero')
+
+
+CAMPI_ELEMENT_TYPE = ('id', 'nome', 'is_base')
+
+
+def albero_annidato(nodi, campi=()):
+    """
+    Lista delle radici, come dizionari annidati (`children`), dei nodi MPTT indicati, letti con una
+    sola query in ordine (tree_id, lft) insieme al riepilogo dell'ElementType. In quest'ordine ogni
+    nodo segue il proprio genitore: una pila dei nodi aperti (quelli con rght non ancora superato)
+    lo aggancia in tempo costante, quindi l'albero si costruisce in tempo lineare.
+    """
+    colonne = ['id', 'parent_id', 'level', *campi, *(f'element_type__{campo}' for campo in CAMPI_ELEMENT_TYPE)]
+    radici, pila = [], []
+    for tree_id, lft, rght, *valori in nodi.order_by('tree_id', 'lft').values_list('tree_id', 'lft', 'rght', *colonne):
+        while pila and (pila[-1][0] != tree_id or pila[-1][1] < lft):
+            pila.pop()
+        nodo = dict(zip(['id', 'parent', 'level', *campi], valori))
+        nodo['element_type'] = dict(zip(CAMPI_ELEMENT_TYPE, valori[3 + len(campi):]))
+        nodo['children'] = []
+        (pila[-1][2]['children'] if pila else radici).append(nodo)
+        pila.append((tree_id, rght, nodo))
+    return radici
@@ -0,0 +1,28 @@
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from mptt.signals import node_moved
+
+from elementtypes.models import ElementType
+from .models import Asset, NodoStruttura, NodoTemplate, StrutturaTemplate
+
+
+@receiver(post_delete, sender=NodoStruttura)
+@receiver(post_delete, sender=NodoTemplate)
+def incrementa_versione_nodo_eliminato(sender, instance, **kwargs):
+    instance.incrementa_versione_albero()
+
+
+@receiver(node_moved, sender=NodoStruttura)
+@receiver(node_moved, sender=NodoTemplate)
+def incrementa_versione_nodo_spostato(sender, instance, **kwargs):
+    instance.incrementa_versione_albero()
+
+
+@receiver(post_save, sender=ElementType)
+def incrementa_versione_alberi_elementtype(sender, instance, created, raw=False, **kwargs):
+    """La lettura dell'albero riporta nome e tipo dell'ElementType di ogni nodo: gli alberi che lo usano cambiano versione."""
+    if raw or created:
+        return
+    Asset.objects.filter(nodi_struttura__element_type=instance).update(versione_albero=F('versione_albero') + 1)
+    StrutturaTemplate.objects.filter(nodi_template__element_type=instance).update(versione_albero=F('versione_albero') + 1)
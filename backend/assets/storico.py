@@ -0,0 +1,119 @@
+"""
+Letture "alla data" degli alberi (nodi degli asset e dei template).
+
+Lo storico dei nodi non conserva i campi MPTT (lft, rght, tree_id, level):
+l'albero in vigore a un istante si ricostruisce dai `parent` delle versioni
+in vigore, scelte con `core.storico.versioni_al` sull'indice
+(id, history_date) delle tabelle storiche. I nodi creati o eliminati dentro
+un'operazione massiva non hanno righe di storico: si ricavano dalle voci
+dell'operazione (intervalli di id) terminata entro l'istante, prendendone
+lo stato dalla prima versione successiva o, in mancanza, dalla riga attuale.
+"""
+import bisect
+from collections import defaultdict
+
+from core.models import VoceOperazione
+from core.storico import versioni_al
+from elementtypes.models import ElementType
+from .serializers import CAMPI_ELEMENT_TYPE
+
+
+def _voci(modello, quando, ids):
+    """
+    Voci delle operazioni massive terminate entro `quando` che hanno creato o eliminato almeno uno
+    degli `ids` (ordinati): l'indice (modello, primo_id, ultimo_id) restringe alle voci i cui estremi
+    comprendono gli id del proprietario, il controllo dei singoli intervalli avviene in memoria.
+    """
+    if not ids:
+        return []
+    candidate = VoceOperazione.objects.filter(
+        modello=modello._meta.label, tipo__in=('+', '-'), operazione__terminata_il__lte=quando,
+        primo_id__lte=ids[-1], ultimo_id__gte=ids[0],
+    ).select_related('operazione')
+    return [voce for voce in candidate if _contenuti(voce, ids)]
+
+
+def _contenuti(voce, ids):
+    """Gli `ids` (ordinati) che cadono negli intervalli della voce."""
+    trovati = []
+    for primo, ultimo in voce.intervalli:
+        trovati.extend(ids[bisect.bisect_left(ids, primo):bisect.bisect_right(ids, ultimo)])
+    return trovati
+
+
+def _nodi_al(modello, proprietario_id, quando, campi):
+    """{id: {colonne}} dei nodi del proprietario esistenti a `quando`, con la data dell'ultima versione."""
+    colonne = ['id', 'parent_id', 'element_type_id', *campi]
+    filtro = {f'{modello.campo_albero}_id': proprietario_id}
+    nodi = {}
+    for data, tipo, *valori in versioni_al(modello.history.filter(**filtro), quando).values_list(
+        'history_date', 'history_type', *colonne
+    ):
+        if tipo != '-':
+            nodi[valori[0]] = dict(zip(colonne, valori), data=data)
+    visti = set(modello.history.filter(**filtro, history_date__lte=quando).values_list('id', flat=True))
+
+    # Tutti gli id mai appartenuti al proprietario: righe attuali e versioni successive a `quando`
+    ids = sorted(
+        visti | set(modello.objects.filter(**filtro).values_list('id', flat=True))
+        | set(modello.history.filter(**filtro, history_date__gt=quando).values_list('id', flat=True))
+    )
+    voci = _voci(modello, quando, ids)
+
+    # Creati da un'operazione massiva terminata entro `quando` e senza versioni fino ad allora
+    create = {pk: voce for voce in voci if voce.tipo == '+' for pk in _contenuti(voce, ids) if pk not in visti}
+    if create:
+        recuperati = {}
+        for valori in modello.history.filter(id__in=set(create), history_date__gt=quando).order_by(
+            'id', 'history_date', 'history_id'
+        ).values_list(*colonne):
+            recuperati.setdefault(valori[0], dict(zip(colonne, valori)))
+        for valori in modello.objects.filter(id__in=set(create) - set(recuperati)).values_list(*colonne):
+            recuperati[valori[0]] = dict(zip(colonne, valori))
+        for pk, nodo in recuperati.items():
+            nodi[pk] = {**nodo, 'data': create[pk].operazione.terminata_il}
+
+    presenti = sorted(nodi)
+    for voce in voci:
+        if voce.tipo == '-':
+            # Eliminati da un'operazione massiva dopo la loro ultima versione
+            for pk in _contenuti(voce, presenti):
+                if pk in nodi and nodi[pk]['data'] <= voce.operazione.terminata_il:
+                    del nodi[pk]
+    return nodi
+
+
+def _element_types_al(ids, quando):
+    """{id: riepilogo} degli ElementType come erano a `quando` (come sono ora se non hanno versioni)."""
+    riepiloghi = {
+        valori[0]: dict(zip(CAMPI_ELEMENT_TYPE, valori))
+        for valori in versioni_al(ElementType.history.filter(id__in=ids), quando).values_list(*CAMPI_ELEMENT_TYPE)
+    }
+    for valori in ElementType.objects.filter(id__in=set(ids) - set(riepiloghi)).values_list(*CAMPI_ELEMENT_TYPE):
+        riepiloghi[valori[0]] = dict(zip(CAMPI_ELEMENT_TYPE, valori))
+    return riepiloghi
+
+
+def albero_al(proprietario, relazione_nodi, quando, campi=()):
+    """
+    L'albero dei nodi di `proprietario` (`relazione_nodi`: 'nodi_struttura' o 'nodi_template')
+    come era a `quando`, nello stesso formato di `albero_annidato`. I nodi il cui genitore non
+    esisteva più a quella data sono esclusi insieme al loro sottoalbero.
+    """
+    modello = getattr(proprietario, relazione_nodi).model
+    nodi = _nodi_al(modello, proprietario.pk, quando, campi)
+    element_types = _element_types_al({nodo['element_type_id'] for nodo in nodi.values()}, quando)
+    figli = defaultdict(list)
+    for pk in sorted(nodi):
+        figli[nodi[pk]['parent_id']].append(pk)
+
+    def costruisci(pk, livello):
+        nodo = nodi[pk]
+        return {
+            'id': pk, 'parent': nodo['parent_id'], 'level': livello,
+            **{campo: nodo[campo] for campo in campi},
+            'element_type': element_types.get(nodo['element_type_id']),
+            'children': [costruisci(figlio, livello + 1) for figlio in figli[pk]],
+        }
+
+    return [costruisci(pk, 0) for pk in figli[None]]
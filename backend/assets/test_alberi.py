@@ -0,0 +1,166 @@
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from controlli.models import Controllo
+from core.models import OperazioneMassiva
+from elementtypes import memo
+from elementtypes.models import ElementType, ValoreElementType
+from minacce.models import Minaccia
+from scenari.models import Scenario
+from .models import Asset, NodoStruttura, NodoTemplate, StrutturaTemplate
+
+
+class CostruzioneAlberiTest(TestCase):
+
+    def setUp(self):
+        scenario = Scenario.objects.create(descrizione="Scenario")
+        minaccia = Minaccia.objects.create(descrizione="M", scenario=scenario)
+        self.database = ElementType.objects.create(nome="database")
+        self.schema = ElementType.objects.create(nome="schema")
+        self.server = ElementType.objects.create(nome="server")
+        for k, et in enumerate((self.database, self.schema, self.server)):
+            et.minacce.set([minaccia])
+            controllo = Controllo.objects.create(
+                nome=f"C{k}", descrizione="", tipologia_controllo="Tecnologico",
+                categoria_controllo="preventive", elementtype=et,
+            )
+            ValoreElementType.objects.create(elementtype=et, minaccia=minaccia, controllo=controllo, valore=0.1 * (k + 1))
+        self.db = ElementType.objects.create(nome="db", is_base=False)
+        self.db.component_element_types.set([self.database, self.schema])
+        ElementType.objects.aggregazione(self.db, [self.database, self.schema])
+        self.root = ElementType.objects.create(nome="root", is_base=False)
+
+        self.template = StrutturaTemplate.objects.create(nome="Template")
+        radice = NodoTemplate.objects.create(template=self.template, element_type=self.root)
+        NodoTemplate.objects.create(template=self.template, element_type=self.db, parent=radice)
+        NodoTemplate.objects.create(template=self.template, element_type=self.server, parent=radice)
+
+    def _struttura(self, asset):
+        return [
+            (nodo.level, nodo.element_type.nome, nodo.parent.element_type.nome if nodo.parent else None, nodo.nome_specifico)
+            for nodo in asset.nodi_struttura.select_related('element_type', 'parent__element_type').order_by('tree_id', 'lft')
+        ]
+
+    def _verifica_mptt(self, radice):
+        """I campi calcolati in memoria coincidono con quelli ricostruiti da django-mptt."""
+        modello = type(radice)
+        campi = lambda: list(modello.objects.filter(tree_id=radice.tree_id).order_by('pk').values_list('lft', 'rght', 'level'))
+        prima = campi()
+        modello.objects.partial_rebuild(radice.tree_id)
+        self.assertEqual(prima, campi())
+
+    def test_applica_template_con_espansione_componenti(self):
+        with memo.misura() as aggregazioni, self.captureOnCommitCallbacks(execute=True):
+            asset = Asset.objects.create(nome="Asset", template_da_applicare=self.template)
+        self.assertEqual(self._struttura(asset), [
+            (0, "root", None, "Asset"),
+            (1, "db", "root", ""),
+            (2, "database", "db", "database"),
+            (2, "schema", "db", "schema"),
+            (1, "server", "root", ""),
+        ])
+        self._verifica_mptt(asset.nodi_struttura.get(level=0))
+        self.assertEqual(aggregazioni, {'radice.differita': 1, 'radice.miss': 1})
+        self.assertEqual(sorted(valore for _, _, valore in asset.get_matrice().celle()), [0.1, 0.2, 0.3])
+        self.assertFalse(self.root.valori_matrice.exists())
+        # Storico per operazione: nessuna riga storica per nodo, un'operazione con i nodi creati
+        self.assertFalse(NodoStruttura.history.filter(asset=asset).exists())
+        operazione = OperazioneMassiva.objects.get(descrizione=f"Applicato il template {self.template.nome}")
+        self.assertEqual(set(operazione.oggetti(NodoStruttura)), set(asset.nodi_struttura.all()))
+
+        # I nodi aggiunti dopo l'inserimento in blocco si inseriscono correttamente nell'albero
+        radice = asset.nodi_struttura.get(level=0)
+        nuovo = NodoStruttura.objects.create(asset=asset, element_type=self.database, parent=radice)
+        radice.refresh_from_db()
+        self.assertEqual(radice.get_descendant_count(), 5)
+        self.assertEqual(list(nuovo.get_ancestors()), [radice])
+        nodo_db = asset.nodi_struttura.get(element_type=self.db)
+        self.assertEqual(
+            sorted(nodo_db.get_descendants().values_list('element_type__nome', flat=True)), ["database", "schema"]
+        )
+
+    def test_query_indipendenti_dalla_dimensione_del_template(self):
+        def query_per_asset(nome, num_derivati):
+            template = StrutturaTemplate.objects.create(nome=nome)
+            radice = NodoTemplate.objects.create(
+                template=template, element_type=ElementType.objects.create(nome=f"root {nome}", is_base=False)
+            )
+            for i in range(num_derivati):
+                derivato = ElementType.objects.create(nome=f"{nome} db {i}", is_base=False)
+                derivato.component_element_types.set([self.database, self.schema])
+                NodoTemplate.objects.create(template=template, element_type=derivato, parent=radice)
+            NodoTemplate.objects.create(template=template, element_type=self.server, parent=radice)
+            with CaptureQueriesContext(connection) as query, self.captureOnCommitCallbacks(execute=True):
+                asset = Asset.objects.create(nome=nome, template_da_applicare=template)
+            self.assertEqual(asset.nodi_struttura.count(), 2 + 3 * num_derivati)
+            return len(query)
+
+        self.assertEqual(query_per_asset("Grande", 30), query_per_asset("Piccolo", 1))
+
+    def test_espansione_componenti_in_blocco(self):
+        piattaforma = ElementType.objects.create(nome="piattaforma", is_base=False)
+        piattaforma.component_element_types.add(self.db)
+        piattaforma.component_element_types.add(self.server)
+        ElementType.objects.aggregazione(piattaforma, [self.db, self.server])
+        with self.captureOnCommitCallbacks(execute=True):
+            asset = Asset.objects.create(nome="Asset")
+            radice = asset.nodi_struttura.get(level=0)
+            nodo = NodoStruttura.objects.create(asset=asset, element_type=piattaforma, parent=radice)
+        self.assertEqual(self._struttura(asset), [
+            (0, "root", None, "Asset"),
+            (1, "piattaforma", "root", ""),
+            (2, "db", "piattaforma", "db"),
+            (3, "database", "db", "database"),
+            (3, "schema", "db", "schema"),
+            (2, "server", "piattaforma", "server"),
+        ])
+        self.assertEqual(nodo.get_descendant_count(), 4)
+        self._verifica_mptt(radice)
+        self.assertEqual(NodoStruttura.history.filter(asset=asset, history_type='+').count(), 6)
+        self.assertEqual(sorted(valore for _, _, valore in asset.get_matrice().celle()), [0.1, 0.2, 0.3])
+
+        # Gli inserimenti successivi nello stesso albero restano coerenti
+        altro = NodoStruttura.objects.create(asset=asset, element_type=self.db, parent=radice)
+        radice.refresh_from_db()
+        nodo.refresh_from_db()
+        self.assertEqual(radice.get_descendant_count(), 8)
+        self.assertEqual(nodo.get_descendant_count(), 4)
+        self.assertEqual(
+            sorted(altro.get_descendants().values_list('element_type__nome', flat=True)), ["database", "schema"]
+        )
+
+    def test_query_espansione_indipendenti_dalla_profondita(self):
+        def query_per_nodo(nome, profondita):
+            # Catena di derivati: ogni livello include il precedente e un tipo di base
+            derivato = self.db
+            for i in range(profondita):
+                successivo = ElementType.objects.create(nome=f"{nome} {i}", is_base=False)
+                successivo.component_element_types.set([derivato, self.server])
+                derivato = successivo
+            with self.captureOnCommitCallbacks(execute=True):
+                asset = Asset.objects.create(nome=nome)
+            radice = asset.nodi_struttura.get(level=0)
+            with CaptureQueriesContext(connection) as query:
+                NodoStruttura.objects.create(asset=asset, element_type=derivato, parent=radice)
+            self.assertEqual(asset.nodi_struttura.count(), 1 + 2 * profondita + 3)
+            self._verifica_mptt(radice)
+            return len(query)
+
+        self.assertEqual(query_per_nodo("Profonda", 8), query_per_nodo("Corta", 1))
+
+    def test_clona_asset_con_nodi_derivati(self):
+        sorgente = Asset.objects.create(nome="Sorgente", template_da_applicare=self.template)
+        NodoStruttura.objects.filter(asset=sorgente, element_type=self.server).update(nome_specifico="srv-01")
+        clone = Asset.objects.create(nome="Clone", cloned_from=sorgente)
+        atteso = [(0, "root", None, "Clone")] + self._struttura(sorgente)[1:]
+        self.assertEqual(self._struttura(clone), atteso)
+        self._verifica_mptt(clone.nodi_struttura.get(level=0))
+
+    def test_clona_template(self):
+        clone = StrutturaTemplate.objects.create(nome="Clone", cloned_from=self.template)
+        self.assertEqual(
+            list(clone.nodi_template.order_by('lft').values_list('level', 'element_type__nome')),
+            [(0, "root"), (1, "db"), (1, "server")],
+        )
+        self._verifica_mptt(clone.nodi_template.get(level=0))
@@ -0,0 +1,99 @@
+from django.test import TestCase
+
+from core.testing import RichiesteAutenticate
+from elementtypes.models import ElementType
+from .models import Asset, NodoStruttura, NodoTemplate, StrutturaTemplate
+from .views import AssetViewSet, StrutturaTemplateViewSet
+
+
+class LetturaAlberoTest(TestCase):
+
+    def setUp(self):
+        self.database = ElementType.objects.create(nome="database")
+        self.schema = ElementType.objects.create(nome="schema")
+        self.db = ElementType.objects.create(nome="db", is_base=False)
+        self.db.component_element_types.set([self.database])
+        self.db.component_element_types.add(self.schema)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.asset = Asset.objects.create(nome="Asset")
+            self.radice = self.asset.nodi_struttura.get(level=0)
+            self.nodo_db = NodoStruttura.objects.create(asset=self.asset, element_type=self.db, parent=self.radice)
+        self.vista = AssetViewSet.as_view({'get': 'albero'})
+
+    def _leggi(self, vista=None, pk=None, **intestazioni):
+        return (vista or self.vista)(RichiesteAutenticate().get('/', **intestazioni), pk=pk or self.asset.pk)
+
+    def _riassunto(self, nodi):
+        return [(nodo['element_type']['nome'], self._riassunto(nodo['children'])) for nodo in nodi]
+
+    def test_albero_annidato(self):
+        with self.assertNumQueries(2):
+            risposta = self._leggi()
+        self.assertEqual(risposta.status_code, 200)
+        [radice] = risposta.data['nodi']
+        self.assertEqual(radice['id'], self.radice.pk)
+        self.assertEqual(radice['nome_specifico'], "Asset")
+        self.assertEqual(radice['element_type'], {'id': self.radice.element_type_id, 'nome': "root", 'is_base': False})
+        self.assertEqual(self._riassunto(risposta.data['nodi']), [
+            ("root", [("db", [("database", []), ("schema", [])])]),
+        ])
+        self.assertEqual(radice['children'][0]['children'][1]['parent'], self.nodo_db.pk)
+
+    def test_albero_invariato_304(self):
+        etag = self._leggi()['ETag']
+        with self.assertNumQueries(1):
+            risposta = self._leggi(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(risposta.status_code, 304)
+
+    def test_modifiche_cambiano_etag(self):
+        etag = self._leggi()['ETag']
+
+        def cambiato():
+            nonlocal etag
+            nuovo = self._leggi(HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(nuovo.status_code, 200)
+            etag = nuovo['ETag']
+
+        with self.captureOnCommitCallbacks(execute=True):
+            server = ElementType.objects.create(nome="server")
+            nodo = NodoStruttura.objects.create(asset=self.asset, element_type=server, parent=self.radice)
+        cambiato()
+        nodo.move_to(self.nodo_db, 'last-child')
+        cambiato()
+        with self.captureOnCommitCallbacks(execute=True):
+            nodo.delete()
+        cambiato()
+        self.schema.nome = "schema logico"
+        self.schema.save()
+        cambiato()
+        self.asset.nome = "Asset rinominato"
+        self.asset.save()
+        cambiato()
+        self.assertEqual(self._leggi(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_salvataggio_dell_asset_non_riporta_indietro_la_versione(self):
+        letto = Asset.objects.get(pk=self.asset.pk)
+        etag = self._leggi()['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            server = ElementType.objects.create(nome="server")
+            NodoStruttura.objects.create(asset=self.asset, element_type=server, parent=self.radice)
+        versione = Asset.objects.get(pk=self.asset.pk).versione_albero
+        # L'istanza letta prima della modifica ai nodi ha un contatore superato
+        letto.nome = "Asset rinominato"
+        letto.save()
+        self.assertGreater(Asset.objects.get(pk=self.asset.pk).versione_albero, versione)
+        self.assertEqual(letto.versione_albero, Asset.objects.get(pk=self.asset.pk).versione_albero)
+        self.assertEqual(self._leggi(HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_albero_template(self):
+        template = StrutturaTemplate.objects.create(nome="Template")
+        radice = NodoTemplate.objects.create(template=template, element_type=self.radice.element_type)
+        NodoTemplate.objects.create(template=template, element_type=self.db, parent=radice)
+        vista = StrutturaTemplateViewSet.as_view({'get': 'albero'})
+        risposta = self._leggi(vista, template.pk)
+        self.assertEqual(self._riassunto(risposta.data['nodi']), [("root", [("db", [])])])
+        self.assertNotIn('nome_specifico', risposta.data['nodi'][0])
+
+        clone = StrutturaTemplate.objects.create(nome="Clone", cloned_from=template)
+        self.assertEqual(self._riassunto(self._leggi(vista, clone.pk).data['nodi']), [("root", [("db", [])])])
+        self.assertNotEqual(self._leggi(vista, clone.pk)['ETag'], risposta['ETag'])
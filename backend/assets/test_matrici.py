@@ -0,0 +1,119 @@
+from django.test import TestCase
+
+from controlli.models import Controllo
+from core.testing import RichiesteAutenticate
+from elementtypes import memo
+from elementtypes.models import ElementType, ValoreElementType
+from minacce.models import Minaccia
+from scenari.models import Scenario
+from .models import Asset, MatriceAsset, NodoStruttura
+from .views import AssetViewSet, NodoStrutturaViewSet
+
+
+class MatriceAssetTest(TestCase):
+
+    def setUp(self):
+        scenario = Scenario.objects.create(descrizione="Scenario")
+        self.minaccia = Minaccia.objects.create(descrizione="M", scenario=scenario)
+        self.basi, self.controlli = [], []
+        for k in range(2):
+            base = ElementType.objects.create(nome=f"base {k}")
+            base.minacce.set([self.minaccia])
+            controllo = Controllo.objects.create(
+                nome=f"C{k}", descrizione="", tipologia_controllo="Tecnologico",
+                categoria_controllo="preventive", elementtype=base,
+            )
+            ValoreElementType.objects.create(elementtype=base, minaccia=self.minaccia, controllo=controllo, valore=0.4 + 0.2 * k)
+            self.basi.append(base)
+            self.controlli.append(controllo)
+
+        # Due asset con lo stesso ElementType "root" del master e figli diversi
+        with self.captureOnCommitCallbacks(execute=True):
+            self.asset_a = Asset.objects.create(nome="A")
+            self.asset_b = Asset.objects.create(nome="B")
+            for asset, base in ((self.asset_a, self.basi[0]), (self.asset_b, self.basi[1])):
+                NodoStruttura.objects.create(asset=asset, element_type=base, parent=asset.nodi_struttura.get(level=0))
+
+    def _celle(self, asset):
+        return sorted(asset.get_matrice().celle())
+
+    def test_matrici_indipendenti_per_asset(self):
+        radice_a, radice_b = (asset.nodi_struttura.get(level=0) for asset in (self.asset_a, self.asset_b))
+        self.assertEqual(radice_a.element_type_id, radice_b.element_type_id)
+        self.assertEqual(self._celle(self.asset_a), [(self.minaccia.pk, self.controlli[0].pk, 0.4)])
+        self.assertEqual(self._celle(self.asset_b), [(self.minaccia.pk, self.controlli[1].pk, 0.6)])
+        self.assertFalse(radice_a.element_type.valori_matrice.exists())
+
+        # Ri-aggregare un asset non tocca la matrice dell'altro
+        prima_b = MatriceAsset.objects.get(asset=self.asset_b).aggiornata_il
+        MatriceAsset.objects.filter(asset=self.asset_a).update(impronta_input='')
+        with memo.misura() as delta:
+            radice_a.aggregate_root_node_matrix()
+        self.assertEqual(delta, {'radice.miss': 1, 'radice.scrittura_evitata': 1})
+        self.assertEqual(MatriceAsset.objects.get(asset=self.asset_b).aggiornata_il, prima_b)
+        self.assertEqual(self._celle(self.asset_b), [(self.minaccia.pk, self.controlli[1].pk, 0.6)])
+
+    def test_dimensione_dai_contatori(self):
+        asset = Asset.objects.select_related('matrice_aggregata').get(pk=self.asset_a.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(asset.get_dimensione_matrice_display(), "1 x 1")
+        self.assertEqual(Asset.objects.create(nome="Vuoto").get_dimensione_matrice_display(), "N/D (Root Aggregato)")
+
+    def test_endpoint_matrice(self):
+        vista = AssetViewSet.as_view({'get': 'matrice'})
+        risposta = vista(RichiesteAutenticate().get('/'), pk=self.asset_b.pk)
+        self.assertEqual(risposta.data, {
+            'minacce': [self.minaccia.pk], 'controlli': [self.controlli[1].pk], 'valori': [[0.6]],
+        })
+
+
+class MatriceSottoalberoTest(TestCase):
+
+    def setUp(self):
+        scenario = Scenario.objects.create(descrizione="Scenario")
+        self.minacce = [Minaccia.objects.create(descrizione=f"M{i}", scenario=scenario) for i in range(2)]
+        self.basi, self.controlli = [], []
+        for k in range(3):
+            base = ElementType.objects.create(nome=f"base {k}")
+            base.minacce.set(self.minacce)
+            controllo = Controllo.objects.create(
+                nome=f"C{k}", descrizione="", tipologia_controllo="Tecnologico",
+                categoria_controllo="preventive", elementtype=base,
+            )
+            ValoreElementType.objects.create(elementtype=base, minaccia=self.minacce[0], controllo=controllo, valore=(0.2, 0.4, 0.6)[k])
+            self.basi.append(base)
+            self.controlli.append(controllo)
+        # Strato "database" = base 0 + base 1, più base 2 direttamente sotto la radice
+        self.database = ElementType.objects.create(nome="database", is_base=False)
+        self.database.component_element_types.set(self.basi[:2])
+        ElementType.objects.aggregazione(self.database, self.basi[:2])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.asset = Asset.objects.create(nome="Asset")
+            self.radice = self.asset.nodi_struttura.get(level=0)
+            self.strato = NodoStruttura.objects.create(asset=self.asset, element_type=self.database, parent=self.radice)
+            NodoStruttura.objects.create(asset=self.asset, element_type=self.basi[2], parent=self.radice)
+        self.strato.refresh_from_db()
+        self.radice.refresh_from_db()
+
+    def test_strato_intermedio(self):
+        with self.assertNumQueries(1):
+            matrice = self.strato.get_matrice_sottoalbero()
+        self.assertEqual(sorted(matrice.celle()), [
+            (self.minacce[0].pk, self.controlli[0].pk, 0.2), (self.minacce[0].pk, self.controlli[1].pk, 0.4),
+        ])
+        foglia = self.asset.nodi_struttura.get(element_type=self.basi[0])
+        self.assertEqual(list(foglia.get_matrice_sottoalbero().celle()), [(self.minacce[0].pk, self.controlli[0].pk, 0.2)])
+
+    def test_radice_coincide_con_matrice_asset(self):
+        self.assertEqual(sorted(self.radice.get_matrice_sottoalbero().celle()), sorted(self.asset.get_matrice().celle()))
+        self.assertEqual(
+            ElementType.get_aggregated_matrix_values(self.basi),
+            {(self.minacce[0].pk, controllo.pk): valore for controllo, valore in zip(self.controlli, (0.2, 0.4, 0.6))},
+        )
+
+    def test_endpoint_matrice_nodo(self):
+        vista = NodoStrutturaViewSet.as_view({'get': 'matrice'})
+        risposta = vista(RichiesteAutenticate().get('/'), pk=self.strato.pk)
+        self.assertEqual(risposta.data, {
+            'minacce': [self.minacce[0].pk], 'controlli': [c.pk for c in self.controlli[:2]], 'valori': [[0.2, 0.4]],
+        })
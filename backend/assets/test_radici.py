@@ -0,0 +1,115 @@
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
+
+from controlli.models import Controllo
+from elementtypes import memo
+from elementtypes.models import ElementType, ValoreElementType
+from minacce.models import Minaccia
+from scenari.models import Scenario
+from .models import Asset, NodoStruttura
+from .radici import aggregazione_differita
+
+
+class _Dati:
+
+    def _crea_dati(self):
+        scenario = Scenario.objects.create(descrizione="Scenario")
+        minaccia = Minaccia.objects.create(descrizione="M", scenario=scenario)
+        self.basi = []
+        for k in range(3):
+            base = ElementType.objects.create(nome=f"base {k}")
+            base.minacce.set([minaccia])
+            controllo = Controllo.objects.create(
+                nome=f"C{k}", descrizione="", tipologia_controllo="Tecnologico",
+                categoria_controllo="preventive", elementtype=base,
+            )
+            ValoreElementType.objects.create(elementtype=base, minaccia=minaccia, controllo=controllo, valore=0.1 * (k + 1))
+            self.basi.append(base)
+        self.derivato = ElementType.objects.create(nome="derivato", is_base=False)
+        self.derivato.component_element_types.set(self.basi[:2])
+        ElementType.objects.aggregazione(self.derivato, self.basi[:2])
+
+    def _valori_radice(self, asset):
+        return sorted(valore for _, _, valore in asset.get_matrice().celle())
+
+
+class AggregazioneDifferitaTest(_Dati, TestCase):
+
+    def setUp(self):
+        self._crea_dati()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.asset = Asset.objects.create(nome="Asset")
+        self.radice = self.asset.nodi_struttura.get(level=0)
+
+    def test_salvataggi_accorpati_in_una_aggregazione(self):
+        with memo.misura() as delta, self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with aggregazione_differita():
+                NodoStruttura.objects.create(asset=self.asset, element_type=self.derivato, parent=self.radice)
+                NodoStruttura.objects.create(asset=self.asset, element_type=self.basi[2], parent=self.radice)
+                # Nessuna aggregazione prima del commit
+                self.assertEqual(self._valori_radice(self.asset), [])
+        # Una sola callback per la transazione
+        self.assertEqual(len(callbacks), 1)
+        # 2 salvataggi (derivato con i componenti inseriti in blocco, base 2) e una sola aggregazione
+        self.assertEqual(delta, {'radice.differita': 1, 'radice.accorpata': 1, 'radice.miss': 1})
+        self.assertEqual(self._valori_radice(self.asset), [0.1, 0.2, 0.3])
+
+    def test_rollback_non_aggrega(self):
+        with memo.misura() as delta, self.captureOnCommitCallbacks(execute=True) as callbacks:
+            try:
+                with transaction.atomic():
+                    NodoStruttura.objects.create(asset=self.asset, element_type=self.basi[2], parent=self.radice)
+                    raise RuntimeError()
+            except RuntimeError:
+                pass
+        self.assertEqual(callbacks, [])
+        self.assertNotIn('radice.miss', delta)
+
+        # Le annotazioni successive al rollback registrano una nuova callback
+        with self.captureOnCommitCallbacks(execute=True):
+            NodoStruttura.objects.create(asset=self.asset, element_type=self.basi[0], parent=self.radice)
+        self.assertEqual(self._valori_radice(self.asset), [0.1])
+
+    def test_rollback_di_un_savepoint(self):
+        # La radice annotata nel savepoint annullato viene annotata di nuovo fuori: l'aggregazione resta
+        with self.captureOnCommitCallbacks(execute=True), transaction.atomic():
+            try:
+                with transaction.atomic():
+                    NodoStruttura.objects.create(asset=self.asset, element_type=self.basi[2], parent=self.radice)
+                    raise RuntimeError()
+            except RuntimeError:
+                pass
+            NodoStruttura.objects.create(asset=self.asset, element_type=self.basi[0], parent=self.radice)
+        self.assertEqual(self._valori_radice(self.asset), [0.1])
+
+
+class AggregazioneAlCommitTest(_Dati, TransactionTestCase):
+
+    def setUp(self):
+        self._crea_dati()
+
+    def test_fuori_transazione_immediata(self):
+        asset = Asset.objects.create(nome="Asset")
+        NodoStruttura.objects.create(asset=asset, element_type=self.basi[2], parent=asset.nodi_struttura.get(level=0))
+        self.assertEqual(self._valori_radice(asset), [0.3])
+
+    def test_al_commit_del_blocco(self):
+        with aggregazione_differita():
+            asset = Asset.objects.create(nome="Asset")
+            NodoStruttura.objects.create(asset=asset, element_type=self.derivato, parent=asset.nodi_struttura.get(level=0))
+            self.assertEqual(self._valori_radice(asset), [])
+        self.assertEqual(self._valori_radice(asset), [0.1, 0.2])
+
+    def test_transazione_annullata_scarta_le_radici_annotate(self):
+        asset = Asset.objects.create(nome="Asset")
+        radice = asset.nodi_struttura.get(level=0)
+        try:
+            with transaction.atomic():
+                NodoStruttura.objects.create(asset=asset, element_type=self.basi[2], parent=radice)
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+        # La transazione successiva registra una nuova callback
+        with aggregazione_differita():
+            NodoStruttura.objects.create(asset=asset, element_type=self.basi[0], parent=radice)
+        self.assertEqual(self._valori_radice(asset), [0.1])
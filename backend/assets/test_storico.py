@@ -0,0 +1,94 @@
+from django.test import TestCase
+from django.utils import timezone
+
+from core.models import OperazioneMassiva, VoceOperazione
+from core.testing import RichiesteAutenticate
+from elementtypes.models import ElementType
+from .models import Asset, NodoStruttura
+from .storico import albero_al
+from .views import AssetViewSet
+
+
+class AlberoAllaDataTest(TestCase):
+
+    def setUp(self):
+        self.database = ElementType.objects.create(nome="database")
+        self.schema = ElementType.objects.create(nome="schema")
+        self.db = ElementType.objects.create(nome="db", is_base=False)
+        self.db.component_element_types.set([self.database, self.schema])
+        self.prima = timezone.now()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.asset = Asset.objects.create(nome="Asset")
+            self.radice = self.asset.nodi_struttura.get(level=0)
+            # I componenti di db sono inseriti da un'operazione massiva, senza storico per riga
+            self.nodo_db = NodoStruttura.objects.create(asset=self.asset, element_type=self.db, parent=self.radice)
+        self.creazione = timezone.now()
+
+    def _riassunto(self, nodi):
+        return [
+            (nodo['nome_specifico'] or nodo['element_type']['nome'], self._riassunto(nodo['children']))
+            for nodo in nodi
+        ]
+
+    def _albero(self, quando):
+        return self._riassunto(albero_al(self.asset, 'nodi_struttura', quando, ('nome_specifico',)))
+
+    def test_ricostruzione_alla_data(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            server = NodoStruttura.objects.create(asset=self.asset, element_type=self.database, parent=self.radice)
+            self.nodo_db.nome_specifico = "Database clienti"
+            self.nodo_db.save()
+        self.database.nome = "database relazionale"
+        self.database.save()
+        modifica = timezone.now()
+        with self.captureOnCommitCallbacks(execute=True):
+            server.delete()
+            self.nodo_db.children.get(element_type=self.schema).delete()
+
+        self.assertEqual(self._albero(self.prima), [])
+        self.assertEqual(self._albero(self.creazione), [
+            ("Asset", [("db", [("database", []), ("schema", [])])]),
+        ])
+        self.assertEqual(self._albero(modifica), [
+            ("Asset", [("Database clienti", [("database", []), ("schema", [])]), ("database relazionale", [])]),
+        ])
+        self.assertEqual(self._albero(timezone.now()), [
+            ("Asset", [("Database clienti", [("database", [])])]),
+        ])
+        [radice] = albero_al(self.asset, 'nodi_struttura', self.creazione, ('nome_specifico',))
+        componente = radice['children'][0]['children'][0]
+        self.assertEqual((radice['level'], componente['level']), (0, 2))
+        self.assertEqual(componente['element_type'], {'id': self.database.pk, 'nome': "database", 'is_base': True})
+        self.assertEqual(radice['children'][0]['parent'], self.radice.pk)
+
+    def test_molte_operazioni(self):
+        # Voci di altre operazioni i cui estremi comprendono i nodi dell'asset, ma non i loro intervalli
+        ids = sorted(self.asset.nodi_struttura.values_list('id', flat=True))
+        operazioni = OperazioneMassiva.objects.bulk_create(
+            OperazioneMassiva(descrizione=f"Template {k}", avviata_il=self.prima, terminata_il=self.prima, righe=2)
+            for k in range(1100)
+        )
+        VoceOperazione.objects.bulk_create(
+            VoceOperazione(
+                operazione=operazione, modello="assets.NodoStruttura", tipo=tipo, intervalli=[[ids[-1] + k, ids[-1] + k]],
+                primo_id=ids[0] - 1 if k % 2 else ids[-1] + k, ultimo_id=ids[-1] + k, righe=1,
+            )
+            for k, operazione in enumerate(operazioni, start=1) for tipo in '+-'
+        )
+        with self.assertNumQueries(6):  # il numero di query non dipende dalle operazioni
+            albero = self._albero(timezone.now())
+        self.assertEqual(albero, [("Asset", [("db", [("database", []), ("schema", [])])])])
+
+    def test_endpoint_albero_al(self):
+        vista = AssetViewSet.as_view({'get': 'albero'})
+        risposta = vista(RichiesteAutenticate().get('/', {'al': self.prima.isoformat()}), pk=self.asset.pk)
+        self.assertEqual(risposta.status_code, 200)
+        self.assertEqual(risposta.data['nodi'], [])
+        self.assertNotIn('ETag', risposta)
+
+        risposta = vista(RichiesteAutenticate().get('/', {'al': self.creazione.isoformat()}), pk=self.asset.pk)
+        self.assertEqual(self._riassunto(risposta.data['nodi']), [
+            ("Asset", [("db", [("database", []), ("schema", [])])]),
+        ])
+        risposta = vista(RichiesteAutenticate().get('/', {'al': "ieri"}), pk=self.asset.pk)
+        self.assertEqual(risposta.status_code, 400)
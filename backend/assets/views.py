@@ -1,15 +1,88 @@
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
 from rest_framework import viewsets
+from rest_framework.decorators import action
+from rest_framework.response import Response
+from campagne.istantanea import leggi
+from campagne.models import VoceIstantanea
+from core.api import ApiMixin
+from core.views import parametro_al
+from elementtypes.serializers import formato_richiesto, matrice_serializzata
 from .models import Asset, NodoStruttura, StrutturaTemplate
-from .serializers import AssetSerializer, NodoStrutturaSerializer, StrutturaTemplateSerializer
+from .serializers import AssetSerializer, NodoStrutturaSerializer, StrutturaTemplateSerializer, albero_annidato
+from .storico import albero_al
 
-class AssetViewSet(viewsets.ModelViewSet):
+class AlberoMixin:
+    """
+    Azione `albero`: l'intero albero dei nodi come JSON annidato. L'ETag deriva dal contatore
+    `versione_albero` del proprietario, quindi una richiesta con If-None-Match di un albero
+    invariato riceve 304 dopo la sola lettura del proprietario. Nelle campagne chiuse i nodi
+    sono letti dall'istantanea precalcolata. Con `?al=<data>` restituisce l'albero com'era a
+    quella data, ricostruito dallo storico (senza ETag).
+    """
+    relazione_nodi = None
+    campi_nodo = ()
+    tipo_istantanea = None
+
+    @action(detail=True, methods=['get'])
+    def albero(self, request, pk=None, **kwargs):
+        proprietario = self.get_object()
+        quando = parametro_al(request)
+        if quando is not None:
+            return Response({
+                'id': proprietario.pk,
+                'al': quando,
+                'nodi': albero_al(proprietario, self.relazione_nodi, quando, self.campi_nodo),
+            })
+        etag = quote_etag(f"{proprietario._meta.model_name}-{proprietario.pk}-{proprietario.versione_albero}")
+        non_modificato = get_conditional_response(request, etag=etag)
+        if non_modificato is not None:
+            return non_modificato
+        voce = leggi(self.tipo_istantanea, proprietario, getattr(self.campagna_richiesta, 'pk', None))
+        risposta = Response({
+            'id': proprietario.pk,
+            'versione': proprietario.versione_albero,
+            'nodi': voce.dati if voce is not None else albero_annidato(
+                getattr(proprietario, self.relazione_nodi).all(), self.campi_nodo),
+        })
+        risposta['ETag'] = etag
+        return risposta
+
+class AssetViewSet(ApiMixin, AlberoMixin, viewsets.ModelViewSet):
     queryset = Asset.objects.all()
     serializer_class = AssetSerializer
+    relazione_nodi = 'nodi_struttura'
+    campi_nodo = ('nome_specifico',)
+    tipo_istantanea = VoceIstantanea.ALBERO_ASSET
+    # AssetSerializer legge lo username dei due responsabili
+    select_related_per_azione = {
+        azione: ('utente_responsabile', 'responsabile_applicativo') for azione in ('list', 'retrieve')
+    }
 
-class NodoStrutturaViewSet(viewsets.ModelViewSet):
+    @action(detail=True, methods=['get'])
+    def matrice(self, request, pk=None, **kwargs):
+        """Matrice aggregata dell'asset letta dalla sua riga precalcolata: id di righe e colonne e valori (`?formato=coo`: solo le celle valorizzate)."""
+        formato = formato_richiesto(request)
+        return Response(matrice_serializzata(self.get_object().get_matrice(), formato))
+
+class NodoStrutturaViewSet(ApiMixin, viewsets.ModelViewSet):
     queryset = NodoStruttura.objects.all()
     serializer_class = NodoStrutturaSerializer
+    campo_proprietario = 'asset'
+    # NodoStrutturaSerializer legge il nome del tipo; NodoStruttura.save anche l'asset e il tipo del genitore
+    select_related_per_azione = {
+        **{azione: ('element_type',) for azione in ('list', 'retrieve')},
+        **{azione: ('asset', 'element_type', 'parent__element_type') for azione in ('update', 'partial_update')},
+    }
+
+    @action(detail=True, methods=['get'])
+    def matrice(self, request, pk=None, **kwargs):
+        """Matrice aggregata del sottoalbero del nodo (MAX sulle celle dei discendenti): id di righe e colonne e valori (`?formato=coo`: solo le celle valorizzate)."""
+        formato = formato_richiesto(request)
+        return Response(matrice_serializzata(self.get_object().get_matrice_sottoalbero(), formato))
 
-class StrutturaTemplateViewSet(viewsets.ModelViewSet):
+class StrutturaTemplateViewSet(ApiMixin, AlberoMixin, viewsets.ModelViewSet):
     queryset = StrutturaTemplate.objects.all()
-    serializer_class = StrutturaTemplateSerializer
\ No newline at end of file
+    serializer_class = StrutturaTemplateSerializer
+    relazione_nodi = 'nodi_template'
+    tipo_istantanea = VoceIstantanea.ALBERO_TEMPLATE
@@ -1,19 +1,20 @@
 from django.contrib import admin, messages
 from import_export.admin import ImportExportModelAdmin
 from simple_history.admin import SimpleHistoryAdmin
-from .models import Campagna
+from .models import Campagna, PopolamentoCampagna
 from datetime import date
 from django.utils.html import format_html
 from django.urls import reverse
 from django.urls import path # Import path for custom admin URLs
 from core.admin_mixins import CustomDeleteActionMixin
-from .views import campagna_dashboard_view # Import the custom view
+from .views import campagna_dashboard_view, campagna_popolamento_view # Import the custom views
 
 @admin.register(Campagna) # Removed MasterAdminMixin
 class CampagnaAdmin(CustomDeleteActionMixin, ImportExportModelAdmin, SimpleHistoryAdmin):
-    list_display = ('anno', 'descrizione', 'status', 'data_inizio', 'data_fine', 'dashboard_link', 'delete_button')
-    list_filter = ('anno', 'status') # Removed MasterCampaignFilter
+    list_display = ('anno', 'descrizione', 'status', 'pronta', 'copia_su_scrittura', 'data_inizio', 'data_fine', 'dashboard_link', 'delete_button')
+    list_filter = ('anno', 'status', 'copia_su_scrittura') # Removed MasterCampaignFilter
     search_fields = ('anno', 'descrizione')
+    actions = ['riaccoda_popolamento', 'rigenera_istantanea']
     
 
 
@@ -22,11 +23,34 @@ class CampagnaAdmin(CustomDeleteActionMixin, ImportExportModelAdmin, SimpleHisto
         return format_html('<a href="{}">Accedi al Dashboard</a>', url)
     dashboard_link.short_description = 'Dashboard'
 
+    @admin.action(description="Ripeti il popolamento delle campagne non pronte")
+    def riaccoda_popolamento(self, request, queryset):
+        from .lavori import accoda_popolamento, recupera_interrotti
+
+        # I lavori rimasti in corso da un worker interrotto non bloccano la ripetizione
+        recupera_interrotti()
+        attivi = (PopolamentoCampagna.IN_CODA, PopolamentoCampagna.IN_CORSO)
+        campagne = queryset.filter(pronta=False).exclude(popolamenti__stato__in=attivi)
+        for campagna in campagne:
+            accoda_popolamento(campagna)
+        self.message_user(request, f"Popolamento accodato per {len(campagne)} campagne.", messages.INFO)
+
+    @admin.action(description="Rigenera l'istantanea delle campagne chiuse")
+    def rigenera_istantanea(self, request, queryset):
+        from .istantanea import crea_istantanea
+
+        campagne = queryset.filter(status='close')
+        for campagna in campagne:
+            crea_istantanea(campagna)
+        self.message_user(request, f"Istantanea rigenerata per {len(campagne)} campagne.", messages.INFO)
+
     def get_urls(self):
         urls = super().get_urls()
         custom_urls = [
             # Registra la vista dashboard sotto l'URL dell'admin per questa campagna
             path('<int:campagna_id>/dashboard/', self.admin_site.admin_view(campagna_dashboard_view), name='campagne_campagna_dashboard'),
+            # Avanzamento del popolamento in JSON, letto periodicamente dal dashboard
+            path('<int:campagna_id>/popolamento/', self.admin_site.admin_view(campagna_popolamento_view), name='campagne_campagna_popolamento'),
         ]
 
         # Filter out any unnamed generic object_id patterns that might conflict.
@@ -45,14 +69,36 @@ class CampagnaAdmin(CustomDeleteActionMixin, ImportExportModelAdmin, SimpleHisto
         if obj and obj.status == 'close':
             # Rende tutti i campi readonly tranne lo status per poterla riaprire se necessario
             return [field.name for field in self.model._meta.fields if field.name != 'status']
+        if obj:
+            # La modalità di popolamento si sceglie solo alla creazione
+            return [*super().get_readonly_fields(request, obj), 'copia_su_scrittura']
         return super().get_readonly_fields(request, obj)
 
     def save_model(self, request, obj, form, change):
         """
-        Sovrascrive save_model per mostrare un messaggio di successo
-        dopo la creazione e il popolamento automatico di una nuova campagna.
+        Sovrascrive save_model per eseguire in background il popolamento automatico
+        di una nuova campagna (vedi `lavori.py`) e indicare dove seguirne l'avanzamento.
         """
         is_new = obj.pk is None
+        obj.popolamento_in_background = is_new
         super().save_model(request, obj, form, change)
-        if is_new:
-            messages.success(request, "Campagna creata e popolata con successo dai dati master.")
+        if is_new and obj.copia_su_scrittura:
+            messages.info(request, "Campagna a copia su scrittura creata: i dati master vengono copiati "
+                                   "nella campagna solo quando vi si modificano.")
+        elif is_new:
+            url = reverse('admin:campagne_campagna_dashboard', args=[obj.pk])
+            messages.info(request, format_html(
+                'Campagna creata: il popolamento dai dati master è in corso in background. '
+                '<a href="{}">Segui l\'avanzamento dal dashboard</a>.', url
+            ))
+
+
+@admin.register(PopolamentoCampagna)
+class PopolamentoCampagnaAdmin(admin.ModelAdmin):
+    list_display = ('campagna', 'stato', 'fasi_completate', 'fasi_totali', 'creato_il', 'iniziato_il', 'terminato_il')
+    list_filter = ('stato',)
+    list_select_related = ('campagna',)
+    readonly_fields = [field.name for field in PopolamentoCampagna._meta.fields]
+
+    def has_add_permission(self, request):
+        return False
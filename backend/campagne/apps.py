@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class CampagneConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'campagne'
+
+    def ready(self):
+        from . import signals  # noqa: F401 - registra i receiver
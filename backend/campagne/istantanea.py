@@ -0,0 +1,185 @@
+"""
+Modello di lettura precalcolato delle campagne chiuse (`IstantaneaCampagna`).
+
+Una campagna chiusa non cambia più, ma le sue letture ricalcolavano a ogni
+richiesta unioni ricorsive di minacce e controlli, matrici dei sottoalberi
+(MAX ... GROUP BY sui nodi), alberi annidati e conteggi del dashboard. Alla
+chiusura (`Campagna.save`) tutto questo viene calcolato una volta e scritto
+come istantanea: una `VoceIstantanea` per ElementType, asset, nodo e albero
+della campagna (master visibili incluse nelle campagne a copia su scrittura),
+più i conteggi. Le letture (`leggi`) fanno un solo SELECT indicizzato su
+(istantanea, tipo, oggetto_id), senza transazioni, lock o storico (le tabelle
+dell'istantanea non sono storicizzate), e solo per le campagne che hanno
+un'istantanea: le campagne con istantanea sono lette una volta e tenute in
+memoria fino alla richiesta successiva o alla creazione o eliminazione di
+un'istantanea, quindi le letture delle campagne aperte e del master non fanno
+query. Se la voce non c'è (copie materializzate dopo la chiusura) si ricade
+sul calcolo abituale. Alla riapertura l'istantanea viene eliminata.
+"""
+import logging
+import time
+from collections import defaultdict
+
+from django.db import transaction
+
+from assets.matrici import carica_matrici_asset
+from assets.models import Asset, NodoStruttura, NodoTemplate, StrutturaTemplate
+from assets.serializers import albero_annidato
+from controlli.models import Controllo
+from elementtypes.compatta import carica_matrici, impacchetta, riduci
+from elementtypes.matrix import MatriceDensa, massimo
+from elementtypes.models import ElementType, ElementTypeClosure
+from minacce.models import Minaccia
+from scenari.models import Scenario
+from .models import IstantaneaCampagna, VoceIstantanea
+from .sovrapposizione import righe
+
+
+# {campagna_id: istantanea_id}, None finché non viene letto
+_istantanee = None
+
+
+def istantanee():
+    """{campagna_id: id dell'istantanea} delle campagne chiuse con istantanea, letto una volta."""
+    global _istantanee
+    if _istantanee is None:
+        _istantanee = dict(IstantaneaCampagna.objects.values_list('campagna_id', 'id'))
+    return _istantanee
+
+
+def dimentica_istantanee(**kwargs):
+    """Scarta l'elenco delle istantanee (receiver: a ogni richiesta e quando un'istantanea cambia)."""
+    global _istantanee
+    _istantanee = None
+
+
+def leggi(tipo, oggetto, campagna_id=None):
+    """
+    VoceIstantanea dell'oggetto se la campagna (la sua o `campagna_id`, per le righe master lette
+    in una campagna a copia su scrittura) è chiusa con istantanea, altrimenti None senza query.
+    """
+    campagna_id = campagna_id or getattr(oggetto, 'campagna_id', None)
+    istantanea_id = istantanee().get(campagna_id) if campagna_id is not None else None
+    if istantanea_id is None:
+        return None
+    return VoceIstantanea.objects.filter(istantanea_id=istantanea_id, tipo=tipo, oggetto_id=oggetto.pk).first()
+
+
+def conteggi(campagna):
+    """Conteggi del dashboard: righe visibili nella campagna (master non copiate incluse nelle campagne a copia su scrittura)."""
+    asset, template = righe(Asset, campagna), righe(StrutturaTemplate, campagna)
+    return {
+        'controlli_count': righe(Controllo, campagna).count(),
+        'minacce_count': righe(Minaccia, campagna).count(),
+        'scenari_count': righe(Scenario, campagna).count(),
+        'elementtypes_count': righe(ElementType, campagna).count(),
+        'assets_count': asset.count(),
+        'strutture_template_count': template.count(),
+        'nodistruttura_count': NodoStruttura.objects.filter(asset__in=asset).count(),
+        'noditemplate_count': NodoTemplate.objects.filter(template__in=template).count(),
+    }
+
+
+def _voce(tipo, oggetto_id, matrice=None, **campi):
+    if matrice is not None:
+        campi['minacce_ids'], campi['controlli_ids'], campi['valori'] = impacchetta(matrice)
+    return VoceIstantanea(tipo=tipo, oggetto_id=oggetto_id, **campi)
+
+
+def _voci_elementtypes(campagna):
+    """Matrice, dimensione e unioni di minacce e controlli (come `get_all_minacce`/`get_all_controlli`) per ElementType."""
+    element_types = list(righe(ElementType, campagna))
+    basi = defaultdict(set)
+    for antenato_id, base_id in ElementTypeClosure.objects.filter(
+        ancestor__in=righe(ElementType, campagna).values('pk'), descendant__is_base=True
+    ).values_list('ancestor_id', 'descendant_id'):
+        basi[antenato_id].add(base_id)
+    tutte_le_basi = set().union(*basi.values()) if basi else set()
+    minacce, controlli = defaultdict(set), defaultdict(set)
+    for et_id, minaccia_id in ElementType.minacce.through.objects.filter(
+        elementtype_id__in=tutte_le_basi | {et.pk for et in element_types}
+    ).values_list('elementtype_id', 'minaccia_id'):
+        minacce[et_id].add(minaccia_id)
+    for et_id, controllo_id in Controllo.objects.filter(elementtype_id__in=tutte_le_basi).values_list('elementtype_id', 'pk'):
+        controlli[et_id].add(controllo_id)
+    valorizzati = defaultdict(int)
+    matrici = carica_matrici(et.pk for et in element_types)
+    for et_id, matrice in matrici.items():
+        valorizzati[et_id] = int(matrice.valori.any(axis=0).sum())
+
+    voci = []
+    for et in element_types:
+        dati = {
+            'minacce': sorted(set().union(*(minacce[base] for base in basi[et.pk]))),
+            'controlli': sorted(set().union(*(controlli[base] for base in basi[et.pk]))),
+            # Come `ElementTypeSerializer.get_matrix_dimension`: minacce proprie x controlli con valori
+            'num_minacce_proprie': len(minacce[et.pk]),
+            'num_controlli_valorizzati': valorizzati[et.pk],
+        }
+        voci.append(_voce(
+            VoceIstantanea.ELEMENTTYPE, et.pk, matrici.get(et.pk) or MatriceDensa([], []),
+            dimensione=et.get_dimensione_matrice_display(), dati=dati,
+        ))
+    return voci
+
+
+def _voci_asset(campagna):
+    """Matrici aggregate e alberi degli asset, matrici dei sottoalberi di ogni nodo."""
+    asset = list(righe(Asset, campagna).select_related('matrice_aggregata'))
+    nodi_asset = NodoStruttura.objects.filter(asset__in=righe(Asset, campagna).values('pk'))
+    matrici = carica_matrici_asset([a.pk for a in asset])
+    voci = [
+        _voce(VoceIstantanea.ASSET, a.pk, matrici.get(a.pk) or MatriceDensa([], []), dimensione=a.get_dimensione_matrice_display())
+        for a in asset
+    ]
+
+    nodi = list(nodi_asset.order_by('tree_id', 'lft').values_list('id', 'parent_id', 'element_type_id'))
+    matrici_et = carica_matrici({et_id for _, _, et_id in nodi})
+    figli = defaultdict(list)
+    for nodo_id, parent_id, _ in nodi:
+        figli[parent_id].append(nodo_id)
+    # In ordine (tree_id, lft) inverso ogni nodo viene dopo i suoi discendenti
+    sottoalberi = {}
+    for nodo_id, _, et_id in reversed(nodi):
+        parti = [sottoalberi[figlio] for figlio in figli[nodo_id]]
+        if et_id in matrici_et:
+            parti.append(matrici_et[et_id])
+        sottoalberi[nodo_id] = riduci(massimo(parti))
+    voci.extend(_voce(VoceIstantanea.NODO, nodo_id, matrice) for nodo_id, matrice in sottoalberi.items())
+    voci.extend(_voci_alberi(VoceIstantanea.ALBERO_ASSET, nodi_asset, 'asset_id', ('nome_specifico',)))
+    return voci
+
+
+def _voci_alberi(tipo, nodi, campo_proprietario, campi):
+    """Un albero annidato (come l'azione `albero` delle API) per proprietario, con due query in tutto."""
+    proprietari = dict(nodi.filter(level=0).values_list('id', campo_proprietario))
+    alberi = defaultdict(list)
+    for radice in albero_annidato(nodi, campi):
+        alberi[proprietari[radice['id']]].append(radice)
+    return [_voce(tipo, proprietario_id, dati=radici) for proprietario_id, radici in alberi.items()]
+
+
+@transaction.atomic
+def crea_istantanea(campagna):
+    """Calcola e registra (sostituendo l'eventuale precedente) l'istantanea della campagna."""
+    inizio = time.perf_counter()
+    IstantaneaCampagna.objects.filter(campagna=campagna).delete()
+    istantanea = IstantaneaCampagna.objects.create(campagna=campagna, conteggi=conteggi(campagna))
+    voci = [
+        *_voci_elementtypes(campagna),
+        *_voci_asset(campagna),
+        *_voci_alberi(VoceIstantanea.ALBERO_TEMPLATE,
+                      NodoTemplate.objects.filter(template__in=righe(StrutturaTemplate, campagna)), 'template_id', ()),
+    ]
+    for voce in voci:
+        voce.istantanea = istantanea
+    VoceIstantanea.objects.bulk_create(voci, batch_size=500)
+    istantanea.durata = time.perf_counter() - inizio
+    istantanea.save(update_fields=['durata'])
+    logging.info(f"Istantanea della campagna '{campagna}': {len(voci)} voci in {istantanea.durata * 1000:.0f} ms.")
+    return istantanea
+
+
+def scarta_istantanea(campagna):
+    """Elimina l'istantanea della campagna (riapertura)."""
+    IstantaneaCampagna.objects.filter(campagna=campagna).delete()
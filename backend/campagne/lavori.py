@@ -0,0 +1,178 @@
+"""
+Popolamento delle campagne in background.
+
+La creazione di una campagna dall'admin non esegue la copia dei dati master
+nella richiesta HTTP: registra un `PopolamentoCampagna` in coda e, al commit,
+avvia un worker locale (`manage.py esegui_popolamenti`, un processo separato
+sullo stesso server: nessun broker, la coda è la tabella dei popolamenti).
+Il worker prende in carico i lavori con un UPDATE condizionato sullo stato
+(due worker non eseguono mai lo stesso lavoro) ed esegue le fasi di
+`popolamento.py` con una transazione per fase, registrando dopo ciascuna righe
+e durata: il dashboard della campagna legge l'avanzamento dalla riga del
+lavoro. La campagna diventa `pronta` solo nella transazione finale, insieme al
+lavoro completato; in caso di errore i dati parziali vengono eliminati e il
+traceback registrato sul lavoro. Finché non è pronta le API rifiutano le
+letture filtrate sulla campagna e quelle delle sue righe (vedi `core/api.py`).
+
+Un worker terminato a metà (processo ucciso, server riavviato) lascia il
+lavoro "in corso": il worker e l'azione "Ripeti il popolamento" dell'admin
+chiudono in errore, eliminandone i dati parziali, i lavori in corso senza
+avanzamento (`aggiornato_il`) da più di `POPOLAMENTO_SCADENZA_MINUTI` il cui
+worker (`processo`, il PID registrato alla presa in carico) non è più in
+esecuzione, che possono così essere rimessi in coda. Il segnale di vita è
+scritto fra una fase e l'altra: una fase più lunga della scadenza non rende
+interrotto un lavoro il cui worker è ancora vivo (dentro la transazione della
+fase un segnale non sarebbe visibile agli altri processi).
+
+Con `POPOLAMENTO_AVVIA_WORKER = False` nelle impostazioni il worker non viene
+avviato automaticamente (es. se gira già `esegui_popolamenti --continuo`).
+"""
+import logging
+import os
+import subprocess
+import sys
+import traceback
+from contextlib import nullcontext
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Campagna, PopolamentoCampagna
+from .popolamento import Popolamento, svuota_campagna
+
+
+def accoda_popolamento(campagna):
+    """Registra il popolamento della campagna in coda e avvia il worker al commit."""
+    lavoro = PopolamentoCampagna.objects.create(campagna=campagna, fasi_totali=len(Popolamento.FASI))
+    if getattr(settings, 'POPOLAMENTO_AVVIA_WORKER', True):
+        transaction.on_commit(avvia_worker)
+    return lavoro
+
+
+def avvia_worker():
+    """Avvia in un processo separato, staccato dalla richiesta, il worker che esegue i lavori in coda."""
+    subprocess.Popen(
+        [sys.executable, str(settings.BASE_DIR / 'manage.py'), 'esegui_popolamenti'],
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+def prendi_in_carico(lavoro):
+    """Passa il lavoro da "in coda" a "in corso" in questo processo; False se un altro worker lo ha già preso."""
+    iniziato_il, processo = timezone.now(), os.getpid()
+    if not PopolamentoCampagna.objects.filter(pk=lavoro.pk, stato=PopolamentoCampagna.IN_CODA).update(
+        stato=PopolamentoCampagna.IN_CORSO, iniziato_il=iniziato_il, aggiornato_il=iniziato_il, processo=processo
+    ):
+        return False
+    lavoro.stato, lavoro.iniziato_il, lavoro.aggiornato_il = PopolamentoCampagna.IN_CORSO, iniziato_il, iniziato_il
+    lavoro.processo = processo
+    return True
+
+
+def processo_attivo(pid):
+    """
+    True se il worker `pid` è ancora in esecuzione su questo server. Il processo corrente
+    non sta eseguendo lavori quando cerca quelli interrotti, e un processo terminato ma non
+    ancora raccolto dal padre (zombie, es. il worker avviato dal server web) non conta.
+    """
+    if not pid or pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    try:
+        with open(f'/proc/{pid}/stat') as stat:
+            return stat.read().rpartition(')')[2].split()[0] != 'Z'
+    except OSError:
+        return True
+
+
+def recupera_interrotti(scadenza=None):
+    """
+    Chiude in errore i lavori in corso senza avanzamento da più di `scadenza` (di default
+    `POPOLAMENTO_SCADENZA_MINUTI`) e con il worker non più in esecuzione, eliminandone i dati
+    parziali; restituisce i lavori recuperati. L'UPDATE condizionato sull'ultimo avanzamento
+    esclude i lavori di cui un worker ha appena registrato una fase.
+    """
+    if scadenza is None:
+        scadenza = timedelta(minutes=settings.POPOLAMENTO_SCADENZA_MINUTI)
+    adesso = timezone.now()
+    recuperati = []
+    # I lavori presi in carico prima che esistesse il segnale di vita contano dall'inizio
+    for lavoro in PopolamentoCampagna.objects.annotate(ultimo_segnale=Coalesce('aggiornato_il', 'iniziato_il')).filter(
+        stato=PopolamentoCampagna.IN_CORSO, ultimo_segnale__lt=adesso - scadenza
+    ).select_related('campagna'):
+        if processo_attivo(lavoro.processo):
+            continue
+        errore = f"Interrotto: nessun avanzamento dalle {timezone.localtime(lavoro.ultimo_segnale):%d/%m/%Y %H:%M}."
+        if not PopolamentoCampagna.objects.filter(
+            pk=lavoro.pk, stato=PopolamentoCampagna.IN_CORSO, aggiornato_il=lavoro.aggiornato_il
+        ).update(stato=PopolamentoCampagna.ERRORE, terminato_il=adesso, errore=errore):
+            continue
+        logging.warning(f"Popolamento della campagna '{lavoro.campagna}' interrotto: dati parziali eliminati.")
+        svuota_campagna(lavoro.campagna)
+        lavoro.stato, lavoro.terminato_il, lavoro.errore = PopolamentoCampagna.ERRORE, adesso, errore
+        recuperati.append(lavoro)
+    return recuperati
+
+
+def esegui_popolamento(lavoro, transazione_unica=False):
+    """
+    Esegue il popolamento del lavoro (già in corso) e restituisce gli esiti per fase.
+    Senza `transazione_unica` ogni fase è registrata a sé e un errore viene catturato sul
+    lavoro (dati parziali eliminati, esiti restituiti fino alla fase fallita); con
+    `transazione_unica` tutto avviene in una transazione e l'errore viene rilanciato.
+    """
+    campagna = lavoro.campagna
+    lavoro.fasi_totali = len(Popolamento.FASI)
+    esiti = []
+
+    def avanzamento(esito, fasi):
+        esiti.append(esito)
+        lavoro.fasi_completate = len(esiti)
+        lavoro.avanzamento = [
+            {'fase': e.fase, 'righe': e.righe, 'durata': round(e.durata, 3)} for e in esiti
+        ]
+        lavoro.aggiornato_il = timezone.now()
+        lavoro.save(update_fields=['fasi_completate', 'fasi_totali', 'avanzamento', 'aggiornato_il'])
+
+    try:
+        with transaction.atomic() if transazione_unica else nullcontext():
+            Popolamento(campagna).esegui(avanzamento=avanzamento, transazione_unica=transazione_unica)
+            with transaction.atomic():
+                Campagna.objects.filter(pk=campagna.pk).update(pronta=True)
+                lavoro.stato, lavoro.terminato_il = PopolamentoCampagna.COMPLETATO, timezone.now()
+                lavoro.save(update_fields=['stato', 'terminato_il'])
+        campagna.pronta = True
+    except Exception:
+        if transazione_unica:
+            raise
+        logging.exception(f"Popolamento della campagna '{campagna}' fallito.")
+        lavoro.stato, lavoro.terminato_il = PopolamentoCampagna.ERRORE, timezone.now()
+        lavoro.errore = traceback.format_exc()
+        svuota_campagna(campagna)
+        lavoro.save(update_fields=['stato', 'terminato_il', 'errore'])
+    return esiti
+
+
+def esegui_lavori_in_coda():
+    """
+    Esegue, in ordine di arrivo, i lavori in coda presi in carico da questo processo; li restituisce.
+    Prima chiude in errore i lavori rimasti in corso da un worker interrotto (`recupera_interrotti`).
+    """
+    recupera_interrotti()
+    eseguiti = []
+    for lavoro in PopolamentoCampagna.objects.filter(stato=PopolamentoCampagna.IN_CODA).select_related(
+        'campagna'
+    ).order_by('id'):
+        if prendi_in_carico(lavoro):
+            esegui_popolamento(lavoro)
+            eseguiti.append(lavoro)
+    return eseguiti
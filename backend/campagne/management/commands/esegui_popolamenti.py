@@ -0,0 +1,41 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from campagne.lavori import esegui_lavori_in_coda
+from campagne.models import PopolamentoCampagna
+
+
+class Command(BaseCommand):
+    help = (
+        "Worker locale dei popolamenti di campagna: esegue i lavori in coda (tabella PopolamentoCampagna, "
+        "nessun broker) registrandone l'avanzamento per fase. Avviato automaticamente alla creazione di una "
+        "campagna dall'admin; con --continuo resta in attesa di nuovi lavori."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--continuo', action='store_true', help="Resta attivo e controlla periodicamente la coda.")
+        parser.add_argument('--intervallo', type=float, default=5.0, help="Secondi tra due controlli della coda.")
+
+    def handle(self, *args, **options):
+        while True:
+            for lavoro in esegui_lavori_in_coda():
+                self._riepilogo(lavoro)
+            if not options['continuo']:
+                break
+            time.sleep(options['intervallo'])
+
+    def _riepilogo(self, lavoro):
+        durata = sum(fase['durata'] for fase in lavoro.avanzamento)
+        if lavoro.stato == PopolamentoCampagna.COMPLETATO:
+            self.stdout.write(self.style.SUCCESS(
+                f"Campagna '{lavoro.campagna}' popolata in {durata * 1000:.0f} ms "
+                f"({lavoro.fasi_completate}/{lavoro.fasi_totali} fasi)."
+            ))
+        else:
+            self.stderr.write(self.style.ERROR(
+                f"Popolamento della campagna '{lavoro.campagna}' fallito dopo "
+                f"{lavoro.fasi_completate}/{lavoro.fasi_totali} fasi:\n{lavoro.errore}"
+            ))
+        for fase in lavoro.avanzamento:
+            self.stdout.write(f"  {fase['fase']}: {fase['righe']} righe in {fase['durata'] * 1000:.0f} ms")
@@ -0,0 +1,43 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('campagne', '0001_initial'),
+    ]
+
+    operations = [
+        # Le campagne esistenti sono già state popolate
+        migrations.AddField(
+            model_name='campagna',
+            name='pronta',
+            field=models.BooleanField(default=True, editable=False, help_text='Vero quando il popolamento dai dati master è stato completato e registrato.', verbose_name='Pronta'),
+        ),
+        migrations.AlterField(
+            model_name='campagna',
+            name='pronta',
+            field=models.BooleanField(default=False, editable=False, help_text='Vero quando il popolamento dai dati master è stato completato e registrato.', verbose_name='Pronta'),
+        ),
+        migrations.CreateModel(
+            name='PopolamentoCampagna',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stato', models.CharField(choices=[('in_coda', 'In coda'), ('in_corso', 'In corso'), ('completato', 'Completato'), ('errore', 'Errore')], default='in_coda', max_length=10, verbose_name='Stato')),
+                ('fasi_completate', models.PositiveIntegerField(default=0, verbose_name='Fasi completate')),
+                ('fasi_totali', models.PositiveIntegerField(default=0, verbose_name='Fasi totali')),
+                ('avanzamento', models.JSONField(blank=True, default=list, help_text="Fasi completate: [{'fase', 'righe', 'durata'}] in ordine di esecuzione.", verbose_name='Avanzamento')),
+                ('errore', models.TextField(blank=True, verbose_name='Errore')),
+                ('creato_il', models.DateTimeField(auto_now_add=True, verbose_name='Creato il')),
+                ('iniziato_il', models.DateTimeField(blank=True, null=True, verbose_name='Iniziato il')),
+                ('terminato_il', models.DateTimeField(blank=True, null=True, verbose_name='Terminato il')),
+                ('campagna', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='popolamenti', to='campagne.campagna')),
+            ],
+            options={
+                'verbose_name': 'Popolamento campagna',
+                'verbose_name_plural': 'Popolamenti campagna',
+                'ordering': ['-creato_il', '-id'],
+            },
+        ),
+    ]
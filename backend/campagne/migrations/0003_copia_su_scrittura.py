@@ -0,0 +1,41 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('campagne', '0002_popolamento_campagna'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='campagna',
+            name='copia_su_scrittura',
+            field=models.BooleanField(default=False, help_text='Non copia i dati master alla creazione: le righe master vengono copiate nella campagna solo quando vi si modificano. Non modificabile dopo la creazione.', verbose_name='Copia su scrittura'),
+        ),
+        migrations.AddField(
+            model_name='campagna',
+            name='sovrapposizione_congelata',
+            field=models.JSONField(blank=True, editable=False, help_text='Alla chiusura di una campagna a copia su scrittura: id massimo delle righe master visibili per modello; le righe master modificate in seguito vengono prima copiate nella campagna.', null=True, verbose_name='Sovrapposizione congelata'),
+        ),
+        migrations.AddField(
+            model_name='historicalcampagna',
+            name='copia_su_scrittura',
+            field=models.BooleanField(default=False, help_text='Non copia i dati master alla creazione: le righe master vengono copiate nella campagna solo quando vi si modificano. Non modificabile dopo la creazione.', verbose_name='Copia su scrittura'),
+        ),
+        migrations.CreateModel(
+            name='EsclusioneSovrapposizione',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('modello', models.CharField(max_length=100, verbose_name='Modello')),
+                ('riga_id', models.PositiveBigIntegerField(verbose_name='Id della riga master')),
+                ('campagna', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='esclusioni', to='campagne.campagna')),
+            ],
+            options={
+                'verbose_name': 'Riga master esclusa',
+                'verbose_name_plural': 'Righe master escluse',
+                'unique_together': {('campagna', 'modello', 'riga_id')},
+            },
+        ),
+    ]
@@ -0,0 +1,45 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('campagne', '0003_copia_su_scrittura'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IstantaneaCampagna',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('conteggi', models.JSONField(default=dict, verbose_name='Conteggi')),
+                ('durata', models.FloatField(default=0.0, verbose_name='Durata (s)')),
+                ('creata_il', models.DateTimeField(auto_now_add=True, verbose_name='Creata il')),
+                ('campagna', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='istantanea', to='campagne.campagna')),
+            ],
+            options={
+                'verbose_name': 'Istantanea campagna',
+                'verbose_name_plural': 'Istantanee campagna',
+            },
+        ),
+        migrations.CreateModel(
+            name='VoceIstantanea',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tipo', models.CharField(choices=[('elementtype', 'Element Type'), ('asset', 'Asset'), ('nodo', 'Sottoalbero di un nodo'), ('albero_asset', 'Albero di un asset'), ('albero_template', 'Albero di un template')], max_length=20, verbose_name='Tipo')),
+                ('oggetto_id', models.PositiveBigIntegerField(verbose_name="Id dell'oggetto")),
+                ('minacce_ids', models.BinaryField(default=b'', verbose_name='Id minacce (righe)')),
+                ('controlli_ids', models.BinaryField(default=b'', verbose_name='Id controlli (colonne)')),
+                ('valori', models.BinaryField(default=b'', verbose_name='Valori (percentuale)')),
+                ('dimensione', models.CharField(blank=True, max_length=50, verbose_name='Dimensione')),
+                ('dati', models.JSONField(blank=True, null=True, verbose_name='Dati')),
+                ('istantanea', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='voci', to='campagne.istantaneacampagna')),
+            ],
+            options={
+                'verbose_name': 'Voce istantanea',
+                'verbose_name_plural': 'Voci istantanea',
+                'unique_together': {('tipo', 'oggetto_id')},
+            },
+        ),
+    ]
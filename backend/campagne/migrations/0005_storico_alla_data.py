@@ -0,0 +1,17 @@
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('campagne', '0004_istantanea_campagna'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='historicalcampagna',
+            index=models.Index(fields=['id', 'history_date'], name='campagne_hi_id_2a3014_idx'),
+        ),
+    ]
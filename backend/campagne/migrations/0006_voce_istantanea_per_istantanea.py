@@ -0,0 +1,15 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('campagne', '0005_storico_alla_data'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='voceistantanea',
+            unique_together={('istantanea', 'tipo', 'oggetto_id')},
+        ),
+    ]
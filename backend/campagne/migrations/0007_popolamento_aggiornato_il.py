@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('campagne', '0006_voce_istantanea_per_istantanea'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='popolamentocampagna',
+            name='aggiornato_il',
+            field=models.DateTimeField(blank=True, help_text='Segnale di vita del worker: alla presa in carico e dopo ogni fase. Un lavoro in corso fermo da più di POPOLAMENTO_SCADENZA_MINUTI è considerato interrotto.', null=True, verbose_name='Aggiornato il'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('campagne', '0007_popolamento_aggiornato_il'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='popolamentocampagna',
+            name='processo',
+            field=models.PositiveIntegerField(blank=True, help_text='PID del worker che ha preso in carico il lavoro.', null=True, verbose_name='Processo'),
+        ),
+        migrations.AlterField(
+            model_name='popolamentocampagna',
+            name='aggiornato_il',
+            field=models.DateTimeField(blank=True, help_text='Segnale di vita del worker: alla presa in carico e dopo ogni fase. Un lavoro in corso fermo da più di POPOLAMENTO_SCADENZA_MINUTI, il cui worker non è più in esecuzione, è considerato interrotto.', null=True, verbose_name='Aggiornato il'),
+        ),
+    ]
@@ -1,12 +1,14 @@
 from django.db import models
-from simple_history.models import HistoricalRecords
-from django.db import transaction
+from django.utils import timezone
+from core.storico import StoricoRecords
 
 
 class Campagna(models.Model):
     """
     Modello per le Campagne di valutazione.
-    La creazione di una campagna comporterà la copia di tutti i dati di base.
+    La creazione di una campagna comporterà la copia di tutti i dati di base,
+    oppure, con `copia_su_scrittura`, nessuna copia: la campagna legge le righe
+    master e ne materializza una copia alla prima modifica (vedi `sovrapposizione.py`).
     """
     STATUS_CHOICES = [
         ('open', 'Aperta'),
@@ -19,7 +21,21 @@ class Campagna(models.Model):
     data_fine = models.DateField("Data fine campagna")
 
     status = models.CharField("Stato", max_length=10, choices=STATUS_CHOICES, default='open')
-    history = HistoricalRecords()
+    pronta = models.BooleanField(
+        "Pronta", default=False, editable=False,
+        help_text="Vero quando il popolamento dai dati master è stato completato e registrato."
+    )
+    copia_su_scrittura = models.BooleanField(
+        "Copia su scrittura", default=False,
+        help_text="Non copia i dati master alla creazione: le righe master vengono copiate nella campagna "
+                  "solo quando vi si modificano. Non modificabile dopo la creazione."
+    )
+    sovrapposizione_congelata = models.JSONField(
+        "Sovrapposizione congelata", null=True, blank=True, editable=False,
+        help_text="Alla chiusura di una campagna a copia su scrittura: id massimo delle righe master visibili "
+                  "per modello; le righe master modificate in seguito vengono prima copiate nella campagna."
+    )
+    history = StoricoRecords(excluded_fields=['pronta', 'sovrapposizione_congelata'])
 
     def __str__(self):
         return f"{self.descrizione} ({self.anno})"
@@ -27,138 +43,194 @@ class Campagna(models.Model):
     def save(self, *args, **kwargs):
         """
         Sovrascrive il metodo save per avviare il popolamento automatico
-        alla creazione di una nuova campagna.
+        alla creazione di una nuova campagna: nella stessa transazione oppure,
+        se `popolamento_in_background` è impostato sull'istanza (admin), accodato
+        a un worker locale (vedi `lavori.py`). Una campagna a copia su scrittura
+        è pronta subito e viene congelata alla chiusura. Alla chiusura si crea
+        l'istantanea di lettura precalcolata, alla riapertura la si elimina.
         """
         is_new = self.pk is None
+        precedente = None if is_new else Campagna.objects.filter(pk=self.pk).values_list('status', flat=True).first()
+        chiusa, riaperta = self.status == 'close' and precedente == 'open', self.status == 'open' and precedente == 'close'
+        if self.copia_su_scrittura:
+            if is_new:
+                self.pronta = True
+            else:
+                self._aggiorna_congelamento(chiusa, riaperta)
         super().save(*args, **kwargs)
-        if is_new:
-            try:
-                # Tenta di recuperare la campagna appena salvata per assicurare che esista
-                # prima di chiamare popola_from_master.
-                self.__class__.objects.get(pk=self.pk)
+        if chiusa:
+            from .istantanea import crea_istantanea
+            crea_istantanea(self)
+        elif riaperta:
+            from .istantanea import scarta_istantanea
+            scarta_istantanea(self)
+        if is_new and not self.copia_su_scrittura:
+            if getattr(self, 'popolamento_in_background', False):
+                from .lavori import accoda_popolamento
+                accoda_popolamento(self)
+            else:
                 self.popola_from_master()
-            except self.__class__.DoesNotExist:
-                pass  # Gestisci il caso in cui, per qualche motivo, non viene trovata (molto improbabile)
 
-    @transaction.atomic
+    def _aggiorna_congelamento(self, chiusa, riaperta):
+        from .sovrapposizione import limiti_master
+
+        if chiusa:
+            self.sovrapposizione_congelata = limiti_master()
+        elif riaperta:
+            self.sovrapposizione_congelata = None
+
     def popola_from_master(self):
         """
         Popola questa campagna (che si presume vuota) clonando tutti i dati
-        di anagrafica "master" (quelli con campagna=NULL).
+        di anagrafica "master" (quelli con campagna=NULL), con il motore di copia
+        in blocco di `popolamento.py`, in un'unica transazione registrata come
+        PopolamentoCampagna. Restituisce le durate per fase (EsitoFase).
         """
- 
-        from controlli.models import Controllo
-        from elementtypes.models import ElementType, ValoreElementType, Minaccia
-        from minacce.models import Minaccia
-        from assets.models import Asset, NodoStruttura, StrutturaTemplate, NodoTemplate
-        from scenari.models import Scenario
-
-        new_campaign = self
-
-        # Dizionari per mappare i vecchi ID ai nuovi oggetti clonati
-        scenario_map, minaccia_map, elementtype_map, controllo_map, template_map = {}, {}, {}, {}, {}
-        # 1. Clona Scenari (nessuna dipendenza da altri modelli clonati)
-        for obj in Scenario.objects.filter(campagna__isnull=True):
-            old_id = obj.id
-            obj.id = None
-            obj._state.adding = True
-            obj.campagna = new_campaign
-            obj.save()
-            scenario_map[old_id] = obj
-
-        # 2. Clona Minacce (dipendono da Scenari)
-        for obj in Minaccia.objects.filter(campagna__isnull=True):
-            old_id = obj.id
-            obj.id = None
-            obj._state.adding = True
-            obj.campagna = new_campaign
-            if obj.scenario_id:
-                obj.scenario = scenario_map.get(obj.scenario_id)
-            obj.save()
-            minaccia_map[old_id] = obj
-
-        # 3. Clona ElementTypes (solo gli oggetti, le relazioni verranno popolate dopo)
-        original_elementtype_minacce = {}
-        for obj in ElementType.objects.filter(campagna__isnull=True).prefetch_related('minacce'):
-            old_id = obj.id
-            original_elementtype_minacce[old_id] = list(obj.minacce.all())
-            obj.cloned_from_id = old_id
-            obj.id = None
-            obj._state.adding = True
-            obj.campagna = new_campaign
-            obj.save()
-            elementtype_map[old_id] = obj
-
-        # Assicura che esista un ElementType 'root' per la campagna
-        ElementType.objects.get_or_create(
-            nome='root',
-            campagna=new_campaign,
-            defaults={'descrizione': 'Elemento di tipo root per la campagna'}
+        from .lavori import esegui_popolamento
+
+        lavoro = PopolamentoCampagna.objects.create(
+            campagna=self, stato=PopolamentoCampagna.IN_CORSO, iniziato_il=timezone.now()
         )
+        self.esiti_popolamento = esegui_popolamento(lavoro, transazione_unica=True)
+        self.pronta = True
+        return self.esiti_popolamento
+
+
+class PopolamentoCampagna(models.Model):
+    """
+    Esecuzione del popolamento di una campagna dai dati master: stato, avanzamento
+    per fase (righe e durata di ogni fase completata) ed eventuale errore.
+    Fa anche da coda per il worker locale (`manage.py esegui_popolamenti`).
+    """
+    IN_CODA, IN_CORSO, COMPLETATO, ERRORE = 'in_coda', 'in_corso', 'completato', 'errore'
+    STATO_CHOICES = [
+        (IN_CODA, 'In coda'),
+        (IN_CORSO, 'In corso'),
+        (COMPLETATO, 'Completato'),
+        (ERRORE, 'Errore'),
+    ]
+
+    campagna = models.ForeignKey(Campagna, on_delete=models.CASCADE, related_name='popolamenti')
+    stato = models.CharField("Stato", max_length=10, choices=STATO_CHOICES, default=IN_CODA)
+    fasi_completate = models.PositiveIntegerField("Fasi completate", default=0)
+    fasi_totali = models.PositiveIntegerField("Fasi totali", default=0)
+    avanzamento = models.JSONField(
+        "Avanzamento", default=list, blank=True,
+        help_text="Fasi completate: [{'fase', 'righe', 'durata'}] in ordine di esecuzione."
+    )
+    errore = models.TextField("Errore", blank=True)
+    creato_il = models.DateTimeField("Creato il", auto_now_add=True)
+    iniziato_il = models.DateTimeField("Iniziato il", null=True, blank=True)
+    aggiornato_il = models.DateTimeField(
+        "Aggiornato il", null=True, blank=True,
+        help_text="Segnale di vita del worker: alla presa in carico e dopo ogni fase. Un lavoro in corso "
+                  "fermo da più di POPOLAMENTO_SCADENZA_MINUTI, il cui worker non è più in esecuzione, "
+                  "è considerato interrotto."
+    )
+    processo = models.PositiveIntegerField(
+        "Processo", null=True, blank=True, help_text="PID del worker che ha preso in carico il lavoro."
+    )
+    terminato_il = models.DateTimeField("Terminato il", null=True, blank=True)
+
+    class Meta:
+        verbose_name = "Popolamento campagna"
+        verbose_name_plural = "Popolamenti campagna"
+        ordering = ['-creato_il', '-id']
+
+    def __str__(self):
+        return f"Popolamento di {self.campagna} ({self.get_stato_display()})"
+
+    @property
+    def fase_in_corso(self):
+        """Nome della fase in esecuzione (None se il lavoro non è in corso)."""
+        from .popolamento import Popolamento
+
+        if self.stato != self.IN_CORSO or self.fasi_completate >= len(Popolamento.FASI):
+            return None
+        return Popolamento.FASI[self.fasi_completate][0]
+
+    def come_dizionario(self):
+        return {
+            'id': self.pk,
+            'stato': self.stato,
+            'stato_display': self.get_stato_display(),
+            'fasi_completate': self.fasi_completate,
+            'fasi_totali': self.fasi_totali,
+            'fase_in_corso': self.fase_in_corso,
+            'avanzamento': self.avanzamento,
+            'errore': self.errore,
+            'pronta': self.campagna.pronta,
+        }
+
+
+class EsclusioneSovrapposizione(models.Model):
+    """
+    Riga master nascosta in una campagna a copia su scrittura: la sua copia nella
+    campagna è stata eliminata, quindi la riga master non deve tornare visibile.
+    """
+    campagna = models.ForeignKey(Campagna, on_delete=models.CASCADE, related_name='esclusioni')
+    modello = models.CharField("Modello", max_length=100)
+    riga_id = models.PositiveBigIntegerField("Id della riga master")
+
+    class Meta:
+        verbose_name = "Riga master esclusa"
+        verbose_name_plural = "Righe master escluse"
+        unique_together = ('campagna', 'modello', 'riga_id')
+
+    def __str__(self):
+        return f"{self.modello} #{self.riga_id} esclusa da {self.campagna}"
+
+
+class IstantaneaCampagna(models.Model):
+    """
+    Modello di lettura precalcolato di una campagna chiusa (vedi `istantanea.py`):
+    conteggi del dashboard e, nelle voci, matrici, dimensioni, unioni di minacce e
+    controlli, matrici dei sottoalberi e alberi. Creata alla chiusura, eliminata alla riapertura.
+    """
+    campagna = models.OneToOneField(Campagna, on_delete=models.CASCADE, related_name='istantanea')
+    conteggi = models.JSONField("Conteggi", default=dict)
+    durata = models.FloatField("Durata (s)", default=0.0)
+    creata_il = models.DateTimeField("Creata il", auto_now_add=True)
+
+    class Meta:
+        verbose_name = "Istantanea campagna"
+        verbose_name_plural = "Istantanee campagna"
+
+    def __str__(self):
+        return f"Istantanea di {self.campagna}"
+
+
+class VoceIstantanea(models.Model):
+    """
+    Dato precalcolato di un oggetto della campagna chiusa: matrice nella forma impacchettata
+    di `MatriceCompatta` (se ne ha una), dimensione e dati JSON. Si legge per (istantanea, tipo, oggetto_id).
+    """
+    ELEMENTTYPE, ASSET, NODO, ALBERO_ASSET, ALBERO_TEMPLATE = 'elementtype', 'asset', 'nodo', 'albero_asset', 'albero_template'
+    TIPO_CHOICES = [
+        (ELEMENTTYPE, 'Element Type'),
+        (ASSET, 'Asset'),
+        (NODO, 'Sottoalbero di un nodo'),
+        (ALBERO_ASSET, "Albero di un asset"),
+        (ALBERO_TEMPLATE, "Albero di un template"),
+    ]
 
-        # 4. Clona Controlli (dipendono da ElementTypes)
-        for obj in Controllo.objects.filter(campagna__isnull=True):
-            old_id = obj.id
-            obj.id = None
-            obj._state.adding = True
-            obj.campagna = new_campaign
-            if obj.elementtype_id:
-                obj.elementtype = elementtype_map.get(obj.elementtype_id)
-            obj.save()
-            controllo_map[old_id] = obj
-
-        # 5. Clona StrutturaTemplate e i loro nodi
-        for master_template in StrutturaTemplate.objects.filter(campagna__isnull=True).prefetch_related('nodi_template'):
-            old_id = master_template.id
-            original_nodes = list(master_template.nodi_template.all())
-            
-            # Clona l'oggetto StrutturaTemplate
-            master_template.id = None
-            master_template._state.adding = True
-            master_template.campagna = new_campaign
-            master_template.cloned_from_id = old_id
-            master_template.save()
-            new_template = master_template
-            template_map[old_id] = new_template
-
-            # Clona i nodi del template in modo sicuro, senza modificare gli originali
-            node_map = {}
-            for node in sorted(original_nodes, key=lambda n: n.level):
-                old_node_id = node.id
-                cloned_parent = node_map.get(node.parent_id) if node.parent_id else None
-                cloned_element_type = elementtype_map.get(node.element_type_id)
-
-                if cloned_element_type:
-                    new_node = NodoTemplate.objects.create(
-                        template=new_template, element_type=cloned_element_type, parent=cloned_parent, campagna=new_campaign
-                    )
-                    node_map[old_node_id] = new_node
-
-        # 6. Clona Asset
-        for obj in Asset.objects.filter(campagna__isnull=True):
-            old_id = obj.id
-            obj.id = None
-            obj._state.adding = True
-            obj.campagna = new_campaign
-            obj.cloned_from_id = old_id
-            if obj.template_da_applicare_id in template_map:
-                obj.template_da_applicare = template_map[obj.template_da_applicare_id]
-            obj.save()
-
-        # 7. Popola relazioni di ElementType (M2M con Minacce e Valori Matrice)
-        valori_da_creare = []
-        for old_et_id, new_et in elementtype_map.items():
-            new_minacce = [minaccia_map[m.id] for m in original_elementtype_minacce[old_et_id] if m.id in minaccia_map]
-            if new_minacce:
-                new_et.minacce.set(new_minacce)
-
-            for valore in ValoreElementType.objects.filter(elementtype_id=old_et_id):
-                new_minaccia = minaccia_map.get(valore.minaccia_id)
-                new_controllo = controllo_map.get(valore.controllo_id)
-                if new_minaccia and new_controllo:
-                    valori_da_creare.append(
-                        ValoreElementType(elementtype=new_et, minaccia=new_minaccia, controllo=new_controllo, valore=valore.valore)
-                    )
-
-        # 8. Crea tutti i valori delle matrici in una sola query per efficienza
-        ValoreElementType.objects.bulk_create(valori_da_creare)
\ No newline at end of file
+    istantanea = models.ForeignKey(IstantaneaCampagna, on_delete=models.CASCADE, related_name='voci')
+    tipo = models.CharField("Tipo", max_length=20, choices=TIPO_CHOICES)
+    oggetto_id = models.PositiveBigIntegerField("Id dell'oggetto")
+    minacce_ids = models.BinaryField("Id minacce (righe)", default=b'')
+    controlli_ids = models.BinaryField("Id controlli (colonne)", default=b'')
+    valori = models.BinaryField("Valori (percentuale)", default=b'')
+    dimensione = models.CharField("Dimensione", max_length=50, blank=True)
+    dati = models.JSONField("Dati", null=True, blank=True)
+
+    class Meta:
+        verbose_name = "Voce istantanea"
+        verbose_name_plural = "Voci istantanea"
+        # Le righe master sono nelle istantanee di tutte le campagne a copia su scrittura chiuse che le leggono
+        unique_together = ('istantanea', 'tipo', 'oggetto_id')
+
+    def matrice(self):
+        """MatriceDensa precalcolata della voce."""
+        from elementtypes.compatta import spacchetta
+
+        return spacchetta(self.minacce_ids, self.controlli_ids, self.valori)
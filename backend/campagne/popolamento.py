@@ -0,0 +1,343 @@
+"""
+Popolamento in blocco di una nuova campagna dai dati master (campagna=NULL).
+
+Ogni modello master viene copiato con bulk insert a lotti, nell'ordine delle
+dipendenze, tenendo per ciascuno la mappa vecchio id -> nuovo id: con le mappe
+vengono rimappate le chiavi esterne dei modelli successivi, le tabelle M2M
+degli ElementType (minacce e componenti), le celle delle matrici e gli alberi
+di template e asset (inseriti con `assets.alberi.inserisci_alberi`). Lo storico
+è registrato come un'unica operazione massiva (`core/storico.py`), con gli
+intervalli di id copiati per modello. Nessun `save()` e nessun segnale
+viene eseguito per riga: le celle delle matrici sono scritte con la loro forma
+compatta (`elementtypes.compatta.sostituisci_matrici`), la tabella di chiusura e
+i contatori di dimensione sono ricostruiti in blocco alla fine, e le matrici
+aggregate degli asset sono copiate da quelle master con gli id rimappati.
+
+Con `selezione` vengono copiate solo le righe master indicate (materializzazione
+delle campagne a copia su scrittura, vedi `sovrapposizione.py`): le mappe partono
+dalle copie già presenti nella campagna, i riferimenti senza copia restano alle
+righe master e le righe della campagna che puntavano alle righe appena copiate
+vengono ripuntate sulle copie.
+
+Ogni fase registra righe copiate e durata (`EsitoFase`); l'esecuzione in
+background con avanzamento persistito è in `lavori.py`. Uso:
+
+    esiti = Popolamento(campagna).esegui(avanzamento=callback)
+"""
+import logging
+import time
+from collections import defaultdict
+from contextlib import nullcontext
+from dataclasses import dataclass
+
+import numpy as np
+from django.db import transaction
+from django.db.models import Case, Value, When
+
+from assets.alberi import dati_da_nodi, inserisci_alberi
+from assets.matrici import carica_matrici_asset, salva_matrici_asset
+from assets.models import Asset, NodoStruttura, NodoTemplate, StrutturaTemplate
+from controlli.models import Controllo
+from core.storico import operazione_massiva, transazione_operazione
+from elementtypes.closure import ricostruisci_chiusura_campagna
+from elementtypes.compatta import da_righe, sincronizza, sostituisci_matrici
+from elementtypes.dimensioni import salva_dimensioni
+from elementtypes.matrix import MatriceDensa
+from elementtypes.models import ElementType, ValoreElementType
+from minacce.models import Minaccia
+from scenari.models import Scenario
+
+
+@dataclass
+class EsitoFase:
+    fase: str
+    righe: int = 0
+    durata: float = 0.0
+
+
+def mappa_copie(modello, campagna_id):
+    """{id master: id copia} delle righe di `modello` già copiate nella campagna."""
+    return dict(
+        modello.objects.filter(campagna_id=campagna_id, cloned_from__isnull=False).values_list('cloned_from_id', 'pk')
+    )
+
+
+def rimappa_matrice(matrice, mappa_minacce, mappa_controlli):
+    """
+    MatriceDensa con gli id di minacce e controlli sostituiti dalle mappe (righe e colonne
+    riordinate per nuovo id); gli id senza corrispondenza restano invariati.
+    """
+    righe = [(mappa_minacce.get(m, m), i) for i, m in enumerate(matrice.minacce_ids)]
+    colonne = [(mappa_controlli.get(c, c), j) for j, c in enumerate(matrice.controlli_ids)]
+    righe.sort()
+    colonne.sort()
+    return MatriceDensa(
+        [m for m, _ in righe],
+        [c for c, _ in colonne],
+        matrice.valori[np.ix_(np.array([i for _, i in righe], dtype=int), np.array([j for _, j in colonne], dtype=int))],
+    )
+
+
+class Popolamento:
+    """
+    Copia nella `campagna` (che si presume vuota) tutti i dati master, in un'unica
+    transazione. `batch_size` è il numero di righe per bulk insert. Con `selezione`
+    ({modello: id master}) copia solo quelle righe in una campagna già avviata.
+    """
+
+    FASI = (
+        ('scenari', '_scenari'),
+        ('minacce', '_minacce'),
+        ('elementtypes', '_elementtypes'),
+        ('controlli', '_controlli'),
+        ('relazioni', '_relazioni'),
+        ('valori', '_valori'),
+        ('template', '_template'),
+        ('asset', '_asset'),
+        ('riferimenti', '_riferimenti'),
+        ('matrici', '_matrici'),
+    )
+
+    def __init__(self, campagna, batch_size=1000, selezione=None):
+        self.campagna = campagna
+        self.batch_size = max(1, batch_size)
+        self.selezione = selezione
+        self.motivo = f"Clonato nella campagna {campagna}"
+        self.scenari, self.minacce, self.elementtypes, self.controlli = {}, {}, {}, {}
+        self.template, self.asset = {}, {}
+        if selezione is not None:
+            self.motivo = f"Materializzato nella campagna {campagna}"
+            self.scenari, self.minacce = mappa_copie(Scenario, campagna.pk), mappa_copie(Minaccia, campagna.pk)
+            self.elementtypes, self.controlli = mappa_copie(ElementType, campagna.pk), mappa_copie(Controllo, campagna.pk)
+            self.template, self.asset = mappa_copie(StrutturaTemplate, campagna.pk), mappa_copie(Asset, campagna.pk)
+        # Righe copiate da questa esecuzione, per modello: {vecchio_id: nuovo_id}
+        self.copiati = defaultdict(dict)
+
+    def esegui(self, avanzamento=None, transazione_unica=True):
+        """
+        Esegue le fasi in ordine e restituisce un EsitoFase per ciascuna.
+        `avanzamento(esito, fasi)` viene chiamato al termine di ogni fase. Con
+        `transazione_unica=False` ogni fase è registrata con una propria transazione
+        (il worker rende così visibile l'avanzamento): in caso di errore le fasi già
+        registrate restano, elencate nell'operazione massiva registrata come interrotta,
+        e vanno rimosse con `svuota_campagna`.
+        """
+        esiti = []
+        with transaction.atomic() if transazione_unica else nullcontext(), \
+                operazione_massiva(self.motivo, campagna_id=self.campagna.pk):
+            for fase, metodo in self.FASI:
+                inizio = time.perf_counter()
+                with transazione_operazione():
+                    righe = getattr(self, metodo)()
+                esito = EsitoFase(fase, righe, time.perf_counter() - inizio)
+                esiti.append(esito)
+                logging.info(f"Campagna '{self.campagna}', fase {fase}: {righe} righe in {esito.durata * 1000:.0f} ms.")
+                if avanzamento:
+                    avanzamento(esito, len(self.FASI))
+        return esiti
+
+    def _copia(self, modello, rimappa=None):
+        """
+        Copia le righe master (selezionate) di `modello` nella campagna, in ordine di id (le
+        copie mantengono l'ordine relativo degli originali e il riferimento `cloned_from`),
+        con `rimappa(obj)` applicata a ogni riga prima dell'azzeramento della chiave.
+        Restituisce {vecchio_id: nuovo_id} delle righe copiate.
+        """
+        righe = modello.objects.filter(campagna__isnull=True)
+        if self.selezione is not None:
+            righe = righe.filter(pk__in=self.selezione.get(modello, ()))
+        oggetti = list(righe.order_by('pk'))
+        vecchi_ids = [obj.pk for obj in oggetti]
+        for obj in oggetti:
+            if rimappa:
+                rimappa(obj)
+            obj.cloned_from_id = obj.pk
+            obj.pk = None
+            obj._state.adding = True
+            obj.campagna = self.campagna
+        modello.objects.bulk_create(oggetti, batch_size=self.batch_size)
+        modello.history.bulk_history_create(oggetti, batch_size=self.batch_size, default_change_reason=self.motivo)
+        copiati = dict(zip(vecchi_ids, (obj.pk for obj in oggetti)))
+        self.copiati[modello] = copiati
+        return copiati
+
+    def _scenari(self):
+        copiati = self._copia(Scenario)
+        self.scenari.update(copiati)
+        return len(copiati)
+
+    def _minacce(self):
+        def rimappa(obj):
+            obj.scenario_id = self.scenari.get(obj.scenario_id, obj.scenario_id)
+
+        copiati = self._copia(Minaccia, rimappa)
+        self.minacce.update(copiati)
+        return len(copiati)
+
+    def _elementtypes(self):
+        copiati = self._copia(ElementType)
+        self.elementtypes.update(copiati)
+        if self.selezione is not None:
+            return len(copiati)
+        # Assicura che esista un ElementType 'root' per la campagna
+        _, creato = ElementType.objects.get_or_create(
+            nome='root',
+            campagna=self.campagna,
+            defaults={'descrizione': 'Elemento di tipo root per la campagna'}
+        )
+        return len(copiati) + creato
+
+    def _controlli(self):
+        def rimappa(obj):
+            obj.elementtype_id = self.elementtypes.get(obj.elementtype_id, obj.elementtype_id)
+
+        copiati = self._copia(Controllo, rimappa)
+        self.controlli.update(copiati)
+        return len(copiati)
+
+    def _relazioni(self):
+        """Righe delle tabelle M2M di minacce e componenti degli ElementType copiati."""
+        copiati = self.copiati[ElementType]
+        minacce = ElementType.minacce.through
+        righe = [
+            minacce(elementtype_id=copiati[et_id], minaccia_id=self.minacce.get(minaccia_id, minaccia_id))
+            for et_id, minaccia_id in minacce.objects.filter(elementtype_id__in=copiati).order_by(
+                'id').values_list('elementtype_id', 'minaccia_id')
+        ]
+        minacce.objects.bulk_create(righe, batch_size=self.batch_size)
+
+        componenti = ElementType.component_element_types.through
+        archi = [
+            componenti(from_elementtype_id=copiati[padre_id], to_elementtype_id=self.elementtypes.get(figlio_id, figlio_id))
+            for padre_id, figlio_id in componenti.objects.filter(from_elementtype_id__in=copiati).order_by(
+                'id').values_list('from_elementtype_id', 'to_elementtype_id')
+        ]
+        # In ordine di id: l'espansione dei componenti nei nodi segue l'ordine delle righe
+        componenti.objects.bulk_create(archi, batch_size=self.batch_size)
+        return len(righe) + len(archi)
+
+    def _valori(self):
+        """Matrici degli ElementType copiati, righe e forma compatta, con minacce e controlli rimappati."""
+        copiati = self.copiati[ElementType]
+        matrici = da_righe(
+            (copiati[et_id], self.minacce.get(minaccia_id, minaccia_id), self.controlli.get(controllo_id, controllo_id), valore)
+            for et_id, minaccia_id, controllo_id, valore in ValoreElementType.objects.filter(
+                elementtype_id__in=copiati
+            ).values_list('elementtype_id', 'minaccia_id', 'controllo_id', 'valore').iterator(chunk_size=self.batch_size * 10)
+        )
+        return sostituisci_matrici(matrici, batch_size=self.batch_size)
+
+    def _template(self):
+        copiati = self._copia(StrutturaTemplate)
+        self.template.update(copiati)
+        nodi = NodoTemplate.objects.filter(template_id__in=copiati).order_by(
+            'template_id', 'level', 'id').values_list('template_id', 'id', 'parent_id', 'element_type_id')
+        radici = self._alberi(
+            ((template_id, nodo_id, parent_id, et_id, {}) for template_id, nodo_id, parent_id, et_id in nodi),
+            copiati, 'template_id',
+        )
+        return len(copiati) + self._inserisci(NodoTemplate, radici)
+
+    def _asset(self):
+        def rimappa(obj):
+            obj.template_da_applicare_id = self.template.get(obj.template_da_applicare_id, obj.template_da_applicare_id)
+
+        copiati = self._copia(Asset, rimappa)
+        self.asset.update(copiati)
+        nodi = NodoStruttura.objects.filter(asset_id__in=copiati).order_by(
+            'asset_id', 'level', 'id').values_list('asset_id', 'id', 'parent_id', 'element_type_id', 'nome_specifico')
+        radici = self._alberi(
+            ((asset_id, nodo_id, parent_id, et_id, {'nome_specifico': nome})
+             for asset_id, nodo_id, parent_id, et_id, nome in nodi),
+            copiati, 'asset_id',
+        )
+        return len(copiati) + self._inserisci(NodoStruttura, radici)
+
+    def _alberi(self, nodi, mappa_proprietari, campo):
+        """
+        Dizionari annidati degli alberi copiati da `nodi` (tuple `(proprietario_id, id, parent_id,
+        element_type_id, campi_nodo)` ordinate per proprietario, livello e id), con proprietario
+        ed ElementType rimappati; gli alberi sono ordinati per nuovo proprietario.
+        """
+        per_proprietario = defaultdict(list)
+        for proprietario_id, *nodo in nodi:
+            per_proprietario[proprietario_id].append(nodo)
+        radici = []
+        for vecchio_id, nuovo_id in sorted(mappa_proprietari.items(), key=lambda voce: voce[1]):
+            radici.extend(dati_da_nodi(
+                [(nodo_id, parent_id, self.elementtypes.get(et_id, et_id), campi)
+                 for nodo_id, parent_id, et_id, campi in per_proprietario[vecchio_id]],
+                {campo: nuovo_id, 'campagna_id': self.campagna.pk},
+            ))
+        return radici
+
+    def _inserisci(self, modello, radici):
+        return len(inserisci_alberi(modello, radici, motivo=self.motivo, batch_size=self.batch_size))
+
+    def _riferimenti(self):
+        """
+        Ripunta sulle copie appena create le chiavi delle righe già presenti nella campagna
+        che si riferivano alle righe master copiate (solo con `selezione`), con un UPDATE per campo.
+        """
+        if self.selezione is None:
+            return 0
+        campagna = self.campagna
+        voci = (
+            (Minaccia.objects.filter(campagna=campagna), 'scenario_id', Scenario),
+            (ElementType.minacce.through.objects.filter(elementtype__campagna=campagna), 'minaccia_id', Minaccia),
+            (ValoreElementType.objects.filter(elementtype__campagna=campagna), 'minaccia_id', Minaccia),
+            (ValoreElementType.objects.filter(elementtype__campagna=campagna), 'controllo_id', Controllo),
+            (Controllo.objects.filter(campagna=campagna), 'elementtype_id', ElementType),
+            (ElementType.component_element_types.through.objects.filter(from_elementtype__campagna=campagna),
+             'to_elementtype_id', ElementType),
+            (NodoStruttura.objects.filter(campagna=campagna), 'element_type_id', ElementType),
+            (NodoTemplate.objects.filter(campagna=campagna), 'element_type_id', ElementType),
+            (Asset.objects.filter(campagna=campagna), 'template_da_applicare_id', StrutturaTemplate),
+        )
+        ripuntate = 0
+        for righe, campo, modello in voci:
+            mappa = self.copiati[modello]
+            if not mappa:
+                continue
+            aggiornate = righe.filter(**{f'{campo}__in': mappa}).update(**{campo: Case(
+                *(When(**{campo: vecchio}, then=Value(nuovo)) for vecchio, nuovo in mappa.items())
+            )})
+            if aggiornate and hasattr(righe.model, 'campo_albero'):
+                righe.model.incrementa_versione(righe.filter(**{f'{campo}__in': mappa.values()}).values_list(
+                    f'{righe.model.campo_albero}_id', flat=True))
+            ripuntate += aggiornate
+        return ripuntate
+
+    def _matrici(self):
+        """
+        Chiusura e contatori di dimensione degli ElementType della campagna (con `selezione`, anche
+        le matrici compatte, le cui righe `_riferimenti` ha ripuntato sulle copie), matrici aggregate
+        degli asset copiati (e, con `selezione`, degli altri asset della campagna).
+        """
+        ricostruisci_chiusura_campagna(self.campagna.pk)
+        element_types = ElementType.objects.filter(campagna=self.campagna)
+        salva_dimensioni(element_types)
+        if self.selezione is not None:
+            sincronizza(element_types.values_list('pk', flat=True))
+        asset = self.copiati[Asset]
+        mappa_asset = dict(asset)
+        if self.selezione is not None and (self.copiati[Minaccia] or self.copiati[Controllo]):
+            for asset_id in Asset.objects.filter(campagna=self.campagna).exclude(pk__in=asset.values()).values_list(
+                    'pk', flat=True):
+                mappa_asset[asset_id] = asset_id
+        matrici = {
+            mappa_asset[asset_id]: rimappa_matrice(matrice, self.minacce, self.controlli)
+            for asset_id, matrice in carica_matrici_asset(mappa_asset).items()
+        }
+        salva_matrici_asset(matrici)
+        return len(matrici)
+
+
+@transaction.atomic
+def svuota_campagna(campagna):
+    """
+    Elimina i dati copiati nella campagna (popolamento interrotto), dai modelli che
+    dipendono dagli altri a quelli di base; la campagna resta, da ripopolare.
+    """
+    for modello in (Asset, StrutturaTemplate, Controllo, ElementType, Minaccia, Scenario):
+        modello.objects.filter(campagna=campagna).delete()
@@ -0,0 +1,96 @@
+from django.core.signals import request_started
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from assets.models import NodoStruttura, NodoTemplate, StrutturaTemplate, Asset
+from controlli.models import Controllo
+from elementtypes.models import ElementType, ValoreElementType
+from .istantanea import dimentica_istantanee
+from .models import Campagna, IstantaneaCampagna
+from .sovrapposizione import MODELLI, campagna_modificata, campagne_congelate, dimentica_congelate, escludi, preserva
+
+
+def preserva_riga(sender, instance, raw=False, **kwargs):
+    """Una riga master esistente sta per cambiare: va preservata nelle campagne congelate."""
+    if raw or instance.campagna_id is not None or instance._state.adding:
+        return
+    preserva(sender, instance.pk)
+
+
+def riga_eliminata(sender, instance, origin=None, **kwargs):
+    """
+    Eliminata la copia di una riga master in una campagna a copia su scrittura: l'originale
+    resta nascosto (non quando si elimina la campagna). Eliminata una riga master: le copie
+    create dai pre_delete, dopo la raccolta delle cascate, perdono il riferimento all'originale.
+    """
+    if instance.campagna_id is None:
+        sender.objects.filter(cloned_from_id=instance.pk).update(cloned_from=None)
+    elif instance.cloned_from_id and not (isinstance(origin, Campagna) or getattr(origin, 'model', None) is Campagna):
+        if Campagna.objects.filter(pk=instance.campagna_id, copia_su_scrittura=True).exists():
+            escludi(instance.campagna_id, sender, instance.cloned_from_id)
+
+
+for modello in MODELLI:
+    pre_save.connect(preserva_riga, sender=modello, dispatch_uid=f'preserva_{modello._meta.label}')
+    pre_delete.connect(preserva_riga, sender=modello, dispatch_uid=f'preserva_eliminata_{modello._meta.label}')
+    post_delete.connect(riga_eliminata, sender=modello, dispatch_uid=f'eliminata_{modello._meta.label}')
+
+
+@receiver(pre_save, sender=Controllo)
+@receiver(pre_delete, sender=Controllo)
+def preserva_elementtype_controllo(sender, instance, raw=False, **kwargs):
+    # I controlli assegnati fanno parte dell'ElementType letto dalle campagne congelate
+    if raw or instance.campagna_id is not None or not campagne_congelate():
+        return
+    precedente_id = None
+    if not instance._state.adding:
+        precedente_id = Controllo.objects.filter(pk=instance.pk).values_list('elementtype_id', flat=True).first()
+    for elementtype_id in {precedente_id, instance.elementtype_id}:
+        preserva(ElementType, elementtype_id)
+
+
+@receiver(m2m_changed, sender=ElementType.minacce.through)
+@receiver(m2m_changed, sender=ElementType.component_element_types.through)
+def preserva_relazioni_elementtype(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('pre_add', 'pre_remove', 'pre_clear') or not campagne_congelate():
+        return
+    if not reverse:
+        element_types = [instance.pk] if instance.campagna_id is None else []
+    elif pk_set:
+        element_types = pk_set
+    elif sender is ElementType.minacce.through:
+        element_types = sender.objects.filter(minaccia_id=instance.pk).values_list('elementtype_id', flat=True)
+    else:
+        element_types = sender.objects.filter(to_elementtype_id=instance.pk).values_list('from_elementtype_id', flat=True)
+    for elementtype_id in list(element_types):
+        preserva(ElementType, elementtype_id)
+
+
+@receiver(pre_save, sender=ValoreElementType)
+def preserva_valori_elementtype(sender, instance, raw=False, **kwargs):
+    # Nessun pre_delete: disattiverebbe la cancellazione rapida delle matrici
+    if not raw:
+        preserva(ElementType, instance.elementtype_id)
+
+
+@receiver(pre_save, sender=NodoStruttura)
+@receiver(pre_delete, sender=NodoStruttura)
+def preserva_albero_asset(sender, instance, raw=False, **kwargs):
+    if not raw and instance.campagna_id is None:
+        preserva(Asset, instance.asset_id)
+
+
+@receiver(pre_save, sender=NodoTemplate)
+@receiver(pre_delete, sender=NodoTemplate)
+def preserva_albero_template(sender, instance, raw=False, **kwargs):
+    if not raw and instance.campagna_id is None:
+        preserva(StrutturaTemplate, instance.template_id)
+
+
+# Gli elenchi in memoria delle campagne congelate e con istantanea valgono al più una richiesta
+request_started.connect(dimentica_congelate, dispatch_uid='dimentica_congelate')
+post_save.connect(campagna_modificata, sender=Campagna, dispatch_uid='campagna_salvata')
+post_delete.connect(campagna_modificata, sender=Campagna, dispatch_uid='campagna_eliminata')
+request_started.connect(dimentica_istantanee, dispatch_uid='dimentica_istantanee')
+post_save.connect(dimentica_istantanee, sender=IstantaneaCampagna, dispatch_uid='istantanea_salvata')
+post_delete.connect(dimentica_istantanee, sender=IstantaneaCampagna, dispatch_uid='istantanea_eliminata')
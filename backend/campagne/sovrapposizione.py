@@ -0,0 +1,229 @@
+"""
+Campagne a copia su scrittura (`Campagna.copia_su_scrittura`).
+
+Una campagna di questo tipo non copia i dati master alla creazione: nella
+campagna sono visibili le sue righe più le righe master non ancora copiate
+(`righe`). Quando una riga master viene modificata dall'area della campagna,
+viene prima materializzata (`materializza`): copiata nella campagna con
+`cloned_from` verso l'originale, insieme alle righe master che vi fanno
+riferimento (una minaccia porta con sé gli ElementType che la usano, un
+ElementType i derivati che lo compongono, i suoi controlli e gli alberi che lo
+contengono), così che le chiavi esterne lette nella campagna restino coerenti.
+La copia usa il motore in blocco di `popolamento.py` limitato alle righe
+selezionate; le righe della campagna che puntavano agli originali vengono
+ripuntate sulle copie. Eliminare una copia lascia un'`EsclusioneSovrapposizione`
+che nasconde l'originale.
+
+Alla chiusura la campagna viene congelata: si registra l'id massimo delle righe
+master di ogni modello (le righe create dopo non sono visibili) e, prima di
+ogni modifica o eliminazione di una riga master ancora letta da una campagna
+congelata, la riga viene materializzata nella campagna (`preserva`, dai
+segnali di `signals.py`). Le scritture in blocco (`update`, `bulk_create`)
+non passano dai segnali: chi le esegue su righe master chiama prima
+`preserva_righe` (ricalcolo delle matrici, costruzione in blocco degli alberi,
+abilitazione massiva degli ElementType). L'elenco delle campagne
+congelate, letto a ogni scrittura master, è tenuto in memoria e riletto a ogni
+richiesta e dopo ogni modifica di una campagna (finché la transazione che l'ha
+modificata non è confermata viene riletto a ogni uso: se venisse annullata,
+l'elenco in memoria sarebbe sbagliato).
+"""
+from collections import defaultdict
+
+from django.db import connection, transaction
+from django.db.models import Max, Q
+
+from assets.models import Asset, StrutturaTemplate
+from controlli.models import Controllo
+from elementtypes.models import ElementType
+from minacce.models import Minaccia
+from scenari.models import Scenario
+from .models import Campagna, EsclusioneSovrapposizione
+from .popolamento import Popolamento, mappa_copie
+
+MODELLI = (Scenario, Minaccia, ElementType, Controllo, StrutturaTemplate, Asset)
+
+
+def gestito(modello):
+    """Vero se le righe master del modello sono visibili nelle campagne a copia su scrittura."""
+    return modello in MODELLI
+
+
+def limiti_master():
+    """{modello: id massimo delle righe master} per il congelamento alla chiusura."""
+    return {
+        modello._meta.label: modello.objects.filter(campagna__isnull=True).aggregate(massimo=Max('pk'))['massimo'] or 0
+        for modello in MODELLI
+    }
+
+
+def master_visibili(modello, campagna):
+    """Righe master di `modello` lette nella campagna: non copiate, non escluse, entro il congelamento."""
+    righe = modello.objects.filter(campagna__isnull=True).exclude(
+        pk__in=modello.objects.filter(campagna=campagna, cloned_from__isnull=False).values('cloned_from')
+    ).exclude(
+        pk__in=EsclusioneSovrapposizione.objects.filter(campagna=campagna, modello=modello._meta.label).values('riga_id')
+    )
+    if campagna.sovrapposizione_congelata is not None:
+        righe = righe.filter(pk__lte=campagna.sovrapposizione_congelata.get(modello._meta.label, 0))
+    return righe
+
+
+def righe(modello, campagna, queryset=None):
+    """
+    Righe di `modello` (o di `queryset`) della campagna: le sue e, se è a copia su
+    scrittura, quelle master visibili.
+    """
+    if queryset is None:
+        queryset = modello.objects.all()
+    if not campagna.copia_su_scrittura or not gestito(modello):
+        return queryset.filter(campagna=campagna)
+    return queryset.filter(Q(campagna=campagna) | Q(pk__in=master_visibili(modello, campagna).values('pk')))
+
+
+def righe_per_campagna(queryset, campagna_id):
+    """Come `righe`, a partire dall'id della campagna (filtri e form dell'admin)."""
+    campagna = Campagna.objects.filter(pk=campagna_id).first()
+    if campagna is None:
+        return queryset.filter(campagna_id=campagna_id)
+    return righe(queryset.model, campagna, queryset)
+
+
+def campagna_sovrapposta(campagna_id):
+    """La campagna se è a copia su scrittura, altrimenti None."""
+    if not campagna_id:
+        return None
+    return Campagna.objects.filter(pk=campagna_id, copia_su_scrittura=True).first()
+
+
+def _referenti(modello, pk, campagna):
+    """Righe master visibili che fanno riferimento alla riga: [(modello, queryset di id)]."""
+    def visibili(altro, **filtro):
+        return (altro, master_visibili(altro, campagna).filter(**filtro).values_list('pk', flat=True).distinct())
+
+    if modello is Scenario:
+        return [visibili(Minaccia, scenario_id=pk)]
+    if modello is Minaccia:
+        return [visibili(ElementType, minacce=pk), visibili(ElementType, valori_matrice__minaccia_id=pk)]
+    if modello is Controllo:
+        return [visibili(ElementType, valori_matrice__controllo_id=pk)]
+    if modello is ElementType:
+        return [
+            visibili(ElementType, component_element_types=pk),
+            visibili(Controllo, elementtype_id=pk),
+            visibili(StrutturaTemplate, nodi_template__element_type_id=pk),
+            visibili(Asset, nodi_struttura__element_type_id=pk),
+        ]
+    if modello is StrutturaTemplate:
+        return [visibili(Asset, template_da_applicare_id=pk)]
+    return []
+
+
+def da_materializzare(campagna, modello, pk):
+    """{modello: {id}} della riga master e, transitivamente, delle righe master che vi fanno riferimento."""
+    selezione = defaultdict(set)
+    coda = [(modello, pk)]
+    while coda:
+        modello, pk = coda.pop()
+        if pk in selezione[modello]:
+            continue
+        selezione[modello].add(pk)
+        for referente, ids in _referenti(modello, pk, campagna):
+            coda.extend((referente, rif_id) for rif_id in ids if rif_id not in selezione[referente])
+    return dict(selezione)
+
+
+@transaction.atomic
+def materializza(campagna, modello, pk):
+    """
+    Restituisce la copia nella campagna della riga `pk` di `modello`, creandola (con le
+    righe che vi fanno riferimento) se la riga è master e non è ancora stata copiata.
+    """
+    riga = modello.objects.get(pk=pk)
+    if riga.campagna_id == campagna.pk:
+        return riga
+    copia_id = mappa_copie(modello, campagna.pk).get(pk)
+    if copia_id is None:
+        Popolamento(campagna, selezione=da_materializzare(campagna, modello, pk)).esegui()
+        copia_id = mappa_copie(modello, campagna.pk)[pk]
+    return modello.objects.get(pk=copia_id)
+
+
+# Elenco in memoria delle campagne congelate e campagne modificate in una transazione non ancora confermata
+_congelate = None
+_modifiche_in_sospeso = False
+
+
+def campagne_congelate():
+    """Campagne a copia su scrittura chiuse, la cui vista dei dati master va preservata."""
+    global _congelate
+    if _congelate is not None:
+        return _congelate
+    congelate = list(Campagna.objects.filter(copia_su_scrittura=True, sovrapposizione_congelata__isnull=False))
+    if not _modifiche_in_sospeso:
+        _congelate = congelate
+    return congelate
+
+
+def dimentica_congelate(**kwargs):
+    """Scarta l'elenco delle campagne congelate (receiver di `request_started`)."""
+    global _congelate, _modifiche_in_sospeso
+    _congelate = None
+    if not connection.in_atomic_block:
+        _modifiche_in_sospeso = False
+
+
+def _modifiche_confermate():
+    global _congelate, _modifiche_in_sospeso
+    _congelate, _modifiche_in_sospeso = None, False
+
+
+def campagna_modificata(**kwargs):
+    """Una campagna è stata salvata o eliminata: l'elenco va riletto, e non tenuto finché non è confermata."""
+    global _congelate, _modifiche_in_sospeso
+    _congelate = None
+    if connection.in_atomic_block:
+        _modifiche_in_sospeso = True
+        transaction.on_commit(_modifiche_confermate)
+
+
+def preserva(modello, pk):
+    """
+    Prima di modificare o eliminare la riga master, la materializza nelle campagne
+    congelate che ancora la leggono, che continuano così a vederla com'era alla chiusura.
+    """
+    if pk is None:
+        return
+    for campagna in campagne_congelate():
+        if master_visibili(modello, campagna).filter(pk=pk).exists():
+            materializza(campagna, modello, pk)
+
+
+def preserva_righe(modello, pks):
+    """Come `preserva`, per le righe master `pks` di una scrittura in blocco (una query per campagna congelata)."""
+    pks = {pk for pk in pks if pk is not None}
+    if not pks:
+        return
+    for campagna in campagne_congelate():
+        for pk in list(master_visibili(modello, campagna).filter(pk__in=pks).values_list('pk', flat=True)):
+            materializza(campagna, modello, pk)
+
+
+def escludi(campagna_id, modello, pk):
+    """Nasconde la riga master `pk` nella campagna (la sua copia è stata eliminata)."""
+    EsclusioneSovrapposizione.objects.get_or_create(campagna_id=campagna_id, modello=modello._meta.label, riga_id=pk)
+
+
+def grafo_sovrapposto(campagna_id):
+    """
+    Grafo di derivazione letto nella campagna (formato di `closure.carica_grafo`): gli archi
+    dei suoi ElementType e quelli degli ElementType master non copiati, con i componenti
+    master sostituiti dalle loro copie.
+    """
+    copie = mappa_copie(ElementType, campagna_id)
+    archi = ElementType.component_element_types.through.objects.filter(
+        Q(from_elementtype__campagna_id=campagna_id) | Q(from_elementtype__campagna__isnull=True)
+    ).exclude(from_elementtype_id__in=copie).values_list('from_elementtype_id', 'to_elementtype_id')
+    grafo = {}
+    for padre_id, figlio_id in archi:
+        grafo.setdefault(padre_id, []).append(copie.get(figlio_id, figlio_id))
+    return grafo
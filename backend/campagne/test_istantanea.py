@@ -0,0 +1,156 @@
+from datetime import date
+
+from django.contrib.auth.models import User
+from django.db.models import Count
+from django.test import TestCase
+
+from assets.matrici import matrice_sottoalbero
+from assets.models import Asset, NodoStruttura, NodoTemplate, StrutturaTemplate
+from assets.views import AssetViewSet
+from controlli.models import Controllo
+from core.testing import RichiesteAutenticate
+from elementtypes.models import ElementType, ValoreElementType
+from elementtypes.views import ElementTypeViewSet
+from minacce.models import Minaccia
+from scenari.models import Scenario
+from .istantanea import conteggi, dimentica_istantanee, leggi
+from .models import Campagna, IstantaneaCampagna, VoceIstantanea
+
+
+class IstantaneaCampagnaTest(TestCase):
+
+    def setUp(self):
+        scenario = Scenario.objects.create(descrizione="Scenario")
+        minacce = [Minaccia.objects.create(descrizione=f"M{i}", scenario=scenario) for i in range(2)]
+        basi = []
+        for k in range(2):
+            base = ElementType.objects.create(nome=f"base {k}")
+            base.minacce.set([minacce[k]])
+            controllo = Controllo.objects.create(
+                nome=f"C{k}", descrizione="", tipologia_controllo="Tecnologico",
+                categoria_controllo="preventive", elementtype=base,
+            )
+            ValoreElementType.objects.create(elementtype=base, minaccia=minacce[k], controllo=controllo, valore=(0.2, 0.3)[k])
+            basi.append(base)
+        derivato = ElementType.objects.create(nome="derivato", is_base=False)
+        derivato.component_element_types.add(*basi)
+        ElementType.objects.aggregazione(derivato, basi)
+
+        template = StrutturaTemplate.objects.create(nome="Template")
+        with self.captureOnCommitCallbacks(execute=True):
+            asset = Asset.objects.create(nome="Asset")
+            radice = asset.nodi_struttura.get(level=0)
+            NodoStruttura.objects.create(asset=asset, element_type=derivato, parent=radice, nome_specifico="Derivato")
+            NodoTemplate.objects.create(template=template, element_type=basi[1])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.campagna = Campagna.objects.create(
+                anno=2030, descrizione="Campagna", data_inizio=date(2030, 1, 1), data_fine=date(2030, 12, 31)
+            )
+        self.asset = Asset.objects.get(campagna=self.campagna)
+        self.derivato = ElementType.objects.get(campagna=self.campagna, nome="derivato")
+
+    def _api(self, viewset, azione, pk):
+        return viewset.as_view({'get': azione})(RichiesteAutenticate().get('/'), pk=pk).data
+
+    def _chiudi(self):
+        self.campagna.status = 'close'
+        self.campagna.save()
+
+    def test_chiusura_crea_le_voci(self):
+        self.assertFalse(IstantaneaCampagna.objects.exists())
+        self._chiudi()
+        istantanea = self.campagna.istantanea
+        self.assertEqual(istantanea.conteggi, conteggi(self.campagna))
+        nodi = self.asset.nodi_struttura.count()
+        self.assertGreater(nodi, 2)
+        self.assertEqual(istantanea.conteggi['nodistruttura_count'], nodi)
+        tipi = dict(istantanea.voci.values('tipo').annotate(n=Count('id')).values_list('tipo', 'n'))
+        self.assertEqual(tipi, {
+            VoceIstantanea.ELEMENTTYPE: ElementType.objects.filter(campagna=self.campagna).count(),
+            VoceIstantanea.ASSET: 1, VoceIstantanea.NODO: nodi,
+            VoceIstantanea.ALBERO_ASSET: 1, VoceIstantanea.ALBERO_TEMPLATE: 1,
+        })
+
+    def test_voci_uguali_al_calcolo(self):
+        attese = {
+            nodo.pk: sorted(matrice_sottoalbero(nodo).celle()) for nodo in self.asset.nodi_struttura.all()
+        }
+        minacce = set(self.derivato.get_all_minacce())
+        controlli = set(self.derivato.get_all_controlli())
+        dimensione = self._api(ElementTypeViewSet, 'retrieve', self.derivato.pk)['matrix_dimension']
+        albero = self._api(AssetViewSet, 'albero', self.asset.pk)['nodi']
+        self._chiudi()
+
+        for nodo in self.asset.nodi_struttura.all():
+            self.assertEqual(sorted(nodo.get_matrice_sottoalbero().celle()), attese[nodo.pk])
+        self.assertEqual(sorted(self.asset.get_matrice().celle()), attese[self.asset.nodi_struttura.get(level=0).pk])
+        self.assertEqual(set(self.derivato.get_all_minacce()), minacce)
+        self.assertEqual(set(self.derivato.get_all_controlli()), controlli)
+        self.assertEqual(self._api(ElementTypeViewSet, 'retrieve', self.derivato.pk)['matrix_dimension'], dimensione)
+        self.assertEqual(self._api(AssetViewSet, 'albero', self.asset.pk)['nodi'], albero)
+
+    def test_letture_dall_istantanea(self):
+        self._chiudi()
+        radice = self.asset.nodi_struttura.get(level=0)
+        celle = sorted(radice.get_matrice_sottoalbero().celle())
+        # Dati modificati in blocco dopo la chiusura: le letture restano quelle dell'istantanea
+        ValoreElementType.objects.filter(elementtype__campagna=self.campagna).delete()
+        self.assertEqual(sorted(radice.get_matrice_sottoalbero().celle()), celle)
+        with self.assertNumQueries(1):
+            radice.get_matrice_sottoalbero()
+        risposta = self._api(ElementTypeViewSet, 'matrice', self.derivato.pk)
+        self.assertTrue(any(any(riga) for riga in risposta['valori']))
+
+        self.client.force_login(User.objects.create_superuser("admin", password="x"))
+        with self.assertNumQueries(6):
+            risposta = self.client.get(f'/admin/campagne/campagna/{self.campagna.pk}/dashboard/')
+        self.assertEqual(risposta.context['campagna'].assets_count, 1)
+
+    def test_riapertura_scarta_l_istantanea(self):
+        self._chiudi()
+        self.campagna.status = 'open'
+        self.campagna.save()
+        self.assertFalse(IstantaneaCampagna.objects.exists())
+        self.assertFalse(VoceIstantanea.objects.exists())
+        ValoreElementType.objects.filter(elementtype__campagna=self.campagna).delete()
+        self.assertEqual(self.derivato.get_all_minacce().count(), 2)
+        radice = self.asset.nodi_struttura.get(level=0)
+        self.assertEqual(sorted(radice.get_matrice_sottoalbero().celle()), sorted(matrice_sottoalbero(radice).celle()))
+
+    def test_campagne_aperte_senza_query(self):
+        dimentica_istantanee()
+        radice = self.asset.nodi_struttura.get(level=0)
+        master = ElementType.objects.get(campagna=None, nome="derivato")
+        # Solo l'elenco delle campagne con istantanea, letto una volta
+        with self.assertNumQueries(1):
+            self.assertIsNone(leggi(VoceIstantanea.ASSET, self.asset))
+            self.assertIsNone(leggi(VoceIstantanea.NODO, radice))
+            self.assertIsNone(leggi(VoceIstantanea.ELEMENTTYPE, self.derivato))
+        with self.assertNumQueries(0):
+            self.assertIsNone(leggi(VoceIstantanea.ELEMENTTYPE, self.derivato))
+            self.assertIsNone(leggi(VoceIstantanea.ELEMENTTYPE, master))
+        self._chiudi()
+        with self.assertNumQueries(2):
+            self.assertIsNotNone(leggi(VoceIstantanea.ELEMENTTYPE, self.derivato))
+
+    def test_copia_su_scrittura_include_le_righe_master(self):
+        master = ElementType.objects.get(campagna=None, nome="derivato")
+        asset = Asset.objects.get(campagna=None)
+        campagne = []
+        for anno in (2031, 2032):
+            with self.captureOnCommitCallbacks(execute=True):
+                campagna = Campagna.objects.create(
+                    anno=anno, descrizione=f"Sovrapposta {anno}", data_inizio=date(anno, 1, 1),
+                    data_fine=date(anno, 12, 31), copia_su_scrittura=True,
+                )
+            campagna.status = 'close'
+            campagna.save()
+            campagne.append(campagna)
+        for campagna in campagne:
+            voce = leggi(VoceIstantanea.ELEMENTTYPE, master, campagna.pk)
+            self.assertEqual(voce.istantanea, campagna.istantanea)
+            self.assertEqual(set(voce.dati['minacce']), set(master.get_all_minacce().values_list('pk', flat=True)))
+            self.assertIsNotNone(leggi(VoceIstantanea.ASSET, asset, campagna.pk))
+            self.assertEqual(campagna.istantanea.voci.filter(tipo=VoceIstantanea.ALBERO_ASSET).get().oggetto_id, asset.pk)
+        self.assertIsNone(leggi(VoceIstantanea.ELEMENTTYPE, master))
+
@@ -0,0 +1,164 @@
+import os
+import subprocess
+import sys
+from datetime import date, timedelta
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import RequestFactory, TestCase, override_settings
+from django.utils import timezone
+
+from assets.models import Asset
+from controlli.models import Controllo
+from controlli.views import ControlloViewSet
+from core.testing import RichiesteAutenticate
+from elementtypes.models import ElementType
+from minacce.models import Minaccia
+from scenari.models import Scenario
+from .lavori import prendi_in_carico, recupera_interrotti
+from .models import Campagna, PopolamentoCampagna
+from .popolamento import Popolamento
+from .views import campagna_popolamento_view
+
+
+@override_settings(POPOLAMENTO_AVVIA_WORKER=False)
+class PopolamentoInBackgroundTest(TestCase):
+
+    def setUp(self):
+        scenario = Scenario.objects.create(descrizione="Scenario")
+        minaccia = Minaccia.objects.create(descrizione="M", scenario=scenario)
+        base = ElementType.objects.create(nome="base")
+        base.minacce.set([minaccia])
+        Controllo.objects.create(
+            nome="C", descrizione="", tipologia_controllo="Tecnologico", categoria_controllo="preventive", elementtype=base,
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            Asset.objects.create(nome="Asset")
+
+    def _crea_campagna(self, in_background=True):
+        campagna = Campagna(anno=2030, descrizione="Campagna", data_inizio=date(2030, 1, 1), data_fine=date(2030, 12, 31))
+        campagna.popolamento_in_background = in_background
+        with self.captureOnCommitCallbacks(execute=True):
+            campagna.save()
+        return campagna
+
+    def _stato(self, campagna):
+        vista = RequestFactory().get('/')
+        vista.user = User.objects.create_user("staff", is_staff=True)
+        return campagna_popolamento_view(vista, campagna.pk)
+
+    def test_accodato_e_eseguito_dal_worker(self):
+        campagna = self._crea_campagna()
+        lavoro = campagna.popolamenti.get()
+        self.assertEqual((lavoro.stato, lavoro.fasi_totali), (PopolamentoCampagna.IN_CODA, len(Popolamento.FASI)))
+        self.assertFalse(Campagna.objects.get(pk=campagna.pk).pronta)
+        self.assertFalse(Controllo.objects.filter(campagna=campagna).exists())
+
+        call_command('esegui_popolamenti', stdout=mock.Mock())
+        lavoro.refresh_from_db()
+        self.assertEqual(lavoro.stato, PopolamentoCampagna.COMPLETATO)
+        self.assertEqual(lavoro.fasi_completate, len(Popolamento.FASI))
+        self.assertEqual([fase['fase'] for fase in lavoro.avanzamento], [fase for fase, _ in Popolamento.FASI])
+        self.assertEqual(next(fase['righe'] for fase in lavoro.avanzamento if fase['fase'] == 'controlli'), 1)
+        self.assertIsNotNone(lavoro.terminato_il)
+        self.assertTrue(Campagna.objects.get(pk=campagna.pk).pronta)
+        self.assertEqual(Asset.objects.filter(campagna=campagna).count(), 1)
+        self.assertEqual(self._stato(campagna).status_code, 200)
+
+    def test_worker_avviato_al_commit(self):
+        with override_settings(POPOLAMENTO_AVVIA_WORKER=True), mock.patch('campagne.lavori.subprocess.Popen') as popen:
+            self._crea_campagna()
+        popen.assert_called_once()
+        self.assertEqual(popen.call_args.args[0][-1], 'esegui_popolamenti')
+
+    def test_presa_in_carico_esclusiva(self):
+        lavoro = self._crea_campagna().popolamenti.get()
+        self.assertTrue(prendi_in_carico(lavoro))
+        self.assertFalse(prendi_in_carico(PopolamentoCampagna.objects.get(pk=lavoro.pk)))
+
+    def test_errore_registrato_e_dati_parziali_eliminati(self):
+        campagna = self._crea_campagna()
+        with mock.patch.object(Popolamento, '_asset', side_effect=RuntimeError("disco pieno")), self.assertLogs(level='ERROR'):
+            call_command('esegui_popolamenti', stdout=mock.Mock(), stderr=mock.Mock())
+        lavoro = campagna.popolamenti.get()
+        self.assertEqual(lavoro.stato, PopolamentoCampagna.ERRORE)
+        self.assertIn("disco pieno", lavoro.errore)
+        self.assertEqual(lavoro.fasi_completate, Popolamento.FASI.index(('asset', '_asset')))
+        self.assertFalse(Campagna.objects.get(pk=campagna.pk).pronta)
+        for modello in (Scenario, Minaccia, ElementType, Controllo, Asset):
+            self.assertFalse(modello.objects.filter(campagna=campagna).exists(), modello.__name__)
+        dati = self._stato(campagna).content.decode()
+        self.assertIn('"stato": "errore"', dati)
+
+    def test_popolamento_sincrono(self):
+        campagna = self._crea_campagna(in_background=False)
+        self.assertTrue(campagna.pronta)
+        self.assertTrue(Campagna.objects.get(pk=campagna.pk).pronta)
+        self.assertEqual(campagna.popolamenti.get().stato, PopolamentoCampagna.COMPLETATO)
+        self.assertEqual(Controllo.objects.filter(campagna=campagna).count(), 1)
+
+    def test_lavoro_interrotto_recuperato_e_ripetuto(self):
+        campagna = self._crea_campagna()
+        lavoro = campagna.popolamenti.get()
+        self.assertTrue(prendi_in_carico(lavoro))
+        # Il worker muore dopo aver registrato una fase
+        Scenario.objects.create(descrizione="Parziale", campagna=campagna)
+        self.assertEqual(recupera_interrotti(), [])
+        PopolamentoCampagna.objects.filter(pk=lavoro.pk).update(aggiornato_il=timezone.now() - timedelta(hours=1))
+
+        self.client.force_login(User.objects.create_superuser("admin", password="x"))
+        with self.assertLogs(level='WARNING'):
+            self.client.post('/admin/campagne/campagna/', {
+                'action': 'riaccoda_popolamento', '_selected_action': [campagna.pk],
+            })
+        lavoro.refresh_from_db()
+        self.assertEqual(lavoro.stato, PopolamentoCampagna.ERRORE)
+        self.assertIn("Interrotto", lavoro.errore)
+        self.assertFalse(Scenario.objects.filter(campagna=campagna).exists())
+        nuovo = campagna.popolamenti.get(stato=PopolamentoCampagna.IN_CODA)
+
+        call_command('esegui_popolamenti', stdout=mock.Mock())
+        nuovo.refresh_from_db()
+        self.assertEqual(nuovo.stato, PopolamentoCampagna.COMPLETATO)
+        self.assertTrue(Campagna.objects.get(pk=campagna.pk).pronta)
+
+    def test_api_campagna_non_pronta(self):
+        campagna = self._crea_campagna()
+        elenco = ControlloViewSet.as_view({'get': 'list'})
+        dettaglio = ControlloViewSet.as_view({'get': 'retrieve'})
+        richiesta = RichiesteAutenticate().get('/', {'campagna': campagna.pk})
+        self.assertEqual(elenco(richiesta).status_code, 409)
+        # Le righe parziali non compaiono negli elenchi senza filtro e il loro dettaglio risponde 409
+        parziale = Controllo.objects.create(
+            nome="Parziale", descrizione="", tipologia_controllo="Tecnologico", categoria_controllo="preventive",
+            campagna=campagna,
+        )
+        risposta = elenco(RichiesteAutenticate().get('/'))
+        self.assertNotIn(parziale.pk, [controllo['id'] for controllo in risposta.data['results']])
+        self.assertEqual(dettaglio(RichiesteAutenticate().get('/'), pk=parziale.pk).status_code, 409)
+        parziale.delete()
+
+        call_command('esegui_popolamenti', stdout=mock.Mock())
+        risposta = elenco(RichiesteAutenticate().get('/', {'campagna': campagna.pk}))
+        self.assertEqual(risposta.status_code, 200)
+        self.assertEqual(len(risposta.data['results']), 1)
+        copia = risposta.data['results'][0]['id']
+        self.assertEqual(dettaglio(RichiesteAutenticate().get('/'), pk=copia).status_code, 200)
+        self.assertEqual(len(elenco(RichiesteAutenticate().get('/')).data['results']), 2)
+
+    def test_lavoro_di_un_worker_attivo_non_recuperato(self):
+        lavoro = self._crea_campagna().popolamenti.get()
+        self.assertTrue(prendi_in_carico(lavoro))
+        self.assertEqual(lavoro.processo, os.getpid())
+        # Una fase più lunga della scadenza: il worker (qui il processo padre) è ancora vivo
+        PopolamentoCampagna.objects.filter(pk=lavoro.pk).update(
+            processo=os.getppid(), aggiornato_il=timezone.now() - timedelta(hours=1)
+        )
+        self.assertEqual(recupera_interrotti(), [])
+        terminato = subprocess.Popen([sys.executable, '-c', ''])
+        terminato.wait()
+        PopolamentoCampagna.objects.filter(pk=lavoro.pk).update(processo=terminato.pid)
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual([recuperato.pk for recuperato in recupera_interrotti()], [lavoro.pk])
+
@@ -0,0 +1,153 @@
+from datetime import date
+from unittest import mock
+
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from assets.models import Asset, NodoStruttura, NodoTemplate, StrutturaTemplate
+from controlli.models import Controllo
+from elementtypes.models import ElementType, ValoreElementType
+from minacce.models import Minaccia
+from scenari.models import Scenario
+from .models import Campagna
+from .popolamento import Popolamento
+
+
+class PopolamentoTest(TestCase):
+
+    def setUp(self):
+        scenario = Scenario.objects.create(descrizione="Scenario")
+        self.minacce = [Minaccia.objects.create(descrizione=f"M{i}", scenario=scenario) for i in range(2)]
+        self.basi = []
+        for k in range(2):
+            base = ElementType.objects.create(nome=f"base {k}")
+            base.minacce.set(self.minacce)
+            controllo = Controllo.objects.create(
+                nome=f"C{k}", descrizione="", tipologia_controllo="Tecnologico",
+                categoria_controllo="preventive", elementtype=base,
+            )
+            ValoreElementType.objects.create(elementtype=base, minaccia=self.minacce[k], controllo=controllo, valore=0.3 + 0.2 * k)
+            self.basi.append(base)
+        self.derivato = ElementType.objects.create(nome="derivato", is_base=False)
+        self.derivato.component_element_types.add(self.basi[1])
+        self.derivato.component_element_types.add(self.basi[0])
+        ElementType.objects.aggregazione(self.derivato, self.basi)
+
+        self.template = StrutturaTemplate.objects.create(nome="Template")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.asset = Asset.objects.create(nome="Asset")
+            radice = self.asset.nodi_struttura.get(level=0)
+            NodoStruttura.objects.create(asset=self.asset, element_type=self.derivato, parent=radice, nome_specifico="Strato")
+            NodoTemplate.objects.create(template=self.template, element_type=self.derivato, parent=NodoTemplate.objects.create(
+                template=self.template, element_type=radice.element_type))
+            Asset.objects.create(nome="Da template", template_da_applicare=self.template)
+
+    def _crea_campagna(self, anno=2030):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Campagna.objects.create(
+                anno=anno, descrizione=f"Campagna {anno}", data_inizio=date(anno, 1, 1), data_fine=date(anno, 12, 31)
+            )
+
+    def _albero(self, asset):
+        return [
+            (nodo.level, nodo.element_type.nome, nodo.nome_specifico)
+            for nodo in asset.nodi_struttura.select_related('element_type').order_by('tree_id', 'lft')
+        ]
+
+    def test_copia_completa_e_rimappata(self):
+        campagna = self._crea_campagna()
+        self.assertEqual([esito.fase for esito in campagna.esiti_popolamento], [fase for fase, _ in Popolamento.FASI])
+        for modello, master in ((Scenario, 1), (Minaccia, 2), (ElementType, 4), (Controllo, 2), (StrutturaTemplate, 1), (Asset, 2)):
+            self.assertEqual(modello.objects.filter(campagna=campagna).count(), master, modello.__name__)
+
+        derivato = ElementType.objects.get(campagna=campagna, nome="derivato")
+        self.assertEqual(derivato.cloned_from, self.derivato)
+        # Componenti copiati nello stesso ordine, chiusura e contatori ricostruiti
+        componenti = ElementType.component_element_types.through.objects.filter(from_elementtype=derivato)
+        self.assertEqual(list(componenti.order_by('id').values_list('to_elementtype__nome', flat=True)), ["base 1", "base 0"])
+        self.assertEqual({et.campagna_id for et in derivato.get_componenti_di_base()}, {campagna.pk})
+        self.assertEqual(derivato.get_dimensione_matrice_display(), "2 x 2 (A)")
+        self.assertEqual(
+            sorted(ValoreElementType.objects.filter(elementtype=derivato).values_list(
+                'minaccia__campagna', 'controllo__campagna', 'valore')),
+            [(campagna.pk, campagna.pk, 0.3), (campagna.pk, campagna.pk, 0.5)],
+        )
+
+        # Alberi copiati così come sono, con gli ElementType della campagna
+        for master in (self.asset, Asset.objects.get(nome="Da template", campagna=None)):
+            copia = Asset.objects.get(campagna=campagna, cloned_from=master)
+            self.assertEqual(self._albero(copia), self._albero(master))
+            self.assertFalse(copia.nodi_struttura.exclude(element_type__campagna=campagna).exists())
+            self.assertFalse(copia.nodi_struttura.exclude(campagna=campagna).exists())
+            self.assertEqual(
+                sorted(valore for _, _, valore in copia.get_matrice().celle()),
+                sorted(valore for _, _, valore in master.get_matrice().celle()),
+            )
+        template = StrutturaTemplate.objects.get(campagna=campagna)
+        self.assertEqual(Asset.objects.get(campagna=campagna, nome="Da template").template_da_applicare, template)
+        self.assertEqual(
+            list(template.nodi_template.order_by('lft').values_list('element_type__nome', 'element_type__campagna')),
+            [("root", campagna.pk), ("derivato", campagna.pk)],
+        )
+
+    def test_storico_per_operazione(self):
+        campagna = self._crea_campagna()
+        self.assertFalse(Controllo.history.filter(campagna=campagna).exists())
+        self.assertFalse(NodoStruttura.history.filter(campagna=campagna).exists())
+        operazione = campagna.operazioni_massive.get()
+        self.assertEqual(operazione.descrizione, f"Clonato nella campagna {campagna}")
+        # L'operazione risponde a "cosa ha creato il popolamento"
+        for modello in (Scenario, Minaccia, ElementType, Controllo, StrutturaTemplate, Asset, NodoStruttura, NodoTemplate):
+            self.assertEqual(
+                set(operazione.oggetti(modello)), set(modello.objects.filter(campagna=campagna)), modello.__name__
+            )
+        self.assertEqual(operazione.righe, sum(voce.righe for voce in operazione.voci.all()))
+
+    def test_storico_per_operazione_interrotta(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            campagna = Campagna.objects.create(
+                anno=2031, descrizione="Vuota", data_inizio=date(2031, 1, 1), data_fine=date(2031, 12, 31),
+                copia_su_scrittura=True,
+            )
+        originale = Popolamento._template
+
+        def template_e_errore(popolamento):
+            originale(popolamento)
+            raise RuntimeError("worker interrotto")
+
+        with mock.patch.object(Popolamento, '_template', template_e_errore), self.assertRaises(RuntimeError):
+            Popolamento(campagna).esegui(transazione_unica=False)
+        # Le fasi già registrate restano con la loro operazione; quella annullata non vi compare
+        self.assertFalse(StrutturaTemplate.objects.filter(campagna=campagna).exists())
+        operazione = campagna.operazioni_massive.get()
+        self.assertFalse(operazione.completata)
+        for modello in (Scenario, Minaccia, ElementType, Controllo):
+            self.assertEqual(
+                set(operazione.oggetti(modello)), set(modello.objects.filter(campagna=campagna)), modello.__name__
+            )
+        self.assertTrue(operazione.oggetti(Controllo).exists())
+        self.assertFalse(operazione.voci.filter(modello='assets.StrutturaTemplate').exists())
+
+    @override_settings(STORICO_PER_OPERAZIONE=False)
+    def test_storico_in_blocco(self):
+        campagna = self._crea_campagna()
+        self.assertFalse(campagna.operazioni_massive.exists())
+        storico = Controllo.history.filter(campagna=campagna)
+        self.assertEqual(storico.count(), 2)
+        self.assertEqual(set(storico.values_list('history_change_reason', 'history_type')), {(f"Clonato nella campagna {campagna}", '+')})
+        self.assertEqual(NodoStruttura.history.filter(campagna=campagna).count(), NodoStruttura.objects.filter(campagna=campagna).count())
+
+    def test_query_indipendenti_dal_numero_di_righe(self):
+        with CaptureQueriesContext(connection) as prima:
+            self._crea_campagna(2030)
+        with self.captureOnCommitCallbacks(execute=True):
+            for i in range(5):
+                Asset.objects.create(nome=f"Altro {i}", template_da_applicare=self.template)
+                Controllo.objects.create(
+                    nome=f"Altro {i}", descrizione="", tipologia_controllo="Processo",
+                    categoria_controllo="detective", elementtype=self.basi[0],
+                )
+        with CaptureQueriesContext(connection) as dopo:
+            self._crea_campagna(2031)
+        self.assertEqual(len(dopo), len(prima))
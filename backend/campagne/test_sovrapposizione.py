@@ -0,0 +1,207 @@
+from datetime import date
+from io import StringIO
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from assets.alberi import FIGLI, inserisci_figli
+from assets.models import Asset, NodoStruttura, NodoTemplate, StrutturaTemplate
+from controlli.models import Controllo
+from elementtypes.models import ElementType, MatriceCompatta, ValoreElementType
+from minacce.models import Minaccia
+from scenari.models import Scenario
+from .models import Campagna
+from .sovrapposizione import campagne_congelate, dimentica_congelate, materializza, righe
+
+
+class CopiaSuScritturaTest(TestCase):
+
+    def setUp(self):
+        self.scenario = Scenario.objects.create(descrizione="Scenario")
+        self.minacce = [Minaccia.objects.create(descrizione=f"M{i}", scenario=self.scenario) for i in range(2)]
+        self.basi, self.controlli = [], []
+        for k in range(2):
+            base = ElementType.objects.create(nome=f"base {k}")
+            base.minacce.set([self.minacce[k]])
+            controllo = Controllo.objects.create(
+                nome=f"C{k}", descrizione="", tipologia_controllo="Tecnologico",
+                categoria_controllo="preventive", elementtype=base,
+            )
+            ValoreElementType.objects.create(elementtype=base, minaccia=self.minacce[k], controllo=controllo, valore=0.3)
+            self.basi.append(base)
+            self.controlli.append(controllo)
+        self.derivato = ElementType.objects.create(nome="derivato", is_base=False)
+        self.derivato.component_element_types.add(*self.basi)
+        ElementType.objects.aggregazione(self.derivato, self.basi)
+
+        self.template = StrutturaTemplate.objects.create(nome="Template")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.asset = Asset.objects.create(nome="Asset")
+            radice = self.asset.nodi_struttura.get(level=0)
+            NodoStruttura.objects.create(asset=self.asset, element_type=self.basi[0], parent=radice, nome_specifico="Solo base")
+            NodoTemplate.objects.create(template=self.template, element_type=self.basi[1])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.campagna = Campagna.objects.create(
+                anno=2030, descrizione="Campagna", data_inizio=date(2030, 1, 1), data_fine=date(2030, 12, 31),
+                copia_su_scrittura=True,
+            )
+
+    def test_creazione_senza_copia(self):
+        self.assertTrue(Campagna.objects.get(pk=self.campagna.pk).pronta)
+        self.assertFalse(self.campagna.popolamenti.exists())
+        for modello in (Scenario, Minaccia, ElementType, Controllo, StrutturaTemplate, Asset):
+            self.assertFalse(modello.objects.filter(campagna=self.campagna).exists(), modello.__name__)
+            self.assertEqual(
+                set(righe(modello, self.campagna)), set(modello.objects.filter(campagna__isnull=True)), modello.__name__
+            )
+
+    def test_materializza_solo_la_riga_senza_referenti(self):
+        copia = materializza(self.campagna, Asset, self.asset.pk)
+        self.assertEqual((copia.campagna, copia.cloned_from), (self.campagna, self.asset))
+        self.assertEqual(materializza(self.campagna, Asset, self.asset.pk), copia)
+        self.assertEqual(list(righe(Asset, self.campagna)), [copia])
+        # Gli ElementType non modificati restano quelli master
+        self.assertEqual(
+            list(copia.nodi_struttura.order_by('lft').values_list('element_type_id', flat=True)),
+            list(self.asset.nodi_struttura.order_by('lft').values_list('element_type_id', flat=True)),
+        )
+        self.assertFalse(copia.nodi_struttura.exclude(campagna=self.campagna).exists())
+        self.assertEqual(sorted(copia.get_matrice().celle()), sorted(self.asset.get_matrice().celle()))
+        self.assertEqual(ElementType.objects.filter(campagna=self.campagna).count(), 0)
+
+    def test_materializza_con_i_referenti(self):
+        base = materializza(self.campagna, ElementType, self.basi[0].pk)
+        self.assertEqual(base.cloned_from, self.basi[0])
+        # Il derivato che la compone, il suo controllo e l'asset che la contiene seguono la copia
+        derivato = ElementType.objects.get(campagna=self.campagna, cloned_from=self.derivato)
+        self.assertEqual(set(derivato.get_componenti_di_base()), {base, self.basi[1]})
+        self.assertEqual(Controllo.objects.get(campagna=self.campagna).elementtype, base)
+        self.assertEqual(
+            set(ValoreElementType.objects.filter(elementtype=derivato).values_list('controllo__campagna', flat=True)),
+            {self.campagna.pk, None},
+        )
+        asset = Asset.objects.get(campagna=self.campagna)
+        self.assertTrue(asset.nodi_struttura.filter(element_type=base).exists())
+        self.assertFalse(StrutturaTemplate.objects.filter(campagna=self.campagna).exists())
+        # La campagna vede una sola versione di ogni riga, il master è invariato
+        self.assertEqual(set(righe(ElementType, self.campagna)), {base, derivato, self.basi[1]} | set(
+            ElementType.objects.filter(campagna__isnull=True, nome='root')))
+        self.assertEqual(ElementType.objects.filter(campagna__isnull=True).count(), 4)
+        self.derivato.refresh_from_db()
+        self.assertEqual(derivato.get_dimensione_matrice_display(), self.derivato.get_dimensione_matrice_display())
+
+    def test_righe_della_campagna_ripuntate_sulle_copie(self):
+        proprio = Controllo.objects.create(
+            nome="Proprio", descrizione="", tipologia_controllo="Processo", categoria_controllo="detective",
+            elementtype=self.basi[1], campagna=self.campagna,
+        )
+        composto = ElementType.objects.create(nome="composto", is_base=False, campagna=self.campagna)
+        composto.component_element_types.add(self.derivato)
+        # Chiusura della campagna calcolata anche attraverso il grafo master
+        self.assertEqual(set(composto.get_componenti_di_base()), set(self.basi))
+
+        base = materializza(self.campagna, ElementType, self.basi[1].pk)
+        proprio.refresh_from_db()
+        self.assertEqual(proprio.elementtype, base)
+        derivato = ElementType.objects.get(campagna=self.campagna, cloned_from=self.derivato)
+        self.assertEqual(list(composto.component_element_types.all()), [derivato])
+        self.assertEqual(set(composto.get_componenti_di_base()), {self.basi[0], base})
+
+    def test_chiusura_congela_la_vista_dei_dati_master(self):
+        self.campagna.status = 'close'
+        self.campagna.save()
+        self.assertEqual(self.campagna.sovrapposizione_congelata['controlli.Controllo'], self.controlli[1].pk)
+
+        self.controlli[0].nome = "C0 rinominato"
+        self.controlli[0].save()
+        Scenario.objects.create(descrizione="Nuovo scenario")
+        self.assertEqual(
+            sorted(righe(Controllo, self.campagna).values_list('nome', flat=True)), ["C0", "C1"]
+        )
+        self.assertEqual(list(righe(Scenario, self.campagna)), [self.scenario])
+        self.assertEqual(Controllo.objects.get(campagna=self.campagna).cloned_from, self.controlli[0])
+
+        self.assertEqual(ElementType.objects.filter(campagna=self.campagna, cloned_from=self.basi[1]).count(), 0)
+        self.basi[1].minacce.clear()
+        copia = ElementType.objects.get(campagna=self.campagna, cloned_from=self.basi[1])
+        self.assertEqual(list(copia.minacce.all()), [self.minacce[1]])
+
+        self.campagna.status = 'open'
+        self.campagna.save()
+        self.assertIsNone(Campagna.objects.get(pk=self.campagna.pk).sovrapposizione_congelata)
+
+    def test_scritture_in_blocco_preservate(self):
+        self.campagna.status = 'close'
+        self.campagna.save()
+        # Matrice del derivato non aggiornata: il ricalcolo master la riscrive in blocco
+        ValoreElementType.objects.filter(elementtype=self.derivato).update(valore=0.99)
+        MatriceCompatta.objects.filter(elementtype=self.derivato).delete()
+        call_command('ricalcola_matrici', '--master', '--processi', '1', stdout=StringIO())
+        self.assertEqual(set(self.derivato.valori_matrice.values_list('valore', flat=True)), {0.3})
+        copia = ElementType.objects.get(campagna=self.campagna, cloned_from=self.derivato)
+        self.assertEqual(set(copia.valori_matrice.values_list('valore', flat=True)), {0.99})
+
+        radice = self.asset.nodi_struttura.get(level=0)
+        inserisci_figli(radice, [{'asset_id': self.asset.pk, 'element_type_id': self.basi[1].pk, FIGLI: []}])
+        self.assertEqual(self.asset.nodi_struttura.count(), 3)
+        self.assertEqual(Asset.objects.get(campagna=self.campagna, cloned_from=self.asset).nodi_struttura.count(), 2)
+
+    def test_eliminazione_della_copia_nasconde_il_master(self):
+        materializza(self.campagna, Asset, self.asset.pk).delete()
+        self.assertFalse(righe(Asset, self.campagna).exists())
+        self.assertTrue(Asset.objects.filter(pk=self.asset.pk).exists())
+        self.campagna.delete()
+
+    def test_modifica_dall_admin(self):
+        self.client.force_login(User.objects.create_superuser("admin", password="x"))
+        url = f"/admin/scenari/scenario/{self.scenario.pk}/change/?campagna__id__exact={self.campagna.pk}"
+        self.assertEqual(self.client.get(url).status_code, 200)
+        risposta = self.client.post(url, {'descrizione': "Scenario della campagna"})
+        self.assertEqual(risposta.status_code, 302)
+        self.assertEqual(Scenario.objects.get(campagna=self.campagna).descrizione, "Scenario della campagna")
+        self.assertEqual(Scenario.objects.get(pk=self.scenario.pk).descrizione, "Scenario")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            completa = Campagna.objects.create(
+                anno=2031, descrizione="Completa", data_inizio=date(2031, 1, 1), data_fine=date(2031, 12, 31)
+            )
+        url = f"/admin/scenari/scenario/{self.scenario.pk}/change/?campagna__id__exact={completa.pk}"
+        with self.assertLogs('django.request', level='WARNING'):
+            self.assertEqual(self.client.get(url).status_code, 403)
+
+    def test_elenco_delle_campagne_congelate_in_memoria(self):
+        self.addCleanup(dimentica_congelate)
+        # Finché la chiusura non è confermata l'elenco è riletto a ogni uso
+        self.campagna.status = 'close'
+        self.campagna.save()
+        for _ in range(2):
+            with self.assertNumQueries(1):
+                self.assertEqual(campagne_congelate(), [self.campagna])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.campagna.descrizione = "Campagna chiusa"
+            self.campagna.save()
+        with self.assertNumQueries(1):
+            campagne_congelate()
+        with self.assertNumQueries(0):
+            self.assertEqual(campagne_congelate(), [self.campagna])
+        # Le scritture master non rileggono l'elenco
+        with CaptureQueriesContext(connection) as query:
+            self.scenario.descrizione = "Scenario rinominato"
+            self.scenario.save()
+            self.scenario.save()
+        self.assertFalse([q for q in query.captured_queries if '"sovrapposizione_congelata" IS NOT NULL' in q['sql']])
+        self.assertEqual(Scenario.objects.get(campagna=self.campagna).descrizione, "Scenario")
+
+    def test_element_type_master_nel_form_dei_nodi(self):
+        copia = materializza(self.campagna, Asset, self.asset.pk)
+        base = materializza(self.campagna, ElementType, self.basi[1].pk)
+        self.client.force_login(User.objects.create_superuser("admin", password="x"))
+        risposta = self.client.get(f"/admin/assets/nodostruttura/add/?asset__id__exact={copia.pk}")
+        element_types = set(risposta.context['adminform'].form.fields['element_type'].queryset)
+        # La base copiata porta con sé il derivato che la compone; l'altra base resta master
+        derivato = ElementType.objects.get(campagna=self.campagna, cloned_from=self.derivato)
+        self.assertEqual(element_types, {self.basi[0], derivato, base})
+
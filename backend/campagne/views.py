@@ -1,13 +1,20 @@
 from rest_framework import viewsets
-from .models import Campagna
+from core.api import ApiMixin
+from .models import Campagna, IstantaneaCampagna, PopolamentoCampagna
 from .serializers import CampagnaSerializer
+from django.http import Http404, JsonResponse
 from django.shortcuts import render, get_object_or_404
 from django.contrib.admin.views.decorators import staff_member_required
 from django.db.models import Count
 from django.db.models import Q
-from assets.models import NodoTemplate, NodoStruttura
+from assets.models import Asset, NodoTemplate, NodoStruttura, StrutturaTemplate
+from controlli.models import Controllo
+from elementtypes.models import ElementType
+from minacce.models import Minaccia
+from scenari.models import Scenario
+from .sovrapposizione import righe
 
-class CampagnaViewSet(viewsets.ModelViewSet):
+class CampagnaViewSet(ApiMixin, viewsets.ModelViewSet):
     queryset = Campagna.objects.all()
     serializer_class = CampagnaSerializer
 
@@ -18,7 +25,31 @@ def campagna_dashboard_view(request, campagna_id):
     """
     # Recupera la campagna.
     campagna = get_object_or_404(Campagna, pk=campagna_id)
+    istantanea = IstantaneaCampagna.objects.filter(campagna=campagna).first()
+    if istantanea is not None:
+        # Campagna chiusa: conteggi precalcolati alla chiusura
+        for attributo, valore in istantanea.conteggi.items():
+            setattr(campagna, attributo, valore)
+    else:
+        campagna = _con_conteggi(campagna)
+    popolamento = campagna.popolamenti.first()
 
+
+    
+    context = {
+        'title': f'Dashboard: {campagna.descrizione}',
+        'campagna': campagna,
+        'popolamento': popolamento,
+        'site_header': 'IT Risk Administrator',
+        'site_title': 'IT Risk Administrator',
+        'has_permission': True,
+    }
+    return render(request, 'admin/campagne/dashboard.html', context)
+
+
+def _con_conteggi(campagna):
+    """La campagna annotata con i conteggi del dashboard, calcolati sul momento."""
+    campagna_id = campagna.pk
     # Esegue i conteggi con query separate e più semplici per migliorare le prestazioni.
     # Annotare più conteggi in una singola query può essere molto lento a causa dei JOIN complessi.
     # I related_name sono definiti nei rispettivi modelli e .count() è efficiente.
@@ -35,14 +66,23 @@ def campagna_dashboard_view(request, campagna_id):
     # Aggiungi i conteggi per assets e template di struttura
     campagna.strutture_template_count = campagna.templates_struttura.count()
     campagna.noditemplate_count = NodoTemplate.objects.filter(campagna=campagna).count()
+    if campagna.copia_su_scrittura:
+        # Conteggi sulle righe visibili nella campagna, master non ancora copiate incluse
+        for attributo, modello in (
+            ('controlli_count', Controllo), ('minacce_count', Minaccia), ('scenari_count', Scenario),
+            ('elementtypes_count', ElementType), ('assets_count', Asset),
+            ('strutture_template_count', StrutturaTemplate),
+        ):
+            setattr(campagna, attributo, righe(modello, campagna).count())
+        campagna.nodistruttura_count = NodoStruttura.objects.filter(asset__in=righe(Asset, campagna)).count()
+        campagna.noditemplate_count = NodoTemplate.objects.filter(template__in=righe(StrutturaTemplate, campagna)).count()
+    return campagna
 
 
-    
-    context = {
-        'title': f'Dashboard: {campagna.descrizione}',
-        'campagna': campagna,
-        'site_header': 'IT Risk Administrator',
-        'site_title': 'IT Risk Administrator',
-        'has_permission': True,
-    }
-    return render(request, 'admin/campagne/dashboard.html', context)
+@staff_member_required
+def campagna_popolamento_view(request, campagna_id):
+    """Stato e avanzamento per fase dell'ultimo popolamento della campagna, in JSON."""
+    popolamento = PopolamentoCampagna.objects.select_related('campagna').filter(campagna_id=campagna_id).first()
+    if popolamento is None:
+        raise Http404("Nessun popolamento registrato per la campagna.")
+    return JsonResponse(popolamento.come_dizionario())
@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('campagne', '0005_storico_alla_data'),
+        ('controlli', '0003_controllo_cloned_from'),
+        ('elementtypes', '0006_storico_alla_data'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='historicalcontrollo',
+            index=models.Index(fields=['id', 'history_date'], name='controlli_h_id_213ea0_idx'),
+        ),
+    ]
@@ -1,6 +1,6 @@
 from django.db import models
 from django.contrib.auth.models import User
-from simple_history.models import HistoricalRecords
+from core.storico import StoricoRecords
 from campagne.models import Campagna
 
 class Controllo(models.Model):
@@ -54,7 +54,17 @@ class Controllo(models.Model):
         null=True,
         blank=True
     )
-    history = HistoricalRecords()
+    cloned_from = models.ForeignKey(
+        'self',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='clones',
+        editable=False,
+        verbose_name="Clonato da (Master)",
+        help_text="Riferimento alla riga master da cui questa è stata copiata nella campagna."
+    )
+    history = StoricoRecords()
 
     def save(self, *args, **kwargs):
         self.peso_controllo = self.PESO_MAPPING.get(self.tipologia_controllo, 0.0)
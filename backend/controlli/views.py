@@ -1,8 +1,8 @@
 from rest_framework import viewsets
+from core.api import ApiMixin
 from .models import Controllo
 from .serializers import ControlloSerializer
 
-class ControlloViewSet(viewsets.ModelViewSet):
+class ControlloViewSet(ApiMixin, viewsets.ModelViewSet):
     queryset = Controllo.objects.all()
     serializer_class = ControlloSerializer
-    filterset_fields = ['campagna', 'tipologia_controllo', 'categoria_controllo', 'elementtype']
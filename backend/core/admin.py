@@ -1,3 +1,61 @@
 from django.contrib import admin
+from django.urls import NoReverseMatch, reverse
+from django.utils.html import format_html
 
-# Register your models here.
+from .models import CompattazioneStorico, OperazioneMassiva, VoceOperazione
+
+
+class VoceOperazioneInline(admin.TabularInline):
+    model = VoceOperazione
+    fields = ('modello', 'tipo', 'righe', 'intervalli_display', 'oggetti_link')
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+    def intervalli_display(self, obj):
+        return ", ".join(str(primo) if primo == ultimo else f"{primo}-{ultimo}" for primo, ultimo in obj.intervalli)
+    intervalli_display.short_description = 'Id'
+
+    def oggetti_link(self, obj):
+        # Elenco delle righe create o modificate ancora presenti, filtrato sugli estremi dell'operazione
+        if obj.tipo == '-':
+            return "-"
+        app_label, nome = obj.modello.lower().split('.')
+        try:
+            url = reverse(f'admin:{app_label}_{nome}_changelist')
+        except NoReverseMatch:
+            return "-"
+        return format_html('<a href="{}?id__gte={}&amp;id__lte={}">Apri</a>', url, obj.primo_id, obj.ultimo_id)
+    oggetti_link.short_description = 'Elenco'
+
+
+@admin.register(OperazioneMassiva)
+class OperazioneMassivaAdmin(admin.ModelAdmin):
+    list_display = ('descrizione', 'campagna', 'utente', 'righe', 'completata', 'avviata_il', 'terminata_il')
+    list_filter = ('completata', 'campagna')
+    list_select_related = ('campagna', 'utente')
+    search_fields = ('descrizione',)
+    readonly_fields = [field.name for field in OperazioneMassiva._meta.fields]
+    inlines = [VoceOperazioneInline]
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(CompattazioneStorico)
+class CompattazioneStoricoAdmin(admin.ModelAdmin):
+    list_display = ('avviata_il', 'stato', 'limite', 'terminata_il')
+    list_filter = ('stato',)
+    readonly_fields = [field.name for field in CompattazioneStorico._meta.fields]
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
@@ -1,6 +1,8 @@
 from django.contrib import admin
 from django.utils.translation import gettext_lazy as _
 
+from campagne.sovrapposizione import righe_per_campagna
+
 class MasterCampaignFilter(admin.SimpleListFilter):
     """
     Filtro personalizzato per visualizzare solo i record master (campagna=NULL)
@@ -53,6 +55,9 @@ class MasterCampaignFilter(admin.SimpleListFilter):
 
         # Default behavior for 'Per Contesto' (self.value() is None)
         if self.value() is None:
+            if campagna_id_from_url and lookup_path == 'campagna':
+                # Include i record master visibili nelle campagne a copia su scrittura
+                return righe_per_campagna(queryset, campagna_id_from_url)
             if campagna_id_from_url:
                 return queryset.filter(**{f"{lookup_path}__id": campagna_id_from_url})
             else:
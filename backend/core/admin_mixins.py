@@ -9,6 +9,8 @@ from django.http import HttpResponseRedirect # Ensure this is imported
 from urllib.parse import urlparse, parse_qs
 
 from django.utils.safestring import mark_safe
+
+from campagne.sovrapposizione import righe_per_campagna
 def get_nested_attr(obj, attr_path):
     attrs = attr_path.split('__')
     for attr in attrs:
@@ -53,12 +55,29 @@ class MasterAdminMixin:
         campagna_id_from_url = request.GET.get(self._get_campaign_param_name())
 
         if obj_campaign is None and campagna_id_from_url:
-            raise PermissionDenied("Non è possibile modificare un record MASTER dall'area di una campagna.")
+            object_id = self._copia_in_campagna(request, obj, campagna_id_from_url, object_id)
         # elif obj_campaign is not None:
         #     messages.info(request, f"Stai operando su un record appartenente alla campagna: '{obj_campaign}'.")
  
         return super().change_view(request, object_id, form_url, extra_context)
 
+    def _copia_in_campagna(self, request, obj, campagna_id, object_id):
+        """
+        Record MASTER aperto dall'area di una campagna: consentito solo nelle campagne a copia
+        su scrittura aperte, dove la modifica (POST) si applica alla copia del record nella
+        campagna, creata al primo salvataggio. Restituisce l'id del record da modificare.
+        """
+        from campagne.sovrapposizione import campagna_sovrapposta, gestito, materializza
+
+        campagna = campagna_sovrapposta(campagna_id)
+        if campagna is None or not gestito(self.model):
+            raise PermissionDenied("Non è possibile modificare un record MASTER dall'area di una campagna.")
+        if request.method != 'POST':
+            return object_id
+        if campagna.status == 'close':
+            raise PermissionDenied("La campagna è chiusa: i suoi record non possono essere modificati.")
+        return str(materializza(campagna, self.model, obj.pk).pk)
+
     def add_view(self, request, form_url='', extra_context=None):
         """
         Sovrascrive la add_view per mantenere il contesto della campagna.
@@ -145,7 +164,8 @@ class MasterAdminMixin:
                 related_model = form_field.queryset.model
                 if hasattr(related_model, 'campagna'):
                     if effective_campagna_id:
-                        form_field.queryset = related_model.objects.filter(campagna_id=effective_campagna_id)
+                        # Nelle campagne a copia su scrittura anche i record master non ancora copiati
+                        form_field.queryset = righe_per_campagna(related_model.objects.all(), effective_campagna_id)
                     else:
                         form_field.queryset = related_model.objects.filter(campagna__isnull=True)
         return form
@@ -230,6 +250,11 @@ class MasterAdminMixin:
         2. Salva l'ID della campagna sulla request per usarlo in response_delete (POST).
         """
         obj = self.get_object(request, object_id)
+        campagna_id_from_url = request.GET.get(self._get_campaign_param_name())
+        if obj and campagna_id_from_url and self._get_campaign_from_obj(obj) is None:
+            # Eliminare dalla campagna un record MASTER elimina (e nasconde) la sua copia
+            object_id = self._copia_in_campagna(request, obj, campagna_id_from_url, object_id)
+            obj = self.get_object(request, object_id)
         if obj and hasattr(obj, 'campagna') and obj.campagna:
             # Salva l'ID della campagna per il reindirizzamento post-cancellazione
             request._campagna_id_for_delete_redirect = obj.campagna.id
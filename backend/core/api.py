@@ -0,0 +1,102 @@
+"""
+Infrastruttura comune delle API REST (`/api/v1/`, vedi `core/urls.py`).
+
+- `PaginazioneCursore`: paginazione a cursore sulla chiave primaria. Ogni
+  pagina è `WHERE id > <cursore> ORDER BY id LIMIT n`, letta sull'indice della
+  chiave: le pagine profonde costano quanto la prima, a differenza di
+  LIMIT/OFFSET, e le righe inserite durante lo scorrimento non spostano le
+  pagine successive.
+- `ApiMixin`: filtro per campagna applicato al queryset (`?campagna=<id>` o
+  `?campagna=master`) e `select_related`/`prefetch_related` per azione, così
+  ogni azione carica solo le relazioni che il serializer o il salvataggio
+  leggono. Una campagna non ancora `pronta` (popolamento in corso o fallito)
+  risponde 409, anche sul dettaglio di una sua riga: i suoi dati sarebbero
+  parziali. Gli elenchi senza filtro ne escludono le righe.
+"""
+from django.db.models import F
+from rest_framework import status
+from rest_framework.exceptions import APIException, ValidationError
+from rest_framework.pagination import CursorPagination
+
+MASTER = 'master'
+
+
+class CampagnaNonPronta(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = "Il popolamento della campagna non è completato: i suoi dati non sono ancora disponibili."
+    default_code = 'campagna_non_pronta'
+
+
+class PaginazioneCursore(CursorPagination):
+    ordering = 'id'
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+
+class ApiMixin:
+    """
+    Mixin dei ViewSet dell'API. `campo_proprietario` indica, per i modelli le cui righe sono
+    visibili attraverso il proprietario (i nodi attraverso asset e template), la relazione da
+    cui ereditare il filtro per campagna; `select_related_per_azione` e
+    `prefetch_related_per_azione` ({azione: campi}) le relazioni da caricare in ogni azione.
+    `campagna_richiesta` è la campagna indicata con `?campagna=<id>`, dopo il filtro.
+    """
+    campo_proprietario = None
+    campagna_richiesta = None
+    select_related_per_azione = {}
+    prefetch_related_per_azione = {}
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        queryset = self.filtra_campagna(queryset)
+        if collegate := self.select_related_per_azione.get(self.action):
+            queryset = queryset.select_related(*collegate)
+        if collegate := self.prefetch_related_per_azione.get(self.action):
+            queryset = queryset.prefetch_related(*collegate)
+        return queryset
+
+    def get_object(self):
+        """La riga richiesta; 409 se appartiene (o il suo proprietario appartiene) a una campagna non pronta."""
+        oggetto = super().get_object()
+        if getattr(oggetto, 'campagna_pronta', None) is False:
+            raise CampagnaNonPronta()
+        return oggetto
+
+    def _campo_campagna(self, modello):
+        """Il percorso della campagna delle righe di `modello` (o del loro proprietario), o None."""
+        if self.campo_proprietario:
+            return f'{self.campo_proprietario}__campagna'
+        if any(campo.name == 'campagna' for campo in modello._meta.fields):
+            return 'campagna'
+        return None
+
+    def filtra_campagna(self, queryset):
+        """
+        Righe della campagna indicata (master visibili incluse nelle campagne a copia su scrittura),
+        o le master; senza filtro, negli elenchi, tutte tranne quelle delle campagne non pronte
+        e, nelle altre azioni, tutte con la prontezza della campagna (`campagna_pronta`, letta da `get_object`).
+        """
+        from campagne.models import Campagna
+        from campagne.sovrapposizione import righe
+
+        valore = self.request.query_params.get('campagna')
+        campo = self._campo_campagna(queryset.model)
+        if campo is None:
+            return queryset
+        if not valore:
+            if self.action == 'list':
+                return queryset.exclude(**{f'{campo}__pronta': False})
+            return queryset.annotate(campagna_pronta=F(f'{campo}__pronta'))
+        if valore == MASTER:
+            return queryset.filter(**{f'{campo}__isnull': True})
+        campagna = Campagna.objects.filter(pk=valore).first() if valore.isdigit() else None
+        if campagna is None:
+            raise ValidationError({'campagna': f"Campagna '{valore}' inesistente: indicare un id o '{MASTER}'."})
+        if not campagna.pronta:
+            raise CampagnaNonPronta()
+        self.campagna_richiesta = campagna
+        if self.campo_proprietario is None:
+            return righe(queryset.model, campagna, queryset)
+        proprietari = queryset.model._meta.get_field(self.campo_proprietario).related_model
+        return queryset.filter(**{f'{self.campo_proprietario}__in': righe(proprietari, campagna).values('pk')})
@@ -0,0 +1,203 @@
+"""
+Conservazione e compattazione dello storico (comando `compatta_storico`).
+
+Le tabelle di django-simple-history crescono senza limite (i salvataggi
+ripetuti di asset, nodi ed ElementType aggiungono una versione ciascuno) e
+le pagine di cronologia dell'admin degli oggetti più modificati rallentano.
+La compattazione lavora per oggetto: conserva tutte le versioni dal `limite`
+in poi (`settings.STORICO_CONSERVAZIONE_GIORNI`) e, tra quelle precedenti,
+solo quelle che contano:
+
+- la creazione e l'eliminazione;
+- l'ultima versione prima del limite (lo stato da cui riparte la finestra);
+- per ogni traguardo delle campagne (apertura, chiusura e ogni cambio di
+  stato, letti dallo storico di Campagna) la versione in vigore in quel
+  momento, per le righe della campagna e per quelle master;
+- nello storico di Campagna, le versioni dei traguardi stessi.
+
+Le versioni intermedie più vecchie vengono eliminate a lotti di oggetti, un
+lotto per transazione; dopo ogni lotto l'avanzamento è registrato in
+`CompattazioneStorico`, quindi un'esecuzione interrotta riprende dall'ultimo
+lotto completato con lo stesso limite. Prima e dopo viene misurata la
+latenza della pagina di cronologia degli oggetti con più versioni.
+"""
+import bisect
+import logging
+import time
+from collections import defaultdict
+from datetime import timedelta
+
+from django.apps import apps
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
+
+from .models import CompattazioneStorico
+
+CONSERVAZIONE_GIORNI = 180
+# Versioni per pagina della cronologia di SimpleHistoryAdmin
+PAGINA_CRONOLOGIA = 100
+
+
+def modelli_storicizzati(etichette=None):
+    """[(modello, modello storico)] dei modelli con storico, eventualmente limitati alle etichette indicate."""
+    risultato = []
+    for modello in apps.get_models():
+        attributo = getattr(modello._meta, 'simple_history_manager_attribute', None)
+        if attributo and (not etichette or modello._meta.label in etichette):
+            risultato.append((modello, getattr(modello, attributo).model))
+    return risultato
+
+
+def traguardi():
+    """
+    ({campagna_id: [date dei traguardi]}, {history_id delle versioni di Campagna che sono traguardi}):
+    la creazione e ogni cambio di stato di ogni campagna.
+    """
+    from campagne.models import Campagna
+
+    date, versioni = defaultdict(list), set()
+    precedente = {}
+    for history_id, campagna_id, data, stato in Campagna.history.order_by('history_date', 'history_id').values_list(
+        'history_id', 'id', 'history_date', 'status'
+    ):
+        if precedente.get(campagna_id) != stato:
+            date[campagna_id].append(data)
+            versioni.add(history_id)
+        precedente[campagna_id] = stato
+    return dict(date), versioni
+
+
+def da_eliminare(versioni, date_traguardi, conservate=()):
+    """
+    history_id da eliminare tra le `versioni` di un oggetto precedenti al limite, [(history_id, data, tipo)]
+    in ordine di data, conservando creazione, eliminazione, l'ultima e quelle in vigore ai traguardi.
+    """
+    if len(versioni) < 2:
+        return []
+    tieni = {versioni[-1][0]}
+    tieni.update(history_id for history_id, _, tipo in versioni if tipo in '+-')
+    tieni.update(history_id for history_id, _, _ in versioni if history_id in conservate)
+    date = [data for _, data, _ in versioni]
+    for traguardo in date_traguardi:
+        posizione = bisect.bisect_right(date, traguardo)
+        if posizione:
+            tieni.add(versioni[posizione - 1][0])
+    return [history_id for history_id, _, _ in versioni if history_id not in tieni]
+
+
+def latenza_cronologia(storico, ids, ripetizioni=3):
+    """Millisecondi (il migliore su `ripetizioni`) per le query della pagina di cronologia degli oggetti `ids`."""
+    if not ids:
+        return 0.0
+    migliore = None
+    for _ in range(ripetizioni):
+        inizio = time.perf_counter()
+        for pk in ids:
+            versioni = storico.objects.filter(id=pk).order_by('-history_date', '-history_id')
+            versioni.count()
+            list(versioni[:PAGINA_CRONOLOGIA])
+        durata = (time.perf_counter() - inizio) * 1000
+        migliore = durata if migliore is None else min(migliore, durata)
+    return migliore
+
+
+def _piu_modificati(storico, quanti=5):
+    return list(storico.objects.values('id').annotate(n=Count('history_id')).order_by('-n').values_list(
+        'id', flat=True)[:quanti])
+
+
+class Compattazione:
+    """
+    Esegue (o riprende) una compattazione. Con `prova=True` conta soltanto le versioni
+    che verrebbero eliminate, senza eliminare né registrare nulla.
+    """
+
+    def __init__(self, giorni=None, modelli=None, lotto=500, prova=False, riprendi=True):
+        self.lotto = max(1, lotto)
+        self.prova = prova
+        self.modelli = modelli_storicizzati(modelli)
+        self.registro = None
+        if riprendi and not prova:
+            self.registro = CompattazioneStorico.objects.filter(stato=CompattazioneStorico.IN_CORSO).first()
+        if self.registro is None:
+            if giorni is None:
+                giorni = getattr(settings, 'STORICO_CONSERVAZIONE_GIORNI', CONSERVAZIONE_GIORNI)
+            self.registro = CompattazioneStorico(limite=timezone.now() - timedelta(days=giorni), avviata_il=timezone.now())
+            if not prova:
+                self.registro.save()
+        self.date_traguardi, self.versioni_traguardo = traguardi()
+        self.tutti_i_traguardi = sorted(data for date in self.date_traguardi.values() for data in date)
+
+    @property
+    def ripresa(self):
+        return bool(self.registro.avanzamento)
+
+    def esegui(self, avanzamento=None):
+        """Compatta i modelli in ordine; `avanzamento(etichetta, eliminate)` dopo ogni lotto. Restituisce il registro."""
+        for modello, storico in self.modelli:
+            etichetta = modello._meta.label
+            stato = self.registro.avanzamento.get(etichetta, {})
+            if stato.get('completato'):
+                continue
+            campione = _piu_modificati(storico)
+            latenza = self.registro.latenza.setdefault(etichetta, [latenza_cronologia(storico, campione), None])
+            self._compatta_modello(modello, storico, stato.get('ultimo_id', 0), avanzamento)
+            latenza[1] = latenza_cronologia(storico, campione) if not self.prova else latenza[0]
+            self.registro.avanzamento[etichetta] = {**self.registro.avanzamento.get(etichetta, {}), 'completato': True}
+            self._salva()
+        self.registro.stato = CompattazioneStorico.COMPLETATA
+        self.registro.terminata_il = timezone.now()
+        self._salva()
+        logging.info(f"{self.registro}: {sum(self.registro.eliminate.values())} versioni eliminate.")
+        return self.registro
+
+    def _date_traguardi(self, modello, campagna_id, pk):
+        if modello._meta.label == 'campagne.Campagna':
+            return self.date_traguardi.get(pk, [])
+        if campagna_id is None:
+            # Le righe master sono lette da tutte le campagne
+            return self.tutti_i_traguardi
+        return self.date_traguardi.get(campagna_id, [])
+
+    def _compatta_modello(self, modello, storico, ultimo_id, avanzamento):
+        etichetta = modello._meta.label
+        limite = self.registro.limite
+        campo_campagna = 'campagna_id' if any(f.name == 'campagna' for f in storico._meta.fields) else 'id'
+        vecchie = storico.objects.filter(history_date__lt=limite)
+        # Le versioni conservate per id valgono solo nello storico di Campagna: gli history_id degli altri
+        # modelli sono di un'altra tabella
+        conservate = self.versioni_traguardo if etichetta == 'campagne.Campagna' else ()
+        while True:
+            # Il lotto successivo di oggetti scorrendo l'indice (id, history_date): ogni lotto legge
+            # solo le proprie righe, senza raggruppare tutto lo storico che resta da scorrere
+            ids = list(vecchie.filter(id__gt=ultimo_id).order_by('id').values_list('id', flat=True).distinct()[
+                :self.lotto])
+            if not ids:
+                break
+            per_oggetto = defaultdict(list)
+            campagne = {}
+            for history_id, pk, data, tipo, campagna_id in vecchie.filter(id__in=ids).order_by(
+                'history_date', 'history_id'
+            ).values_list('history_id', 'id', 'history_date', 'history_type', campo_campagna):
+                per_oggetto[pk].append((history_id, data, tipo))
+                # La versione più recente decide a quale campagna appartiene l'oggetto
+                campagne[pk] = campagna_id if campo_campagna != 'id' else None
+            eliminare = []
+            for pk, versioni in per_oggetto.items():
+                eliminare.extend(da_eliminare(versioni, self._date_traguardi(modello, campagne[pk], pk), conservate))
+            ultimo_id = ids[-1]
+            with transaction.atomic():
+                if not self.prova:
+                    for inizio in range(0, len(eliminare), self.lotto):
+                        storico.objects.filter(history_id__in=eliminare[inizio:inizio + self.lotto]).delete()
+                self.registro.eliminate[etichetta] = self.registro.eliminate.get(etichetta, 0) + len(eliminare)
+                self.registro.avanzamento[etichetta] = {'ultimo_id': ultimo_id, 'completato': False}
+                self._salva()
+            if avanzamento:
+                avanzamento(etichetta, len(eliminare))
+
+    def _salva(self):
+        if not self.prova:
+            self.registro.save()
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+
+from core.compattazione import Compattazione
+
+
+class Command(BaseCommand):
+    help = (
+        "Compatta le tabelle dello storico: conserva ogni versione nella finestra di conservazione "
+        "(STORICO_CONSERVAZIONE_GIORNI), creazioni, eliminazioni e le versioni in vigore all'apertura e alla "
+        "chiusura delle campagne, ed elimina a lotti le versioni intermedie più vecchie. Un'esecuzione "
+        "interrotta viene ripresa dall'ultimo lotto completato."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--giorni', type=int, help="Giorni di storico conservati per intero (predefinito dalle impostazioni).")
+        parser.add_argument('--modello', action='append', dest='modelli', help="Solo questo modello (es. assets.Asset); ripetibile.")
+        parser.add_argument('--lotto', type=int, default=500, help="Oggetti per lotto (una transazione per lotto).")
+        parser.add_argument('--prova', action='store_true', help="Conta le versioni da eliminare senza eliminarle.")
+        parser.add_argument('--da-capo', action='store_true', help="Ignora un'esecuzione interrotta e ne avvia una nuova.")
+
+    def handle(self, *args, **options):
+        compattazione = Compattazione(
+            giorni=options['giorni'], modelli=options['modelli'], lotto=options['lotto'],
+            prova=options['prova'], riprendi=not options['da_capo'],
+        )
+        if compattazione.ripresa:
+            self.stdout.write(self.style.WARNING(f"Ripresa di: {compattazione.registro}"))
+        self.stdout.write(f"Conservate per intero le versioni dal {compattazione.registro.limite:%d/%m/%Y %H:%M}.")
+        registro = compattazione.esegui()
+
+        for etichetta, eliminate in sorted(registro.eliminate.items()):
+            prima, dopo = registro.latenza.get(etichetta, [0.0, 0.0])
+            self.stdout.write(
+                f"  {etichetta}: {eliminate} versioni {'da eliminare' if options['prova'] else 'eliminate'}, "
+                f"cronologia degli oggetti più modificati {prima:.1f} ms -> {dopo:.1f} ms"
+            )
+        totale = sum(registro.eliminate.values())
+        if options['prova']:
+            self.stdout.write(self.style.SUCCESS(f"Prova: {totale} versioni verrebbero eliminate."))
+        else:
+            self.stdout.write(self.style.SUCCESS(f"Compattazione completata: {totale} versioni eliminate."))
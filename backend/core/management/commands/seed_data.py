@@ -9,6 +9,7 @@ from assets.models import Asset, NodoStruttura
 from controlli.models import Controllo
 from elementtypes.models import ElementType
 from django.utils.text import slugify
+from core.storico import operazione_massiva
 
 
 class Command(BaseCommand):
@@ -46,22 +47,10 @@ class Command(BaseCommand):
             self.stdout.write("Superuser 'admin' creato con password 'admin'.")
         admin_user = User.objects.get(username='admin')
         
-        # 2. Creazione anagrafiche "master" (senza campagna)
-        self.stdout.write(self.style.SUCCESS("\nCreazione anagrafiche master..."))
-        scenari = self._crea_scenari()
-        minacce = self._crea_minacce(scenari)
-        element_types_base = self._crea_elementtype_base()
-        self._crea_controlli(element_types_base, admin_user) # I controlli vengono associati agli ET
-        self._popola_matrici_base(element_types_base, minacce)
-        element_types_derivati = self._crea_elementtype_derivati()
+        # 2-4. Anagrafiche, template e asset master come un'unica operazione massiva (vedi core/storico.py)
+        with operazione_massiva("Seeding dei dati master", utente=admin_user):
+            templates = self._crea_dati_master(admin_user)
 
-        # 3. Creazione template strutture
-        self.stdout.write(self.style.SUCCESS("\nCreazione template strutture..."))
-        templates = self._crea_templates(15)
-
-        # 4. Creazione Asset master con assegnazione template
-        self.stdout.write(self.style.SUCCESS("\nCreazione Asset master con template..."))
-        self._crea_assets_master(admin_user, templates, 100)
         # 5. Creazione e popolamento della campagna iniziale
         self.stdout.write(self.style.SUCCESS("\nCreazione e popolamento della campagna iniziale '2024'..."))
         campagna_2024, created = Campagna.objects.get_or_create(
@@ -86,6 +75,25 @@ class Command(BaseCommand):
         self.stdout.write(f"Asset master creati: {Asset.objects.filter(campagna__isnull=True).count()} (con template assegnato)")
         self.stdout.write(self.style.SUCCESS("--- Seeding completato con successo! ---"))
 
+    def _crea_dati_master(self, admin_user):
+        # 2. Creazione anagrafiche "master" (senza campagna)
+        self.stdout.write(self.style.SUCCESS("\nCreazione anagrafiche master..."))
+        scenari = self._crea_scenari()
+        minacce = self._crea_minacce(scenari)
+        element_types_base = self._crea_elementtype_base()
+        self._crea_controlli(element_types_base, admin_user) # I controlli vengono associati agli ET
+        self._popola_matrici_base(element_types_base, minacce)
+        element_types_derivati = self._crea_elementtype_derivati()
+
+        # 3. Creazione template strutture
+        self.stdout.write(self.style.SUCCESS("\nCreazione template strutture..."))
+        templates = self._crea_templates(15)
+
+        # 4. Creazione Asset master con assegnazione template
+        self.stdout.write(self.style.SUCCESS("\nCreazione Asset master con template..."))
+        self._crea_assets_master(admin_user, templates, 100)
+        return templates
+
     def _crea_scenari(self):
         scenari_data = [f"Scenario di rischio {i} (Master)" for i in range(1, 6)]  # Make descriptions unique
         scenari = [Scenario.objects.get_or_create(descrizione=desc, campagna=None)[0] for desc in scenari_data]
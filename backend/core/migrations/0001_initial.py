@@ -0,0 +1,52 @@
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('campagne', '0004_istantanea_campagna'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OperazioneMassiva',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('descrizione', models.CharField(max_length=255, verbose_name='Operazione')),
+                ('avviata_il', models.DateTimeField(verbose_name='Avviata il')),
+                ('terminata_il', models.DateTimeField(verbose_name='Terminata il')),
+                ('righe', models.PositiveIntegerField(default=0, verbose_name='Righe')),
+                ('campagna', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='operazioni_massive', to='campagne.campagna', verbose_name='Campagna')),
+                ('utente', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='Utente')),
+            ],
+            options={
+                'verbose_name': 'Operazione massiva',
+                'verbose_name_plural': 'Operazioni massive',
+                'ordering': ['-avviata_il'],
+            },
+        ),
+        migrations.CreateModel(
+            name='VoceOperazione',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('modello', models.CharField(max_length=100, verbose_name='Modello')),
+                ('tipo', models.CharField(choices=[('+', 'Creazione'), ('~', 'Modifica'), ('-', 'Eliminazione')], max_length=1, verbose_name='Tipo')),
+                ('intervalli', models.JSONField(default=list, verbose_name='Intervalli di id')),
+                ('primo_id', models.BigIntegerField(verbose_name='Primo id')),
+                ('ultimo_id', models.BigIntegerField(verbose_name='Ultimo id')),
+                ('righe', models.PositiveIntegerField(verbose_name='Righe')),
+                ('operazione', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='voci', to='core.operazionemassiva')),
+            ],
+            options={
+                'verbose_name': "Voce dell'operazione",
+                'verbose_name_plural': "Voci dell'operazione",
+                'indexes': [models.Index(fields=['modello', 'primo_id', 'ultimo_id'], name='core_voceop_modello_bac0b6_idx')],
+                'unique_together': {('operazione', 'modello', 'tipo')},
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CompattazioneStorico',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('limite', models.DateTimeField(verbose_name='Conserva tutte le versioni dal')),
+                ('stato', models.CharField(choices=[('in_corso', 'In corso'), ('completata', 'Completata')], default='in_corso', max_length=10, verbose_name='Stato')),
+                ('avanzamento', models.JSONField(default=dict, verbose_name='Avanzamento')),
+                ('eliminate', models.JSONField(default=dict, verbose_name='Righe eliminate per modello')),
+                ('latenza', models.JSONField(default=dict, verbose_name='Latenza della cronologia')),
+                ('avviata_il', models.DateTimeField(auto_now_add=True, verbose_name='Avviata il')),
+                ('terminata_il', models.DateTimeField(blank=True, null=True, verbose_name='Terminata il')),
+            ],
+            options={
+                'verbose_name': 'Compattazione dello storico',
+                'verbose_name_plural': 'Compattazioni dello storico',
+                'ordering': ['-avviata_il'],
+            },
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_compattazione_storico'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='operazionemassiva',
+            name='completata',
+            field=models.BooleanField(default=True, verbose_name='Completata'),
+        ),
+    ]
@@ -1,3 +1,95 @@
+from django.apps import apps
+from django.conf import settings
 from django.db import models
+from django.db.models import Q
 
-# Create your models here.
+
+class OperazioneMassiva(models.Model):
+    """
+    Storico per operazione delle operazioni in blocco (popolamento delle campagne, applicazione
+    dei template, seeding): al posto di una riga di storico per oggetto registra chi ha eseguito
+    l'operazione e quali righe ha creato, modificato o eliminato, per modello (vedi `core/storico.py`).
+    """
+    descrizione = models.CharField("Operazione", max_length=255)
+    utente = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True, related_name='+', verbose_name="Utente"
+    )
+    campagna = models.ForeignKey(
+        'campagne.Campagna', on_delete=models.SET_NULL, null=True, blank=True,
+        related_name='operazioni_massive', verbose_name="Campagna",
+    )
+    avviata_il = models.DateTimeField("Avviata il")
+    terminata_il = models.DateTimeField("Terminata il")
+    righe = models.PositiveIntegerField("Righe", default=0)
+    # False se l'operazione si è interrotta con un errore: le righe sono quelle già registrate
+    completata = models.BooleanField("Completata", default=True)
+
+    class Meta:
+        verbose_name = "Operazione massiva"
+        verbose_name_plural = "Operazioni massive"
+        ordering = ['-avviata_il']
+
+    def __str__(self):
+        esito = "" if self.completata else ", interrotta"
+        return f"{self.descrizione} ({self.avviata_il:%d/%m/%Y %H:%M}{esito})"
+
+    def oggetti(self, modello, tipo='+'):
+        """Righe di `modello` ancora esistenti che l'operazione ha creato (o modificato, con tipo '~')."""
+        voce = self.voci.filter(modello=modello._meta.label, tipo=tipo).first()
+        return voce.oggetti() if voce else modello.objects.none()
+
+
+class VoceOperazione(models.Model):
+    """Righe di un modello toccate da un'operazione massiva, come intervalli di id."""
+    TIPI = [('+', 'Creazione'), ('~', 'Modifica'), ('-', 'Eliminazione')]
+
+    operazione = models.ForeignKey(OperazioneMassiva, on_delete=models.CASCADE, related_name='voci')
+    modello = models.CharField("Modello", max_length=100)
+    tipo = models.CharField("Tipo", max_length=1, choices=TIPI)
+    # [[primo_id, ultimo_id], ...] ordinati e disgiunti; primo/ultimo_id ne sono gli estremi (indicizzati)
+    intervalli = models.JSONField("Intervalli di id", default=list)
+    primo_id = models.BigIntegerField("Primo id")
+    ultimo_id = models.BigIntegerField("Ultimo id")
+    righe = models.PositiveIntegerField("Righe")
+
+    class Meta:
+        verbose_name = "Voce dell'operazione"
+        verbose_name_plural = "Voci dell'operazione"
+        unique_together = ('operazione', 'modello', 'tipo')
+        indexes = [models.Index(fields=['modello', 'primo_id', 'ultimo_id'])]
+
+    def __str__(self):
+        return f"{self.get_tipo_display()} di {self.righe} {self.modello}"
+
+    def contiene(self, pk):
+        return any(primo <= pk <= ultimo for primo, ultimo in self.intervalli)
+
+    def oggetti(self):
+        filtro = Q()
+        for primo, ultimo in self.intervalli:
+            filtro |= Q(pk__range=(primo, ultimo))
+        return apps.get_model(self.modello).objects.filter(filtro)
+
+
+class CompattazioneStorico(models.Model):
+    """Esecuzione (anche interrotta e ripresa) del comando `compatta_storico`, con avanzamento per modello."""
+    IN_CORSO, COMPLETATA = 'in_corso', 'completata'
+    STATI = [(IN_CORSO, 'In corso'), (COMPLETATA, 'Completata')]
+
+    limite = models.DateTimeField("Conserva tutte le versioni dal")
+    stato = models.CharField("Stato", max_length=10, choices=STATI, default=IN_CORSO)
+    # {modello: ultimo id di oggetto compattato}: la ripresa riparte da qui
+    avanzamento = models.JSONField("Avanzamento", default=dict)
+    eliminate = models.JSONField("Righe eliminate per modello", default=dict)
+    # {modello: [ms prima, ms dopo]} della pagina di cronologia degli oggetti con più versioni
+    latenza = models.JSONField("Latenza della cronologia", default=dict)
+    avviata_il = models.DateTimeField("Avviata il", auto_now_add=True)
+    terminata_il = models.DateTimeField("Terminata il", null=True, blank=True)
+
+    class Meta:
+        verbose_name = "Compattazione dello storico"
+        verbose_name_plural = "Compattazioni dello storico"
+        ordering = ['-avviata_il']
+
+    def __str__(self):
+        return f"Compattazione dello storico del {self.avviata_il:%d/%m/%Y %H:%M} ({self.get_stato_display()})"
@@ -0,0 +1,180 @@
+"""
+Storico per operazione delle operazioni in blocco.
+
+Ogni modello ha lo storico di django-simple-history, che scrive una riga per
+oggetto a ogni salvataggio: popolare una campagna, applicare un template o il
+seeding raddoppiano così le scritture e fanno crescere le tabelle storiche di
+una riga per oggetto. Dentro `operazione_massiva(...)` lo storico per riga è
+sospeso: le righe che sarebbero state scritte, sia dai segnali dei singoli
+salvataggi ed eliminazioni sia da `bulk_history_create`, vengono raccolte come
+intervalli di id per modello e tipo (creazione, modifica, eliminazione) e
+registrate alla fine in una sola `OperazioneMassiva`, con utente e campagna.
+L'operazione risponde ancora a "cosa ha creato questo popolamento"
+(`OperazioneMassiva.oggetti`) e compare nella cronologia dell'admin degli
+oggetti che ha toccato.
+
+Per questo i modelli usano `StoricoRecords` al posto di `HistoricalRecords`;
+fuori da un'operazione il comportamento è quello di django-simple-history.
+Le operazioni annidate confluiscono in quella più esterna. Con
+`settings.STORICO_PER_OPERAZIONE = False` lo storico resta per riga.
+
+Se il blocco termina con un errore l'operazione viene registrata comunque,
+come non completata, con le righe raccolte fino a quel momento: chi registra
+a passi in transazioni separate (il popolamento nel worker) usa
+`transazione_operazione()`, che scarta le righe di un passo annullato, così
+l'operazione elenca esattamente le righe rimaste. Se invece l'errore annulla
+anche la transazione che contiene l'operazione, la registrazione sparisce
+insieme alle righe.
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import OuterRef, Subquery
+from django.utils import timezone
+from simple_history.manager import HistoryManager
+from simple_history.models import HistoricalRecords
+
+_operazione = ContextVar('operazione_massiva', default=None)
+
+
+class Raccolta:
+    """Righe toccate dall'operazione in corso: {(modello, tipo): {id}}."""
+
+    def __init__(self, descrizione, utente, campagna_id):
+        self.descrizione, self.utente, self.campagna_id = descrizione, utente, campagna_id
+        self.avviata_il = timezone.now()
+        self.righe = defaultdict(set)
+        self.operazione = None
+
+    def aggiungi(self, modello, tipo, ids):
+        self.righe[(modello._meta.label, tipo)].update(pk for pk in ids if pk is not None)
+
+    def registra(self, completata=True):
+        from .models import OperazioneMassiva, VoceOperazione
+
+        self.operazione = OperazioneMassiva.objects.create(
+            descrizione=self.descrizione[:255], utente=self.utente, campagna_id=self.campagna_id,
+            avviata_il=self.avviata_il, terminata_il=timezone.now(),
+            righe=sum(len(ids) for ids in self.righe.values()), completata=completata,
+        )
+        voci = []
+        for (modello, tipo), ids in sorted(self.righe.items()):
+            if not ids:
+                continue
+            estremi = intervalli(ids)
+            voci.append(VoceOperazione(
+                operazione=self.operazione, modello=modello, tipo=tipo, intervalli=estremi,
+                primo_id=estremi[0][0], ultimo_id=estremi[-1][1], righe=len(ids),
+            ))
+        VoceOperazione.objects.bulk_create(voci)
+        return self.operazione
+
+
+def intervalli(ids):
+    """[[primo, ultimo], ...] degli id consecutivi, in ordine."""
+    risultato = []
+    for pk in sorted(ids):
+        if risultato and pk == risultato[-1][1] + 1:
+            risultato[-1][1] = pk
+        else:
+            risultato.append([pk, pk])
+    return risultato
+
+
+def versioni_al(versioni, quando):
+    """
+    Delle versioni storiche indicate (queryset di un modello storico), l'ultima di ogni oggetto
+    registrata entro `quando`, eliminazioni comprese: per ogni riga candidata una subquery
+    correlata sull'indice (id, history_date) trova la versione più recente dell'oggetto.
+    """
+    storico = versioni.model
+    ultima = storico.objects.filter(id=OuterRef('id'), history_date__lte=quando).order_by(
+        '-history_date', '-history_id').values('history_id')[:1]
+    return versioni.filter(history_date__lte=quando, history_id=Subquery(ultima))
+
+
+def operazione_corrente():
+    """La Raccolta dell'operazione massiva in corso, o None."""
+    return _operazione.get()
+
+
+@contextmanager
+def operazione_massiva(descrizione, utente=None, campagna_id=None):
+    """
+    Sospende lo storico per riga nel blocco e, se il blocco termina senza errori, registra
+    l'OperazioneMassiva (disponibile poi in `raccolta.operazione`). Restituisce la Raccolta,
+    o None se lo storico per operazione è disattivato.
+    """
+    esterna = _operazione.get()
+    if esterna is not None or not getattr(settings, 'STORICO_PER_OPERAZIONE', True):
+        yield esterna
+        return
+    if utente is None:
+        # Come django-simple-history: l'utente della richiesta, se c'è HistoryRequestMiddleware
+        richiesta = getattr(HistoricalRecords.context, 'request', None)
+        if richiesta is not None and richiesta.user.is_authenticated:
+            utente = richiesta.user
+    raccolta = Raccolta(descrizione, utente, campagna_id)
+    token = _operazione.set(raccolta)
+    try:
+        yield raccolta
+    except BaseException:
+        _operazione.reset(token)
+        # In una transazione già da annullare la registrazione sparirebbe comunque con le righe
+        if any(raccolta.righe.values()) and not transaction.get_connection().needs_rollback:
+            raccolta.registra(completata=False)
+        raise
+    _operazione.reset(token)
+    raccolta.registra()
+
+
+@contextmanager
+def transazione_operazione():
+    """
+    `transaction.atomic()` per un passo di un'operazione massiva registrata a passi: se il passo
+    viene annullato, anche le righe raccolte al suo interno vengono scartate dall'operazione.
+    """
+    raccolta = _operazione.get()
+    precedenti = {chiave: set(ids) for chiave, ids in raccolta.righe.items()} if raccolta is not None else None
+    try:
+        with transaction.atomic():
+            yield
+    except BaseException:
+        if raccolta is not None:
+            raccolta.righe = defaultdict(set, precedenti)
+        raise
+
+
+class StoricoManager(HistoryManager):
+
+    def bulk_history_create(self, objs, batch_size=None, update=False, **kwargs):
+        raccolta = _operazione.get()
+        if raccolta is None:
+            return super().bulk_history_create(objs, batch_size=batch_size, update=update, **kwargs)
+        raccolta.aggiungi(self.model.instance_type, '~' if update else '+', (obj.pk for obj in objs))
+        return []
+
+
+class StoricoRecords(HistoricalRecords):
+    """
+    HistoricalRecords che, dentro un'operazione massiva, la aggiorna invece di scrivere lo storico per riga.
+    Le tabelle storiche hanno un indice (id, history_date) per le letture "alla data" (`versioni_al`).
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('history_manager', StoricoManager)
+        super().__init__(*args, **kwargs)
+
+    def get_meta_options(self, model):
+        opzioni = super().get_meta_options(model)
+        opzioni['indexes'] = (*opzioni.get('indexes', ()), models.Index(fields=[model._meta.pk.attname, 'history_date']))
+        return opzioni
+
+    def create_historical_record(self, instance, history_type, using=None):
+        raccolta = _operazione.get()
+        if raccolta is None:
+            return super().create_historical_record(instance, history_type, using=using)
+        raccolta.aggiungi(type(instance), history_type, [instance.pk])
@@ -0,0 +1,14 @@
+from django import template
+
+from core.models import VoceOperazione
+
+register = template.Library()
+
+
+@register.simple_tag
+def operazioni_massive(oggetto):
+    """Voci delle operazioni massive (senza storico per riga) che hanno toccato l'oggetto, dalla più recente."""
+    voci = VoceOperazione.objects.filter(
+        modello=oggetto._meta.label, primo_id__lte=oggetto.pk, ultimo_id__gte=oggetto.pk
+    ).select_related('operazione__utente').order_by('-operazione__avviata_il')
+    return [voce for voce in voci if voce.contiene(oggetto.pk)]
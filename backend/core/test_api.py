@@ -0,0 +1,130 @@
+from datetime import date
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from assets.models import Asset, NodoStruttura
+from campagne.models import Campagna
+from elementtypes.models import ElementType
+from minacce.models import Minaccia
+from scenari.models import Scenario
+
+
+class ApiTest(TestCase):
+
+    def setUp(self):
+        self.database = ElementType.objects.create(nome="database")
+        self.schema = ElementType.objects.create(nome="schema")
+        self.db = ElementType.objects.create(nome="db", is_base=False)
+        self.db.component_element_types.set([self.database, self.schema])
+        with self.captureOnCommitCallbacks(execute=True):
+            for i in range(5):
+                asset = Asset.objects.create(nome=f"Asset {i}")
+                NodoStruttura.objects.create(asset=asset, element_type=self.db, parent=asset.nodi_struttura.get(level=0))
+        self.asset = asset
+        self.client.force_login(User.objects.create_superuser("admin", password="x"))
+
+    def _campagna(self, **campi):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Campagna.objects.create(
+                descrizione="Campagna", data_inizio=date(2030, 1, 1), data_fine=date(2030, 12, 31), **{'anno': 2030, **campi}
+            )
+
+    def _ids(self, url):
+        """Id di tutte le righe seguendo i cursori `next`, con il numero di query di ogni pagina."""
+        ids, query = [], []
+        while url:
+            with CaptureQueriesContext(connection) as catturate:
+                risposta = self.client.get(url)
+            self.assertEqual(risposta.status_code, 200, risposta.content)
+            ids.extend(riga['id'] for riga in risposta.json()['results'])
+            query.append(len(catturate))
+            url = risposta.json()['next']
+        return ids, query
+
+    def test_rotte_versionate(self):
+        risposta = self.client.get('/api/v1/')
+        self.assertEqual(risposta.status_code, 200)
+        self.assertIn('nodi-struttura', risposta.json())
+        self.assertEqual(self.client.get(f'/api/v1/assets/{self.asset.pk}/albero/').status_code, 200)
+        self.assertEqual(self.client.get('/api/v2/assets/').status_code, 404)
+
+    def test_permessi(self):
+        self.client.logout()
+        self.assertEqual(self.client.get('/api/v1/assets/').status_code, 403)
+        lettore = User.objects.create_user("lettore", password="x")
+        self.client.force_login(lettore)
+        self.assertEqual(self.client.get('/api/v1/assets/').status_code, 200)
+        self.assertEqual(self.client.delete(f'/api/v1/assets/{self.asset.pk}/').status_code, 403)
+        self.assertTrue(Asset.objects.filter(pk=self.asset.pk).exists())
+
+    def test_paginazione_a_cursore(self):
+        ids, query = self._ids('/api/v1/nodi-struttura/?page_size=4')
+        self.assertEqual(ids, sorted(NodoStruttura.objects.values_list('id', flat=True)))
+        self.assertEqual(len(ids), 20)
+        # Le pagine profonde costano quanto la prima (sessione, utente e una query per pagina)
+        self.assertEqual(set(query), {3})
+        risposta = self.client.get('/api/v1/nodi-struttura/?page_size=5000')
+        self.assertEqual(len(risposta.json()['results']), 20)
+
+    def test_filtro_per_campagna(self):
+        copiata = self._campagna()
+        master_ids = set(NodoStruttura.objects.filter(campagna__isnull=True).values_list('id', flat=True))
+        copiati_ids = set(NodoStruttura.objects.filter(campagna=copiata).values_list('id', flat=True))
+        self.assertEqual(len(copiati_ids), 20)
+        self.assertEqual(set(self._ids('/api/v1/nodi-struttura/?campagna=master')[0]), master_ids)
+        self.assertEqual(set(self._ids(f'/api/v1/nodi-struttura/?campagna={copiata.pk}')[0]), copiati_ids)
+        self.assertEqual(
+            self._ids(f'/api/v1/assets/?campagna={copiata.pk}')[0],
+            list(Asset.objects.filter(campagna=copiata).order_by('id').values_list('id', flat=True)),
+        )
+
+        # Nelle campagne a copia su scrittura le righe master sono visibili, nodi compresi
+        sovrapposta = self._campagna(copia_su_scrittura=True, anno=2031)
+        self.assertEqual(
+            self._ids(f'/api/v1/assets/?campagna={sovrapposta.pk}')[0],
+            list(Asset.objects.filter(campagna__isnull=True).order_by('id').values_list('id', flat=True)),
+        )
+        self.assertEqual(set(self._ids(f'/api/v1/nodi-struttura/?campagna={sovrapposta.pk}')[0]), master_ids)
+
+        self.assertEqual(self.client.get('/api/v1/assets/?campagna=0').status_code, 400)
+        self.assertEqual(self.client.get('/api/v1/assets/?campagna=tutte').status_code, 400)
+
+    def test_relazioni_per_azione(self):
+        nodo = NodoStruttura.objects.filter(level=1).first()
+        with CaptureQueriesContext(connection) as catturate:
+            risposta = self.client.patch(
+                f'/api/v1/nodi-struttura/{nodo.pk}/', {'nome_specifico': "Database clienti"},
+                content_type='application/json',
+            )
+        self.assertEqual(risposta.status_code, 200)
+        self.assertEqual(NodoStruttura.objects.get(pk=nodo.pk).nome_specifico, "Database clienti")
+        # Asset e tipo del genitore arrivano con il nodo, non con query separate
+        self.assertFalse([q for q in catturate if 'FROM "assets_asset"' in q['sql'] and 'JOIN' not in q['sql']])
+
+        # Elenchi di nodi e asset: nomi dei tipi e responsabili nella stessa query delle righe
+        self.asset.utente_responsabile = User.objects.get(username="admin")
+        self.asset.save()
+        self.assertEqual(set(self._ids('/api/v1/nodi-struttura/?page_size=2')[1]), {3})
+        self.assertEqual(set(self._ids('/api/v1/assets/?page_size=2')[1]), {3})
+        nodo = self.client.get(f'/api/v1/nodi-struttura/{nodo.pk}/').json()
+        self.assertEqual(nodo['element_type_nome'], "db")
+        self.assertFalse({'lft', 'rght', 'tree_id', 'level'} & set(nodo))
+        asset = self.client.get(f'/api/v1/assets/{self.asset.pk}/').json()
+        self.assertEqual(asset['utente_responsabile_username'], "admin")
+        self.assertIsNone(asset['responsabile_applicativo_username'])
+
+        scenario = Scenario.objects.create(descrizione="S")
+        self.database.minacce.add(Minaccia.objects.create(descrizione="M", scenario=scenario))
+        with CaptureQueriesContext(connection) as una:
+            self.client.get('/api/v1/elementtypes/?page_size=1')
+        with CaptureQueriesContext(connection) as tre:
+            risposta = self.client.get('/api/v1/elementtypes/?page_size=3')
+        # Relazioni precaricate e dimensione annotata: nessuna query per ElementType
+        self.assertEqual(len(una), len(tre))
+        database = risposta.json()['results'][0]
+        self.assertEqual(database['minacce'], list(self.database.minacce.values_list('id', flat=True)))
+        self.assertEqual(database['matrix_dimension'], "1 x 0")
+        self.assertNotIn('valori_matrice', database)
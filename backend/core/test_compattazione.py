@@ -0,0 +1,90 @@
+from datetime import date, timedelta
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+
+from campagne.models import Campagna
+from scenari.models import Scenario
+from .compattazione import Compattazione
+from .models import CompattazioneStorico
+
+
+def _salva(oggetto, giorni_fa, **campi):
+    for campo, valore in campi.items():
+        setattr(oggetto, campo, valore)
+    oggetto._history_date = timezone.now() - timedelta(days=giorni_fa)
+    oggetto.save()
+    return oggetto
+
+
+class CompattazioneStoricoTest(TestCase):
+
+    def setUp(self):
+        # Campagna aperta 280 giorni fa e chiusa 220 giorni fa
+        self.campagna = _salva(
+            Campagna(anno=2030, descrizione="Campagna", data_inizio=date(2030, 1, 1), data_fine=date(2030, 12, 31)), 280
+        )
+        _salva(self.campagna, 260, descrizione="Campagna rinominata")
+        _salva(self.campagna, 220, status='close')
+        self.scenario = _salva(Scenario(descrizione="v400"), 400)
+        for giorni in (350, 300, 250, 240, 200, 10):
+            _salva(self.scenario, giorni, descrizione=f"v{giorni}")
+
+    def _versioni(self, oggetto):
+        return list(type(oggetto).history.filter(id=oggetto.pk).order_by('history_date').values_list('descrizione', flat=True))
+
+    def test_politica_di_conservazione(self):
+        registro = Compattazione(giorni=180).esegui()
+        # Creazione, versioni in vigore all'apertura (v300) e alla chiusura (v240), ultima prima del limite, finestra
+        self.assertEqual(self._versioni(self.scenario), ["v400", "v300", "v240", "v200", "v10"])
+        # Lo storico della campagna conserva i traguardi (creazione e chiusura) e l'ultima versione
+        self.assertEqual(
+            list(Campagna.history.filter(id=self.campagna.pk).order_by('history_date').values_list('status', flat=True)),
+            ['open', 'close'],
+        )
+        self.assertEqual((registro.eliminate['scenari.Scenario'], registro.eliminate['campagne.Campagna']), (2, 1))
+        self.assertEqual(sum(registro.eliminate.values()), 3)
+        self.assertEqual(registro.stato, CompattazioneStorico.COMPLETATA)
+        self.assertEqual(len(registro.latenza['scenari.Scenario']), 2)
+
+    def test_prova(self):
+        registro = Compattazione(giorni=180, prova=True).esegui()
+        self.assertEqual(registro.eliminate['scenari.Scenario'], 2)
+        self.assertEqual(len(self._versioni(self.scenario)), 7)
+        self.assertFalse(CompattazioneStorico.objects.exists())
+
+    def test_ripresa_dopo_interruzione(self):
+        altro = _salva(Scenario(descrizione="a400"), 400)
+        for giorni in (390, 380):
+            _salva(altro, giorni, descrizione=f"a{giorni}")
+
+        def interrompi(etichetta, eliminate):
+            raise KeyboardInterrupt
+
+        with self.assertRaises(KeyboardInterrupt):
+            Compattazione(giorni=180, modelli=['scenari.Scenario'], lotto=1).esegui(avanzamento=interrompi)
+        registro = CompattazioneStorico.objects.get()
+        self.assertEqual(registro.stato, CompattazioneStorico.IN_CORSO)
+        self.assertEqual(registro.eliminate, {'scenari.Scenario': 2})
+
+        uscita = StringIO()
+        call_command('compatta_storico', '--modello', 'scenari.Scenario', stdout=uscita)
+        self.assertIn("Ripresa di", uscita.getvalue())
+        self.assertIn("3 versioni eliminate", uscita.getvalue())
+        registro.refresh_from_db()
+        self.assertEqual((registro.stato, registro.eliminate), (CompattazioneStorico.COMPLETATA, {'scenari.Scenario': 3}))
+        self.assertEqual(self._versioni(altro), ["a400", "a380"])
+
+    def test_traguardi_solo_nello_storico_di_campagna(self):
+        altro = _salva(Scenario(descrizione="a400"), 400)
+        for giorni in (390, 380):
+            _salva(altro, giorni, descrizione=f"a{giorni}")
+        # Una versione intermedia dello scenario con lo stesso history_id di un traguardo della campagna
+        traguardo = Campagna.history.filter(id=self.campagna.pk, status='close').get()
+        Campagna.history.filter(history_id=traguardo.history_id).update(history_id=9999)
+        Scenario.history.filter(id=altro.pk, descrizione="a390").update(history_id=9999)
+        Compattazione(giorni=180).esegui()
+        self.assertEqual(self._versioni(altro), ["a400", "a380"])
+        self.assertTrue(Campagna.history.filter(history_id=9999).exists())
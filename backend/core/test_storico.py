@@ -0,0 +1,81 @@
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+
+from minacce.models import Minaccia
+from scenari.models import Scenario
+from .models import OperazioneMassiva
+from .storico import intervalli, operazione_massiva, transazione_operazione
+
+
+class StoricoPerOperazioneTest(TestCase):
+
+    def test_storico_per_riga_sospeso(self):
+        utente = User.objects.create_user("operatore")
+        with operazione_massiva("Import", utente=utente) as raccolta:
+            scenari = [Scenario.objects.create(descrizione=f"S{i}") for i in range(3)]
+            Minaccia.objects.create(descrizione="M", scenario=scenari[0])
+            scenari[1].descrizione = "S1 modificato"
+            scenari[1].save()
+            scenari[2].delete()
+        self.assertFalse(Scenario.history.exists())
+        self.assertFalse(Minaccia.history.exists())
+
+        operazione = raccolta.operazione
+        self.assertEqual((operazione.utente, operazione.righe), (utente, 6))
+        self.assertEqual(
+            {(voce.modello, voce.tipo, voce.righe) for voce in operazione.voci.all()},
+            {("scenari.Scenario", '+', 3), ("scenari.Scenario", '~', 1), ("scenari.Scenario", '-', 1),
+             ("minacce.Minaccia", '+', 1)},
+        )
+        self.assertEqual(set(operazione.oggetti(Scenario)), set(scenari[:2]))
+        self.assertEqual(list(operazione.oggetti(Scenario, '~')), [scenari[1]])
+
+        # Fuori dall'operazione lo storico torna per riga
+        scenari[0].save()
+        self.assertEqual(Scenario.history.count(), 1)
+
+    def test_operazioni_annidate_e_errori(self):
+        with operazione_massiva("Esterna") as esterna:
+            with operazione_massiva("Interna") as interna:
+                Scenario.objects.create(descrizione="S")
+        self.assertIs(interna, esterna)
+        self.assertEqual(list(OperazioneMassiva.objects.values_list('descrizione', flat=True)), ["Esterna"])
+
+        with self.assertRaises(ValueError), operazione_massiva("Fallita"):
+            raise ValueError
+        self.assertFalse(OperazioneMassiva.objects.filter(descrizione="Fallita").exists())
+
+        # Interrotta dopo aver registrato righe: l'operazione resta, come non completata
+        with self.assertRaises(ValueError), operazione_massiva("Interrotta"):
+            scenario = Scenario.objects.create(descrizione="Registrato")
+            with self.assertRaises(ValueError), transazione_operazione():
+                Scenario.objects.create(descrizione="Annullato")
+                raise ValueError
+            raise ValueError
+        interrotta = OperazioneMassiva.objects.get(descrizione="Interrotta")
+        self.assertFalse(interrotta.completata)
+        self.assertEqual(list(interrotta.oggetti(Scenario)), [scenario])
+        self.assertEqual(interrotta.righe, 1)
+
+    @override_settings(STORICO_PER_OPERAZIONE=False)
+    def test_disattivato(self):
+        with operazione_massiva("Import") as raccolta:
+            Scenario.objects.create(descrizione="S")
+        self.assertIsNone(raccolta)
+        self.assertEqual(Scenario.history.count(), 1)
+        self.assertFalse(OperazioneMassiva.objects.exists())
+
+    def test_intervalli(self):
+        self.assertEqual(intervalli({7, 3, 4, 5, 9, 10}), [[3, 5], [7, 7], [9, 10]])
+
+    def test_cronologia_dell_admin(self):
+        with operazione_massiva("Import degli scenari"):
+            scenario = Scenario.objects.create(descrizione="S")
+        self.client.force_login(User.objects.create_superuser("admin", password="x"))
+        risposta = self.client.get(f"/admin/scenari/scenario/{scenario.pk}/history/")
+        self.assertContains(risposta, "Import degli scenari")
+        operazione = OperazioneMassiva.objects.get()
+        risposta = self.client.get(f"/admin/core/operazionemassiva/{operazione.pk}/change/")
+        self.assertContains(risposta, f"?id__gte={scenario.pk}&amp;id__lte={scenario.pk}")
+        elenco = self.client.get(f"/admin/scenari/scenario/?id__gte={scenario.pk}&id__lte={scenario.pk}")
+        self.assertEqual(elenco.context['cl'].result_count, 1)
@@ -0,0 +1,16 @@
+"""Strumenti comuni dei test."""
+from django.contrib.auth.models import User
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+
+class RichiesteAutenticate(APIRequestFactory):
+    """APIRequestFactory le cui richieste sono già autenticate (di default come superutente, senza query)."""
+
+    def __init__(self, utente=None, **defaults):
+        super().__init__(**defaults)
+        self.utente = utente or User(username="test", is_active=True, is_staff=True, is_superuser=True)
+
+    def generic(self, *args, **kwargs):
+        richiesta = super().generic(*args, **kwargs)
+        force_authenticate(richiesta, user=self.utente)
+        return richiesta
@@ -1,5 +1,25 @@
-from django.urls import path
+from django.urls import include, re_path
+from rest_framework.routers import DefaultRouter
 
-# Questo file è ora dedicato alle API.
-# Aggiungi qui i tuoi pattern URL per le API.
-urlpatterns = []
\ No newline at end of file
+from assets.views import AssetViewSet, NodoStrutturaViewSet, StrutturaTemplateViewSet
+from campagne.views import CampagnaViewSet
+from controlli.views import ControlloViewSet
+from elementtypes.views import ElementTypeViewSet, ValoreElementTypeViewSet
+from minacce.views import MinacciaViewSet
+from scenari.views import ScenarioViewSet
+
+# API REST versionata: /api/v1/<risorsa>/ (versione letta da URLPathVersioning, vedi REST_FRAMEWORK)
+router = DefaultRouter()
+router.register(r'campagne', CampagnaViewSet)
+router.register(r'scenari', ScenarioViewSet)
+router.register(r'minacce', MinacciaViewSet)
+router.register(r'controlli', ControlloViewSet)
+router.register(r'elementtypes', ElementTypeViewSet)
+router.register(r'valori-elementtype', ValoreElementTypeViewSet)
+router.register(r'assets', AssetViewSet)
+router.register(r'nodi-struttura', NodoStrutturaViewSet)
+router.register(r'strutture-template', StrutturaTemplateViewSet)
+
+urlpatterns = [
+    re_path(r'^(?P<version>v1)/', include(router.urls)),
+]
@@ -1 +1,24 @@
-from django.shortcuts import render
+from datetime import datetime, time
+
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from rest_framework.exceptions import ValidationError
+
+
+def parametro_al(request):
+    """
+    Istante del parametro `?al=` (data o data e ora ISO 8601) per le letture "alla data", o None.
+    Una data senza ora indica la fine di quel giorno; senza fuso orario vale quello del progetto.
+    """
+    valore = request.query_params.get('al')
+    if not valore:
+        return None
+    try:
+        quando = parse_datetime(valore)
+        if quando is None and (giorno := parse_date(valore)) is not None:
+            quando = datetime.combine(giorno, time.max)
+    except ValueError:
+        quando = None
+    if quando is None:
+        raise ValidationError({'al': "Data non valida: usare il formato ISO 8601 (es. 2025-01-31T18:00)."})
+    return timezone.make_aware(quando) if timezone.is_naive(quando) else quando
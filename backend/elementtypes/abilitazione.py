@@ -0,0 +1,127 @@
+"""
+Verifica dei requisiti per abilitare gli ElementType di base.
+
+Un ElementType di base è abilitabile se:
+1. ha almeno una minaccia associata (righe della matrice);
+2. ha almeno un controllo assegnato (colonne della matrice);
+3. ogni minaccia ha almeno un controllo valorizzato nella matrice;
+4. ogni minaccia ha almeno 2 controlli preventive e 2 detective valorizzati;
+5. ogni controllo assegnato è valorizzato per almeno una minaccia.
+
+I conteggi per minaccia e i controlli non coperti sono calcolati con query
+raggruppate per un intero insieme di ElementType (uno solo, o tutti quelli di
+una campagna), con un numero di query indipendente dalla dimensione delle matrici.
+"""
+from collections import defaultdict
+
+from django.db.models import Count, Exists, OuterRef, Q
+
+MIN_CONTROLLI_PER_CATEGORIA = 2
+
+
+def _elenco(nomi):
+    return ', '.join(f'"{nome}"' for nome in nomi)
+
+
+class EsitoAbilitazione:
+    """Risultato della verifica per un singolo ElementType."""
+
+    def __init__(self, elementtype_id):
+        self.elementtype_id = elementtype_id
+        self.minacce = []  # (id, descrizione) nell'ordine delle minacce associate
+        self.num_controlli = 0
+        self.minacce_senza_valori = []
+        self.minacce_incomplete = []
+        self.controlli_non_coperti = []
+
+    @property
+    def abilitabile(self):
+        return self.errore is None
+
+    @property
+    def errore(self):
+        """Primo requisito non soddisfatto (codice, messaggio) oppure None."""
+        if not self.minacce:
+            return 'senza_minacce', "L'ElementType non può essere abilitato perché non ha minacce associate (righe della matrice)."
+        if not self.num_controlli:
+            return 'senza_controlli', "L'ElementType non può essere abilitato perché non ha controlli assegnati (colonne della matrice)."
+        if self.minacce_senza_valori:
+            return 'minacce_senza_valori', (
+                "L'ElementType non può essere abilitato perché le seguenti minacce (righe) "
+                "non hanno nessun controllo associato nella matrice: "
+                f"{_elenco(self.minacce_senza_valori)}."
+            )
+        if self.minacce_incomplete:
+            return 'minacce_incomplete', (
+                "L'ElementType non può essere abilitato perché le seguenti minacce non hanno almeno "
+                f"{MIN_CONTROLLI_PER_CATEGORIA} controlli preventivi e {MIN_CONTROLLI_PER_CATEGORIA} "
+                "controlli detective associati nella matrice: "
+                f"{_elenco(self.minacce_incomplete)}."
+            )
+        if self.controlli_non_coperti:
+            return 'controlli_non_coperti', (
+                "L'ElementType non può essere abilitato perché i seguenti controlli assegnati "
+                "non sono presenti nella matrice di rischio (non associati a nessuna minaccia): "
+                f"{_elenco(self.controlli_non_coperti)}."
+            )
+        return None
+
+    @property
+    def messaggio(self):
+        errore = self.errore
+        return errore[1] if errore else None
+
+
+def valuta_abilitazione(element_types):
+    """
+    Verifica i requisiti di abilitazione per gli ElementType del queryset indicato
+    (ad es. `ElementType.objects.filter(pk=...)` o `.filter(campagna=..., is_base=True)`).
+    Restituisce {elementtype_id: EsitoAbilitazione}.
+    """
+    from controlli.models import Controllo
+    from .models import ElementType, ValoreElementType
+
+    esiti = {et_id: EsitoAbilitazione(et_id) for et_id in element_types.values_list('id', flat=True)}
+    if not esiti:
+        return esiti
+
+    for et_id, minaccia_id, descrizione in ElementType.minacce.through.objects.filter(
+        elementtype_id__in=esiti
+    ).order_by('minaccia_id').values_list('elementtype_id', 'minaccia_id', 'minaccia__descrizione'):
+        esiti[et_id].minacce.append((minaccia_id, descrizione))
+
+    # Un unico GROUP BY sui valori della matrice: controlli preventive/detective per (ElementType, minaccia)
+    conteggi = defaultdict(dict)
+    for et_id, minaccia_id, preventive, detective in ValoreElementType.objects.filter(
+        elementtype_id__in=esiti
+    ).values('elementtype_id', 'minaccia_id').annotate(
+        preventive=Count('id', filter=Q(controllo__categoria_controllo='preventive')),
+        detective=Count('id', filter=Q(controllo__categoria_controllo='detective')),
+    ).values_list('elementtype_id', 'minaccia_id', 'preventive', 'detective'):
+        conteggi[et_id][minaccia_id] = (preventive, detective)
+
+    # Controlli assegnati, marcando quelli senza alcun valore nella matrice del proprio ElementType
+    for et_id, nome, coperto in Controllo.objects.filter(elementtype_id__in=esiti).annotate(
+        coperto=Exists(ValoreElementType.objects.filter(
+            elementtype_id=OuterRef('elementtype_id'), controllo_id=OuterRef('pk')
+        ))
+    ).order_by('id').values_list('elementtype_id', 'nome', 'coperto'):
+        esiti[et_id].num_controlli += 1
+        if not coperto:
+            esiti[et_id].controlli_non_coperti.append(nome)
+
+    for et_id, esito in esiti.items():
+        for minaccia_id, descrizione in esito.minacce:
+            preventive, detective = conteggi[et_id].get(minaccia_id, (0, 0))
+            if not preventive and not detective:
+                esito.minacce_senza_valori.append(descrizione)
+            elif preventive < MIN_CONTROLLI_PER_CATEGORIA or detective < MIN_CONTROLLI_PER_CATEGORIA:
+                esito.minacce_incomplete.append(descrizione)
+    return esiti
+
+
+def valuta_elementtype(elementtype):
+    """Verifica i requisiti di abilitazione di un singolo ElementType salvato."""
+    from .models import ElementType
+
+    return valuta_abilitazione(ElementType.objects.filter(pk=elementtype.pk))[elementtype.pk]
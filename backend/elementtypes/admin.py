@@ -2,12 +2,17 @@ from django.contrib import admin, messages
 from django.db import transaction, models
 from django.db.models import Q
 from django import forms
+from simple_history.utils import bulk_update_with_history
 
 from django.contrib.admin.widgets import RelatedFieldWidgetWrapper
 from core.admin_mixins import MasterAdminMixin, CustomDeleteActionMixin
 from core.admin_filters import MasterCampaignFilter
-from .models import ElementType, ValoreElementType
-from .forms import ElementTypeForm
+from campagne.sovrapposizione import preserva_righe, righe_per_campagna
+from .models import ElementType
+from .forms import ElementTypeForm, applica_matrice_post
+from .abilitazione import valuta_abilitazione, valuta_elementtype
+from .compatta import carica_matrice
+from .dimensioni import aggiorna_dimensioni
 from controlli.models import Controllo
 from minacce.models import Minaccia
 
@@ -22,6 +27,7 @@ class ElementTypeAdmin(CustomDeleteActionMixin, MasterAdminMixin, admin.ModelAdm
     readonly_fields = ('campagna', 'is_base')
 
     filter_horizontal = ('minacce', 'component_element_types',)
+    actions = ['abilita_idonei']
 
     # Rimuoviamo i fieldsets statici perché ora li gestiamo dinamicamente con get_fieldsets
     # fieldsets = (...)
@@ -76,20 +82,38 @@ class ElementTypeAdmin(CustomDeleteActionMixin, MasterAdminMixin, admin.ModelAdm
         super().save_model(request, obj, form, change)
 
     def get_queryset(self, request):
-        qs = super().get_queryset(request)
-        qs = qs.prefetch_related(
-            'minacce', 
-            'controls_assigned_to_elementtype',
-            'component_element_types__minacce',
-            'component_element_types__controls_assigned_to_elementtype'
-        )
-        return qs
+        # La dimensione della matrice è letta dai contatori materializzati: non servono prefetch.
+        return super().get_queryset(request)
 
     def dimensione_matrice(self, obj):
-        # Chiama il metodo del modello che ora contiene la logica corretta (anche ricorsiva)
+        # Legge i contatori num_minacce/num_controlli mantenuti dai segnali (anche per i derivati)
         return obj.get_dimensione_matrice_display()
     dimensione_matrice.short_description = 'Dim. Matrice'
 
+    @admin.action(description="Abilita gli ElementType di base selezionati che soddisfano i requisiti")
+    def abilita_idonei(self, request, queryset):
+        candidati = queryset.filter(is_base=True, is_enabled=False)
+        esiti = valuta_abilitazione(candidati)
+        da_abilitare = [et for et in candidati if esiti[et.pk].abilitabile]
+        for et in da_abilitare:
+            et.is_enabled = True
+        with transaction.atomic():
+            preserva_righe(ElementType, [et.pk for et in da_abilitare if et.campagna_id is None])
+            bulk_update_with_history(
+                da_abilitare, ElementType, ['is_enabled'],
+                default_user=request.user, default_change_reason="Abilitazione massiva",
+            )
+
+        if da_abilitare:
+            self.message_user(request, f"{len(da_abilitare)} ElementType abilitati.", messages.SUCCESS)
+        non_idonei = len(candidati) - len(da_abilitare)
+        if non_idonei:
+            self.message_user(
+                request,
+                f"{non_idonei} ElementType non soddisfano i requisiti di abilitazione e sono rimasti disabilitati.",
+                messages.WARNING,
+            )
+
     def get_form(self, request, obj=None, **kwargs):
         form_class = super().get_form(request, obj, **kwargs)
         class ElementTypeAdminForm(form_class):
@@ -113,18 +137,16 @@ class ElementTypeAdmin(CustomDeleteActionMixin, MasterAdminMixin, admin.ModelAdm
                     'minacce': Minaccia,
                     'component_element_types': ElementType,
                 }
+                # Campagna dell'ElementType o, per i record master aperti da una campagna, quella dell'URL
+                campagna_id = (instance.campagna_id if instance and instance.pk else None) or request.GET.get('campagna__id__exact')
                 for field_name, model in m2m_fields_to_filter.items():
                     if field_name in self.fields:
-                        if instance and instance.pk:
-                            if instance.campagna:
-                                queryset = model.objects.filter(campagna=instance.campagna)
-                            else:
-                                queryset = model.objects.filter(campagna__isnull=True)
-                            if field_name == 'component_element_types':
-                                queryset = queryset.exclude(pk=instance.pk)
+                        if campagna_id:
+                            queryset = righe_per_campagna(model.objects.all(), campagna_id)
                         else:
-                            campagna_id = request.GET.get('campagna__id__exact')
-                            queryset = model.objects.filter(campagna_id=campagna_id) if campagna_id else model.objects.filter(campagna__isnull=True)
+                            queryset = model.objects.filter(campagna__isnull=True)
+                        if instance and instance.pk and field_name == 'component_element_types':
+                            queryset = queryset.exclude(pk=instance.pk)
                         self.fields[field_name].queryset = queryset
                         if field_name in ['component_element_types', 'minacce']:
                             self.fields[field_name].label = "" # Rimuove l'etichetta del campo
@@ -137,6 +159,9 @@ class ElementTypeAdmin(CustomDeleteActionMixin, MasterAdminMixin, admin.ModelAdm
         current_pks = {c.pk for c in obj.controls_assigned_to_elementtype.all()}
         Controllo.objects.filter(pk__in=(selected_pks - current_pks)).update(elementtype=obj)
         Controllo.objects.filter(pk__in=(current_pks - selected_pks)).update(elementtype=None)
+        if selected_pks != current_pks:
+            # update() non invia segnali: i contatori delle colonne vanno riallineati qui.
+            aggiorna_dimensioni([obj.pk])
         
         if not obj.is_base:
             components = obj.component_element_types.all()
@@ -158,14 +183,14 @@ class ElementTypeAdmin(CustomDeleteActionMixin, MasterAdminMixin, admin.ModelAdm
                 context['matrix_render_problem'] = True
                 context['matrix_render_problem_message'] = "Associare almeno un controllo nella sezione 'Configurazione Controlli (colonne)' e salvare per visualizzare la matrice."
             else:
-                valori_dict = {(v.minaccia_id, v.controllo_id): v.valore for v in ValoreElementType.objects.filter(elementtype=obj)}
+                matrice = carica_matrice(obj.pk)
                 matrix_data = []
                 all_threats_have_non_zero_value = True
                 for minaccia in minacce:
                     row = {'minaccia': minaccia, 'cells': []}
                     has_non_zero_value_in_row = False
                     for controllo in controlli:
-                        value = valori_dict.get((minaccia.id, controllo.id))
+                        value = matrice.get(minaccia.id, controllo.id) or None
                         if value is not None and value != 0:
                             has_non_zero_value_in_row = True
                         formatted_value = str(value).replace('.', ',') if value is not None else None
@@ -179,22 +204,20 @@ class ElementTypeAdmin(CustomDeleteActionMixin, MasterAdminMixin, admin.ModelAdm
                     context['matrix_incomplete_warning'] = True
                     context['matrix_incomplete_warning_message'] = "Attenzione: alcune minacce non hanno valori di controllo (diversi da zero) associati. L'Element Type non potrà essere abilitato finché la matrice non sarà completa."
         if obj and not obj.is_base:
-            components = obj.component_element_types.all()
-            # Usa i nuovi metodi ricorsivi per ottenere minacce e controlli
-            aggregated_minacce = obj.get_all_minacce().order_by('descrizione')
-            aggregated_controlli = obj.get_all_controlli().order_by('nome')
+            # Righe e colonne come tuple compatte; i valori aggregati sono letti con un unico fetch
+            # della forma compatta (vedi compatta.py) e disposti in memoria, come per i tipi base.
+            aggregated_minacce = list(obj.get_all_minacce().order_by('descrizione').values_list('id', 'descrizione'))
+            aggregated_controlli = list(obj.get_all_controlli().order_by('nome').values_list('id', 'nome', 'descrizione'))
 
-            if aggregated_minacce.exists() and aggregated_controlli.exists():
+            if aggregated_minacce and aggregated_controlli:
+                matrice = carica_matrice(obj.pk)
                 aggregated_matrix_data = []
-                for minaccia in aggregated_minacce:
-                    row = {'minaccia': minaccia, 'cells': []}
-                    for controllo in aggregated_controlli:
-                        # Il valore viene letto direttamente dalla matrice aggregata del padre
-                        valore_obj = obj.valori_matrice.filter(minaccia=minaccia, controllo=controllo).first()
-                        value = valore_obj.valore if valore_obj else None
-                        formatted_value = str(value).replace('.', ',') if value is not None else ''
-                        row['cells'].append({'controllo': controllo, 'value': formatted_value})
-                    aggregated_matrix_data.append(row)
+                for minaccia_id, descrizione in aggregated_minacce:
+                    valori = []
+                    for controllo_id, _, _ in aggregated_controlli:
+                        value = matrice.get(minaccia_id, controllo_id)
+                        valori.append(str(value).replace('.', ',') if value else '')
+                    aggregated_matrix_data.append((minaccia_id, descrizione, valori))
                 context['aggregated_matrix_data'] = aggregated_matrix_data
                 context['aggregated_matrix_controlli'] = aggregated_controlli
         return super().render_change_form(request, context, add, change, form_url, obj)
@@ -202,91 +225,28 @@ class ElementTypeAdmin(CustomDeleteActionMixin, MasterAdminMixin, admin.ModelAdm
     def response_change(self, request, obj):
         if obj.is_base and request.method == 'POST':
             with transaction.atomic():
-                minacce = obj.minacce.all()
-                controlli = Controllo.objects.filter(elementtype=obj)
-                matrix_changed = False
-                # is_enabled_changed_in_post = 'is_enabled' in request.POST and request.POST['is_enabled'] == 'on' # Not used in final logic
-                post_keys = {k for k in request.POST if k.startswith('matrix-')}
-                for minaccia in minacce:
-                    for controllo in controlli:
-                        form_field_name = f'matrix-{minaccia.id}-{controllo.id}'
-                        if form_field_name in post_keys:
-                            valore_str = request.POST.get(form_field_name, '').strip()
-                            existing_value = ValoreElementType.objects.filter(elementtype=obj, minaccia=minaccia, controllo=controllo).first()
+                # Una sola lettura della matrice corrente e scrittura del diff in blocco
+                modifiche, errori = applica_matrice_post(obj, request.POST)
+                for errore in errori:
+                    messages.error(request, errore)
+                matrix_changed = bool(modifiche)
 
-                            # Normalize string for parsing
-                            valore_str_norm = valore_str.replace(',', '.').strip()
+                # Aggiorna solo le celle dei tipi derivati e delle radici degli asset che dipendono da quelle modificate.
+                propagazione = modifiche.propaga() if modifiche else None
 
-                            if not valore_str_norm: # Handles empty string
-                                if existing_value:
-                                    existing_value.delete()
-                                    matrix_changed = True
-                                continue # Move to next cell
-
-                            try:
-                                valore = float(valore_str_norm)
-
-                                # If the value is 0, treat it as "not saved" (delete if exists)
-                                if valore == 0.0:
-                                    if existing_value:
-                                        existing_value.delete()
-                                        matrix_changed = True
-                                    continue # Move to next cell, as 0 is not saved
-
-                                # Validation for values between 0.01 and 1.0
-                                if not (0.0 < valore <= 1.0): # Value must be strictly greater than 0
-                                    messages.error(request, f"Valore '{valore_str}' non valido per la cella ({minaccia.descrizione}, {controllo.nome}). Il valore deve essere compreso tra 0.01 e 1. Modifica non salvata per questa cella.")
-                                    continue
-
-                                if '.' in valore_str_norm and len(valore_str_norm.split('.')[-1]) > 2:
-                                    messages.error(request, f"Valore '{valore_str}' non valido per la cella ({minaccia.descrizione}, {controllo.nome}). Il valore deve avere al massimo due cifre decimali. Modifica non salvata per questa cella.")
-                                    continue
-
-                                if not existing_value or existing_value.valore != valore:
-                                    ValoreElementType.objects.update_or_create(
-                                        elementtype=obj, minaccia=minaccia, controllo=controllo,
-                                        defaults={'valore': valore}
-                                    )
-                                    matrix_changed = True
-
-                            except (ValueError, TypeError):
-                                messages.error(request, f"Valore non numerico '{valore_str}' per la cella ({minaccia.descrizione}, {controllo.nome}). Ignorato.")
-                                continue
-                
                 # Dopo aver processato i valori della matrice, si valida lo stato di 'is_enabled'.
                 is_enabled_from_form = obj.is_enabled
                 should_be_enabled = is_enabled_from_form
                 validation_error_message = None
 
                 if is_enabled_from_form:
-                    # Eseguiamo la validazione completa contro lo stato attuale del DB all'interno della transazione.
-                    # Questo garantisce che stiamo usando i dati più aggiornati, inclusi i valori della matrice appena salvati.
-                    current_minacce = obj.minacce.all()
-                    current_controlli = Controllo.objects.filter(elementtype=obj)
-
-                    if not current_minacce.exists():
+                    # Validazione completa contro lo stato del DB all'interno della transazione,
+                    # inclusi i valori della matrice appena salvati (stesso servizio di clean()).
+                    esito = valuta_elementtype(obj)
+                    if not esito.abilitabile:
                         should_be_enabled = False
-                        validation_error_message = "L'ElementType non può essere abilitato perché non ha minacce associate (righe della matrice)."
-                    elif not current_controlli.exists():
-                        should_be_enabled = False
-                        validation_error_message = "L'ElementType non può essere abilitato perché non ha controlli assegnati (colonne della matrice)."
-                    else:
-                        # Vincolo 3: Ogni riga (minaccia) deve avere almeno un valore.
-                        # Questa query critica legge i dati aggiornati all'interno della transazione.
-                        threat_ids_with_values = set(ValoreElementType.objects.filter(elementtype=obj).values_list('minaccia_id', flat=True))
-                        
-                        threats_without_values = [
-                            f'"{m.descrizione}"' for m in current_minacce if m.id not in threat_ids_with_values
-                        ]
+                        validation_error_message = esito.messaggio
 
-                        if threats_without_values:
-                            should_be_enabled = False
-                            validation_error_message = (
-                                "L'ElementType non può essere abilitato perché le seguenti minacce (righe) "
-                                "non hanno nessun controllo associato nella matrice: "
-                                f"{', '.join(threats_without_values)}."
-                            )
-                
                 # Se la validazione fallisce, aggiorna l'oggetto e informa l'utente.
                 if not should_be_enabled and is_enabled_from_form:
                     obj.is_enabled = False
@@ -295,4 +255,11 @@ class ElementTypeAdmin(CustomDeleteActionMixin, MasterAdminMixin, admin.ModelAdm
 
             if matrix_changed:
                 self.message_user(request, f"Matrice per '{obj.nome}' aggiornata con successo.", messages.SUCCESS)
+            if propagazione and (propagazione['derivati'] or propagazione['radici']):
+                self.message_user(
+                    request,
+                    f"Modifiche propagate a {propagazione['derivati']} tipi derivati e {propagazione['radici']} "
+                    f"radici di asset ({propagazione['celle']} celle aggiornate).",
+                    messages.INFO,
+                )
         return super().response_change(request, obj)
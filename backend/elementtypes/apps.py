@@ -4,4 +4,7 @@ logger = logging.getLogger(__name__)
 
 class ElementtypesConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
-    name = 'elementtypes'
\ No newline at end of file
+    name = 'elementtypes'
+
+    def ready(self):
+        from . import signals  # noqa: F401 - registra i receiver
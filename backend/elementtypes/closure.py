@@ -0,0 +1,102 @@
+"""
+Manutenzione della tabella di chiusura (ElementTypeClosure) del grafo di
+derivazione `component_element_types`.
+
+Per ogni coppia (antenato, discendente) raggiungibile esiste una riga con la
+distanza minima tra i due nodi; ogni ElementType è antenato di sé stesso a
+distanza 0. Le interrogazioni ricorsive ("tutti i componenti di base di X",
+"tutti i derivati che dipendono da Y") diventano così un singolo join.
+"""
+from collections import deque
+
+from django.core.exceptions import ValidationError
+
+
+def carica_grafo(campagna_id):
+    """
+    Carica con una query gli archi padre -> componente degli ElementType
+    della campagna (o del master se `campagna_id` è None); per una campagna a
+    copia su scrittura anche quelli degli ElementType master che vi sono visibili.
+    Restituisce un dizionario {elementtype_id: [component_id, ...]}.
+    """
+    from campagne.sovrapposizione import campagna_sovrapposta, grafo_sovrapposto
+    from .models import ElementType
+
+    if campagna_sovrapposta(campagna_id):
+        return grafo_sovrapposto(campagna_id)
+
+    through = ElementType.component_element_types.through
+    archi = through.objects.filter(from_elementtype__campagna_id=campagna_id).values_list(
+        'from_elementtype_id', 'to_elementtype_id'
+    )
+    grafo = {}
+    for padre_id, figlio_id in archi:
+        grafo.setdefault(padre_id, []).append(figlio_id)
+    return grafo
+
+
+def discendenti(grafo, origine_id):
+    """Visita in ampiezza: {discendente_id: distanza minima}, origine inclusa a distanza 0."""
+    distanze = {origine_id: 0}
+    coda = deque([origine_id])
+    while coda:
+        nodo = coda.popleft()
+        for figlio in grafo.get(nodo, ()):
+            if figlio not in distanze:
+                distanze[figlio] = distanze[nodo] + 1
+                coda.append(figlio)
+    return distanze
+
+
+def antenati_ids(element_type_ids):
+    """Id di tutti gli antenati (inclusi i nodi stessi) secondo la chiusura corrente."""
+    from .models import ElementTypeClosure
+
+    return set(
+        ElementTypeClosure.objects.filter(descendant_id__in=element_type_ids).values_list('ancestor_id', flat=True)
+    ) | set(element_type_ids)
+
+
+def verifica_aciclicita(padre_id, componenti_ids):
+    """
+    Solleva ValidationError se collegare `componenti_ids` come componenti di
+    `padre_id` creerebbe un ciclo (un componente è il padre o un suo antenato).
+    """
+    from .models import ElementType
+
+    in_ciclo = set(componenti_ids) & antenati_ids([padre_id])
+    if in_ciclo:
+        nomi = ElementType.objects.filter(pk__in=in_ciclo).values_list('nome', flat=True)
+        raise ValidationError(
+            "Impossibile aggiungere i componenti %(nomi)s: si creerebbe un ciclo nel grafo di derivazione.",
+            params={'nomi': ", ".join(f'"{nome}"' for nome in sorted(nomi))},
+            code='ciclo_derivazione',
+        )
+
+
+def ricostruisci_chiusura(element_type_ids, campagna_id):
+    """
+    Ricalcola le righe di chiusura che hanno come antenato uno degli
+    ElementType indicati, a partire dagli archi correnti del grafo.
+    """
+    from .models import ElementTypeClosure
+
+    element_type_ids = set(element_type_ids)
+    if not element_type_ids:
+        return
+    grafo = carica_grafo(campagna_id)
+    nuove_righe = [
+        ElementTypeClosure(ancestor_id=antenato_id, descendant_id=discendente_id, depth=distanza)
+        for antenato_id in element_type_ids
+        for discendente_id, distanza in discendenti(grafo, antenato_id).items()
+    ]
+    ElementTypeClosure.objects.filter(ancestor_id__in=element_type_ids).delete()
+    ElementTypeClosure.objects.bulk_create(nuove_righe)
+
+
+def ricostruisci_chiusura_campagna(campagna_id):
+    """Ricostruisce da zero la chiusura di tutti gli ElementType di una campagna (o del master)."""
+    from .models import ElementType
+
+    ids = ElementType.objects.filter(campagna_id=campagna_id).values_list('id', flat=True)
+    ricostruisci_chiusura(ids, campagna_id)
@@ -0,0 +1,300 @@
+"""
+Archiviazione compatta delle matrici di rischio (`MatriceCompatta`).
+
+I valori ammessi vanno da 0.01 a 1.00 con due decimali: ogni cella è salvata
+come percentuale in un byte (uint8, 0 = cella assente), insieme ai vettori
+ordinati degli id di minacce e controlli. Una matrice intera si carica con un
+solo fetch e occupa una frazione della memoria delle singole righe.
+
+La tabella `ValoreElementType` resta la fonte dei dati. Le righe si scrivono e
+si eliminano solo da qui, e ogni scrittura allinea la forma compatta:
+`scrivi_celle` per le modifiche puntuali, `sostituisci_matrici` per le
+riscritture complete, `elimina_celle` per le cancellazioni (non c'è un
+post_delete, che disattiverebbe la cancellazione rapida); il salvataggio di una
+singola riga è allineato dal segnale post_save. Chi legge usa `carica_matrici`,
+che ricade sulle righe per gli ElementType senza forma compatta. Il
+meccanismo si disattiva con `MATRICI_COMPATTE = False` nelle impostazioni.
+"""
+import hashlib
+from collections import defaultdict
+
+import numpy as np
+from django.conf import settings
+
+from .matrix import MatriceDensa
+
+TIPO_ID = np.dtype('<i8')
+TIPO_VALORE = np.uint8
+SCALA = 100
+
+
+def attive():
+    return getattr(settings, 'MATRICI_COMPATTE', True)
+
+
+def impacchetta(matrice):
+    """Converte una MatriceDensa nei tre campi binari (id minacce, id controlli, valori)."""
+    valori = np.rint(np.clip(matrice.valori, 0.0, 1.0) * SCALA).astype(TIPO_VALORE)
+    return (
+        np.asarray(matrice.minacce_ids, dtype=TIPO_ID).tobytes(),
+        np.asarray(matrice.controlli_ids, dtype=TIPO_ID).tobytes(),
+        np.ascontiguousarray(valori).tobytes(),
+    )
+
+
+def impronta(campi):
+    """Hash del contenuto impacchettato (id minacce, id controlli, valori): fa da versione della matrice."""
+    minacce, controlli, valori = (bytes(campo) for campo in campi)
+    digest = hashlib.sha1(f"{len(minacce)}:{len(controlli)}:".encode())
+    for parte in (minacce, controlli, valori):
+        digest.update(parte)
+    return digest.hexdigest()
+
+
+def riduci(matrice):
+    """Elimina righe e colonne senza celle valorizzate (forma equivalente a quella ricostruita dalle righe)."""
+    righe = np.flatnonzero(matrice.valori.any(axis=1))
+    colonne = np.flatnonzero(matrice.valori.any(axis=0))
+    return MatriceDensa(
+        [matrice.minacce_ids[i] for i in righe],
+        [matrice.controlli_ids[j] for j in colonne],
+        matrice.valori[np.ix_(righe, colonne)],
+    )
+
+
+def spacchetta(minacce_ids, controlli_ids, valori):
+    """Ricostruisce la MatriceDensa (valori float64 in 0..1) dai campi binari."""
+    minacce = np.frombuffer(bytes(minacce_ids), dtype=TIPO_ID).tolist()
+    controlli = np.frombuffer(bytes(controlli_ids), dtype=TIPO_ID).tolist()
+    dati = np.frombuffer(bytes(valori), dtype=TIPO_VALORE).reshape(len(minacce), len(controlli))
+    return MatriceDensa(minacce, controlli, dati / SCALA)
+
+
+def da_righe(righe):
+    """{elementtype_id: MatriceDensa} dalle tuple (elementtype_id, minaccia_id, controllo_id, valore)."""
+    celle = defaultdict(list)
+    for et_id, minaccia_id, controllo_id, valore in righe:
+        celle[et_id].append((minaccia_id, controllo_id, valore))
+    matrici = {}
+    for et_id, elenco in celle.items():
+        matrice = MatriceDensa(sorted({m for m, _, _ in elenco}), sorted({c for _, c, _ in elenco}))
+        for minaccia_id, controllo_id, valore in elenco:
+            matrice.valori[matrice.indice_minacce[minaccia_id], matrice.indice_controlli[controllo_id]] = valore
+        matrici[et_id] = matrice
+    return matrici
+
+
+def carica_da_righe(element_type_ids):
+    """Carica le matrici dalle righe di ValoreElementType con una sola query."""
+    from .models import ValoreElementType
+
+    return da_righe(
+        ValoreElementType.objects.filter(elementtype_id__in=element_type_ids)
+        .values_list('elementtype_id', 'minaccia_id', 'controllo_id', 'valore')
+        .iterator(chunk_size=10000)
+    )
+
+
+def carica_matrici(element_type_ids):
+    """
+    {elementtype_id: MatriceDensa} per gli ElementType indicati: un fetch sulla
+    forma compatta e, solo per quelli che non la hanno, una query sulle righe.
+    Gli ElementType senza celle non compaiono nel risultato.
+    """
+    from .models import MatriceCompatta
+
+    element_type_ids = set(element_type_ids)
+    matrici = {}
+    if attive():
+        for et_id, minacce_ids, controlli_ids, valori in MatriceCompatta.objects.filter(
+            elementtype_id__in=element_type_ids
+        ).values_list('elementtype_id', 'minacce_ids', 'controlli_ids', 'valori'):
+            matrici[et_id] = spacchetta(minacce_ids, controlli_ids, valori)
+    mancanti = element_type_ids - set(matrici)
+    if mancanti:
+        matrici.update(carica_da_righe(mancanti))
+    return matrici
+
+
+def carica_matrice(element_type_id):
+    """Matrice di un singolo ElementType (vuota se non ha celle)."""
+    return carica_matrici([element_type_id]).get(element_type_id) or MatriceDensa([], [])
+
+
+def salva(matrici, eliminare=(), impronte_input=None, impronte_salvate=None):
+    """
+    Scrive (upsert) le matrici compatte {elementtype_id: MatriceDensa} ed elimina quelle indicate.
+    `impronte_input` ({elementtype_id: hash}) registra gli input da cui una matrice è stata aggregata;
+    per le altre l'impronta degli input viene azzerata, così la prossima aggregazione la ricalcola.
+    Le matrici che cambiano contenuto aggiungono una `VersioneMatrice`; chi ha già letto le impronte
+    attuali ({elementtype_id: impronta}) le passa in `impronte_salvate` per evitarne la rilettura.
+    """
+    from .models import MatriceCompatta
+
+    if not attive():
+        return
+    impronte_input = impronte_input or {}
+    oggetti = []
+    for et_id, matrice in matrici.items():
+        campi = impacchetta(matrice)
+        oggetti.append(MatriceCompatta(
+            elementtype_id=et_id, minacce_ids=campi[0], controlli_ids=campi[1], valori=campi[2],
+            impronta=impronta(campi), impronta_input=impronte_input.get(et_id, ''),
+        ))
+    _registra_versioni(oggetti, eliminare, impronte_salvate)
+    if eliminare:
+        MatriceCompatta.objects.filter(elementtype_id__in=eliminare).delete()
+    if matrici:
+        MatriceCompatta.objects.bulk_create(
+            oggetti,
+            update_conflicts=True,
+            unique_fields=['elementtype'],
+            update_fields=['minacce_ids', 'controlli_ids', 'valori', 'impronta', 'impronta_input', 'aggiornata_il'],
+            batch_size=500,
+        )
+
+
+def _registra_versioni(oggetti, eliminare, salvate=None):
+    """Aggiunge a `VersioneMatrice` le matrici il cui contenuto cambia e quelle eliminate (vedi `storico.py`)."""
+    from django.utils import timezone
+
+    from .models import MatriceCompatta, VersioneMatrice
+
+    if salvate is None:
+        ids = {obj.elementtype_id for obj in oggetti} | set(eliminare)
+        salvate = dict(MatriceCompatta.objects.filter(elementtype_id__in=ids).values_list('elementtype_id', 'impronta'))
+    adesso = timezone.now()
+    versioni = [
+        VersioneMatrice(
+            elementtype_id=obj.elementtype_id, registrata_il=adesso, minacce_ids=obj.minacce_ids,
+            controlli_ids=obj.controlli_ids, valori=obj.valori, impronta=obj.impronta,
+        )
+        for obj in oggetti if salvate.get(obj.elementtype_id) != obj.impronta
+    ]
+    versioni.extend(
+        VersioneMatrice(elementtype_id=et_id, registrata_il=adesso, eliminata=True) for et_id in eliminare if et_id in salvate
+    )
+    VersioneMatrice.objects.bulk_create(versioni, batch_size=500)
+
+
+def scrivi_celle(celle_per_elementtype, esistenti=None):
+    """
+    Scrive le celle {elementtype_id: {(minaccia_id, controllo_id): valore}} nelle righe di
+    ValoreElementType (valore 0 = cella eliminata), con al più un inserimento, un aggiornamento
+    e una cancellazione in blocco, e le applica alla forma compatta (`aggiorna_celle`). Chi ha già
+    letto le righe passa `esistenti` ({(elementtype_id, minaccia_id, controllo_id): pk}).
+    Restituisce il numero di righe scritte o eliminate.
+    """
+    from .models import ValoreElementType
+
+    celle_per_elementtype = {et_id: celle for et_id, celle in celle_per_elementtype.items() if celle}
+    if not celle_per_elementtype:
+        return 0
+    if esistenti is None:
+        esistenti = {
+            (et_id, minaccia_id, controllo_id): pk
+            for pk, et_id, minaccia_id, controllo_id in ValoreElementType.objects.filter(
+                elementtype_id__in=celle_per_elementtype
+            ).values_list('pk', 'elementtype_id', 'minaccia_id', 'controllo_id')
+        }
+    da_creare, da_aggiornare, da_eliminare = [], [], []
+    for et_id, celle in celle_per_elementtype.items():
+        for (minaccia_id, controllo_id), valore in celle.items():
+            pk = esistenti.get((et_id, minaccia_id, controllo_id))
+            if pk is None:
+                if valore > 0:
+                    da_creare.append(ValoreElementType(
+                        elementtype_id=et_id, minaccia_id=minaccia_id, controllo_id=controllo_id, valore=valore
+                    ))
+            elif valore > 0:
+                da_aggiornare.append(ValoreElementType(pk=pk, valore=valore))
+            else:
+                da_eliminare.append(pk)
+    if da_creare:
+        ValoreElementType.objects.bulk_create(da_creare)
+    if da_aggiornare:
+        ValoreElementType.objects.bulk_update(da_aggiornare, ['valore'])
+    if da_eliminare:
+        ValoreElementType.objects.filter(pk__in=da_eliminare).delete()
+    aggiorna_celle(celle_per_elementtype)
+    return len(da_creare) + len(da_aggiornare) + len(da_eliminare)
+
+
+def sostituisci_matrici(matrici, impronte_input=None, batch_size=None):
+    """
+    Riscrive per intero le matrici {elementtype_id: MatriceDensa}: elimina le righe degli
+    ElementType, inserisce le celle in blocco (a lotti di `batch_size`) e salva la forma compatta
+    (`salva`, con le eventuali `impronte_input`). Restituisce il numero di celle inserite.
+    """
+    from .models import ValoreElementType
+
+    if not matrici:
+        return 0
+    ValoreElementType.objects.filter(elementtype_id__in=matrici).delete()
+    celle = [
+        ValoreElementType(elementtype_id=et_id, minaccia_id=minaccia_id, controllo_id=controllo_id, valore=valore)
+        for et_id, matrice in matrici.items() for minaccia_id, controllo_id, valore in matrice.celle()
+    ]
+    ValoreElementType.objects.bulk_create(celle, batch_size=batch_size)
+    salva(matrici, impronte_input=impronte_input)
+    return len(celle)
+
+
+def elimina_celle(queryset):
+    """Elimina le righe del queryset di ValoreElementType e allinea la forma compatta; ne restituisce il numero."""
+    celle, esistenti = defaultdict(dict), {}
+    for pk, et_id, minaccia_id, controllo_id in queryset.values_list('pk', 'elementtype_id', 'minaccia_id', 'controllo_id'):
+        celle[et_id][(minaccia_id, controllo_id)] = 0.0
+        esistenti[(et_id, minaccia_id, controllo_id)] = pk
+    return scrivi_celle(celle, esistenti)
+
+
+def sincronizza(element_type_ids):
+    """Ricostruisce dalle righe la forma compatta degli ElementType indicati."""
+    element_type_ids = {pk for pk in element_type_ids if pk is not None}
+    if not attive() or not element_type_ids:
+        return
+    matrici = carica_da_righe(element_type_ids)
+    salva(matrici, eliminare=element_type_ids - set(matrici))
+
+
+def aggiorna_celle(celle_per_elementtype):
+    """
+    Applica alla forma compatta le celle modificate {elementtype_id: {(minaccia_id, controllo_id): valore}}
+    (valore 0 = cella eliminata), senza rileggere le righe. Righe e colonne nuove vengono aggiunte;
+    gli ElementType ancora privi di forma compatta vengono ricostruiti dalle righe.
+    """
+    from .models import MatriceCompatta
+
+    celle_per_elementtype = {et_id: celle for et_id, celle in celle_per_elementtype.items() if celle}
+    if not attive() or not celle_per_elementtype:
+        return
+    esistenti, impronte = {}, {}
+    for et_id, minacce_ids, controlli_ids, valori, salvata in MatriceCompatta.objects.filter(
+        elementtype_id__in=celle_per_elementtype
+    ).values_list('elementtype_id', 'minacce_ids', 'controlli_ids', 'valori', 'impronta'):
+        esistenti[et_id] = spacchetta(minacce_ids, controlli_ids, valori)
+        impronte[et_id] = salvata
+
+    aggiornate = {}
+    for et_id, matrice in esistenti.items():
+        celle = celle_per_elementtype[et_id]
+        nuove_minacce = {m for m, _ in celle} - set(matrice.indice_minacce)
+        nuovi_controlli = {c for _, c in celle} - set(matrice.indice_controlli)
+        if nuove_minacce or nuovi_controlli:
+            matrice = _estendi(matrice, nuove_minacce, nuovi_controlli)
+        for (minaccia_id, controllo_id), valore in celle.items():
+            matrice.valori[matrice.indice_minacce[minaccia_id], matrice.indice_controlli[controllo_id]] = valore
+        aggiornate[et_id] = matrice
+    salva(aggiornate, impronte_salvate=impronte)
+    sincronizza(set(celle_per_elementtype) - set(esistenti))
+
+
+def _estendi(matrice, nuove_minacce, nuovi_controlli):
+    estesa = MatriceDensa(
+        sorted(set(matrice.minacce_ids) | nuove_minacce), sorted(set(matrice.controlli_ids) | nuovi_controlli)
+    )
+    righe = [estesa.indice_minacce[m] for m in matrice.minacce_ids]
+    colonne = [estesa.indice_controlli[c] for c in matrice.controlli_ids]
+    estesa.valori[np.ix_(righe, colonne)] = matrice.valori
+    return estesa
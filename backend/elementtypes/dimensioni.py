@@ -0,0 +1,96 @@
+"""
+Contatori materializzati della dimensione delle matrici (`num_minacce` x `num_controlli`).
+
+I contatori sono calcolati con poche query raggruppate per un intero insieme
+di ElementType e mantenuti dai segnali in `signals.py` (valori della matrice,
+minacce, riassegnazione dei controlli, componenti dei derivati). Le liste
+dell'admin leggono così la dimensione direttamente dalla riga dell'ElementType.
+"""
+from django.db import transaction
+from django.db.models import Count
+
+
+def calcola_dimensioni(element_types):
+    """
+    Calcola {elementtype_id: (num_minacce, num_controlli)} per gli ElementType indicati:
+    - tipo "root": minacce e controlli distinti presenti nella matrice aggregata;
+    - tipo base: minacce associate e controlli assegnati;
+    - tipo derivato: unione ricorsiva sui componenti di base (tabella di chiusura).
+    """
+    from controlli.models import Controllo
+    from .models import ElementType, ValoreElementType
+
+    root_ids, base_ids, derivati_ids = [], [], []
+    for et_id, nome, is_base in element_types.values_list('id', 'nome', 'is_base'):
+        if nome == "root":
+            root_ids.append(et_id)
+        elif is_base:
+            base_ids.append(et_id)
+        else:
+            derivati_ids.append(et_id)
+
+    minacce, controlli = {}, {}
+    if root_ids:
+        for riga in ValoreElementType.objects.filter(elementtype_id__in=root_ids).values('elementtype_id').annotate(
+            num_minacce=Count('minaccia_id', distinct=True), num_controlli=Count('controllo_id', distinct=True)
+        ):
+            minacce[riga['elementtype_id']] = riga['num_minacce']
+            controlli[riga['elementtype_id']] = riga['num_controlli']
+    if base_ids:
+        minacce.update(
+            ElementType.minacce.through.objects.filter(elementtype_id__in=base_ids)
+            .values('elementtype_id').annotate(n=Count('minaccia_id')).values_list('elementtype_id', 'n')
+        )
+        controlli.update(
+            Controllo.objects.filter(elementtype_id__in=base_ids)
+            .values('elementtype_id').annotate(n=Count('id')).values_list('elementtype_id', 'n')
+        )
+    if derivati_ids:
+        antenato = 'elementtype__closure_antenati__ancestor_id'
+        minacce.update(
+            ElementType.minacce.through.objects.filter(
+                **{f'{antenato}__in': derivati_ids}, elementtype__is_base=True
+            ).values(antenato).annotate(n=Count('minaccia_id', distinct=True)).values_list(antenato, 'n')
+        )
+        controlli.update(
+            Controllo.objects.filter(
+                **{f'{antenato}__in': derivati_ids}, elementtype__is_base=True
+            ).values(antenato).annotate(n=Count('id', distinct=True)).values_list(antenato, 'n')
+        )
+
+    return {
+        et_id: (minacce.get(et_id, 0), controlli.get(et_id, 0))
+        for et_id in root_ids + base_ids + derivati_ids
+    }
+
+
+@transaction.atomic
+def aggiorna_dimensioni(element_type_ids, includi_antenati=True):
+    """
+    Ricalcola e salva i contatori degli ElementType indicati e, se richiesto,
+    dei derivati che li includono. Restituisce il numero di righe aggiornate.
+    """
+    from .closure import antenati_ids
+    from .models import ElementType
+
+    element_type_ids = {pk for pk in element_type_ids if pk is not None}
+    if not element_type_ids:
+        return 0
+    if includi_antenati:
+        element_type_ids = antenati_ids(element_type_ids)
+    return salva_dimensioni(ElementType.objects.filter(pk__in=element_type_ids))
+
+
+def salva_dimensioni(element_types, batch_size=500):
+    """Scrive i contatori ricalcolati solo per gli ElementType il cui valore è cambiato."""
+    from .models import ElementType
+
+    dimensioni = calcola_dimensioni(element_types)
+    da_aggiornare = []
+    for et in element_types.only('id', 'num_minacce', 'num_controlli'):
+        num_minacce, num_controlli = dimensioni.get(et.pk, (0, 0))
+        if (et.num_minacce, et.num_controlli) != (num_minacce, num_controlli):
+            et.num_minacce, et.num_controlli = num_minacce, num_controlli
+            da_aggiornare.append(et)
+    ElementType.objects.bulk_update(da_aggiornare, ['num_minacce', 'num_controlli'], batch_size=batch_size)
+    return len(da_aggiornare)
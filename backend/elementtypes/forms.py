@@ -15,4 +15,87 @@ class ElementTypeForm(forms.ModelForm):
 
     class Meta:
         model = ElementType
-        fields = '__all__'
\ No newline at end of file
+        fields = '__all__'
+
+    def clean_component_element_types(self):
+        """Impedisce di selezionare componenti che creerebbero un ciclo di derivazione."""
+        from .closure import verifica_aciclicita
+
+        componenti = self.cleaned_data.get('component_element_types')
+        if componenti and self.instance.pk:
+            verifica_aciclicita(self.instance.pk, [c.pk for c in componenti])
+        return componenti
+
+
+def applica_matrice_post(elementtype, dati_post):
+    """
+    Applica all'ElementType di base le celle `matrix-<minaccia>-<controllo>` inviate dal form.
+
+    La matrice corrente viene letta una sola volta, le celle sono validate in memoria e la
+    differenza è scritta con `scrivi_celle` (un bulk_create, un bulk_update e una delete). Una cella vuota o
+    pari a 0 elimina il valore esistente; le celle non valide sono ignorate.
+    Restituisce (modifiche, errori): le celle modificate come ModificheMatrice e i messaggi
+    di errore per cella, nell'ordine della griglia.
+    """
+    from .compatta import scrivi_celle
+    from .models import ValoreElementType
+    from .propagation import ModificheMatrice
+
+    modifiche = ModificheMatrice()
+    errori = []
+    chiavi_post = {k for k in dati_post if k.startswith('matrix-')}
+    if not chiavi_post:
+        return modifiche, errori
+
+    minacce = list(elementtype.minacce.all())
+    controlli = list(Controllo.objects.filter(elementtype=elementtype))
+    esistenti = {
+        (minaccia_id, controllo_id): (pk, valore)
+        for pk, minaccia_id, controllo_id, valore in ValoreElementType.objects.filter(
+            elementtype=elementtype
+        ).values_list('pk', 'minaccia_id', 'controllo_id', 'valore')
+    }
+
+    nuovi_valori = {}
+    for minaccia in minacce:
+        for controllo in controlli:
+            nome_campo = f'matrix-{minaccia.id}-{controllo.id}'
+            if nome_campo not in chiavi_post:
+                continue
+            valore_str = dati_post.get(nome_campo, '').strip()
+            valore_str_norm = valore_str.replace(',', '.').strip()
+            esistente = esistenti.get((minaccia.id, controllo.id))
+
+            if valore_str_norm:
+                try:
+                    valore = float(valore_str_norm)
+                except (ValueError, TypeError):
+                    errori.append(f"Valore non numerico '{valore_str}' per la cella ({minaccia.descrizione}, {controllo.nome}). Ignorato.")
+                    continue
+            else:
+                valore = 0.0
+
+            # Il valore 0 (o la cella vuota) non viene salvato: si elimina l'eventuale valore esistente
+            if valore == 0.0:
+                if esistente:
+                    nuovi_valori[(minaccia.id, controllo.id)] = 0.0
+                    modifiche.registra(elementtype.pk, minaccia.id, controllo.id)
+                continue
+
+            if not (0.0 < valore <= 1.0):
+                errori.append(f"Valore '{valore_str}' non valido per la cella ({minaccia.descrizione}, {controllo.nome}). Il valore deve essere compreso tra 0.01 e 1. Modifica non salvata per questa cella.")
+                continue
+            if '.' in valore_str_norm and len(valore_str_norm.split('.')[-1]) > 2:
+                errori.append(f"Valore '{valore_str}' non valido per la cella ({minaccia.descrizione}, {controllo.nome}). Il valore deve avere al massimo due cifre decimali. Modifica non salvata per questa cella.")
+                continue
+
+            if esistente and esistente[1] == valore:
+                continue
+            nuovi_valori[(minaccia.id, controllo.id)] = valore
+            modifiche.registra(elementtype.pk, minaccia.id, controllo.id)
+
+    scrivi_celle(
+        {elementtype.pk: nuovi_valori},
+        esistenti={(elementtype.pk,) + cella: pk for cella, (pk, _) in esistenti.items()},
+    )
+    return modifiche, errori
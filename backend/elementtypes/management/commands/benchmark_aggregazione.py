@@ -0,0 +1,133 @@
+import random
+import time
+from contextlib import contextmanager
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from controlli.models import Controllo
+from elementtypes.compatta import scrivi_celle
+from elementtypes.models import ElementType
+from minacce.models import Minaccia
+from scenari.models import Scenario
+
+PREFISSO = "__bench__"
+
+
+class _Rollback(Exception):
+    pass
+
+
+@contextmanager
+def conta_query():
+    """Conta le query eseguite nel blocco (senza il limite del log di debug)."""
+    contatore = [0]
+
+    def wrapper(execute, sql, params, many, context):
+        contatore[0] += 1
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(wrapper):
+        yield contatore
+
+
+class Command(BaseCommand):
+    help = (
+        "Misura i tempi di aggregazione di un ElementType derivato su dati sintetici "
+        "(eseguito in una transazione annullata al termine)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--minacce', type=int, default=45, help="Numero di minacce (righe).")
+        parser.add_argument('--controlli', type=int, default=280, help="Numero di controlli (colonne).")
+        parser.add_argument('--componenti', type=int, default=4, help="Numero di ElementType base componenti.")
+        parser.add_argument('--densita', type=float, default=0.4, help="Frazione di celle valorizzate (0-1).")
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument(
+            '--legacy',
+            action='store_true',
+            help="Esegue anche il calcolo cella per cella tramite get_valore_matrice, per confronto (lento).",
+        )
+
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
+        try:
+            with transaction.atomic():
+                padre, componenti = self._crea_dati(options)
+                self._misura(padre, componenti, options['legacy'])
+                raise _Rollback()
+        except _Rollback:
+            pass
+
+    def _crea_dati(self, options):
+        scenario = Scenario.objects.create(descrizione=f"{PREFISSO} scenario")
+        minacce = Minaccia.objects.bulk_create([
+            Minaccia(descrizione=f"{PREFISSO} minaccia {i}", scenario=scenario)
+            for i in range(options['minacce'])
+        ])
+        componenti = [
+            ElementType.objects.create(nome=f"{PREFISSO} base {k}", is_base=True)
+            for k in range(options['componenti'])
+        ]
+        controlli = Controllo.objects.bulk_create([
+            Controllo(
+                nome=f"{PREFISSO} controllo {j}",
+                descrizione="",
+                tipologia_controllo='Tecnologico',
+                peso_controllo=Controllo.PESO_MAPPING['Tecnologico'],
+                categoria_controllo=random.choice(Controllo.CATEGORIA_CHOICES)[0],
+                elementtype=componenti[j % len(componenti)],
+            )
+            for j in range(options['controlli'])
+        ])
+
+        valori = {}
+        for et in componenti:
+            et.minacce.set(minacce)
+            valori[et.pk] = {
+                (minaccia.pk, controllo.pk): round(random.uniform(0.01, 1.0), 2)
+                for minaccia in minacce for controllo in controlli if random.random() < options['densita']
+            }
+        celle = scrivi_celle(valori, esistenti={})
+
+        # Tipo derivato a due livelli: (base 0 + base 1) -> intermedio; intermedio + restanti -> padre
+        intermedio = ElementType.objects.create(nome=f"{PREFISSO} intermedio", is_base=False)
+        intermedio.component_element_types.set(componenti[:2])
+        padre = ElementType.objects.create(nome=f"{PREFISSO} derivato", is_base=False)
+        padre.component_element_types.set([intermedio] + componenti[2:])
+
+        self.stdout.write(
+            f"Dati sintetici: {len(minacce)} minacce x {len(controlli)} controlli, "
+            f"{len(componenti)} componenti base, {celle} celle valorizzate."
+        )
+        return padre, [intermedio] + componenti[2:]
+
+    def _misura(self, padre, componenti, legacy):
+        with conta_query() as query:
+            inizio = time.perf_counter()
+            ElementType.objects.aggregazione(padre, componenti)
+            durata = time.perf_counter() - inizio
+        self.stdout.write(self.style.SUCCESS(
+            f"Aggregazione densa: {durata * 1000:.1f} ms, {query[0]} query, "
+            f"{padre.valori_matrice.count()} celle scritte."
+        ))
+
+        if not legacy:
+            return
+
+        minacce = list(padre.get_all_minacce())
+        controlli = list(padre.get_all_controlli())
+        with conta_query() as query:
+            inizio = time.perf_counter()
+            celle = 0
+            for minaccia in minacce:
+                for controllo in controlli:
+                    if max((c.get_valore_matrice(minaccia, controllo) for c in componenti), default=0.0) > 0:
+                        celle += 1
+            durata_legacy = time.perf_counter() - inizio
+        self.stdout.write(
+            f"Calcolo cella per cella (legacy): {durata_legacy * 1000:.1f} ms, "
+            f"{query[0]} query, {celle} celle non nulle."
+        )
+        if durata:
+            self.stdout.write(self.style.SUCCESS(f"Speedup: {durata_legacy / durata:.0f}x"))
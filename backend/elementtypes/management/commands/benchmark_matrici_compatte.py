@@ -0,0 +1,104 @@
+import math
+import random
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from controlli.models import Controllo
+from elementtypes.compatta import carica_da_righe, carica_matrici, sincronizza
+from elementtypes.models import ElementType, MatriceCompatta, ValoreElementType
+from minacce.models import Minaccia
+from scenari.models import Scenario
+
+from .benchmark_aggregazione import PREFISSO, _Rollback, conta_query
+
+
+class Command(BaseCommand):
+    help = (
+        "Confronta il caricamento di una matrice dalle righe di ValoreElementType e dalla forma "
+        "compatta (uint8) a diverse dimensioni (eseguito in una transazione annullata al termine)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--celle', type=int, nargs='+', default=[10_000, 100_000, 1_000_000],
+            help="Numero di celle valorizzate delle matrici da misurare (matrici piene, circa quadrate).",
+        )
+        parser.add_argument('--ripetizioni', type=int, default=3, help="Ripetizioni per misura (si riporta la migliore).")
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
+        self.stdout.write(
+            f"{'celle':>10} | {'righe ms':>9} {'righe MB':>9} {'q':>3} | "
+            f"{'compatta ms':>11} {'compatta MB':>11} {'q':>3} | {'byte salvati':>12} | {'speedup':>7}"
+        )
+        for celle in options['celle']:
+            try:
+                with transaction.atomic():
+                    et = self._crea_matrice(celle)
+                    self._misura(et, options['ripetizioni'])
+                    raise _Rollback()
+            except _Rollback:
+                pass
+
+    def _crea_matrice(self, celle):
+        num_minacce = max(1, int(math.sqrt(celle)))
+        num_controlli = max(1, math.ceil(celle / num_minacce))
+        scenario = Scenario.objects.create(descrizione=f"{PREFISSO} scenario")
+        et = ElementType.objects.create(nome=f"{PREFISSO} base {celle}", is_base=True)
+        minacce = Minaccia.objects.bulk_create([
+            Minaccia(descrizione=f"{PREFISSO} minaccia {i}", scenario=scenario) for i in range(num_minacce)
+        ])
+        controlli = Controllo.objects.bulk_create([
+            Controllo(
+                nome=f"{PREFISSO} controllo {j}",
+                descrizione="",
+                tipologia_controllo='Tecnologico',
+                peso_controllo=Controllo.PESO_MAPPING['Tecnologico'],
+                categoria_controllo=random.choice(Controllo.CATEGORIA_CHOICES)[0],
+                elementtype=et,
+            )
+            for j in range(num_controlli)
+        ])
+        generate = (
+            ValoreElementType(elementtype=et, minaccia=m, controllo=c, valore=random.randint(1, 100) / 100)
+            for m in minacce for c in controlli
+        )
+        lotto = []
+        for n, valore in enumerate(generate):
+            if n >= celle:
+                break
+            lotto.append(valore)
+            if len(lotto) == 20_000:
+                ValoreElementType.objects.bulk_create(lotto)
+                lotto = []
+        ValoreElementType.objects.bulk_create(lotto)
+        sincronizza([et.pk])
+        return et
+
+    def _migliore(self, funzione, ripetizioni):
+        durate, picco = [], 0
+        for _ in range(ripetizioni):
+            tracemalloc.start()
+            with conta_query() as query:
+                inizio = time.perf_counter()
+                funzione()
+                durate.append(time.perf_counter() - inizio)
+            picco = max(picco, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        return min(durate), picco, query[0]
+
+    def _misura(self, et, ripetizioni):
+        celle = et.valori_matrice.count()
+        righe_s, righe_mem, righe_q = self._migliore(lambda: carica_da_righe([et.pk]), ripetizioni)
+        compatta_s, compatta_mem, compatta_q = self._migliore(lambda: carica_matrici([et.pk]), ripetizioni)
+        compatta = MatriceCompatta.objects.get(elementtype=et)
+        byte_salvati = len(compatta.minacce_ids) + len(compatta.controlli_ids) + len(compatta.valori)
+        self.stdout.write(
+            f"{celle:>10} | {righe_s * 1000:>9.1f} {righe_mem / 2**20:>9.1f} {righe_q:>3} | "
+            f"{compatta_s * 1000:>11.1f} {compatta_mem / 2**20:>11.1f} {compatta_q:>3} | "
+            f"{byte_salvati:>12} | {righe_s / compatta_s:>6.0f}x"
+        )
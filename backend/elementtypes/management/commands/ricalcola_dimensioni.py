@@ -0,0 +1,63 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from elementtypes.dimensioni import calcola_dimensioni, salva_dimensioni
+from elementtypes.models import ElementType
+
+
+class Command(BaseCommand):
+    help = (
+        "Ricalcola in blocco i contatori num_minacce/num_controlli degli ElementType. "
+        "Con --verifica segnala le differenze senza scrivere nulla."
+    )
+
+    def add_arguments(self, parser):
+        gruppo = parser.add_mutually_exclusive_group()
+        gruppo.add_argument('--campagna', type=int, help="Limita il ricalcolo agli ElementType della campagna indicata.")
+        gruppo.add_argument('--master', action='store_true', help="Limita il ricalcolo agli ElementType master.")
+        parser.add_argument(
+            '--verifica',
+            action='store_true',
+            help="Confronta i contatori salvati con quelli ricalcolati ed esce con errore in caso di differenze.",
+        )
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        element_types = ElementType.objects.all()
+        if options['campagna']:
+            element_types = element_types.filter(campagna_id=options['campagna'])
+        elif options['master']:
+            element_types = element_types.filter(campagna__isnull=True)
+
+        inizio = time.perf_counter()
+        if options['verifica']:
+            self._verifica(element_types)
+            return
+
+        with transaction.atomic():
+            aggiornati = salva_dimensioni(element_types, batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Contatori ricalcolati su {element_types.count()} ElementType: {aggiornati} aggiornati "
+            f"in {(time.perf_counter() - inizio) * 1000:.0f} ms."
+        ))
+
+    def _verifica(self, element_types):
+        dimensioni = calcola_dimensioni(element_types)
+        differenze = []
+        for et_id, nome, campagna_id, num_minacce, num_controlli in element_types.values_list(
+            'id', 'nome', 'campagna_id', 'num_minacce', 'num_controlli'
+        ):
+            attese = dimensioni.get(et_id, (0, 0))
+            if (num_minacce, num_controlli) != attese:
+                differenze.append((et_id, nome, campagna_id, (num_minacce, num_controlli), attese))
+
+        for et_id, nome, campagna_id, salvate, attese in differenze:
+            self.stdout.write(
+                f"  ElementType {et_id} '{nome}' (campagna {campagna_id or 'master'}): "
+                f"salvato {salvate[0]}x{salvate[1]}, atteso {attese[0]}x{attese[1]}"
+            )
+        if differenze:
+            raise CommandError(f"{len(differenze)} ElementType con contatori non allineati.")
+        self.stdout.write(self.style.SUCCESS(f"Contatori allineati su {len(dimensioni)} ElementType."))
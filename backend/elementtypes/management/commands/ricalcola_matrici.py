@@ -0,0 +1,63 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from campagne.models import Campagna
+from elementtypes import memo
+from elementtypes.ricalcolo import CampagnaChiusa, CicloDerivazione, Ricalcolo
+
+
+class Command(BaseCommand):
+    help = (
+        "Ricalcola le matrici aggregate degli ElementType derivati e dei nodi radice degli asset di una "
+        "campagna (o del master), per livelli del grafo di derivazione e con un pool di processi. "
+        "Le matrici con input invariati vengono saltate: il comando si può rieseguire senza effetti. "
+        "Le campagne chiuse non si ricalcolano."
+    )
+
+    def add_arguments(self, parser):
+        gruppo = parser.add_mutually_exclusive_group(required=True)
+        gruppo.add_argument('--campagna', type=int, help="Ricalcola le matrici della campagna indicata.")
+        gruppo.add_argument('--master', action='store_true', help="Ricalcola le matrici master.")
+        parser.add_argument(
+            '--processi', type=int, default=os.cpu_count() or 1,
+            help="Processi di calcolo (1 = nessun pool). Predefinito: numero di CPU.",
+        )
+        parser.add_argument('--batch-size', type=int, default=200, help="Matrici scritte per transazione.")
+        parser.add_argument(
+            '--forza', action='store_true',
+            help="Ricalcola anche le matrici con impronta degli input invariata.",
+        )
+
+    def handle(self, *args, **options):
+        ricalcolo = Ricalcolo(
+            campagna_id=options['campagna'],
+            processi=options['processi'],
+            batch_size=options['batch_size'],
+            forza=options['forza'],
+        )
+        inizio = time.perf_counter()
+        try:
+            with memo.misura() as contatori:
+                esiti = ricalcolo.esegui(avanzamento=self._avanzamento)
+        except Campagna.DoesNotExist as e:
+            raise CommandError(f"Campagna {options['campagna']} inesistente.") from e
+        except (CampagnaChiusa, CicloDerivazione) as e:
+            raise CommandError(str(e)) from e
+
+        totale = lambda campo: sum(getattr(esito, campo) for esito in esiti)
+        self.stdout.write(self.style.SUCCESS(
+            f"Ricalcolo completato in {(time.perf_counter() - inizio) * 1000:.0f} ms: "
+            f"{totale('matrici')} matrici in {len(esiti)} livelli, {totale('saltate')} saltate, "
+            f"{totale('invariate')} invariate, {totale('scritte')} scritte ({totale('celle')} celle)."
+        ))
+        if options['verbosity'] > 1:
+            self.stdout.write(f"Contatori: {contatori}")
+
+    def _avanzamento(self, esito, livelli):
+        self.stdout.write(
+            f"  Livello {esito.livello}/{livelli} ({esito.tipo}): {esito.matrici} matrici, "
+            f"{esito.saltate} saltate, {esito.invariate} invariate, {esito.scritte} scritte "
+            f"({esito.celle} celle) in {esito.durata * 1000:.0f} ms"
+        )
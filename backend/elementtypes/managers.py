@@ -1,8 +1,6 @@
 from django.db import models, transaction
-from minacce.models import Minaccia
 import logging
 logger = logging.getLogger(__name__)
-from controlli.models import Controllo
 
 
 class ElementTypeManager(models.Manager):
@@ -11,37 +9,47 @@ class ElementTypeManager(models.Manager):
         """
         Aggrega le matrici degli element type figli e popola la matrice
         dell'element type padre.
+
+        Le matrici dei componenti di base vengono caricate una sola volta in
+        memoria (vedi `elementtypes.matrix`) e il MAX viene calcolato sulla pila
+        densa; il risultato è scritto con un unico bulk insert.
+
+        L'aggregazione è memoizzata (vedi `elementtypes.memo`): se l'impronta
+        degli input (componenti di base con la loro versione, righe e colonne)
+        coincide con quella salvata la matrice non viene ricalcolata; se il
+        risultato ricalcolato coincide con quello salvato non viene riscritto.
         """
-        from .models import ValoreElementType
-        
-        # --- LOGICA MODIFICATA ---
-        # La lista delle sorgenti per l'aggregazione ora include sia il padre
-        # (con la sua eventuale matrice preesistente) sia tutti i suoi figli.
-        # Utilizziamo i nuovi metodi ricorsivi per ottenere l'unione corretta.
-        
-        # Colonne (Controlli) -> Unione ricorsiva
-        controlli_set = parent_element_type.get_all_controlli()
-
-        # Righe (Minacce) -> Unione ricorsiva
-        minacce_set = parent_element_type.get_all_minacce()
-
-        # Pulisce la vecchia matrice e imposta le nuove minacce
-        parent_element_type.valori_matrice.all().delete()
-        parent_element_type.minacce.set(minacce_set)
-
-        
-        # Calcolo valori aggregati (MAX)
-        valori_da_creare = []
-        for minaccia in minacce_set:
-            for controllo in controlli_set:
-                max_valore = 0.0
-                # Itera sui componenti figli per trovare il valore massimo in modo ricorsivo.
-                for et_figlio in child_element_types:
-                    valore_figlio = et_figlio.get_valore_matrice(minaccia, controllo)
-                    if valore_figlio > max_valore:
-                        max_valore = valore_figlio
-                
-                if max_valore > 0:
-                    valori_da_creare.append(ValoreElementType(elementtype=parent_element_type, minaccia=minaccia, controllo=controllo, valore=max_valore))
-        
-        ValoreElementType.objects.bulk_create(valori_da_creare)
\ No newline at end of file
+        from . import memo
+        from .compatta import attive, carica_matrice, impacchetta, impronta, sostituisci_matrici
+        from .matrix import calcola_aggregazione, input_aggregazione
+
+        input = input_aggregazione(parent_element_type, child_element_types)
+        basi_figli, minacce_ids, controlli_ids = input
+        impronta_nuova = impronta_salvata = None
+        if attive():
+            impronta_nuova = memo.impronta_input(basi_figli, memo.impronte(basi_figli), minacce_ids, controlli_ids)
+            impronta_salvata, impronta_input_salvata = memo.stato(parent_element_type.pk)
+            if impronta_input_salvata == impronta_nuova:
+                memo.registra('aggregazione', 'hit')
+                parent_element_type.minacce.set(minacce_ids)
+                return carica_matrice(parent_element_type.pk)
+            memo.registra('aggregazione', 'miss')
+
+        matrice = calcola_aggregazione(parent_element_type, child_element_types, input=input)
+        parent_element_type.minacce.set(matrice.minacce_ids)
+
+        if impronta_salvata and impronta_salvata == impronta(impacchetta(matrice)):
+            memo.registra('aggregazione', 'scrittura_evitata')
+            memo.registra_input(parent_element_type.pk, impronta_nuova)
+            return matrice
+
+        # Sostituisce la vecchia matrice; quella calcolata in memoria è già la forma compatta da
+        # salvare, con l'impronta dei suoi input (anche se vuota, così una nuova aggregazione identica viene saltata)
+        celle_scritte = sostituisci_matrici(
+            {parent_element_type.pk: matrice}, impronte_input={parent_element_type.pk: impronta_nuova or ''}
+        )
+        logger.info(
+            "Aggregazione di '%s': matrice %dx%d, %d celle scritte.",
+            parent_element_type.nome, matrice.shape[0], matrice.shape[1], celle_scritte,
+        )
+        return matrice
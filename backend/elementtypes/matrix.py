@@ -0,0 +1,161 @@
+"""
+Motore in memoria per le matrici di rischio degli ElementType.
+
+Le matrici vengono caricate con una sola query per insieme di ElementType
+in array NumPy densi, indicizzati per posizione di minaccia (righe) e di
+controllo (colonne). L'aggregazione dei tipi derivati diventa così un MAX
+elemento per elemento sulla pila delle matrici dei componenti, senza una
+query per cella.
+"""
+import numpy as np
+
+
+class MatriceDensa:
+    """
+    Matrice di rischio densa: righe = minacce, colonne = controlli.
+    Le celle assenti valgono 0.0, coerentemente con `get_valore_matrice`.
+    """
+
+    def __init__(self, minacce_ids, controlli_ids, valori=None):
+        self.minacce_ids = list(minacce_ids)
+        self.controlli_ids = list(controlli_ids)
+        self.indice_minacce = {pk: i for i, pk in enumerate(self.minacce_ids)}
+        self.indice_controlli = {pk: j for j, pk in enumerate(self.controlli_ids)}
+        if valori is None:
+            valori = np.zeros((len(self.minacce_ids), len(self.controlli_ids)), dtype=np.float64)
+        self.valori = valori
+
+    @property
+    def shape(self):
+        return self.valori.shape
+
+    def get(self, minaccia_id, controllo_id):
+        i = self.indice_minacce.get(minaccia_id)
+        j = self.indice_controlli.get(controllo_id)
+        if i is None or j is None:
+            return 0.0
+        return float(self.valori[i, j])
+
+    def celle(self):
+        """Restituisce le celle non nulle come tuple (minaccia_id, controllo_id, valore)."""
+        righe, colonne = np.nonzero(self.valori)
+        for i, j in zip(righe.tolist(), colonne.tolist()):
+            yield self.minacce_ids[i], self.controlli_ids[j], float(self.valori[i, j])
+
+
+def componenti_di_base(element_type_ids):
+    """
+    Id dei componenti di base raggiungibili dagli ElementType indicati,
+    risolti con un unico join sulla tabella di chiusura.
+    """
+    from .models import ElementTypeClosure
+
+    return set(
+        ElementTypeClosure.objects.filter(
+            ancestor_id__in=element_type_ids, descendant__is_base=True
+        ).values_list('descendant_id', flat=True)
+    )
+
+
+def carica_pila(element_type_ids, minacce_ids, controlli_ids):
+    """
+    Carica le matrici degli ElementType indicati in un unico array
+    tridimensionale (componente, minaccia, controllo) con un solo fetch
+    (forma compatta, vedi `compatta.py`, con ricaduta sulle righe).
+    Le celle fuori dagli insiemi di righe/colonne richiesti vengono ignorate.
+    """
+    from .compatta import carica_matrici
+
+    element_type_ids = list(element_type_ids)
+    pila = MatriceDensa(minacce_ids, controlli_ids)
+    valori = np.zeros((len(element_type_ids),) + pila.shape, dtype=np.float64)
+    if not element_type_ids or not valori.size:
+        return valori, pila
+
+    matrici = carica_matrici(element_type_ids)
+    for k, et_id in enumerate(element_type_ids):
+        matrice = matrici.get(et_id)
+        indici = _proiezione(matrice, pila) if matrice is not None else None
+        if indici:
+            origine, destinazione = indici
+            valori[k][destinazione] = matrice.valori[origine]
+    return valori, pila
+
+
+def _proiezione(matrice, destinazione):
+    """
+    Indici (origine, destinazione) per copiare le celle di `matrice` che cadono
+    nelle righe/colonne di `destinazione`; None se non ce ne sono.
+    """
+    righe = [(i, destinazione.indice_minacce[m]) for i, m in enumerate(matrice.minacce_ids) if m in destinazione.indice_minacce]
+    colonne = [(j, destinazione.indice_controlli[c]) for j, c in enumerate(matrice.controlli_ids) if c in destinazione.indice_controlli]
+    if not righe or not colonne:
+        return None
+    origine_r, destinazione_r = zip(*righe)
+    origine_c, destinazione_c = zip(*colonne)
+    return np.ix_(origine_r, origine_c), np.ix_(destinazione_r, destinazione_c)
+
+
+def aggrega_matrici(minacce_ids, controlli_ids, matrici):
+    """
+    MAX cella per cella di matrici già caricate, limitato alle righe e colonne
+    indicate (come `calcola_aggregazione`, senza accesso al database).
+    """
+    risultato = MatriceDensa(minacce_ids, controlli_ids)
+    for matrice in matrici:
+        indici = _proiezione(matrice, risultato)
+        if indici:
+            origine, destinazione = indici
+            risultato.valori[destinazione] = np.maximum(risultato.valori[destinazione], matrice.valori[origine])
+    return risultato
+
+
+def massimo(matrici):
+    """MAX cella per cella di più MatriceDensa, sull'unione delle loro righe e colonne."""
+    matrici = list(matrici)
+    risultato = MatriceDensa(
+        sorted({m for matrice in matrici for m in matrice.minacce_ids}),
+        sorted({c for matrice in matrici for c in matrice.controlli_ids}),
+    )
+    for matrice in matrici:
+        righe = [risultato.indice_minacce[m] for m in matrice.minacce_ids]
+        colonne = [risultato.indice_controlli[c] for c in matrice.controlli_ids]
+        blocco = np.ix_(righe, colonne)
+        risultato.valori[blocco] = np.maximum(risultato.valori[blocco], matrice.valori)
+    return risultato
+
+
+def input_aggregazione(parent_element_type, child_element_types):
+    """
+    Input dell'aggregazione di un ElementType derivato: componenti di base
+    raggiunti dai figli (ordinati) e righe/colonne della matrice risultante,
+    cioè l'unione ricorsiva delle minacce e dei controlli dei componenti di
+    base del padre (come `get_all_minacce`/`get_all_controlli`).
+    """
+    from controlli.models import Controllo
+    from .models import ElementType
+
+    basi_padre = componenti_di_base([parent_element_type.pk])
+    basi_figli = componenti_di_base([et.pk for et in child_element_types])
+
+    minacce_ids = sorted(set(
+        ElementType.minacce.through.objects.filter(elementtype_id__in=basi_padre).values_list('minaccia_id', flat=True)
+    ))
+    controlli_ids = sorted(
+        Controllo.objects.filter(elementtype_id__in=basi_padre).values_list('id', flat=True)
+    )
+    return sorted(basi_figli), minacce_ids, controlli_ids
+
+
+def calcola_aggregazione(parent_element_type, child_element_types, input=None):
+    """
+    Calcola in memoria la matrice aggregata di un ElementType derivato:
+    i valori sono il MAX, cella per cella, delle matrici di base raggiunte
+    dai figli indicati (come `get_valore_matrice`). `input` riusa il
+    risultato di `input_aggregazione` se già calcolato.
+    """
+    basi_figli, minacce_ids, controlli_ids = input or input_aggregazione(parent_element_type, child_element_types)
+    valori, risultato = carica_pila(basi_figli, minacce_ids, controlli_ids)
+    if valori.shape[0]:
+        risultato.valori = valori.max(axis=0)
+    return risultato
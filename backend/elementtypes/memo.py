@@ -0,0 +1,85 @@
+"""
+Memoizzazione delle matrici aggregate tramite impronta degli input.
+
+Ogni matrice compatta porta l'impronta del proprio contenuto (che ne fa da
+versione) e, se è stata aggregata, l'impronta degli input da cui è stata
+calcolata: gli id dei componenti con le rispettive versioni, più le righe e
+colonne richieste. Un'aggregazione con la stessa impronta degli input viene
+saltata (hit); se viene ricalcolata (miss) ma il risultato coincide con la
+matrice salvata, la riscrittura viene saltata.
+
+I contatori sono per processo; `misura()` restituisce quelli accumulati in un
+blocco, ad esempio durante la creazione di un albero di nodi.
+"""
+import hashlib
+import logging
+from collections import Counter
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+_contatori = Counter()
+
+
+def registra(tipo, esito):
+    """Incrementa il contatore `<tipo>.<esito>` (es. `radice.hit`, `aggregazione.scrittura_evitata`)."""
+    _contatori[f"{tipo}.{esito}"] += 1
+    logger.debug("Memo %s: %s", tipo, esito)
+
+
+def contatori():
+    return dict(_contatori)
+
+
+def azzera():
+    _contatori.clear()
+
+
+@contextmanager
+def misura():
+    """Raccoglie nel dizionario restituito i contatori incrementati all'interno del blocco."""
+    prima = Counter(_contatori)
+    delta = {}
+    try:
+        yield delta
+    finally:
+        delta.update(_contatori - prima)
+
+
+def impronte(element_type_ids):
+    """{elementtype_id: impronta del contenuto} per gli ElementType con forma compatta."""
+    from .models import MatriceCompatta
+
+    return dict(
+        MatriceCompatta.objects.filter(elementtype_id__in=element_type_ids).values_list('elementtype_id', 'impronta')
+    )
+
+
+def impronta_input(componenti_ids, versioni, *dettagli):
+    """
+    Impronta degli input di un'aggregazione: componenti ordinati con la loro versione
+    (`versioni`, da `impronte()`) e gli eventuali dettagli aggiuntivi (righe e colonne
+    richieste). Un componente senza forma compatta non ha celle e ha versione vuota.
+    """
+    digest = hashlib.sha1()
+    for et_id in sorted(componenti_ids):
+        digest.update(f"{et_id}:{versioni.get(et_id, '')};".encode())
+    for dettaglio in dettagli:
+        digest.update(f"|{','.join(map(str, dettaglio))}".encode())
+    return digest.hexdigest()
+
+
+def stato(element_type_id):
+    """(impronta, impronta_input) della matrice salvata, oppure (None, None)."""
+    from .models import MatriceCompatta
+
+    return MatriceCompatta.objects.filter(elementtype_id=element_type_id).values_list(
+        'impronta', 'impronta_input'
+    ).first() or (None, None)
+
+
+def registra_input(element_type_id, impronta):
+    """Associa alla matrice salvata (invariata) l'impronta degli input appena verificati."""
+    from .models import MatriceCompatta
+
+    MatriceCompatta.objects.filter(elementtype_id=element_type_id).update(impronta_input=impronta)
@@ -0,0 +1,58 @@
+# Generated by Django 5.2.3 on 2026-10-18 10:50
+
+import django.db.models.deletion
+from collections import deque
+
+from django.db import migrations, models
+
+
+def popola_chiusura(apps, schema_editor):
+    ElementType = apps.get_model('elementtypes', 'ElementType')
+    ElementTypeClosure = apps.get_model('elementtypes', 'ElementTypeClosure')
+    through = ElementType.component_element_types.through
+
+    grafo = {}
+    for padre_id, figlio_id in through.objects.values_list('from_elementtype_id', 'to_elementtype_id'):
+        grafo.setdefault(padre_id, []).append(figlio_id)
+
+    righe = []
+    for origine_id in ElementType.objects.values_list('id', flat=True):
+        distanze = {origine_id: 0}
+        coda = deque([origine_id])
+        while coda:
+            nodo = coda.popleft()
+            for figlio in grafo.get(nodo, ()):
+                if figlio not in distanze:
+                    distanze[figlio] = distanze[nodo] + 1
+                    coda.append(figlio)
+        righe.extend(
+            ElementTypeClosure(ancestor_id=origine_id, descendant_id=discendente_id, depth=distanza)
+            for discendente_id, distanza in distanze.items()
+        )
+    ElementTypeClosure.objects.bulk_create(righe, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('elementtypes', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ElementTypeClosure',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveIntegerField(default=0, verbose_name='Distanza')),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='closure_discendenti', to='elementtypes.elementtype')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='closure_antenati', to='elementtypes.elementtype')),
+            ],
+            options={
+                'verbose_name': 'Chiusura Element Type',
+                'verbose_name_plural': 'Chiusure Element Type',
+                'indexes': [models.Index(fields=['descendant', 'ancestor'], name='elementtype_descend_44a2fc_idx')],
+                'unique_together': {('ancestor', 'descendant')},
+            },
+        ),
+        migrations.RunPython(popola_chiusura, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 5.2.3 on 2026-10-18 10:53
+
+from django.db import migrations, models
+
+
+def popola_contatori(apps, schema_editor):
+    ElementType = apps.get_model('elementtypes', 'ElementType')
+    ElementTypeClosure = apps.get_model('elementtypes', 'ElementTypeClosure')
+    ValoreElementType = apps.get_model('elementtypes', 'ValoreElementType')
+    Controllo = apps.get_model('controlli', 'Controllo')
+    through = ElementType.minacce.through
+
+    base_ids = set(ElementType.objects.filter(is_base=True).values_list('id', flat=True))
+    minacce_base, controlli_base = {}, {}
+    for et_id, minaccia_id in through.objects.values_list('elementtype_id', 'minaccia_id'):
+        minacce_base.setdefault(et_id, set()).add(minaccia_id)
+    for et_id, controllo_id in Controllo.objects.filter(elementtype__isnull=False).values_list('elementtype_id', 'id'):
+        controlli_base.setdefault(et_id, set()).add(controllo_id)
+    basi = {}
+    for antenato_id, discendente_id in ElementTypeClosure.objects.values_list('ancestor_id', 'descendant_id'):
+        if discendente_id in base_ids:
+            basi.setdefault(antenato_id, set()).add(discendente_id)
+
+    da_aggiornare = []
+    for et in ElementType.objects.all():
+        if et.nome == "root":
+            celle = ValoreElementType.objects.filter(elementtype_id=et.pk)
+            et.num_minacce = celle.values('minaccia_id').distinct().count()
+            et.num_controlli = celle.values('controllo_id').distinct().count()
+        else:
+            componenti = {et.pk} if et.is_base else basi.get(et.pk, set())
+            et.num_minacce = len(set().union(*(minacce_base.get(c, set()) for c in componenti)))
+            et.num_controlli = len(set().union(*(controlli_base.get(c, set()) for c in componenti)))
+        da_aggiornare.append(et)
+    ElementType.objects.bulk_update(da_aggiornare, ['num_minacce', 'num_controlli'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('elementtypes', '0002_elementtypeclosure'),
+        ('controlli', '0002_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='elementtype',
+            name='num_controlli',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Contatore materializzato delle colonne della matrice (vedi elementtypes.dimensioni).', verbose_name='N. controlli'),
+        ),
+        migrations.AddField(
+            model_name='elementtype',
+            name='num_minacce',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Contatore materializzato delle righe della matrice (vedi elementtypes.dimensioni).', verbose_name='N. minacce'),
+        ),
+        migrations.RunPython(popola_contatori, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 5.2.3 on 2026-10-18 11:01
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def popola_matrici_compatte(apps, schema_editor):
+    import numpy as np
+
+    ValoreElementType = apps.get_model('elementtypes', 'ValoreElementType')
+    MatriceCompatta = apps.get_model('elementtypes', 'MatriceCompatta')
+
+    celle = {}
+    for et_id, minaccia_id, controllo_id, valore in ValoreElementType.objects.values_list(
+        'elementtype_id', 'minaccia_id', 'controllo_id', 'valore'
+    ).iterator(chunk_size=10000):
+        celle.setdefault(et_id, []).append((minaccia_id, controllo_id, valore))
+
+    matrici = []
+    for et_id, elenco in celle.items():
+        minacce = sorted({m for m, _, _ in elenco})
+        controlli = sorted({c for _, c, _ in elenco})
+        righe = {m: i for i, m in enumerate(minacce)}
+        colonne = {c: j for j, c in enumerate(controlli)}
+        valori = np.zeros((len(minacce), len(controlli)), dtype=np.uint8)
+        for minaccia_id, controllo_id, valore in elenco:
+            valori[righe[minaccia_id], colonne[controllo_id]] = round(min(max(valore, 0.0), 1.0) * 100)
+        matrici.append(MatriceCompatta(
+            elementtype_id=et_id,
+            minacce_ids=np.asarray(minacce, dtype='<i8').tobytes(),
+            controlli_ids=np.asarray(controlli, dtype='<i8').tobytes(),
+            valori=valori.tobytes(),
+        ))
+    MatriceCompatta.objects.bulk_create(matrici, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('elementtypes', '0003_contatori_dimensione'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MatriceCompatta',
+            fields=[
+                ('elementtype', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='matrice_compatta', serialize=False, to='elementtypes.elementtype')),
+                ('minacce_ids', models.BinaryField(verbose_name='Id minacce (righe)')),
+                ('controlli_ids', models.BinaryField(verbose_name='Id controlli (colonne)')),
+                ('valori', models.BinaryField(verbose_name='Valori (percentuale)')),
+                ('aggiornata_il', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Matrice compatta Element Type',
+                'verbose_name_plural': 'Matrici compatte Element Type',
+            },
+        ),
+        migrations.RunPython(popola_matrici_compatte, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.3 on 2026-10-18 11:05
+
+from django.db import migrations, models
+
+
+def calcola_impronte(apps, schema_editor):
+    import hashlib
+
+    MatriceCompatta = apps.get_model('elementtypes', 'MatriceCompatta')
+    matrici = []
+    for matrice in MatriceCompatta.objects.all().iterator(chunk_size=500):
+        minacce, controlli, valori = bytes(matrice.minacce_ids), bytes(matrice.controlli_ids), bytes(matrice.valori)
+        digest = hashlib.sha1(f"{len(minacce)}:{len(controlli)}:".encode())
+        for parte in (minacce, controlli, valori):
+            digest.update(parte)
+        matrice.impronta = digest.hexdigest()
+        matrici.append(matrice)
+    MatriceCompatta.objects.bulk_update(matrici, ['impronta'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('elementtypes', '0004_matricecompatta'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='matricecompatta',
+            name='impronta',
+            field=models.CharField(blank=True, help_text='Hash del contenuto: cambia a ogni modifica della matrice e ne fa da versione.', max_length=40, verbose_name='Impronta'),
+        ),
+        migrations.AddField(
+            model_name='matricecompatta',
+            name='impronta_input',
+            field=models.CharField(blank=True, help_text='Hash dei componenti e delle loro versioni da cui è stata aggregata (vedi memo.py).', max_length=40, verbose_name='Impronta degli input'),
+        ),
+        migrations.RunPython(calcola_impronte, migrations.RunPython.noop),
+    ]
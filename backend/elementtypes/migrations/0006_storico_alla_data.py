@@ -0,0 +1,50 @@
+from django.db import migrations, models
+
+
+def versioni_iniziali(apps, schema_editor):
+    # Le matrici esistenti diventano la prima versione, alla data del loro ultimo aggiornamento
+    MatriceCompatta = apps.get_model('elementtypes', 'MatriceCompatta')
+    VersioneMatrice = apps.get_model('elementtypes', 'VersioneMatrice')
+    VersioneMatrice.objects.bulk_create([
+        VersioneMatrice(
+            elementtype_id=matrice.elementtype_id, registrata_il=matrice.aggiornata_il, minacce_ids=matrice.minacce_ids,
+            controlli_ids=matrice.controlli_ids, valori=matrice.valori, impronta=matrice.impronta,
+        )
+        for matrice in MatriceCompatta.objects.iterator()
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('elementtypes', '0005_impronte_matrici'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VersioneMatrice',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('elementtype_id', models.BigIntegerField(verbose_name='ElementType')),
+                ('registrata_il', models.DateTimeField(verbose_name='Registrata il')),
+                ('minacce_ids', models.BinaryField(default=b'', verbose_name='Id minacce (righe)')),
+                ('controlli_ids', models.BinaryField(default=b'', verbose_name='Id controlli (colonne)')),
+                ('valori', models.BinaryField(default=b'', verbose_name='Valori (percentuale)')),
+                ('impronta', models.CharField(blank=True, max_length=40, verbose_name='Impronta')),
+                ('eliminata', models.BooleanField(default=False, verbose_name='Eliminata')),
+            ],
+            options={
+                'verbose_name': 'Versione matrice Element Type',
+                'verbose_name_plural': 'Versioni matrice Element Type',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='historicalelementtype',
+            index=models.Index(fields=['id', 'history_date'], name='elementtype_id_2fa284_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='versionematrice',
+            index=models.Index(fields=['elementtype_id', 'registrata_il'], name='elementtype_element_332238_idx'),
+        ),
+        migrations.RunPython(versioni_iniziali, migrations.RunPython.noop),
+    ]
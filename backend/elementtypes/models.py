@@ -1,11 +1,10 @@
 from django.db import models
 from django.core.exceptions import ValidationError
-from simple_history.models import HistoricalRecords
+from core.storico import StoricoRecords
 from campagne.models import Campagna
 from minacce.models import Minaccia
 from controlli.models import Controllo
 from .managers import ElementTypeManager # Importa il manager personalizzato
-import logging
 
 class ElementType(models.Model):
     nome = models.CharField("Nome", max_length=255)
@@ -43,7 +42,15 @@ class ElementType(models.Model):
         verbose_name="Clonato da (Master)",
         help_text="Riferimento all'ElementType master da cui questo è stato clonato."
     )
-    history = HistoricalRecords()
+    num_minacce = models.PositiveIntegerField(
+        "N. minacce", default=0, editable=False,
+        help_text="Contatore materializzato delle righe della matrice (vedi elementtypes.dimensioni)."
+    )
+    num_controlli = models.PositiveIntegerField(
+        "N. controlli", default=0, editable=False,
+        help_text="Contatore materializzato delle colonne della matrice (vedi elementtypes.dimensioni)."
+    )
+    history = StoricoRecords(excluded_fields=['num_minacce', 'num_controlli'])
     objects = ElementTypeManager()
 
     def __str__(self):
@@ -63,99 +70,87 @@ class ElementType(models.Model):
                                   "per poter configurare la matrice di rischio."
                 })
 
+            # Conteggi per minaccia e controlli non coperti calcolati con query raggruppate
+            from .abilitazione import valuta_elementtype
+            esito = valuta_elementtype(self)
+
             # Vincolo 1: L'ElementType deve avere almeno una minaccia associata.
-            if not self.minacce.exists():
-                raise ValidationError({
-                    'is_enabled': "L'ElementType non può essere abilitato perché non ha minacce associate (righe della matrice)."
-                })
+            if not esito.minacce:
+                raise ValidationError({'is_enabled': esito.messaggio})
 
-            # Vincolo 2 (Nuovo): Ogni minaccia associata deve avere almeno 4 controlli (2 preventive e 2 detective).
-            for minaccia in self.minacce.all():
-                preventive_controls_count = self.valori_matrice.filter(
-                    minaccia=minaccia,
-                    controllo__categoria_controllo='preventive'
-                ).count()
-                detective_controls_count = self.valori_matrice.filter(
-                    minaccia=minaccia,
-                    controllo__categoria_controllo='detective'
-                ).count()
-
-                if preventive_controls_count < 2 or detective_controls_count < 2:
-                    self.is_enabled = False
-                    break
-            
-            if not self.is_enabled:
+            # Vincolo 2: Ogni minaccia associata deve avere almeno 4 controlli (2 preventive e 2 detective).
+            if esito.minacce_senza_valori or esito.minacce_incomplete:
+                self.is_enabled = False
                 return
 
-            # Vincolo 3 (Modificato): Tutti i controlli dell'ElementType devono essere associati ad almeno una minaccia.
-            # E ogni minaccia deve avere almeno un controllo nella matrice.
-            assigned_controls_ids = self.valori_matrice.values_list('controllo_id', flat=True).distinct()
-            all_controls_for_elementtype = self.controls_assigned_to_elementtype.all()
-
-            controls_not_in_matrix = [
-                f'"{control.nome}"' for control in all_controls_for_elementtype
-                if control.id not in assigned_controls_ids
-            ]
-
-            if controls_not_in_matrix:
-                error_message = (
-                    "L'ElementType non può essere abilitato perché i seguenti controlli assegnati "
-                    "non sono presenti nella matrice di rischio (non associati a nessuna minaccia): "
-                    f"{', '.join(controls_not_in_matrix)}."
-                )
-                raise ValidationError({'is_enabled': error_message})
+            # Vincolo 3: Tutti i controlli dell'ElementType devono essere associati ad almeno una minaccia.
+            if esito.controlli_non_coperti:
+                raise ValidationError({'is_enabled': esito.messaggio})
 
     def get_dimensione_matrice_display(self):
         """
-        Calcola e restituisce una stringa che rappresenta la dimensione della matrice
+        Restituisce una stringa che rappresenta la dimensione della matrice
         (Minacce x Controlli). Gestisce sia i tipi base che quelli derivati.
-        Per una performance ottimale, il chiamante dovrebbe pre-caricare le relazioni
-        con prefetch_related.
+        Legge i contatori materializzati `num_minacce`/`num_controlli`, quindi
+        non esegue query.
         """
+        num_minacce, num_controlli = self.num_minacce, self.num_controlli
         if self.nome == "root":
-            # For the special 'root' ElementType, calculate dimension from aggregated values
-            num_minacce = self.valori_matrice.values('minaccia').distinct().count()
-            num_controlli = self.valori_matrice.values('controllo').distinct().count()
             return f"{num_minacce} x {num_controlli}" if num_minacce or num_controlli else "N/D (Root Aggregato)"
         elif self.is_base:
-            # Per i tipi base, i conteggi sono diretti.
-            num_minacce = self.minacce.count()
-            num_controlli = self.controls_assigned_to_elementtype.count()
             return f"{num_minacce} x {num_controlli}" if num_minacce or num_controlli else "N/D"
         else:
-            # Per i tipi derivati, usa i metodi ricorsivi per ottenere i conteggi corretti.
-            if not self.component_element_types.exists():
+            if not num_minacce and not num_controlli:
                 return "N/D (derivato)"
-            
-            num_minacce = self.get_all_minacce().count()
-            num_controlli = self.get_all_controlli().count()
             return f"{num_minacce} x {num_controlli} (A)"
 
     def get_all_controlli(self):
         """
         Restituisce un queryset di tutti i controlli associati, gestendo la derivazione ricorsiva.
+        Per i tipi derivati è un unico join sulla tabella di chiusura; nelle campagne
+        chiuse l'unione è letta dall'istantanea precalcolata.
         """
+        voce = self._voce_istantanea()
+        if voce is not None:
+            return Controllo.objects.filter(pk__in=voce.dati['controlli'])
         if self.is_base:
             return self.controls_assigned_to_elementtype.all()
-        
-        all_control_ids = set()
-        for component in self.component_element_types.all():
-            all_control_ids.update(component.get_all_controlli().values_list('id', flat=True))
-            
-        return Controllo.objects.filter(id__in=all_control_ids)
+
+        return Controllo.objects.filter(
+            elementtype__closure_antenati__ancestor=self,
+            elementtype__is_base=True,
+        )
 
     def get_all_minacce(self):
         """
         Restituisce un queryset di tutte le minacce applicabili, gestendo la derivazione ricorsiva.
+        Per i tipi derivati è un unico join sulla tabella di chiusura; nelle campagne
+        chiuse l'unione è letta dall'istantanea precalcolata.
         """
+        voce = self._voce_istantanea()
+        if voce is not None:
+            return Minaccia.objects.filter(pk__in=voce.dati['minacce'])
         if self.is_base:
             return self.minacce.all()
-        
-        all_minaccia_ids = set()
-        for component in self.component_element_types.all():
-            all_minaccia_ids.update(component.get_all_minacce().values_list('id', flat=True))
-            
-        return Minaccia.objects.filter(id__in=all_minaccia_ids)
+
+        return Minaccia.objects.filter(
+            elementtype__closure_antenati__ancestor=self,
+            elementtype__is_base=True,
+        ).distinct()
+
+    def _voce_istantanea(self):
+        from campagne.istantanea import leggi
+        from campagne.models import VoceIstantanea
+
+        return leggi(VoceIstantanea.ELEMENTTYPE, self)
+
+    def get_componenti_di_base(self):
+        """Tutti gli ElementType di base da cui questo tipo deriva (sé stesso se è di base)."""
+        return ElementType.objects.filter(closure_antenati__ancestor=self, is_base=True)
+
+    def get_derivati_dipendenti(self):
+        """Tutti gli ElementType derivati che includono, direttamente o indirettamente, questo tipo."""
+        return ElementType.objects.filter(closure_discendenti__descendant=self, closure_discendenti__depth__gt=0)
 
     def get_valore_matrice(self, minaccia, controllo):
         """
@@ -177,21 +172,16 @@ class ElementType(models.Model):
     def get_aggregated_matrix_values(cls, element_types):
         """
         Aggregates matrix values from a list of ElementType instances.
-        For each (minaccia, controllo) pair, takes the maximum value.
+        For each (minaccia, controllo) pair, takes the maximum value, computed by the
+        database with a single MAX ... GROUP BY query.
         Returns a dictionary: {(minaccia_id, controllo_id): max_valore}
         """
-        logging.info(f"--- Aggregating matrix values for ElementTypes: {[et.nome for et in element_types]} ---")
-        aggregated_values = {}
-        # Pre-fetch all ValoreElementType for the given element_types to avoid N+1 queries
-        valori_to_process = ValoreElementType.objects.filter(elementtype__in=element_types).select_related('minaccia', 'controllo')
-
-        for valore_obj in valori_to_process:
-            key = (valore_obj.minaccia_id, valore_obj.controllo_id)
-            logging.info(f"  Processing ValoreElementType: ET={valore_obj.elementtype.nome}, Minaccia={valore_obj.minaccia.descrizione}, Controllo={valore_obj.controllo.nome}, Valore={valore_obj.valore}")
-            aggregated_values[key] = max(aggregated_values.get(key, 0.0), valore_obj.valore)
-            logging.info(f"  Current aggregated value for ({valore_obj.minaccia.descrizione}, {valore_obj.controllo.nome}): {aggregated_values[key]}")
-        logging.info(f"Final aggregated values: {aggregated_values}")
-        return aggregated_values
+        return {
+            (minaccia_id, controllo_id): valore
+            for minaccia_id, controllo_id, valore in ValoreElementType.objects.filter(elementtype__in=element_types)
+            .values('minaccia_id', 'controllo_id').annotate(valore=models.Max('valore'))
+            .values_list('minaccia_id', 'controllo_id', 'valore')
+        }
 
     class Meta:
         verbose_name = "Element Type"
@@ -207,4 +197,70 @@ class ValoreElementType(models.Model):
     class Meta:
         unique_together = ('elementtype', 'minaccia', 'controllo')
         verbose_name = 'Valore Matrice Element Type'
-        verbose_name_plural = 'Valori Matrice Element Type'
\ No newline at end of file
+        verbose_name_plural = 'Valori Matrice Element Type'
+
+class ElementTypeClosure(models.Model):
+    """
+    Tabella di chiusura del grafo di derivazione `component_element_types`:
+    una riga per ogni coppia (antenato, discendente) raggiungibile, inclusa la
+    coppia riflessiva a distanza 0. Mantenuta dai segnali in `signals.py`.
+    """
+    ancestor = models.ForeignKey(ElementType, on_delete=models.CASCADE, related_name='closure_discendenti')
+    descendant = models.ForeignKey(ElementType, on_delete=models.CASCADE, related_name='closure_antenati')
+    depth = models.PositiveIntegerField("Distanza", default=0)
+
+    class Meta:
+        unique_together = ('ancestor', 'descendant')
+        indexes = [models.Index(fields=['descendant', 'ancestor'])]
+        verbose_name = 'Chiusura Element Type'
+        verbose_name_plural = 'Chiusure Element Type'
+
+
+class MatriceCompatta(models.Model):
+    """
+    Rappresentazione compatta dell'intera matrice di un ElementType, allineata
+    alle righe di `ValoreElementType` (vedi `compatta.py`): vettori ordinati
+    degli id di minacce e controlli (int64) e valori in percentuale (uint8,
+    0 = cella assente) in ordine riga per riga. Si legge con un solo fetch.
+    Le impronte permettono di saltare le aggregazioni con input invariati.
+    """
+    elementtype = models.OneToOneField(
+        ElementType, on_delete=models.CASCADE, primary_key=True, related_name='matrice_compatta'
+    )
+    minacce_ids = models.BinaryField("Id minacce (righe)")
+    controlli_ids = models.BinaryField("Id controlli (colonne)")
+    valori = models.BinaryField("Valori (percentuale)")
+    impronta = models.CharField(
+        "Impronta", max_length=40, blank=True,
+        help_text="Hash del contenuto: cambia a ogni modifica della matrice e ne fa da versione."
+    )
+    impronta_input = models.CharField(
+        "Impronta degli input", max_length=40, blank=True,
+        help_text="Hash dei componenti e delle loro versioni da cui è stata aggregata (vedi memo.py)."
+    )
+    aggiornata_il = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = 'Matrice compatta Element Type'
+        verbose_name_plural = 'Matrici compatte Element Type'
+
+
+class VersioneMatrice(models.Model):
+    """
+    Storico della matrice di un ElementType: una riga, nella forma compatta, per ogni contenuto
+    scritto da `compatta.salva` (le righe di `ValoreElementType` sono scritte in blocco e non
+    passano dallo storico per riga). Serve alle letture "alla data" (`storico.matrici_al`); le
+    versioni restano anche dopo l'eliminazione dell'ElementType.
+    """
+    elementtype_id = models.BigIntegerField("ElementType")
+    registrata_il = models.DateTimeField("Registrata il")
+    minacce_ids = models.BinaryField("Id minacce (righe)", default=b'')
+    controlli_ids = models.BinaryField("Id controlli (colonne)", default=b'')
+    valori = models.BinaryField("Valori (percentuale)", default=b'')
+    impronta = models.CharField("Impronta", max_length=40, blank=True)
+    eliminata = models.BooleanField("Eliminata", default=False)
+
+    class Meta:
+        verbose_name = 'Versione matrice Element Type'
+        verbose_name_plural = 'Versioni matrice Element Type'
+        indexes = [models.Index(fields=['elementtype_id', 'registrata_il'])]
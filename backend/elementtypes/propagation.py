@@ -0,0 +1,132 @@
+"""
+Propagazione incrementale delle modifiche di cella delle matrici di base.
+
+Quando cambia una cella (elementtype, minaccia, controllo) di un ElementType
+di base, vanno aggiornati solo:
+- i tipi derivati che lo includono (antenati nella tabella di chiusura), per
+  le sole celle modificate, come MAX sui rispettivi componenti di base;
+- le matrici aggregate degli asset (`assets.MatriceAsset`) che hanno tra i
+  figli diretti delle radici uno degli ElementType coinvolti, come MAX sui
+  figli diretti.
+
+Il costo è proporzionale al numero di celle e di dipendenti coinvolti, non
+alla dimensione delle matrici o al numero di asset della campagna.
+"""
+import logging
+from collections import defaultdict
+
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+
+class ModificheMatrice:
+    """Registro delle celle modificate, raggruppate per ElementType di base."""
+
+    def __init__(self):
+        self.celle = defaultdict(set)
+
+    def registra(self, elementtype_id, minaccia_id, controllo_id):
+        self.celle[elementtype_id].add((minaccia_id, controllo_id))
+
+    def __bool__(self):
+        return any(self.celle.values())
+
+    def __len__(self):
+        return sum(len(celle) for celle in self.celle.values())
+
+    def propaga(self):
+        return propaga_modifiche(self.celle)
+
+
+@transaction.atomic
+def propaga_modifiche(celle_per_elementtype):
+    """
+    Ricalcola le celle dipendenti da quelle indicate ({elementtype_id: {(minaccia_id, controllo_id)}}).
+    Le matrici di base devono essere già state aggiornate.
+    Restituisce un dizionario con il numero di derivati, asset (radici) e celle riscritte.
+    """
+    from assets.matrici import aggiorna_celle_asset
+    from assets.models import NodoStruttura
+    from .compatta import scrivi_celle
+    from .models import ElementTypeClosure, ValoreElementType
+
+    celle_per_elementtype = {et_id: set(celle) for et_id, celle in celle_per_elementtype.items() if celle}
+    statistiche = {'derivati': 0, 'radici': 0, 'celle': 0}
+    if not celle_per_elementtype:
+        return statistiche
+
+    # 1. Derivati coinvolti e celle da ricalcolare per ciascuno
+    celle_derivati = defaultdict(set)
+    for derivato_id, base_id in ElementTypeClosure.objects.filter(
+        descendant_id__in=celle_per_elementtype.keys(), depth__gt=0
+    ).values_list('ancestor_id', 'descendant_id'):
+        celle_derivati[derivato_id] |= celle_per_elementtype[base_id]
+
+    componenti_derivati = defaultdict(set)
+    for derivato_id, base_id in ElementTypeClosure.objects.filter(
+        ancestor_id__in=celle_derivati.keys(), descendant__is_base=True
+    ).values_list('ancestor_id', 'descendant_id'):
+        componenti_derivati[derivato_id].add(base_id)
+
+    # 2. Asset con un figlio diretto delle radici coinvolto
+    celle_modificate = dict(celle_per_elementtype)
+    celle_modificate.update(celle_derivati)
+    figli_radici = defaultdict(set)
+    for asset_id, figlio_et_id in NodoStruttura.objects.filter(
+        level=1,
+        asset_id__in=NodoStruttura.objects.filter(level=1, element_type_id__in=celle_modificate.keys()).values('asset_id'),
+    ).values_list('asset_id', 'element_type_id'):
+        figli_radici[asset_id].add(figlio_et_id)
+
+    # 3. Un'unica lettura dei valori correnti per tutte le celle e gli ElementType coinvolti
+    tutte_le_celle = set().union(*celle_modificate.values())
+    minacce_ids = {m for m, _ in tutte_le_celle}
+    controlli_ids = {c for _, c in tutte_le_celle}
+    et_ids = set(celle_modificate) | set().union(*componenti_derivati.values(), *figli_radici.values())
+    valori = {
+        (et_id, m, c): (pk, valore)
+        for pk, et_id, m, c, valore in ValoreElementType.objects.filter(
+            elementtype_id__in=et_ids, minaccia_id__in=minacce_ids, controllo_id__in=controlli_ids
+        ).values_list('pk', 'elementtype_id', 'minaccia_id', 'controllo_id', 'valore')
+    }
+
+    def valore_corrente(et_id, cella):
+        riga = valori.get((et_id,) + cella)
+        return riga[1] if riga else 0.0
+
+    # 4. Nuovi valori in memoria: prima i derivati, poi le radici che li leggono
+    nuovi = {}
+    for derivato_id, celle in celle_derivati.items():
+        for cella in celle:
+            nuovi[(derivato_id,) + cella] = max(
+                (valore_corrente(base_id, cella) for base_id in componenti_derivati[derivato_id]), default=0.0
+            )
+    for chiave, valore in nuovi.items():
+        riga = valori.get(chiave)
+        valori[chiave] = (riga[0] if riga else None, valore)
+
+    celle_asset = defaultdict(dict)
+    for asset_id in sorted(figli_radici):
+        celle = set().union(*(celle_modificate.get(et_id, ()) for et_id in figli_radici[asset_id]))
+        for cella in celle:
+            celle_asset[asset_id][cella] = max(
+                (valore_corrente(et_id, cella) for et_id in figli_radici[asset_id]), default=0.0
+            )
+
+    # 5. Scrittura del diff con operazioni bulk
+    celle_derivate = defaultdict(dict)
+    for (et_id, minaccia_id, controllo_id), valore in nuovi.items():
+        celle_derivate[et_id][(minaccia_id, controllo_id)] = valore
+    celle_scritte = scrivi_celle(
+        celle_derivate, esistenti={chiave: riga[0] for chiave, riga in valori.items() if riga[0] is not None}
+    )
+    celle_radici = aggiorna_celle_asset(celle_asset)
+
+    statistiche.update(
+        derivati=len(celle_derivati),
+        radici=len(figli_radici),
+        celle=celle_scritte + celle_radici,
+    )
+    logger.info("Propagazione modifiche matrice: %s", statistiche)
+    return statistiche
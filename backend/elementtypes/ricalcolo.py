@@ -0,0 +1,366 @@
+"""
+Ricalcolo in blocco delle matrici aggregate di una campagna (o del master).
+
+Le matrici derivate dipendono da quelle dei componenti e le matrici aggregate
+degli asset (`assets.MatriceAsset`) da quelle degli ElementType figli delle
+radici: il grafo di derivazione (archi `component_element_types`) viene
+ordinato topologicamente e ricalcolato per livelli, con gli asset per ultimi.
+Livello per livello:
+
+1. gli input vengono letti dalla memoria (caricati con poche query all'inizio
+   e aggiornati con i risultati dei livelli precedenti);
+2. le matrici con impronta degli input invariata vengono saltate (vedi `memo.py`);
+3. le altre, indipendenti tra loro, sono calcolate in parallelo da un pool di
+   processi (solo NumPy, nessun accesso al database nei processi figli);
+4. i risultati diversi da quelli salvati vengono scritti a lotti, una
+   transazione per lotto.
+
+Il ricalcolo è idempotente: una seconda esecuzione trova tutti gli input invariati.
+Le righe della campagna sono quelle di `campagne.sovrapposizione.righe` (nelle
+campagne a copia su scrittura anche le righe master lette); le campagne chiuse
+non si ricalcolano.
+"""
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from graphlib import CycleError, TopologicalSorter
+
+from .compatta import attive, impacchetta, impronta, riduci
+from .matrix import aggrega_matrici, massimo
+
+RADICE = 'radice'
+
+
+class CicloDerivazione(Exception):
+    """Il grafo dei componenti contiene un ciclo: l'ordinamento topologico è impossibile."""
+
+
+class CampagnaChiusa(Exception):
+    """La campagna è chiusa: le sue matrici non cambiano più."""
+
+
+@dataclass
+class EsitoLivello:
+    livello: int
+    tipo: str  # 'derivati' o 'radici'
+    matrici: int = 0
+    saltate: int = 0
+    invariate: int = 0
+    scritte: int = 0
+    celle: int = 0
+    durata: float = 0.0
+
+
+@dataclass
+class _Compito:
+    """
+    Matrice da aggregare: id dell'ElementType derivato o dell'asset (radici), righe/colonne
+    (None per le radici, unione dei figli) e matrici di input.
+    """
+    chiave: int
+    impronta_input: str
+    minacce_ids: list = None
+    controlli_ids: list = None
+    matrici: list = None
+
+
+def _calcola(compito):
+    """Eseguito nei processi del pool: solo calcolo in memoria."""
+    if compito.minacce_ids is None:
+        matrice = riduci(massimo(compito.matrici))
+    else:
+        matrice = aggrega_matrici(compito.minacce_ids, compito.controlli_ids, compito.matrici)
+    return compito.chiave, matrice
+
+
+def livelli_derivazione(derivati_ids, componenti):
+    """
+    Ordina i derivati per livelli topologici: ogni livello contiene solo derivati i
+    cui componenti derivati stanno nei livelli precedenti. `componenti` è
+    {derivato_id: insieme dei componenti diretti}; i componenti esterni (di base) sono ignorati.
+    """
+    derivati_ids = set(derivati_ids)
+    ordinamento = TopologicalSorter({
+        et_id: componenti.get(et_id, set()) & derivati_ids for et_id in derivati_ids
+    })
+    try:
+        ordinamento.prepare()
+    except CycleError as e:
+        raise CicloDerivazione(f"Ciclo tra i componenti degli ElementType: {e.args[1]}") from e
+    livelli = []
+    while ordinamento.is_active():
+        pronti = sorted(ordinamento.get_ready())
+        livelli.append(pronti)
+        ordinamento.done(*pronti)
+    return livelli
+
+
+class Ricalcolo:
+    """
+    Ricalcolo delle matrici aggregate (ElementType derivati e asset) di una
+    campagna; `campagna_id=None` indica il master. Uso:
+
+        esiti = Ricalcolo(campagna_id, processi=4).esegui(avanzamento=callback)
+    """
+
+    def __init__(self, campagna_id=None, processi=1, batch_size=200, forza=False):
+        self.campagna_id = campagna_id
+        self.processi = max(1, processi)
+        self.batch_size = max(1, batch_size)
+        self.forza = forza or not attive()
+
+    # --- Caricamento ---------------------------------------------------------
+
+    def _righe(self, modello):
+        """Righe del modello lette nella campagna (master visibili incluse) o, per il master, le righe master."""
+        from campagne.sovrapposizione import righe
+
+        if self.campagna is None:
+            return modello.objects.filter(campagna__isnull=True)
+        return righe(modello, self.campagna)
+
+    def _carica(self):
+        from assets.models import Asset, MatriceAsset, NodoStruttura
+        from campagne.models import Campagna
+        from controlli.models import Controllo
+        from .compatta import carica_matrici
+        from .models import ElementType, ElementTypeClosure, MatriceCompatta
+
+        self.campagna = None
+        if self.campagna_id is not None:
+            self.campagna = Campagna.objects.get(pk=self.campagna_id)
+            if self.campagna.status == 'close':
+                raise CampagnaChiusa(f"La campagna '{self.campagna}' è chiusa: le sue matrici non si ricalcolano.")
+
+        # Il tipo "root" dei nodi radice non ha componenti né matrice propria
+        derivati = set(
+            self._righe(ElementType).filter(is_base=False).exclude(nome="root").values_list('id', flat=True)
+        )
+
+        self.componenti = defaultdict(set)
+        for derivato_id, componente_id in ElementType.component_element_types.through.objects.filter(
+            from_elementtype_id__in=derivati
+        ).values_list('from_elementtype_id', 'to_elementtype_id'):
+            self.componenti[derivato_id].add(componente_id)
+
+        self.basi = defaultdict(set)
+        for antenato_id, base_id in ElementTypeClosure.objects.filter(
+            ancestor_id__in=derivati, descendant__is_base=True
+        ).values_list('ancestor_id', 'descendant_id'):
+            self.basi[antenato_id].add(base_id)
+        tutte_le_basi = set().union(*self.basi.values()) if self.basi else set()
+
+        # Asset con almeno una radice: {asset_id: ElementType dei figli diretti delle radici}
+        self.radici = {}
+        for asset_id, livello, et_id in NodoStruttura.objects.filter(
+            level__lte=1, asset__in=self._righe(Asset).values('pk')
+        ).values_list('asset_id', 'level', 'element_type_id'):
+            figli = self.radici.setdefault(asset_id, set())
+            if livello:
+                figli.add(et_id)
+        self.derivati = derivati
+
+        self.minacce = defaultdict(set)
+        self.minacce_basi = defaultdict(set)
+        for et_id, minaccia_id in ElementType.minacce.through.objects.filter(
+            elementtype_id__in=tutte_le_basi | self.derivati
+        ).values_list('elementtype_id', 'minaccia_id'):
+            (self.minacce_basi if et_id in tutte_le_basi else self.minacce)[et_id].add(minaccia_id)
+        self.controlli_basi = defaultdict(set)
+        for et_id, controllo_id in Controllo.objects.filter(elementtype_id__in=tutte_le_basi).values_list('elementtype_id', 'id'):
+            self.controlli_basi[et_id].add(controllo_id)
+
+        figli_radici = set().union(*self.radici.values()) if self.radici else set()
+        input_ids = tutte_le_basi | self.derivati | figli_radici
+        self.matrici = carica_matrici(input_ids)
+        self.impronte = {}
+        self.impronte_input = {}
+        for et_id, impronta_salvata, impronta_input_salvata in MatriceCompatta.objects.filter(
+            elementtype_id__in=input_ids
+        ).values_list('elementtype_id', 'impronta', 'impronta_input'):
+            self.impronte[et_id] = impronta_salvata
+            self.impronte_input[et_id] = impronta_input_salvata
+        self.impronte_asset = {}
+        self.impronte_input_asset = {}
+        for asset_id, impronta_salvata, impronta_input_salvata in MatriceAsset.objects.filter(
+            asset_id__in=self.radici
+        ).values_list('asset_id', 'impronta', 'impronta_input'):
+            self.impronte_asset[asset_id] = impronta_salvata
+            self.impronte_input_asset[asset_id] = impronta_input_salvata
+
+    # --- Compiti ---------------------------------------------------------------
+
+    def _compito_derivato(self, et_id):
+        from .memo import impronta_input
+
+        basi = sorted(self.basi.get(et_id, ()))
+        minacce_ids = sorted(set().union(*(self.minacce_basi[b] for b in basi))) if basi else []
+        controlli_ids = sorted(set().union(*(self.controlli_basi[b] for b in basi))) if basi else []
+        compito = _Compito(et_id, impronta_input(basi, self.impronte, minacce_ids, controlli_ids), minacce_ids, controlli_ids)
+        compito.matrici = [self.matrici[b] for b in basi if b in self.matrici]
+        return compito
+
+    def _compito_radice(self, asset_id):
+        from .memo import impronta_input
+
+        figli_ids = sorted(self.radici[asset_id])
+        compito = _Compito(asset_id, impronta_input(figli_ids, self.impronte, [RADICE]))
+        compito.matrici = [self.matrici[f] for f in figli_ids if f in self.matrici]
+        return compito
+
+    # --- Esecuzione ------------------------------------------------------------
+
+    def esegui(self, avanzamento=None):
+        """Ricalcola tutti i livelli e restituisce la lista degli EsitoLivello."""
+        self._carica()
+        livelli = [('derivati', livello) for livello in livelli_derivazione(self.derivati, self.componenti)]
+        if self.radici:
+            livelli.append(('radici', sorted(self.radici)))
+
+        esiti = []
+        pool = ProcessPoolExecutor(self.processi) if self.processi > 1 else None
+        try:
+            for numero, (tipo, et_ids) in enumerate(livelli, start=1):
+                esito = self._esegui_livello(numero, tipo, et_ids, pool)
+                esiti.append(esito)
+                if avanzamento:
+                    avanzamento(esito, len(livelli))
+        finally:
+            if pool:
+                pool.shutdown()
+        return esiti
+
+    def _esegui_livello(self, numero, tipo, chiavi, pool):
+        from . import memo
+
+        inizio = time.perf_counter()
+        esito = EsitoLivello(numero, tipo, matrici=len(chiavi))
+        if tipo == 'derivati':
+            contatore, crea, impronte_input_salvate = 'aggregazione', self._compito_derivato, self.impronte_input
+        else:
+            contatore, crea, impronte_input_salvate = RADICE, self._compito_radice, self.impronte_input_asset
+
+        compiti = []
+        for chiave in chiavi:
+            compito = crea(chiave)
+            if not self.forza and impronte_input_salvate.get(chiave) == compito.impronta_input:
+                memo.registra(contatore, 'hit')
+                esito.saltate += 1
+            else:
+                memo.registra(contatore, 'miss')
+                compiti.append(compito)
+        impronte_input = {compito.chiave: compito.impronta_input for compito in compiti}
+
+        if pool and len(compiti) > 1:
+            risultati = pool.map(_calcola, compiti, chunksize=max(1, len(compiti) // (self.processi * 4)))
+        else:
+            risultati = map(_calcola, compiti)
+
+        scrivi = self._scrivi if tipo == 'derivati' else self._scrivi_radici
+        lotto = []
+        for chiave, matrice in risultati:
+            lotto.append((chiave, matrice))
+            if len(lotto) >= self.batch_size:
+                scrivi(lotto, impronte_input, esito)
+                lotto = []
+        if lotto:
+            scrivi(lotto, impronte_input, esito)
+        if tipo == 'derivati':
+            self._allinea_minacce(chiavi)
+
+        esito.durata = time.perf_counter() - inizio
+        return esito
+
+    def _scrivi(self, lotto, impronte_input, esito):
+        """Scrive in una transazione le matrici derivate del lotto che differiscono da quelle salvate."""
+        from django.db import transaction
+
+        from campagne.sovrapposizione import preserva_righe
+        from . import memo
+        from .compatta import sostituisci_matrici
+        from .models import ElementType, MatriceCompatta
+
+        da_scrivere, invariate = {}, []
+        for et_id, matrice in lotto:
+            impronta_nuova = impronta(impacchetta(matrice))
+            if self.impronte.get(et_id) == impronta_nuova:
+                invariate.append(et_id)
+                memo.registra('aggregazione', 'scrittura_evitata')
+            else:
+                da_scrivere[et_id] = matrice
+            # I livelli successivi leggono le matrici e le versioni aggiornate
+            self.matrici[et_id] = matrice
+            self.impronte[et_id] = impronta_nuova
+
+        with transaction.atomic():
+            if invariate:
+                MatriceCompatta.objects.bulk_update(
+                    [MatriceCompatta(elementtype_id=et_id, impronta_input=impronte_input[et_id]) for et_id in invariate],
+                    ['impronta_input'],
+                )
+            if da_scrivere:
+                preserva_righe(ElementType, da_scrivere)
+                esito.celle += sostituisci_matrici(
+                    da_scrivere, impronte_input={et_id: impronte_input[et_id] for et_id in da_scrivere},
+                    batch_size=self.batch_size,
+                )
+        esito.invariate += len(invariate)
+        esito.scritte += len(da_scrivere)
+
+    def _scrivi_radici(self, lotto, impronte_input, esito):
+        """Scrive in una transazione le matrici aggregate degli asset del lotto che differiscono da quelle salvate."""
+        from django.db import transaction
+
+        from assets.matrici import salva_matrici_asset
+        from assets.models import Asset, MatriceAsset
+        from campagne.sovrapposizione import preserva_righe
+        from . import memo
+
+        da_scrivere, invariate = {}, []
+        for asset_id, matrice in lotto:
+            if self.impronte_asset.get(asset_id) == impronta(impacchetta(matrice)):
+                invariate.append(asset_id)
+                memo.registra(RADICE, 'scrittura_evitata')
+            else:
+                da_scrivere[asset_id] = matrice
+
+        with transaction.atomic():
+            if invariate:
+                MatriceAsset.objects.bulk_update(
+                    [MatriceAsset(asset_id=asset_id, impronta_input=impronte_input[asset_id]) for asset_id in invariate],
+                    ['impronta_input'],
+                )
+            preserva_righe(Asset, da_scrivere)
+            salva_matrici_asset(da_scrivere, impronte_input={asset_id: impronte_input[asset_id] for asset_id in da_scrivere})
+        esito.celle += sum(int(matrice.valori.astype(bool).sum()) for matrice in da_scrivere.values())
+        esito.invariate += len(invariate)
+        esito.scritte += len(da_scrivere)
+
+    def _allinea_minacce(self, et_ids):
+        """
+        Imposta le minacce dei derivati (unione ricorsiva di quelle delle basi), come `aggregazione`.
+        I contatori dei derivati dipendono solo dalle basi e non vanno ricalcolati.
+        """
+        from django.db import transaction
+
+        from campagne.sovrapposizione import preserva_righe
+        from .models import ElementType
+
+        Through = ElementType.minacce.through
+        diversi = {}
+        for et_id in et_ids:
+            attese = set().union(*(self.minacce_basi[b] for b in self.basi.get(et_id, ()))) if self.basi.get(et_id) else set()
+            if attese != self.minacce[et_id]:
+                diversi[et_id] = attese
+        if not diversi:
+            return
+        with transaction.atomic():
+            preserva_righe(ElementType, diversi)
+            Through.objects.filter(elementtype_id__in=diversi).delete()
+            Through.objects.bulk_create([
+                Through(elementtype_id=et_id, minaccia_id=minaccia_id)
+                for et_id, minacce in diversi.items() for minaccia_id in minacce
+            ], batch_size=5000)
+        for et_id, minacce in diversi.items():
+            self.minacce[et_id] = minacce
@@ -1,14 +1,62 @@
+import numpy as np
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 from rest_framework import serializers
+from rest_framework.exceptions import ValidationError
+from campagne.istantanea import leggi
+from campagne.models import VoceIstantanea
 from .models import ElementType, ValoreElementType
 
+FORMATI_MATRICE = ('densa', 'coo')
+
+
+def formato_richiesto(request):
+    """Il formato della matrice chiesto con `?formato=` ('densa' se assente)."""
+    formato = request.query_params.get('formato', FORMATI_MATRICE[0])
+    if formato not in FORMATI_MATRICE:
+        raise ValidationError({'formato': f"Formato '{formato}' non valido: {', '.join(FORMATI_MATRICE)}."})
+    return formato
+
+
+def matrice_serializzata(matrice, formato='densa'):
+    """
+    Rappresentazione JSON di una MatriceDensa: id di righe (`minacce`) e colonne (`controlli`) e
+    `valori` riga per riga; con formato 'coo' solo le celle valorizzate, come indici di riga e di
+    colonna (`righe`, `colonne`) e valori paralleli. I valori escono dall'array numpy senza
+    passare da un oggetto per cella.
+    """
+    valori = matrice.valori.round(2)
+    dati = {'minacce': matrice.minacce_ids, 'controlli': matrice.controlli_ids}
+    if formato == 'coo':
+        righe, colonne = np.nonzero(valori)
+        dati.update(righe=righe.tolist(), colonne=colonne.tolist(), valori=valori[righe, colonne].tolist())
+    else:
+        dati['valori'] = valori.tolist()
+    return dati
+
+
+def con_dimensioni(queryset):
+    """Annota minacce proprie e controlli valorizzati di ogni ElementType (due subquery nello stesso SELECT)."""
+    def conteggio(righe, campo):
+        return Coalesce(Subquery(
+            righe.filter(elementtype_id=OuterRef('pk')).order_by().values('elementtype_id')
+            .annotate(n=Count(campo, distinct=True)).values('n'),
+            output_field=IntegerField(),
+        ), 0)
+
+    return queryset.annotate(
+        num_minacce_proprie=conteggio(ElementType.minacce.through.objects.all(), 'minaccia_id'),
+        num_controlli_valorizzati=conteggio(ValoreElementType.objects.all(), 'controllo_id'),
+    )
+
+
 class ValoreElementTypeSerializer(serializers.ModelSerializer):
     class Meta:
         model = ValoreElementType
         fields = '__all__'
 
 class ElementTypeSerializer(serializers.ModelSerializer):
-    # Optionally, include matrix values in the serializer
-    valori_matrice = ValoreElementTypeSerializer(many=True, read_only=True)
+    # I valori della matrice si leggono dall'azione `matrice` (forma compatta), non annidati qui
     matrix_dimension = serializers.SerializerMethodField() # Aggiungi questo campo
     
     class Meta:
@@ -17,12 +65,19 @@ class ElementTypeSerializer(serializers.ModelSerializer):
 
     def get_matrix_dimension(self, obj):
         """
-        Calcola la dimensione della matrice (Minacce x Controlli) per l'ElementType.
+        Calcola la dimensione della matrice (Minacce x Controlli) per l'ElementType: dai conteggi
+        annotati da `con_dimensioni` se presenti, altrimenti dall'istantanea nelle campagne chiuse
+        o con due conteggi.
         """
         if not obj.pk: # Per oggetti non ancora salvati
             return "N/A"
-        num_minacce = obj.minacce.count()
-        num_controlli = obj.valori_matrice.values('controllo').distinct().count()
+        if hasattr(obj, 'num_minacce_proprie'):
+            num_minacce, num_controlli = obj.num_minacce_proprie, obj.num_controlli_valorizzati
+        elif (voce := leggi(VoceIstantanea.ELEMENTTYPE, obj)) is not None:
+            num_minacce, num_controlli = voce.dati['num_minacce_proprie'], voce.dati['num_controlli_valorizzati']
+        else:
+            num_minacce = obj.minacce.count()
+            num_controlli = obj.valori_matrice.values('controllo').distinct().count()
         if num_minacce == 0 and num_controlli == 0:
             return "N/A"
-        return f"{num_minacce} x {num_controlli}"
\ No newline at end of file
+        return f"{num_minacce} x {num_controlli}"
@@ -0,0 +1,127 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from controlli.models import Controllo
+from minacce.models import Minaccia
+from .closure import antenati_ids, ricostruisci_chiusura, verifica_aciclicita
+from .compatta import aggiorna_celle, sincronizza
+from .dimensioni import aggiorna_dimensioni
+from .models import ElementType, ElementTypeClosure, ValoreElementType
+
+
+@receiver(post_save, sender=ElementType)
+def crea_chiusura_riflessiva(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    if created:
+        ElementTypeClosure.objects.get_or_create(ancestor=instance, descendant=instance, defaults={'depth': 0})
+    else:
+        # Il passaggio base/derivato cambia il modo in cui si contano righe e colonne.
+        aggiorna_dimensioni([instance.pk])
+
+
+@receiver(m2m_changed, sender=ElementType.component_element_types.through)
+def aggiorna_chiusura(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Mantiene la tabella di chiusura allineata alle modifiche dei componenti.
+    In `pre_add` rifiuta i collegamenti che creerebbero un ciclo; dopo ogni
+    modifica ricalcola le righe degli antenati coinvolti e i loro contatori.
+    """
+    if action == 'pre_add':
+        for padre_id, componenti_ids in _archi(instance, reverse, pk_set):
+            verifica_aciclicita(padre_id, componenti_ids)
+        return
+
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    # La chiusura non è ancora aggiornata: gli antenati letti qui sono quelli
+    # precedenti alla modifica, sempre un sovrainsieme di quelli da ricalcolare.
+    origini = {instance.pk}
+    if reverse and pk_set:
+        origini |= set(pk_set)
+    antenati = antenati_ids(origini)
+    ricostruisci_chiusura(antenati, instance.campagna_id)
+    aggiorna_dimensioni(antenati, includi_antenati=False)
+
+
+def _archi(instance, reverse, pk_set):
+    if not reverse:
+        return [(instance.pk, set(pk_set))]
+    return [(padre_id, {instance.pk}) for padre_id in pk_set]
+
+
+@receiver(m2m_changed, sender=ElementType.minacce.through)
+def aggiorna_dimensioni_minacce(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            aggiorna_dimensioni([instance.pk])
+        return
+    # Lato Minaccia: in caso di clear gli ElementType coinvolti vanno letti prima della modifica.
+    if action == 'pre_clear':
+        instance._elementtypes_da_aggiornare = list(instance.elementtype_set.values_list('pk', flat=True))
+    elif action in ('post_add', 'post_remove'):
+        aggiorna_dimensioni(pk_set)
+    elif action == 'post_clear':
+        aggiorna_dimensioni(getattr(instance, '_elementtypes_da_aggiornare', []))
+
+
+@receiver(pre_delete, sender=Minaccia)
+def memorizza_elementtypes_minaccia(sender, instance, **kwargs):
+    instance._elementtypes_da_aggiornare = list(instance.elementtype_set.values_list('pk', flat=True))
+    instance._matrici_da_sincronizzare = _matrici_con_valori(minaccia=instance)
+
+
+@receiver(post_delete, sender=Minaccia)
+def aggiorna_dimensioni_minaccia_eliminata(sender, instance, **kwargs):
+    aggiorna_dimensioni(getattr(instance, '_elementtypes_da_aggiornare', []))
+    sincronizza(getattr(instance, '_matrici_da_sincronizzare', []))
+
+
+def _matrici_con_valori(**filtro):
+    # ElementType le cui celle vengono eliminate in cascata insieme alla riga/colonna
+    return set(ValoreElementType.objects.filter(**filtro).values_list('elementtype_id', flat=True).distinct())
+
+
+@receiver(pre_save, sender=Controllo)
+def memorizza_elementtype_precedente(sender, instance, raw=False, **kwargs):
+    instance._elementtype_precedente_id = None
+    if instance.pk and not raw:
+        instance._elementtype_precedente_id = (
+            Controllo.objects.filter(pk=instance.pk).values_list('elementtype_id', flat=True).first()
+        )
+
+
+@receiver(post_save, sender=Controllo)
+def aggiorna_dimensioni_controllo(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    precedente_id = getattr(instance, '_elementtype_precedente_id', None)
+    if created or precedente_id != instance.elementtype_id:
+        aggiorna_dimensioni([precedente_id, instance.elementtype_id])
+
+
+@receiver(pre_delete, sender=Controllo)
+def memorizza_matrici_controllo(sender, instance, **kwargs):
+    instance._matrici_da_sincronizzare = _matrici_con_valori(controllo=instance)
+
+
+@receiver(post_delete, sender=Controllo)
+def aggiorna_dimensioni_controllo_eliminato(sender, instance, **kwargs):
+    aggiorna_dimensioni([instance.elementtype_id])
+    sincronizza(getattr(instance, '_matrici_da_sincronizzare', []))
+
+
+@receiver(post_save, sender=ValoreElementType)
+def aggiorna_valore_salvato(sender, instance, raw=False, **kwargs):
+    """
+    Allinea forma compatta e, per il tipo "root", contatori di dimensione al salvataggio di una singola cella.
+    Non si registra un post_delete: disattiverebbe la cancellazione rapida delle matrici;
+    le scritture in blocco e le cancellazioni passano da `compatta` (`scrivi_celle`,
+    `sostituisci_matrici`, `elimina_celle`), che allinea la forma compatta.
+    """
+    if raw:
+        return
+    aggiorna_celle({instance.elementtype_id: {(instance.minaccia_id, instance.controllo_id): instance.valore}})
+    if instance.elementtype.nome == "root":
+        aggiorna_dimensioni([instance.elementtype_id])
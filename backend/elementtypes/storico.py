@@ -0,0 +1,34 @@
+"""
+Letture "alla data" delle matrici degli ElementType.
+
+`compatta.salva` aggiunge una `VersioneMatrice` ogni volta che il contenuto
+di una matrice cambia (e una riga `eliminata` quando la forma compatta viene
+rimossa). La matrice in vigore a un istante è l'ultima versione registrata
+entro quell'istante: una subquery correlata sull'indice
+(elementtype_id, registrata_il) la trova con un solo accesso per matrice.
+"""
+from django.db.models import OuterRef, Subquery
+
+from .compatta import spacchetta
+from .matrix import MatriceDensa
+
+
+def matrici_al(element_type_ids, quando):
+    """{elementtype_id: MatriceDensa} in vigore a `quando`; mancano le matrici non ancora registrate o eliminate."""
+    from .models import VersioneMatrice
+
+    ultima = VersioneMatrice.objects.filter(
+        elementtype_id=OuterRef('elementtype_id'), registrata_il__lte=quando
+    ).order_by('-registrata_il', '-id').values('id')[:1]
+    versioni = VersioneMatrice.objects.filter(
+        elementtype_id__in=set(element_type_ids), registrata_il__lte=quando, id=Subquery(ultima)
+    ).values_list('elementtype_id', 'eliminata', 'minacce_ids', 'controlli_ids', 'valori')
+    return {
+        et_id: spacchetta(minacce_ids, controlli_ids, valori)
+        for et_id, eliminata, minacce_ids, controlli_ids, valori in versioni if not eliminata
+    }
+
+
+def matrice_al(element_type_id, quando):
+    """Matrice di un singolo ElementType a `quando` (vuota se allora non aveva celle)."""
+    return matrici_al([element_type_id], quando).get(element_type_id) or MatriceDensa([], [])
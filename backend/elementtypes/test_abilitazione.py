@@ -0,0 +1,120 @@
+from datetime import date
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.test import TestCase
+from django.urls import reverse
+
+from campagne.models import Campagna
+from controlli.models import Controllo
+from minacce.models import Minaccia
+from scenari.models import Scenario
+from .abilitazione import valuta_abilitazione, valuta_elementtype
+from .models import ElementType, ValoreElementType
+
+
+class AbilitazioneElementTypeTest(TestCase):
+
+    def setUp(self):
+        self.scenario = Scenario.objects.create(descrizione="Scenario")
+        self.et = self._crea_elementtype("database")
+
+    def _crea_elementtype(self, nome, num_minacce=2):
+        et = ElementType.objects.create(nome=nome)
+        minacce = [
+            Minaccia.objects.create(descrizione=f"{nome} M{i}", scenario=self.scenario) for i in range(num_minacce)
+        ]
+        et.minacce.set(minacce)
+        controlli = [
+            Controllo.objects.create(
+                nome=f"{nome} {categoria} {j}", descrizione="", tipologia_controllo="Tecnologico",
+                categoria_controllo=categoria, elementtype=et,
+            )
+            for categoria in ('preventive', 'detective') for j in range(2)
+        ]
+        ValoreElementType.objects.bulk_create([
+            ValoreElementType(elementtype=et, minaccia=m, controllo=c, valore=0.5) for m in minacce for c in controlli
+        ])
+        return et
+
+    def test_elementtype_completo_abilitabile(self):
+        esito = valuta_elementtype(self.et)
+        self.assertTrue(esito.abilitabile)
+        self.et.is_enabled = True
+        self.et.clean()
+        self.assertTrue(self.et.is_enabled)
+
+    def test_minaccia_senza_due_detective(self):
+        minaccia = self.et.minacce.order_by('pk').first()
+        ValoreElementType.objects.filter(
+            elementtype=self.et, minaccia=minaccia, controllo__categoria_controllo='detective'
+        ).first().delete()
+        esito = valuta_elementtype(self.et)
+        self.assertEqual(esito.minacce_incomplete, [minaccia.descrizione])
+        self.assertEqual(esito.errore[0], 'minacce_incomplete')
+        # clean() mantiene il comportamento esistente: disabilita senza sollevare errori
+        self.et.is_enabled = True
+        self.et.clean()
+        self.assertFalse(self.et.is_enabled)
+
+    def test_minaccia_senza_valori(self):
+        nuova = Minaccia.objects.create(descrizione="Scoperta", scenario=self.scenario)
+        self.et.minacce.add(nuova)
+        esito = valuta_elementtype(self.et)
+        self.assertEqual(esito.minacce_senza_valori, ["Scoperta"])
+        self.assertIn('"Scoperta"', esito.messaggio)
+
+    def test_controllo_non_coperto(self):
+        Controllo.objects.create(
+            nome="Orfano", descrizione="", tipologia_controllo="Documentale",
+            categoria_controllo="preventive", elementtype=self.et,
+        )
+        self.et.is_enabled = True
+        with self.assertRaisesMessage(ValidationError, 'non associati a nessuna minaccia): "Orfano".'):
+            self.et.clean()
+
+    def test_senza_minacce(self):
+        self.et.minacce.clear()
+        self.et.is_enabled = True
+        with self.assertRaisesMessage(ValidationError, "non ha minacce associate"):
+            self.et.clean()
+
+    def test_numero_query_costante_su_piu_elementtype(self):
+        altri = [self._crea_elementtype(f"altro {i}", num_minacce=3) for i in range(5)]
+        ValoreElementType.objects.filter(elementtype=altri[0]).delete()
+        with self.assertNumQueries(4):
+            esiti = valuta_abilitazione(ElementType.objects.filter(is_base=True))
+        self.assertEqual(len(esiti), 6)
+        self.assertFalse(esiti[altri[0].pk].abilitabile)
+        self.assertEqual(sum(esito.abilitabile for esito in esiti.values()), 5)
+
+    def test_azione_abilita_idonei(self):
+        incompleto = self._crea_elementtype("incompleto")
+        ValoreElementType.objects.filter(elementtype=incompleto, controllo__categoria_controllo='preventive').delete()
+        admin = User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.force_login(admin)
+        self.client.post(reverse('admin:elementtypes_elementtype_changelist'), {
+            'action': 'abilita_idonei',
+            '_selected_action': [self.et.pk, incompleto.pk],
+        })
+        self.et.refresh_from_db()
+        incompleto.refresh_from_db()
+        self.assertTrue(self.et.is_enabled)
+        self.assertFalse(incompleto.is_enabled)
+        self.assertEqual(self.et.history.first().history_change_reason, "Abilitazione massiva")
+
+    def test_abilitazione_massiva_preserva_le_campagne_congelate(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            campagna = Campagna.objects.create(
+                anno=2030, descrizione="Campagna", data_inizio=date(2030, 1, 1), data_fine=date(2030, 12, 31),
+                copia_su_scrittura=True,
+            )
+        campagna.status = 'close'
+        campagna.save()
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'admin'))
+        self.client.post(reverse('admin:elementtypes_elementtype_changelist'), {
+            'action': 'abilita_idonei',
+            '_selected_action': [self.et.pk],
+        })
+        self.assertTrue(ElementType.objects.get(pk=self.et.pk).is_enabled)
+        self.assertFalse(ElementType.objects.get(campagna=campagna, cloned_from=self.et).is_enabled)
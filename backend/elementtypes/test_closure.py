@@ -0,0 +1,78 @@
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.test import TestCase
+
+from controlli.models import Controllo
+from minacce.models import Minaccia
+from scenari.models import Scenario
+from .models import ElementType, ElementTypeClosure
+
+
+class ElementTypeClosureTest(TestCase):
+
+    def setUp(self):
+        self.database = ElementType.objects.create(nome="database")
+        self.schema = ElementType.objects.create(nome="schema")
+        self.server = ElementType.objects.create(nome="server")
+        self.db = ElementType.objects.create(nome="db", is_base=False)
+        self.backend = ElementType.objects.create(nome="backend", is_base=False)
+        self.db.component_element_types.set([self.database, self.schema])
+        self.backend.component_element_types.set([self.db, self.server])
+
+    def _coppie(self):
+        return set(ElementTypeClosure.objects.values_list('ancestor__nome', 'descendant__nome', 'depth'))
+
+    def test_chiusura_completa(self):
+        riflessive = {(et.nome, et.nome, 0) for et in (self.database, self.schema, self.server, self.db, self.backend)}
+        self.assertEqual(self._coppie(), riflessive | {
+            ('db', 'database', 1), ('db', 'schema', 1),
+            ('backend', 'db', 1), ('backend', 'server', 1),
+            ('backend', 'database', 2), ('backend', 'schema', 2),
+        })
+
+    def test_componenti_di_base_e_derivati_dipendenti(self):
+        self.assertEqual(
+            set(self.backend.get_componenti_di_base().values_list('nome', flat=True)),
+            {'database', 'schema', 'server'},
+        )
+        self.assertEqual(
+            set(self.schema.get_derivati_dipendenti().values_list('nome', flat=True)),
+            {'db', 'backend'},
+        )
+
+    def test_rimozione_componente_aggiorna_antenati(self):
+        self.db.component_element_types.remove(self.schema)
+        self.assertFalse(ElementTypeClosure.objects.filter(ancestor=self.backend, descendant=self.schema).exists())
+        self.assertTrue(ElementTypeClosure.objects.filter(ancestor=self.backend, descendant=self.database).exists())
+
+    def test_modifica_dal_lato_inverso(self):
+        self.server.elementtype_set.add(self.db)
+        self.assertEqual(
+            ElementTypeClosure.objects.get(ancestor=self.backend, descendant=self.server).depth, 1
+        )
+        self.assertTrue(ElementTypeClosure.objects.filter(ancestor=self.db, descendant=self.server).exists())
+        self.schema.elementtype_set.clear()
+        self.assertFalse(ElementTypeClosure.objects.filter(ancestor=self.backend, descendant=self.schema).exists())
+
+    def test_ciclo_rifiutato(self):
+        with self.assertRaises(ValidationError), transaction.atomic():
+            self.db.component_element_types.add(self.backend)
+        with self.assertRaises(ValidationError), transaction.atomic():
+            self.db.component_element_types.add(self.db)
+        with self.assertRaises(ValidationError), transaction.atomic():
+            self.backend.elementtype_set.add(self.database)
+        self.assertFalse(self.db.component_element_types.filter(pk=self.backend.pk).exists())
+
+    def test_unioni_ricorsive_in_una_query(self):
+        scenario = Scenario.objects.create(descrizione="Scenario")
+        minaccia = Minaccia.objects.create(descrizione="Minaccia", scenario=scenario)
+        self.database.minacce.add(minaccia)
+        self.server.minacce.add(minaccia)
+        Controllo.objects.create(
+            nome="C1", descrizione="", tipologia_controllo="Tecnologico",
+            categoria_controllo="preventive", elementtype=self.schema,
+        )
+        with self.assertNumQueries(1):
+            self.assertEqual(list(self.backend.get_all_minacce()), [minaccia])
+        with self.assertNumQueries(1):
+            self.assertEqual(self.backend.get_all_controlli().count(), 1)
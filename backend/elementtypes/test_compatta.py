@@ -0,0 +1,170 @@
+import numpy as np
+from django.test import TestCase, override_settings
+
+from controlli.models import Controllo
+from core.testing import RichiesteAutenticate
+from minacce.models import Minaccia
+from scenari.models import Scenario
+from .compatta import (
+    aggiorna_celle, carica_da_righe, carica_matrici, elimina_celle, impacchetta, scrivi_celle, spacchetta,
+)
+from .matrix import MatriceDensa
+from .models import ElementType, MatriceCompatta, ValoreElementType
+from .views import ElementTypeViewSet
+
+
+class MatriceCompattaTest(TestCase):
+
+    def setUp(self):
+        self.scenario = Scenario.objects.create(descrizione="Scenario")
+        self.minacce = [Minaccia.objects.create(descrizione=f"M{i}", scenario=self.scenario) for i in range(3)]
+        self.database = ElementType.objects.create(nome="database")
+        self.schema = ElementType.objects.create(nome="schema")
+        self.controlli = [
+            Controllo.objects.create(
+                nome=f"C{j}", descrizione="", tipologia_controllo="Tecnologico",
+                categoria_controllo="preventive", elementtype=et,
+            )
+            for j, et in enumerate((self.database, self.database, self.schema))
+        ]
+        self.database.minacce.set(self.minacce)
+        self.schema.minacce.set(self.minacce)
+
+    def _valore(self, et, i, j, valore):
+        return ValoreElementType.objects.create(
+            elementtype=et, minaccia=self.minacce[i], controllo=self.controlli[j], valore=valore
+        )
+
+    def _allineata(self, et):
+        compatta = carica_matrici([et.pk]).get(et.pk)
+        righe = carica_da_righe([et.pk]).get(et.pk)
+        celle = lambda m: set(m.celle()) if m is not None else set()
+        self.assertEqual(celle(compatta), celle(righe))
+
+    def test_impacchettamento_reversibile(self):
+        matrice = MatriceDensa([3, 7], [10, 11, 12], np.array([[0.01, 0.0, 1.0], [0.57, 0.29, 0.0]]))
+        campi = impacchetta(matrice)
+        self.assertEqual(len(campi[2]), 6)
+        ricostruita = spacchetta(*campi)
+        self.assertEqual(list(ricostruita.celle()), list(matrice.celle()))
+
+    def test_segnale_su_singola_cella(self):
+        self._valore(self.database, 0, 0, 0.5)
+        self._valore(self.database, 2, 1, 0.25)
+        self.assertTrue(MatriceCompatta.objects.filter(elementtype=self.database).exists())
+        self._allineata(self.database)
+        valore = self._valore(self.database, 1, 0, 0.33)
+        valore.valore = 0.66
+        valore.save()
+        self._allineata(self.database)
+        self.assertEqual(carica_matrici([self.database.pk])[self.database.pk].get(self.minacce[1].pk, self.controlli[0].pk), 0.66)
+
+    def test_aggiornamento_puntuale_estende_righe_e_colonne(self):
+        self._valore(self.database, 0, 0, 0.5)
+        ValoreElementType.objects.bulk_create([ValoreElementType(
+            elementtype=self.database, minaccia=self.minacce[2], controllo=self.controlli[1], valore=0.75
+        )])
+        ValoreElementType.objects.filter(elementtype=self.database, minaccia=self.minacce[0]).delete()
+        aggiorna_celle({self.database.pk: {
+            (self.minacce[2].pk, self.controlli[1].pk): 0.75,
+            (self.minacce[0].pk, self.controlli[0].pk): 0.0,
+        }})
+        self._allineata(self.database)
+
+    def test_scrittura_ed_eliminazione_in_blocco(self):
+        self._valore(self.database, 0, 0, 0.5)
+        self._valore(self.schema, 1, 2, 0.4)
+        scrivi_celle({
+            self.database.pk: {(self.minacce[0].pk, self.controlli[0].pk): 0.8, (self.minacce[2].pk, self.controlli[1].pk): 0.3},
+            self.schema.pk: {(self.minacce[1].pk, self.controlli[2].pk): 0.0},
+        })
+        self.assertEqual(self.database.valori_matrice.count(), 2)
+        self.assertFalse(self.schema.valori_matrice.exists())
+        self._allineata(self.database)
+        self._allineata(self.schema)
+
+        eliminate = elimina_celle(ValoreElementType.objects.filter(minaccia=self.minacce[0]))
+        self.assertEqual(eliminate, 1)
+        self.assertEqual(
+            set(carica_matrici([self.database.pk])[self.database.pk].celle()),
+            {(self.minacce[2].pk, self.controlli[1].pk, 0.3)},
+        )
+        self._allineata(self.database)
+
+    def test_aggregazione_e_post_admin(self):
+        from .forms import applica_matrice_post
+        self._valore(self.database, 0, 0, 0.5)
+        self._valore(self.schema, 0, 2, 0.8)
+        derivato = ElementType.objects.create(nome="db", is_base=False)
+        derivato.component_element_types.set([self.database, self.schema])
+        ElementType.objects.aggregazione(derivato, [self.database, self.schema])
+        self._allineata(derivato)
+
+        modifiche, _ = applica_matrice_post(self.database, {
+            f'matrix-{self.minacce[1].pk}-{self.controlli[1].pk}': '0,4',
+            f'matrix-{self.minacce[0].pk}-{self.controlli[0].pk}': '',
+        })
+        self._allineata(self.database)
+        modifiche.propaga()
+        self._allineata(derivato)
+        ElementType.objects.aggregazione(derivato, [self.database, self.schema])
+        self._allineata(derivato)
+
+    def test_eliminazione_controllo_in_cascata(self):
+        self._valore(self.database, 0, 0, 0.5)
+        self._valore(self.database, 0, 1, 0.6)
+        self.controlli[0].delete()
+        self._allineata(self.database)
+
+    @override_settings(MATRICI_COMPATTE=False)
+    def test_disattivata_legge_le_righe(self):
+        self._valore(self.database, 0, 0, 0.5)
+        self.assertFalse(MatriceCompatta.objects.exists())
+        self.assertEqual(carica_matrici([self.database.pk])[self.database.pk].get(self.minacce[0].pk, self.controlli[0].pk), 0.5)
+
+    def test_endpoint_matrice(self):
+        self._valore(self.database, 0, 0, 0.5)
+        self._valore(self.database, 1, 1, 0.07)
+        vista = ElementTypeViewSet.as_view({'get': 'matrice'})
+        with self.assertNumQueries(1):  # ElementType e matrice compatta insieme
+            risposta = vista(RichiesteAutenticate().get('/'), pk=self.database.pk)
+        self.assertEqual(risposta.status_code, 200)
+        self.assertEqual(risposta.data, {
+            'minacce': [self.minacce[0].pk, self.minacce[1].pk],
+            'controlli': [self.controlli[0].pk, self.controlli[1].pk],
+            'valori': [[0.5, 0.0], [0.0, 0.07]],
+        })
+
+    def test_endpoint_matrice_coo_e_get_condizionale(self):
+        self._valore(self.database, 0, 0, 0.5)
+        self._valore(self.database, 1, 1, 0.07)
+        vista = ElementTypeViewSet.as_view({'get': 'matrice'})
+        risposta = vista(RichiesteAutenticate().get('/', {'formato': 'coo'}), pk=self.database.pk)
+        self.assertEqual(risposta.data, {
+            'minacce': [self.minacce[0].pk, self.minacce[1].pk],
+            'controlli': [self.controlli[0].pk, self.controlli[1].pk],
+            'righe': [0, 1], 'colonne': [0, 1], 'valori': [0.5, 0.07],
+        })
+
+        etag = vista(RichiesteAutenticate().get('/'), pk=self.database.pk)['ETag']
+        self.assertNotEqual(etag, risposta['ETag'])
+        with self.assertNumQueries(1):
+            risposta = vista(RichiesteAutenticate().get('/', HTTP_IF_NONE_MATCH=etag), pk=self.database.pk)
+        self.assertEqual(risposta.status_code, 304)
+        self._valore(self.database, 2, 0, 0.3)
+        risposta = vista(RichiesteAutenticate().get('/', HTTP_IF_NONE_MATCH=etag), pk=self.database.pk)
+        self.assertEqual(risposta.status_code, 200)
+        self.assertEqual(len(risposta.data['minacce']), 3)
+
+        self.assertEqual(vista(RichiesteAutenticate().get('/', {'formato': 'csv'}), pk=self.database.pk).status_code, 400)
+        self.assertEqual(vista(RichiesteAutenticate().get('/'), pk=0).status_code, 404)
+
+    @override_settings(MATRICI_COMPATTE=False)
+    def test_endpoint_matrice_senza_forma_compatta(self):
+        self._valore(self.database, 0, 0, 0.5)
+        vista = ElementTypeViewSet.as_view({'get': 'matrice'})
+        risposta = vista(RichiesteAutenticate().get('/'), pk=self.database.pk)
+        self.assertEqual(risposta.data['valori'], [[0.5]])
+        self.assertEqual(
+            vista(RichiesteAutenticate().get('/', HTTP_IF_NONE_MATCH=risposta['ETag']), pk=self.database.pk).status_code, 304
+        )
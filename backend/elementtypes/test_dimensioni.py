@@ -0,0 +1,98 @@
+from io import StringIO
+
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from assets.models import Asset, NodoStruttura
+from controlli.models import Controllo
+from minacce.models import Minaccia
+from scenari.models import Scenario
+from .models import ElementType, ValoreElementType
+
+
+class ContatoriDimensioneTest(TestCase):
+
+    def setUp(self):
+        scenario = Scenario.objects.create(descrizione="Scenario")
+        self.minacce = [Minaccia.objects.create(descrizione=f"M{i}", scenario=scenario) for i in range(3)]
+        self.database = ElementType.objects.create(nome="database")
+        self.schema = ElementType.objects.create(nome="schema")
+        self.database.minacce.set(self.minacce[:2])
+        self.schema.minacce.set(self.minacce[1:])
+        self.controlli = [
+            Controllo.objects.create(
+                nome=f"C{i}", descrizione="", tipologia_controllo="Tecnologico",
+                categoria_controllo="preventive", elementtype=et,
+            )
+            for i, et in enumerate((self.database, self.database, self.schema))
+        ]
+        self.db = ElementType.objects.create(nome="db", is_base=False)
+        self.db.component_element_types.set([self.database, self.schema])
+
+    def _dimensione(self, et):
+        et.refresh_from_db()
+        return et.num_minacce, et.num_controlli
+
+    def test_contatori_base_e_derivati(self):
+        self.assertEqual(self._dimensione(self.database), (2, 2))
+        self.assertEqual(self._dimensione(self.schema), (2, 1))
+        self.assertEqual(self._dimensione(self.db), (3, 3))
+        self.assertEqual(self.db.get_dimensione_matrice_display(), "3 x 3 (A)")
+
+    def test_modifiche_minacce_e_controlli(self):
+        self.schema.minacce.remove(self.minacce[2])
+        self.assertEqual(self._dimensione(self.db), (2, 3))
+        self.minacce[0].elementtype_set.clear()
+        self.assertEqual(self._dimensione(self.database), (1, 2))
+
+        controllo = self.controlli[0]
+        controllo.elementtype = self.schema
+        controllo.save()
+        self.assertEqual(self._dimensione(self.database), (1, 1))
+        self.assertEqual(self._dimensione(self.schema), (1, 2))
+        self.assertEqual(self._dimensione(self.db), (1, 3))
+
+        controllo.delete()
+        self.assertEqual(self._dimensione(self.schema), (1, 1))
+
+    def test_modifica_componenti(self):
+        self.db.component_element_types.remove(self.schema)
+        self.assertEqual(self._dimensione(self.db), (2, 2))
+        self.db.component_element_types.clear()
+        self.assertEqual(ElementType.objects.get(pk=self.db.pk).get_dimensione_matrice_display(), "N/D (derivato)")
+
+    def test_radice_aggregata(self):
+        ValoreElementType.objects.create(
+            elementtype=self.database, minaccia=self.minacce[0], controllo=self.controlli[0], valore=0.5
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            asset = Asset.objects.create(nome="Asset")
+            radice = asset.nodi_struttura.get(level=0)
+            NodoStruttura.objects.create(asset=asset, element_type=self.database, parent=radice)
+        asset = Asset.objects.select_related('matrice_aggregata').get(pk=asset.pk)
+        self.assertEqual((asset.matrice_aggregata.num_minacce, asset.matrice_aggregata.num_controlli), (1, 1))
+        self.assertEqual(radice.get_dimensione_matrice_display(), "1 x 1")
+
+    def test_comando_verifica(self):
+        ElementType.objects.filter(pk=self.db.pk).update(num_minacce=0)
+        with self.assertRaises(CommandError):
+            call_command('ricalcola_dimensioni', '--verifica', stdout=StringIO())
+        call_command('ricalcola_dimensioni', '--master', stdout=StringIO())
+        self.assertEqual(self._dimensione(self.db), (3, 3))
+        call_command('ricalcola_dimensioni', '--verifica', stdout=StringIO())
+
+    def test_changelist_senza_query_per_riga(self):
+        admin = User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.force_login(admin)
+        url = reverse('admin:elementtypes_elementtype_changelist')
+        with CaptureQueriesContext(connection) as prima:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        for i in range(5):
+            ElementType.objects.create(nome=f"extra {i}", is_base=i % 2 == 0)
+        with CaptureQueriesContext(connection) as dopo:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(len(prima), len(dopo))
@@ -0,0 +1,91 @@
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from controlli.models import Controllo
+from minacce.models import Minaccia
+from scenari.models import Scenario
+from .forms import applica_matrice_post
+from .models import ElementType, ValoreElementType
+
+
+class ApplicaMatricePostTest(TestCase):
+
+    def setUp(self):
+        scenario = Scenario.objects.create(descrizione="Scenario")
+        self.et = ElementType.objects.create(nome="database")
+        self.minacce = [Minaccia.objects.create(descrizione=f"M{i}", scenario=scenario) for i in range(6)]
+        self.et.minacce.set(self.minacce)
+        self.controlli = [
+            Controllo.objects.create(
+                nome=f"C{j}", descrizione="", tipologia_controllo="Tecnologico",
+                categoria_controllo="preventive", elementtype=self.et,
+            )
+            for j in range(6)
+        ]
+
+    def _campo(self, i, j):
+        return f'matrix-{self.minacce[i].pk}-{self.controlli[j].pk}'
+
+    def _valore(self, i, j, valore):
+        ValoreElementType.objects.create(
+            elementtype=self.et, minaccia=self.minacce[i], controllo=self.controlli[j], valore=valore
+        )
+
+    def _matrice(self):
+        return {
+            (m, c): v for m, c, v in
+            ValoreElementType.objects.filter(elementtype=self.et).values_list('minaccia_id', 'controllo_id', 'valore')
+        }
+
+    def test_diff_creazione_aggiornamento_cancellazione(self):
+        self._valore(0, 0, 0.5)
+        self._valore(0, 1, 0.5)
+        self._valore(0, 2, 0.5)
+        self._valore(0, 3, 0.5)
+        modifiche, errori = applica_matrice_post(self.et, {
+            self._campo(0, 0): '0,75',  # aggiornamento (virgola decimale)
+            self._campo(0, 1): '0.5',   # invariato
+            self._campo(0, 2): '',      # cancellazione
+            self._campo(0, 3): '0',     # cancellazione
+            self._campo(1, 0): '1',     # creazione
+            self._campo(1, 1): '',      # cella vuota senza valore: nessuna modifica
+        })
+        self.assertEqual(errori, [])
+        self.assertEqual(len(modifiche), 4)
+        self.assertEqual(self._matrice(), {
+            (self.minacce[0].pk, self.controlli[0].pk): 0.75,
+            (self.minacce[0].pk, self.controlli[1].pk): 0.5,
+            (self.minacce[1].pk, self.controlli[0].pk): 1.0,
+        })
+
+    def test_errori_per_cella_non_salvate(self):
+        self._valore(0, 0, 0.5)
+        _, errori = applica_matrice_post(self.et, {
+            self._campo(0, 0): '1.5',
+            self._campo(0, 1): '0.123',
+            self._campo(0, 2): 'abc',
+            self._campo(0, 3): '-0.2',
+        })
+        self.assertEqual(len(errori), 4)
+        self.assertIn("compreso tra 0.01 e 1", errori[0])
+        self.assertIn("al massimo due cifre decimali", errori[1])
+        self.assertIn("Valore non numerico 'abc' per la cella (M0, C2)", errori[2])
+        self.assertIn("compreso tra 0.01 e 1", errori[3])
+        self.assertEqual(self._matrice(), {(self.minacce[0].pk, self.controlli[0].pk): 0.5})
+
+    def test_numero_query_indipendente_dalle_celle(self):
+        for i in range(6):
+            self._valore(i, 0, 0.5)
+            self._valore(i, 1, 0.5)
+        dati = {}
+        for i in range(6):
+            dati[self._campo(i, 0)] = '0.9'
+            dati[self._campo(i, 1)] = ''
+            for j in range(2, 6):
+                dati[self._campo(i, j)] = '0.3'
+        with CaptureQueriesContext(connection) as query:
+            modifiche, errori = applica_matrice_post(self.et, dati)
+        self.assertEqual(errori, [])
+        self.assertEqual(len(modifiche), 36)
+        self.assertLessEqual(len([q for q in query.captured_queries if 'SAVEPOINT' not in q['sql']]), 9)
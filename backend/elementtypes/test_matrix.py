@@ -0,0 +1,132 @@
+from datetime import date
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from campagne.models import Campagna
+from controlli.models import Controllo
+from minacce.models import Minaccia
+from scenari.models import Scenario
+from .models import ElementType, ValoreElementType
+
+
+class AggregazioneMatriceTest(TestCase):
+
+    def setUp(self):
+        self.campagna = Campagna.objects.create(
+            anno=2025, descrizione="Campagna test", data_inizio=date(2025, 1, 1), data_fine=date(2025, 12, 31)
+        )
+        scenario = Scenario.objects.create(descrizione="Scenario", campagna=self.campagna)
+        self.minacce = [
+            Minaccia.objects.create(descrizione=f"Minaccia {i}", scenario=scenario, campagna=self.campagna)
+            for i in range(4)
+        ]
+        self.database = ElementType.objects.create(nome="database", campagna=self.campagna)
+        self.schema = ElementType.objects.create(nome="schema", campagna=self.campagna)
+        self.server = ElementType.objects.create(nome="server", campagna=self.campagna)
+        self.controlli = {}
+        for et in (self.database, self.schema, self.server):
+            self.controlli[et.pk] = [
+                Controllo.objects.create(
+                    nome=f"{et.nome} C{j}", descrizione="", tipologia_controllo="Tecnologico",
+                    categoria_controllo="preventive", elementtype=et, campagna=self.campagna,
+                )
+                for j in range(3)
+            ]
+
+        self.database.minacce.set(self.minacce[:3])
+        self.schema.minacce.set(self.minacce[1:])
+        self.server.minacce.set(self.minacce[:2])
+
+        # Celle sovrapposte tra database e schema (stesso controllo di database) per verificare il MAX
+        self._valore(self.database, self.minacce[1], self.controlli[self.database.pk][0], 0.3)
+        self._valore(self.schema, self.minacce[1], self.controlli[self.database.pk][0], 0.7)
+        self._valore(self.database, self.minacce[0], self.controlli[self.database.pk][1], 0.5)
+        self._valore(self.schema, self.minacce[3], self.controlli[self.schema.pk][2], 0.9)
+        self._valore(self.server, self.minacce[0], self.controlli[self.server.pk][0], 0.4)
+
+        self.db = ElementType.objects.create(nome="db", campagna=self.campagna, is_base=False)
+        self.db.component_element_types.set([self.database, self.schema])
+        self.backend = ElementType.objects.create(nome="backend", campagna=self.campagna, is_base=False)
+        self.backend.component_element_types.set([self.db, self.server])
+
+    def _valore(self, et, minaccia, controllo, valore):
+        ValoreElementType.objects.create(elementtype=et, minaccia=minaccia, controllo=controllo, valore=valore)
+
+    def _matrice_attesa(self, parent, children):
+        """Calcolo di riferimento cella per cella tramite get_valore_matrice."""
+        attesa = {}
+        for minaccia in parent.get_all_minacce():
+            for controllo in parent.get_all_controlli():
+                valore = max(child.get_valore_matrice(minaccia, controllo) for child in children)
+                if valore > 0:
+                    attesa[(minaccia.pk, controllo.pk)] = valore
+        return attesa
+
+    def _matrice_salvata(self, et):
+        return {(v.minaccia_id, v.controllo_id): v.valore for v in et.valori_matrice.all()}
+
+    def test_aggregazione_uguale_al_calcolo_ricorsivo(self):
+        ElementType.objects.aggregazione(self.db, [self.database, self.schema])
+        self.assertEqual(self._matrice_salvata(self.db), self._matrice_attesa(self.db, [self.database, self.schema]))
+        self.assertEqual(self._matrice_salvata(self.db)[(self.minacce[1].pk, self.controlli[self.database.pk][0].pk)], 0.7)
+        self.assertEqual(set(self.db.minacce.values_list('pk', flat=True)), {m.pk for m in self.minacce})
+
+    def test_aggregazione_derivato_di_derivato(self):
+        children = [self.db, self.server]
+        ElementType.objects.aggregazione(self.backend, children)
+        self.assertEqual(self._matrice_salvata(self.backend), self._matrice_attesa(self.backend, children))
+        self.assertEqual(len(self._matrice_salvata(self.backend)), 4)
+
+    def test_aggregazione_sostituisce_la_matrice_precedente(self):
+        minaccia, controllo = self.minacce[2], self.controlli[self.server.pk][2]
+        self._valore(self.db, minaccia, controllo, 1.0)
+        ElementType.objects.aggregazione(self.db, [self.database, self.schema])
+        self.assertNotIn((minaccia.pk, controllo.pk), self._matrice_salvata(self.db))
+
+    def test_numero_query_indipendente_dalla_dimensione(self):
+        with CaptureQueriesContext(connection) as piccola:
+            ElementType.objects.aggregazione(self.backend, [self.db, self.server])
+
+        nuove_minacce = [
+            Minaccia.objects.create(descrizione=f"Extra {i}", scenario=self.minacce[0].scenario, campagna=self.campagna)
+            for i in range(20)
+        ]
+        self.server.minacce.add(*nuove_minacce)
+        for minaccia in nuove_minacce:
+            for controllo in self.controlli[self.server.pk]:
+                self._valore(self.server, minaccia, controllo, 0.6)
+
+        with CaptureQueriesContext(connection) as grande:
+            ElementType.objects.aggregazione(self.backend, [self.db, self.server])
+        self.assertEqual(len(self._matrice_salvata(self.backend)), 4 + 60)
+        self.assertLessEqual(len(grande.captured_queries), len(piccola.captured_queries) + 2)
+
+    def test_pagina_derivato_con_numero_query_costante(self):
+        admin = User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.force_login(admin)
+        ElementType.objects.aggregazione(self.backend, [self.db, self.server])
+        url = reverse('admin:elementtypes_elementtype_change', args=[self.backend.pk])
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as piccola:
+            risposta = self.client.get(url)
+        self.assertEqual(len(risposta.context['aggregated_matrix_data']), 4)
+        self.assertIn('0,7', risposta.context['aggregated_matrix_data'][1][2])
+
+        nuove_minacce = [
+            Minaccia.objects.create(descrizione=f"Extra {i}", scenario=self.minacce[0].scenario, campagna=self.campagna)
+            for i in range(20)
+        ]
+        self.server.minacce.add(*nuove_minacce)
+        for minaccia in nuove_minacce:
+            for controllo in self.controlli[self.server.pk]:
+                self._valore(self.server, minaccia, controllo, 0.6)
+        ElementType.objects.aggregazione(self.backend, [self.db, self.server])
+
+        with CaptureQueriesContext(connection) as grande:
+            risposta = self.client.get(url)
+        self.assertEqual(len(risposta.context['aggregated_matrix_data']), 24)
+        self.assertEqual(len(grande.captured_queries), len(piccola.captured_queries))
@@ -0,0 +1,93 @@
+from django.test import TestCase, override_settings
+
+from assets.models import Asset, NodoStruttura
+from controlli.models import Controllo
+from minacce.models import Minaccia
+from scenari.models import Scenario
+from . import memo
+from .models import ElementType, MatriceCompatta, ValoreElementType
+
+
+class MemoAggregazioneTest(TestCase):
+
+    def setUp(self):
+        scenario = Scenario.objects.create(descrizione="Scenario")
+        self.minacce = [Minaccia.objects.create(descrizione=f"M{i}", scenario=scenario) for i in range(2)]
+        self.database = ElementType.objects.create(nome="database")
+        self.schema = ElementType.objects.create(nome="schema")
+        self.controlli = {}
+        for et in (self.database, self.schema):
+            et.minacce.set(self.minacce)
+            self.controlli[et.nome] = Controllo.objects.create(
+                nome=f"{et.nome} C", descrizione="", tipologia_controllo="Tecnologico",
+                categoria_controllo="preventive", elementtype=et,
+            )
+        self.valore_database = ValoreElementType.objects.create(
+            elementtype=self.database, minaccia=self.minacce[0], controllo=self.controlli['database'], valore=0.5
+        )
+        ValoreElementType.objects.create(
+            elementtype=self.schema, minaccia=self.minacce[1], controllo=self.controlli['schema'], valore=0.3
+        )
+        self.db = ElementType.objects.create(nome="db", is_base=False)
+        self.db.component_element_types.set([self.database, self.schema])
+        ElementType.objects.aggregazione(self.db, [self.database, self.schema])
+        memo.azzera()
+
+    def _aggrega(self):
+        with memo.misura() as delta:
+            matrice = ElementType.objects.aggregazione(self.db, [self.database, self.schema])
+        return matrice, delta
+
+    def test_input_invariati_saltano_il_ricalcolo(self):
+        prima = MatriceCompatta.objects.get(elementtype=self.db).aggiornata_il
+        matrice, delta = self._aggrega()
+        self.assertEqual(delta, {'aggregazione.hit': 1})
+        self.assertEqual(matrice.get(self.minacce[0].pk, self.controlli['database'].pk), 0.5)
+        self.assertEqual(MatriceCompatta.objects.get(elementtype=self.db).aggiornata_il, prima)
+
+    def test_componente_modificato_ricalcola(self):
+        self.valore_database.valore = 0.9
+        self.valore_database.save()
+        matrice, delta = self._aggrega()
+        self.assertEqual(delta, {'aggregazione.miss': 1})
+        self.assertEqual(matrice.get(self.minacce[0].pk, self.controlli['database'].pk), 0.9)
+        self.assertEqual(
+            self.db.valori_matrice.get(minaccia=self.minacce[0], controllo=self.controlli['database']).valore, 0.9
+        )
+        self.assertEqual(self._aggrega()[1], {'aggregazione.hit': 1})
+
+    def test_risultato_invariato_non_riscrive(self):
+        # La propagazione aggiorna già la matrice derivata: il ricalcolo trova lo stesso risultato
+        MatriceCompatta.objects.filter(elementtype=self.db).update(impronta_input='')
+        ids_prima = set(self.db.valori_matrice.values_list('pk', flat=True))
+        _, delta = self._aggrega()
+        self.assertEqual(delta, {'aggregazione.miss': 1, 'aggregazione.scrittura_evitata': 1})
+        self.assertEqual(set(self.db.valori_matrice.values_list('pk', flat=True)), ids_prima)
+        self.assertEqual(self._aggrega()[1], {'aggregazione.hit': 1})
+
+    def test_radice_con_nodi_invariati(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            asset = Asset.objects.create(nome="Asset")
+        radice = asset.nodi_struttura.get(level=0)
+        with memo.misura() as delta, self.captureOnCommitCallbacks(execute=True):
+            nodo_db = NodoStruttura.objects.create(asset=asset, element_type=self.db, parent=radice)
+        # Il nodo derivato crea in blocco i nodi dei componenti: una sola aggregazione
+        self.assertEqual(delta, {'radice.differita': 1, 'radice.miss': 1})
+        valori = {(m, c): v for m, c, v in asset.get_matrice().celle()}
+        self.assertEqual(valori, {
+            (self.minacce[0].pk, self.controlli['database'].pk): 0.5,
+            (self.minacce[1].pk, self.controlli['schema'].pk): 0.3,
+        })
+
+        with memo.misura() as delta, self.captureOnCommitCallbacks(execute=True):
+            NodoStruttura.objects.create(asset=asset, element_type=self.database, parent=radice)
+        self.assertEqual(delta, {'radice.differita': 1, 'radice.miss': 1, 'radice.scrittura_evitata': 1})
+        with memo.misura() as delta, self.captureOnCommitCallbacks(execute=True):
+            nodo_db.nome_specifico = "db principale"
+            nodo_db.save()
+        self.assertEqual(delta, {'radice.differita': 1, 'radice.hit': 1})
+
+    @override_settings(MATRICI_COMPATTE=False)
+    def test_disattivata_ricalcola_sempre(self):
+        self._aggrega()
+        self.assertEqual(memo.contatori(), {})
@@ -0,0 +1,129 @@
+from django.test import TestCase
+
+from assets.models import Asset, MatriceAsset, NodoStruttura
+from controlli.models import Controllo
+from core.testing import RichiesteAutenticate
+from minacce.models import Minaccia
+from scenari.models import Scenario
+from .compatta import sincronizza
+from .models import ElementType, ValoreElementType
+from .propagation import ModificheMatrice
+from .views import ValoreElementTypeViewSet
+
+
+class PropagazioneModificheTest(TestCase):
+
+    def setUp(self):
+        scenario = Scenario.objects.create(descrizione="Scenario")
+        self.minacce = [Minaccia.objects.create(descrizione=f"M{i}", scenario=scenario) for i in range(3)]
+        self.database = ElementType.objects.create(nome="database")
+        self.schema = ElementType.objects.create(nome="schema")
+        self.server = ElementType.objects.create(nome="server")
+        self.controlli = {}
+        for et in (self.database, self.schema, self.server):
+            et.minacce.set(self.minacce)
+            self.controlli[et.nome] = [
+                Controllo.objects.create(
+                    nome=f"{et.nome} C{j}", descrizione="", tipologia_controllo="Tecnologico",
+                    categoria_controllo="preventive", elementtype=et,
+                )
+                for j in range(2)
+            ]
+        self.cella = (self.minacce[0], self.controlli['database'][0])
+        self._valore(self.database, *self.cella, 0.5)
+        self._valore(self.schema, *self.cella, 0.3)
+        self._valore(self.schema, self.minacce[1], self.controlli['schema'][1], 0.6)
+        self._valore(self.server, self.minacce[2], self.controlli['server'][0], 0.4)
+
+        self.db = ElementType.objects.create(nome="db", is_base=False)
+        self.db.component_element_types.set([self.database, self.schema])
+        ElementType.objects.aggregazione(self.db, [self.database, self.schema])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.asset = Asset.objects.create(nome="Asset")
+            self.radice = self.asset.nodi_struttura.get(level=0)
+            NodoStruttura.objects.create(asset=self.asset, element_type=self.db, parent=self.radice)
+            NodoStruttura.objects.create(asset=self.asset, element_type=self.server, parent=self.radice)
+        self.radice.refresh_from_db()
+
+    def _valore(self, et, minaccia, controllo, valore):
+        ValoreElementType.objects.create(elementtype=et, minaccia=minaccia, controllo=controllo, valore=valore)
+
+    def _matrice(self, et):
+        return {(v.minaccia_id, v.controllo_id): v.valore for v in et.valori_matrice.all()}
+
+    def _matrice_asset(self):
+        return {(m, c): v for m, c, v in self.asset.get_matrice().celle()}
+
+    def _verifica_come_ricalcolo_completo(self):
+        propagata_db = self._matrice(self.db)
+        propagata_radice = self._matrice_asset()
+        ElementType.objects.aggregazione(self.db, [self.database, self.schema])
+        MatriceAsset.objects.filter(asset=self.asset).delete()
+        self.radice.aggregate_root_node_matrix()
+        self.assertEqual(propagata_db, self._matrice(self.db))
+        self.assertEqual(propagata_radice, self._matrice_asset())
+        return propagata_db, propagata_radice
+
+    def test_aumento_valore_propagato(self):
+        ValoreElementType.objects.filter(elementtype=self.database).update(valore=0.95)
+        sincronizza([self.database.pk])
+        modifiche = ModificheMatrice()
+        modifiche.registra(self.database.pk, self.cella[0].pk, self.cella[1].pk)
+        statistiche = modifiche.propaga()
+
+        self.assertEqual(statistiche['derivati'], 1)
+        self.assertEqual(statistiche['radici'], 1)
+        chiave = (self.cella[0].pk, self.cella[1].pk)
+        self.assertEqual(self._matrice(self.db)[chiave], 0.95)
+        self.assertEqual(self._matrice_asset()[chiave], 0.95)
+        self._verifica_come_ricalcolo_completo()
+
+    def test_cancellazione_cella_ricade_sugli_altri_componenti(self):
+        ValoreElementType.objects.filter(elementtype=self.database).delete()
+        ValoreElementType.objects.filter(elementtype=self.schema, minaccia=self.minacce[1]).delete()
+        sincronizza([self.database.pk, self.schema.pk])
+        modifiche = ModificheMatrice()
+        modifiche.registra(self.database.pk, self.cella[0].pk, self.cella[1].pk)
+        modifiche.registra(self.schema.pk, self.minacce[1].pk, self.controlli['schema'][1].pk)
+        modifiche.propaga()
+
+        propagata_db, _ = self._verifica_come_ricalcolo_completo()
+        self.assertEqual(propagata_db, {(self.cella[0].pk, self.cella[1].pk): 0.3})
+
+    def test_nuova_cella_su_componente_diretto_della_radice(self):
+        self._valore(self.server, self.minacce[1], self.controlli['server'][1], 0.8)
+        modifiche = ModificheMatrice()
+        modifiche.registra(self.server.pk, self.minacce[1].pk, self.controlli['server'][1].pk)
+        statistiche = modifiche.propaga()
+
+        self.assertEqual(statistiche, {'derivati': 0, 'radici': 1, 'celle': 1})
+        self._verifica_come_ricalcolo_completo()
+
+    def test_modifiche_dall_api_propagate(self):
+        chiave = (self.cella[0].pk, self.cella[1].pk)
+        cella = self.database.valori_matrice.get(minaccia=self.cella[0], controllo=self.cella[1])
+        modifica = ValoreElementTypeViewSet.as_view({'patch': 'partial_update'})
+        risposta = modifica(RichiesteAutenticate().patch('/', {'valore': 0.95}, format='json'), pk=cella.pk)
+        self.assertEqual(risposta.status_code, 200)
+        self.assertEqual(self._matrice(self.db)[chiave], 0.95)
+        self.assertEqual(self._matrice_asset()[chiave], 0.95)
+
+        elimina = ValoreElementTypeViewSet.as_view({'delete': 'destroy'})
+        self.assertEqual(elimina(RichiesteAutenticate().delete('/'), pk=cella.pk).status_code, 204)
+        propagata_db, _ = self._verifica_come_ricalcolo_completo()
+        self.assertEqual(propagata_db[chiave], 0.3)
+
+    def test_numero_query_costante(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            for i in range(5):
+                altro = Asset.objects.create(nome=f"Altro {i}")
+                NodoStruttura.objects.create(asset=altro, element_type=self.db, parent=altro.nodi_struttura.get(level=0))
+        ValoreElementType.objects.filter(elementtype=self.database).update(valore=0.9)
+        sincronizza([self.database.pk])
+        modifiche = ModificheMatrice()
+        modifiche.registra(self.database.pk, self.cella[0].pk, self.cella[1].pk)
+        # Le matrici dei 6 asset si leggono e riscrivono con una query ciascuna (più la versione della matrice)
+        with self.assertNumQueries(12):
+            statistiche = modifiche.propaga()
+        self.assertEqual(statistiche['radici'], 6)
@@ -0,0 +1,121 @@
+from datetime import date
+from io import StringIO
+
+from django.core.management import CommandError, call_command
+from django.test import TestCase
+
+from assets.models import Asset, MatriceAsset, NodoStruttura
+from campagne.models import Campagna
+from controlli.models import Controllo
+from minacce.models import Minaccia
+from scenari.models import Scenario
+from .compatta import carica_da_righe, carica_matrici
+from .models import ElementType, MatriceCompatta, ValoreElementType
+from .ricalcolo import CampagnaChiusa, CicloDerivazione, Ricalcolo, livelli_derivazione
+
+
+class RicalcoloMatriciTest(TestCase):
+
+    def setUp(self):
+        scenario = Scenario.objects.create(descrizione="Scenario")
+        self.minacce = [Minaccia.objects.create(descrizione=f"M{i}", scenario=scenario) for i in range(3)]
+        self.basi = [ElementType.objects.create(nome=f"base {k}") for k in range(3)]
+        for k, base in enumerate(self.basi):
+            base.minacce.set(self.minacce[k:k + 2])
+            controllo = Controllo.objects.create(
+                nome=f"C{k}", descrizione="", tipologia_controllo="Tecnologico",
+                categoria_controllo="preventive", elementtype=base,
+            )
+            for minaccia in self.minacce[k:k + 2]:
+                ValoreElementType.objects.create(
+                    elementtype=base, minaccia=minaccia, controllo=controllo, valore=0.1 * (k + 1)
+                )
+        # db = base 0 + base 1; piattaforma = db + base 2 (due livelli di derivati)
+        self.db = ElementType.objects.create(nome="db", is_base=False)
+        self.db.component_element_types.set(self.basi[:2])
+        ElementType.objects.aggregazione(self.db, self.basi[:2])
+        self.piattaforma = ElementType.objects.create(nome="piattaforma", is_base=False)
+        self.piattaforma.component_element_types.set([self.db, self.basi[2]])
+        ElementType.objects.aggregazione(self.piattaforma, [self.db, self.basi[2]])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.asset = Asset.objects.create(nome="Asset")
+            self.radice = self.asset.nodi_struttura.get(level=0)
+            NodoStruttura.objects.create(asset=self.asset, element_type=self.piattaforma, parent=self.radice)
+        self.attese = self._matrici()
+
+    def _matrici(self):
+        matrici = {et_id: sorted(matrice.celle()) for et_id, matrice in carica_da_righe([self.db.pk, self.piattaforma.pk]).items()}
+        matrici['asset'] = sorted(self.asset.get_matrice().celle())
+        return matrici
+
+    def _corrompi(self):
+        """Simula un import massivo che lascia matrici derivate e dell'asset non aggiornate."""
+        ids = [self.db.pk, self.piattaforma.pk]
+        ValoreElementType.objects.filter(elementtype_id__in=ids).update(valore=0.99)
+        MatriceCompatta.objects.filter(elementtype_id__in=ids).delete()
+        MatriceAsset.objects.filter(asset=self.asset).delete()
+
+    def _esegui(self, *argomenti):
+        output = StringIO()
+        call_command('ricalcola_matrici', '--master', *argomenti, stdout=output)
+        return output.getvalue()
+
+    def test_livelli_topologici(self):
+        componenti = {self.db.pk: {b.pk for b in self.basi[:2]}, self.piattaforma.pk: {self.db.pk, self.basi[2].pk}}
+        self.assertEqual(
+            livelli_derivazione([self.db.pk, self.piattaforma.pk], componenti),
+            [[self.db.pk], [self.piattaforma.pk]],
+        )
+        with self.assertRaises(CicloDerivazione):
+            livelli_derivazione([1, 2], {1: {2}, 2: {1}})
+
+    def test_ricostruisce_derivati_e_radici(self):
+        self._corrompi()
+        output = self._esegui('--processi', '1')
+        self.assertIn("Livello 3/3 (radici)", output)
+        self.assertEqual(self._matrici(), self.attese)
+        compatte = carica_matrici([self.piattaforma.pk])
+        self.assertEqual(sorted(compatte[self.piattaforma.pk].celle()), self.attese[self.piattaforma.pk])
+
+    def test_pool_di_processi(self):
+        self._corrompi()
+        self._esegui('--processi', '2', '--batch-size', '1')
+        self.assertEqual(self._matrici(), self.attese)
+
+    def test_rieseguibile(self):
+        self._esegui('--processi', '1')
+        esiti = Ricalcolo(processi=1).esegui()
+        self.assertEqual([(e.matrici, e.saltate, e.scritte) for e in esiti], [(1, 1, 0), (1, 1, 0), (1, 1, 0)])
+        self.assertEqual(self._matrici(), self.attese)
+        # Le singole aggregazioni riconoscono gli input registrati dal comando
+        ids_prima = set(self.piattaforma.valori_matrice.values_list('pk', flat=True))
+        ElementType.objects.aggregazione(self.piattaforma, [self.db, self.basi[2]])
+        self.assertEqual(set(self.piattaforma.valori_matrice.values_list('pk', flat=True)), ids_prima)
+
+    def _campagna_sovrapposta(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Campagna.objects.create(
+                anno=2030, descrizione="Campagna", data_inizio=date(2030, 1, 1), data_fine=date(2030, 12, 31),
+                copia_su_scrittura=True,
+            )
+
+    def test_campagna_a_copia_su_scrittura_legge_le_righe_master(self):
+        campagna = self._campagna_sovrapposta()
+        self._corrompi()
+        esiti = Ricalcolo(campagna.pk, processi=1).esegui()
+        self.assertEqual([e.matrici for e in esiti], [1, 1, 1])
+        self.assertEqual(self._matrici(), self.attese)
+
+    def test_campagna_chiusa_rifiutata(self):
+        campagna = self._campagna_sovrapposta()
+        campagna.status = 'close'
+        campagna.save()
+        self._corrompi()
+        with self.assertRaises(CampagnaChiusa):
+            Ricalcolo(campagna.pk, processi=1).esegui()
+        with self.assertRaisesMessage(CommandError, "è chiusa"):
+            call_command('ricalcola_matrici', '--campagna', str(campagna.pk), stdout=StringIO())
+        self.assertEqual(
+            set(ValoreElementType.objects.filter(elementtype=self.db).values_list('valore', flat=True)), {0.99}
+        )
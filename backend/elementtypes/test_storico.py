@@ -0,0 +1,62 @@
+from django.test import TestCase
+from django.utils import timezone
+
+from controlli.models import Controllo
+from core.testing import RichiesteAutenticate
+from minacce.models import Minaccia
+from scenari.models import Scenario
+from .compatta import aggiorna_celle, sincronizza
+from .models import ElementType, ValoreElementType, VersioneMatrice
+from .storico import matrice_al, matrici_al
+from .views import ElementTypeViewSet
+
+
+class MatriceAllaDataTest(TestCase):
+
+    def setUp(self):
+        scenario = Scenario.objects.create(descrizione="Scenario")
+        self.minacce = [Minaccia.objects.create(descrizione=f"M{i}", scenario=scenario) for i in range(2)]
+        self.database = ElementType.objects.create(nome="database")
+        self.database.minacce.set(self.minacce)
+        self.controllo = Controllo.objects.create(
+            nome="C", descrizione="", tipologia_controllo="Tecnologico",
+            categoria_controllo="preventive", elementtype=self.database,
+        )
+
+    def _celle(self, matrice):
+        return set(matrice.celle())
+
+    def test_versioni_alla_data(self):
+        prima = timezone.now()
+        valore = ValoreElementType.objects.create(
+            elementtype=self.database, minaccia=self.minacce[0], controllo=self.controllo, valore=0.5
+        )
+        creata = timezone.now()
+        valore.valore = 0.75
+        valore.save()
+        modificata = timezone.now()
+        # Una riscrittura senza cambiamenti non aggiunge versioni
+        sincronizza([self.database.pk])
+        self.assertEqual(VersioneMatrice.objects.filter(elementtype_id=self.database.pk).count(), 2)
+        valore.delete()
+        aggiorna_celle({self.database.pk: {(self.minacce[0].pk, self.controllo.pk): 0.0}})
+
+        m0, c = self.minacce[0].pk, self.controllo.pk
+        self.assertEqual(matrici_al([self.database.pk], prima), {})
+        self.assertEqual(self._celle(matrice_al(self.database.pk, creata)), {(m0, c, 0.5)})
+        self.assertEqual(self._celle(matrice_al(self.database.pk, modificata)), {(m0, c, 0.75)})
+        self.assertEqual(self._celle(matrice_al(self.database.pk, timezone.now())), set())
+
+    def test_endpoint_matrice_al(self):
+        valore = ValoreElementType.objects.create(
+            elementtype=self.database, minaccia=self.minacce[1], controllo=self.controllo, valore=0.3
+        )
+        quando = timezone.now()
+        valore.valore = 0.9
+        valore.save()
+        vista = ElementTypeViewSet.as_view({'get': 'matrice'})
+        with self.assertNumQueries(2):  # ElementType, versione della matrice
+            risposta = vista(RichiesteAutenticate().get('/', {'al': quando.isoformat()}), pk=self.database.pk)
+        self.assertEqual(risposta.data, {
+            'minacce': [self.minacce[1].pk], 'controlli': [self.controllo.pk], 'valori': [[0.3]],
+        })
@@ -1,13 +1,104 @@
+from django.db import transaction
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
 from rest_framework import viewsets
+from rest_framework.generics import get_object_or_404
+from rest_framework.decorators import action
+from rest_framework.response import Response
+from campagne.istantanea import leggi
+from campagne.models import VoceIstantanea
+from core.api import ApiMixin, CampagnaNonPronta
+from core.views import parametro_al
+from .compatta import carica_da_righe, elimina_celle, impacchetta, impronta, scrivi_celle, spacchetta
+from .dimensioni import aggiorna_dimensioni
+from .matrix import MatriceDensa
 from .models import ElementType, ValoreElementType
-from .serializers import ElementTypeSerializer, ValoreElementTypeSerializer
+from .propagation import ModificheMatrice
+from .serializers import (
+    ElementTypeSerializer, ValoreElementTypeSerializer, con_dimensioni, formato_richiesto, matrice_serializzata,
+)
+from .storico import matrice_al
 
-class ElementTypeViewSet(viewsets.ModelViewSet):
+class ElementTypeViewSet(ApiMixin, viewsets.ModelViewSet):
     queryset = ElementType.objects.all()
     serializer_class = ElementTypeSerializer
-    filterset_fields = ['campagna', 'is_base', 'is_enabled']
+    prefetch_related_per_azione = {azione: ('minacce', 'component_element_types') for azione in ('list', 'retrieve')}
 
-class ValoreElementTypeViewSet(viewsets.ModelViewSet):
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        return con_dimensioni(queryset) if self.action in ('list', 'retrieve') else queryset
+
+    @action(detail=True, methods=['get'])
+    def matrice(self, request, pk=None, **kwargs):
+        """
+        Matrice densa dell'ElementType: id di righe e colonne e valori riga per riga, oppure con
+        `?formato=coo` le sole celle valorizzate (vedi `matrice_serializzata`). L'ElementType e la
+        sua forma compatta si leggono con una sola query; l'impronta della matrice fa da ETag, quindi
+        una richiesta con If-None-Match di una matrice invariata riceve 304. Senza forma compatta
+        la matrice viene dall'istantanea (campagne chiuse) o dalle righe. Con `?al=<data>` la
+        matrice in vigore a quella data, dalle versioni registrate (`storico.matrici_al`), senza ETag.
+        """
+        formato = formato_richiesto(request)
+        quando = parametro_al(request)
+        if quando is not None:
+            return Response(matrice_serializzata(matrice_al(self.get_object().pk, quando), formato))
+        et_id, campagna_id, pronta, *campi, impronta_salvata = get_object_or_404(
+            self.filter_queryset(self.get_queryset()).values_list(
+                'pk', 'campagna_id', 'campagna__pronta', 'matrice_compatta__minacce_ids', 'matrice_compatta__controlli_ids',
+                'matrice_compatta__valori', 'matrice_compatta__impronta',
+            ),
+            pk=pk,
+        )
+        if pronta is False:
+            raise CampagnaNonPronta()
+        matrice = None
+        if impronta_salvata is None:
+            voce = leggi(VoceIstantanea.ELEMENTTYPE, ElementType(pk=et_id, campagna_id=campagna_id),
+                         getattr(self.campagna_richiesta, 'pk', None))
+            matrice = voce.matrice() if voce is not None else (
+                carica_da_righe([et_id]).get(et_id) or MatriceDensa([], []))
+            impronta_salvata = impronta(impacchetta(matrice))
+        etag = quote_etag(f"elementtype-{et_id}-{formato}-{impronta_salvata}")
+        non_modificato = get_conditional_response(request, etag=etag)
+        if non_modificato is not None:
+            return non_modificato
+        risposta = Response(matrice_serializzata(matrice or spacchetta(*campi), formato))
+        risposta['ETag'] = etag
+        return risposta
+
+class ValoreElementTypeViewSet(ApiMixin, viewsets.ModelViewSet):
     queryset = ValoreElementType.objects.all()
     serializer_class = ValoreElementTypeSerializer
-    filterset_fields = ['elementtype', 'minaccia', 'controllo']
\ No newline at end of file
+    campo_proprietario = 'elementtype'
+    select_related_per_azione = {'destroy': ('elementtype',)}
+
+    # Come la modifica della matrice dall'admin, ogni scrittura si propaga ai derivati e alle radici degli asset
+    def perform_create(self, serializer):
+        with transaction.atomic():
+            istanza = serializer.save()
+            self._propaga([(istanza.elementtype_id, istanza.minaccia_id, istanza.controllo_id)])
+
+    def perform_update(self, serializer):
+        precedente = serializer.instance
+        et_id, cella = precedente.elementtype_id, (precedente.minaccia_id, precedente.controllo_id)
+        with transaction.atomic():
+            istanza = serializer.save()
+            nuova = (istanza.elementtype_id, istanza.minaccia_id, istanza.controllo_id)
+            if nuova != (et_id,) + cella:
+                # La riga è stata spostata: la vecchia cella non ha più righe, resta da svuotare nella forma compatta
+                scrivi_celle({et_id: {cella: 0.0}}, esistenti={})
+            self._propaga({(et_id,) + cella, nuova})
+
+    def perform_destroy(self, instance):
+        # Il salvataggio è gestito dal segnale post_save; la cancellazione passa da `elimina_celle`.
+        with transaction.atomic():
+            elimina_celle(ValoreElementType.objects.filter(pk=instance.pk))
+            if instance.elementtype.nome == "root":
+                aggiorna_dimensioni([instance.elementtype_id])
+            self._propaga([(instance.elementtype_id, instance.minaccia_id, instance.controllo_id)])
+
+    def _propaga(self, celle):
+        modifiche = ModificheMatrice()
+        for et_id, minaccia_id, controllo_id in celle:
+            modifiche.registra(et_id, minaccia_id, controllo_id)
+        modifiche.propaga()
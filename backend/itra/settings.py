@@ -186,3 +186,29 @@ LOGGING_CONFIG = None
 #        'level': 'DEBUG', # Mostra tutto, dal DEBUG in su
 #    },
 #}
+
+# Matrici di rischio: mantiene e legge la forma compatta (uint8) per ElementType (vedi elementtypes/compatta.py)
+MATRICI_COMPATTE = True
+
+# Popolamento delle campagne create dall'admin: avvia automaticamente il worker locale al commit (vedi campagne/lavori.py)
+POPOLAMENTO_AVVIA_WORKER = True
+
+# Minuti senza avanzamento dopo i quali un popolamento in corso, se il suo worker è terminato, è considerato interrotto e può essere ripetuto
+POPOLAMENTO_SCADENZA_MINUTI = 30
+
+# Operazioni in blocco (popolamento, template, seeding): un'unica riga di storico per operazione al posto di una per oggetto (vedi core/storico.py)
+STORICO_PER_OPERAZIONE = True
+
+# Storico: giorni in cui ogni versione è conservata; le più vecchie sono compattate da `manage.py compatta_storico` (vedi core/compattazione.py)
+STORICO_CONSERVAZIONE_GIORNI = 180
+
+# API REST (vedi core/api.py e core/urls.py): utenti autenticati con i permessi del modello per le scritture,
+# versione nel percorso, paginazione a cursore
+REST_FRAMEWORK = {
+    'DEFAULT_PERMISSION_CLASSES': ['rest_framework.permissions.DjangoModelPermissions'],
+    'DEFAULT_VERSIONING_CLASS': 'rest_framework.versioning.URLPathVersioning',
+    'DEFAULT_VERSION': 'v1',
+    'ALLOWED_VERSIONS': ['v1'],
+    'DEFAULT_PAGINATION_CLASS': 'core.api.PaginazioneCursore',
+    'PAGE_SIZE': 100,
+}
@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('campagne', '0005_storico_alla_data'),
+        ('minacce', '0002_minaccia_cloned_from'),
+        ('scenari', '0003_storico_alla_data'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='historicalminaccia',
+            index=models.Index(fields=['id', 'history_date'], name='minacce_his_id_9101d3_idx'),
+        ),
+    ]
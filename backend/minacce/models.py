@@ -1,5 +1,5 @@
 from django.db import models
-from simple_history.models import HistoricalRecords
+from core.storico import StoricoRecords
 from campagne.models import Campagna
 from scenari.models import Scenario
 
@@ -13,7 +13,17 @@ class Minaccia(models.Model):
         null=True,
         blank=True
     )
-    history = HistoricalRecords()
+    cloned_from = models.ForeignKey(
+        'self',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='clones',
+        editable=False,
+        verbose_name="Clonato da (Master)",
+        help_text="Riferimento alla riga master da cui questa è stata copiata nella campagna."
+    )
+    history = StoricoRecords()
 
     def __str__(self):
         return self.descrizione
@@ -1,8 +1,8 @@
 from rest_framework import viewsets
+from core.api import ApiMixin
 from .models import Minaccia
 from .serializers import MinacciaSerializer
 
-class MinacciaViewSet(viewsets.ModelViewSet):
+class MinacciaViewSet(ApiMixin, viewsets.ModelViewSet):
     queryset = Minaccia.objects.all()
     serializer_class = MinacciaSerializer
-    filterset_fields = ['campagna', 'scenario']
\ No newline at end of file
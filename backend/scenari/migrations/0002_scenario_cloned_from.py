@@ -0,0 +1,22 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scenari', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='historicalscenario',
+            name='cloned_from',
+            field=models.ForeignKey(blank=True, db_constraint=False, editable=False, help_text='Riferimento alla riga master da cui questa è stata copiata nella campagna.', null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='scenari.scenario', verbose_name='Clonato da (Master)'),
+        ),
+        migrations.AddField(
+            model_name='scenario',
+            name='cloned_from',
+            field=models.ForeignKey(blank=True, editable=False, help_text='Riferimento alla riga master da cui questa è stata copiata nella campagna.', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='clones', to='scenari.scenario', verbose_name='Clonato da (Master)'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('campagne', '0005_storico_alla_data'),
+        ('scenari', '0002_scenario_cloned_from'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='historicalscenario',
+            index=models.Index(fields=['id', 'history_date'], name='scenari_his_id_10a144_idx'),
+        ),
+    ]
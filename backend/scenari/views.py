@@ -1,8 +1,8 @@
 from rest_framework import viewsets
+from core.api import ApiMixin
 from .models import Scenario
 from .serializers import ScenarioSerializer
 
-class ScenarioViewSet(viewsets.ModelViewSet):
+class ScenarioViewSet(ApiMixin, viewsets.ModelViewSet):
     queryset = Scenario.objects.all()
     serializer_class = ScenarioSerializer
-    filterset_fields = ['campagna']
\ No newline at end of file